@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+#
+# benchmark_event_parser.py
+# -------------------------
+# Microbenchmark for the parsing of the events of shop_decrypt and shop_update_db. Compares the
+# old way (check_event_structure and get_fields_from_event both parse the Message, json.dumps of
+# the event for every log line) with shop_event from the shop layer (one pass, one json.dumps).
+#
+# Runs locally, no AWS access is needed. Example:
+#   ./benchmark_event_parser.py --number 20000 --lines 10
+#
+
+import os
+import sys
+import json
+import base64
+import timeit
+import argparse
+
+# shop_event is part of the shop layer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shop", "layer"))
+import shop_event
+
+# get_parameters
+# --------------
+
+def get_parameters():
+
+  parser = argparse.ArgumentParser(description = "Microbenchmark of the event parser of the shop Lambda functions")
+  parser.add_argument("--number", type = int, default = 20000, help = "number of events per measurement")
+  parser.add_argument("--repeat", type = int, default = 5,     help = "number of measurements, the fastest one is used")
+  parser.add_argument("--lines",  type = int, default = 10,    help = "number of sales lines in the shop_update_db event")
+
+  arguments = parser.parse_args()
+
+  return {"number": arguments.number, "repeat": arguments.repeat, "lines": arguments.lines}
+
+# get_sns_event
+# -------------
+
+def get_sns_event(message):
+
+  event = {"Records": [{"EventSource": "aws:sns", "Sns": {"Type": "Notification", "Message": json.dumps(message)}}]}
+
+  return {"event": event}
+
+# get_decrypt_event
+# -----------------
+
+def get_decrypt_event():
+
+  body     = {"shop_id": "AMIS1", "message_id": "1234560102_0123456789abc_1-20201231",
+              "content_base64": base64.standard_b64encode(os.urandom(256)).decode("utf-8")}
+  response = get_sns_event({"body": json.dumps(body)})
+
+  return response
+
+# get_update_db_event
+# -------------------
+
+def get_update_db_event(number_of_lines):
+
+  sales    = [{"item_no": str(20000 + line), "gross_number": "1", "gross_turnover": "1.25"} for line in range(number_of_lines)]
+  message  = {"shop_id": "AMIS1", "message_id": "1234560102_0123456789abc_1-20201231", "decrypted_content": json.dumps({"sales": sales})}
+  response = get_sns_event(message)
+
+  return response
+
+# Old versions
+# ------------
+# Same json handling as the functions in shop_decrypt and shop_update_db before shop_event was used
+# (the print statements are left out, the json.dumps calls for the log lines are not).
+
+def old_decrypt(event):
+
+  json.dumps(event)
+
+  body = json.loads(event["Records"][0]["Sns"]["Message"])["body"]
+  str(body)
+  valid = ('shop_id' in body) and ('message_id' in body) and ('content_base64' in body)
+
+  message        = json.loads(event["Records"][0]["Sns"]["Message"])
+  body           = json.loads(message["body"])
+  shop_id        = body["shop_id"]
+  message_id     = body["message_id"]
+  content_base64 = bytearray(body["content_base64"], "utf-8")
+
+  json.dumps(event)
+
+  return valid
+
+def old_update_db(event):
+
+  json.dumps(event)
+
+  message           = json.loads(event["Records"][0]["Sns"]["Message"])
+  json.dumps(message)
+  shop_id           = message["shop_id"]
+  message_id        = message["message_id"]
+  decrypted_content = json.loads(message["decrypted_content"])
+  json.dumps(decrypted_content)
+
+  for sales_item in decrypted_content["sales"]:
+    int(sales_item["item_no"])
+    float(sales_item["gross_number"])
+    float(sales_item["gross_turnover"])
+
+  json.dumps(event)
+
+  return shop_id
+
+# New versions
+# ------------
+
+def new_decrypt(event):
+
+  event_json = json.dumps(event)
+  response   = shop_event.parse_encrypted_event(event)
+
+  return response["succeeded"]
+
+def new_update_db(event):
+
+  event_json = json.dumps(event)
+  response   = shop_event.parse_decrypted_event(event)
+
+  return response["succeeded"]
+
+# measure
+# -------
+# Returns the cost per event in microseconds
+
+def measure(function, event, number, repeat):
+
+  times        = timeit.repeat(lambda: function(event), number = number, repeat = repeat)
+  microseconds = min(times) / number * 1000000
+
+  return {"microseconds": microseconds}
+
+# Main program:
+# =============
+
+response        = get_parameters()
+number          = response["number"]
+repeat          = response["repeat"]
+number_of_lines = response["lines"]
+
+decrypt_event   = get_decrypt_event()["event"]
+update_db_event = get_update_db_event(number_of_lines)["event"]
+
+print ("Events per measurement = " + str(number) + ", measurements = " + str(repeat) + ", sales lines = " + str(number_of_lines))
+print ("")
+
+for name, old_function, new_function, event in [("shop_decrypt",   old_decrypt,   new_decrypt,   decrypt_event),
+                                                ("shop_update_db", old_update_db, new_update_db, update_db_event)]:
+
+  old_cost = measure(old_function, event, number, repeat)["microseconds"]
+  new_cost = measure(new_function, event, number, repeat)["microseconds"]
+
+  print (format(name, "<16") + ": before " + format(old_cost, "8.2f") + " us/event, after " + format(new_cost, "8.2f") + " us/event (" + format((1 - new_cost / old_cost) * 100, ".0f") + "% less)")
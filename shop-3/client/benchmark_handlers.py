@@ -0,0 +1,432 @@
+#!/usr/bin/python3
+#
+# benchmark_handlers.py
+# ---------------------
+# Microbenchmark of the lambda_handler functions of shop_accept, shop_decrypt and shop_update_db,
+# in this process, with in-memory stand-ins for AWS:
+#
+# - KMS      : RSA keys that are generated at the start, decrypt uses RSAES_OAEP_SHA_256 like KMS
+# - SNS      : publish only keeps the number of messages
+# - DynamoDB : dicts for the shops and shops-message-ids tables (the update mode "item")
+#
+# Runs synthetic SNS events (API Gateway events for shop_accept) with baskets of 1, 10 and 100 sales
+# lines through every handler and prints per call the mean and p99 of the CPU time, the peak of the
+# memory allocations (tracemalloc) and the import time of the function. So the Python overhead of
+# the handlers can be measured without deploying, f.e. before and after a change in a hot loop.
+#
+# Baskets that don't fit in one RSA block are sent in the envelope format (see
+# encrypt_envelope_and_send.py), with one data key per shop like the clients do.
+#
+# Needs boto3, aws-xray-sdk and cryptography (pip3 install boto3 aws-xray-sdk cryptography), not
+# AWS access. Example:
+#   ./benchmark_handlers.py --calls 2000 --lines 1,10,100 --output benchmark.json
+
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import argparse
+import importlib
+import contextlib
+import subprocess
+import tracemalloc
+
+SHOP_DIRECTORY   = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shop")
+LAYER_DIRECTORY  = os.path.join(SHOP_DIRECTORY, "layer")
+FUNCTIONS        = ["shop_accept", "shop_decrypt", "shop_update_db"]
+
+SHOP_ID          = "AMIS1"
+NAME_PREFIX      = "benchmark"
+KEY_PREFIX       = "KeyBenchmark"
+
+# RSA 2048 with OAEP SHA-256 encrypts at most 190 bytes
+
+RSA_KEY_SIZE     = 2048
+RSA_MAX_BYTES    = 190
+DATA_KEY_SIZE    = 256
+AES_GCM_NONCE    = 12
+
+# get_parameters
+# --------------
+
+def get_parameters():
+
+  parser = argparse.ArgumentParser(description = "Microbenchmark of the shop Lambda handlers with in-memory stand-ins for AWS")
+  parser.add_argument("--calls",         type = int, default = 2000, help = "calls per handler and basket size")
+  parser.add_argument("--warmup",        type = int, default = 50,   help = "calls before the measurement")
+  parser.add_argument("--alloc-calls",   type = int, default = 200,  help = "calls with tracemalloc (slow) per handler and basket size")
+  parser.add_argument("--import-repeat", type = int, default = 5,    help = "imports per function, every import in a new python process")
+  parser.add_argument("--lines",         default = "1,10,100",       help = "sales lines per basket, separated by commas")
+  parser.add_argument("--functions",     default = ",".join(FUNCTIONS), help = "functions to benchmark, separated by commas")
+  parser.add_argument("--log-level",     default = "INFO",           help = "log_level of the functions, the log lines are written to /dev/null")
+  parser.add_argument("--output",        default = None,             help = "json file for the results")
+
+  arguments = parser.parse_args()
+
+  return { "calls"         : arguments.calls,
+           "warmup"        : arguments.warmup,
+           "alloc_calls"   : arguments.alloc_calls,
+           "import_repeat" : arguments.import_repeat,
+           "lines"         : [int(lines) for lines in arguments.lines.split(",")],
+           "functions"     : arguments.functions.split(","),
+           "log_level"     : arguments.log_level,
+           "output"        : arguments.output }
+
+# set_environment
+# ---------------
+# Before the functions are imported: shop_log and shop_metrics read their settings at import time.
+# X-Ray is switched off, there is no daemon.
+
+def set_environment(log_level):
+
+  os.environ["name_prefix"]                 = NAME_PREFIX
+  os.environ["key_prefix"]                  = KEY_PREFIX
+  os.environ["to_shop_decrypt_topic_arn"]   = "arn:aws:sns:local:000000000000:" + NAME_PREFIX + "_to_shop_decrypt"
+  os.environ["to_shop_update_db_topic_arn"] = "arn:aws:sns:local:000000000000:" + NAME_PREFIX + "_to_shop_update_db"
+  os.environ["log_level"]                   = log_level
+  os.environ["update_mode"]                 = "item"
+  os.environ["AWS_XRAY_SDK_ENABLED"]        = "false"
+  os.environ["AWS_LAMBDA_FUNCTION_NAME"]    = "benchmark"
+  os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+
+  sys.path.append(LAYER_DIRECTORY)
+  for function in FUNCTIONS:
+    sys.path.append(os.path.join(SHOP_DIRECTORY, "lambdas", function))
+
+  return
+
+# get_client_error
+# ----------------
+
+def get_client_error(code, message, operation_name):
+
+  from botocore.exceptions import ClientError
+
+  return ClientError({"Error": {"Code": code, "Message": message}}, operation_name)
+
+# FakeKMS
+# -------
+
+class FakeKMS:
+
+  def __init__(self, shop_ids):
+
+    from cryptography.hazmat.primitives.asymmetric import rsa, padding
+    from cryptography.hazmat.primitives            import hashes
+
+    self.padding     = padding.OAEP(mgf = padding.MGF1(algorithm = hashes.SHA256()), algorithm = hashes.SHA256(), label = None)
+    self.keys        = { "alias/" + KEY_PREFIX + shop_id: rsa.generate_private_key(public_exponent = 65537, key_size = RSA_KEY_SIZE)
+                         for shop_id in shop_ids }
+
+  def encrypt(self, KeyId, Plaintext, EncryptionAlgorithm):
+
+    return { "KeyId": KeyId, "CiphertextBlob": self.keys[KeyId].public_key().encrypt(Plaintext, self.padding), "EncryptionAlgorithm": EncryptionAlgorithm }
+
+  def decrypt(self, CiphertextBlob, KeyId, EncryptionAlgorithm):
+
+    if (KeyId not in self.keys):
+      raise get_client_error("NotFoundException", "Alias " + KeyId + " is not found.", "Decrypt")
+
+    try:
+      plaintext = self.keys[KeyId].decrypt(CiphertextBlob, self.padding)
+    except ValueError:
+      raise get_client_error("InvalidCiphertextException", "", "Decrypt")
+
+    return { "KeyId": KeyId, "Plaintext": plaintext, "EncryptionAlgorithm": EncryptionAlgorithm }
+
+# FakeSNS
+# -------
+
+class FakeSNS:
+
+  def __init__(self):
+
+    self.published = 0
+
+  def publish(self, TopicArn, Message):
+
+    self.published += 1
+
+    return { "MessageId": str(uuid.uuid4()) }
+
+# FakeDynamoDB
+# ------------
+# Only the calls of the update mode "item" of shop_update_db: the conditional put_item of the
+# message_id and the update_item of the stock per sales line.
+
+class FakeDynamoDB:
+
+  def __init__(self):
+
+    self.tables = {}
+
+  def put_item(self, TableName, Item, ConditionExpression = None):
+
+    table = self.tables.setdefault(TableName, {})
+    key   = (Item["shop_id"]["S"], Item["message_id"]["S"])
+
+    if ((ConditionExpression != None) and (key in table)):
+      raise get_client_error("ConditionalCheckFailedException", "The conditional request failed", "PutItem")
+
+    table[key] = Item
+
+    return {}
+
+  def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues = None):
+
+    table          = self.tables.setdefault(TableName, {})
+    item           = table.setdefault((Key["shop_id"]["S"], Key["record_type"]["S"]), {"gross_number": 0.0, "gross_turnover": 0.0, "stock": 1000000.0})
+    gross_number   = float(ExpressionAttributeValues[":gross_number"]["N"])
+    gross_turnover = float(ExpressionAttributeValues[":gross_turnover"]["N"])
+
+    item["gross_number"]   += gross_number
+    item["gross_turnover"] += gross_turnover
+    item["stock"]          -= gross_number
+
+    return { "Attributes": { name: { "N": str(value) } for name, value in item.items() } }
+
+# FakeContext
+# -----------
+
+class FakeContext:
+
+  function_name      = "benchmark"
+  memory_limit_in_mb = 128
+
+  def get_remaining_time_in_millis(self):
+
+    return 10000
+
+# install_fakes
+# -------------
+
+def install_fakes():
+
+  import shop_clients
+
+  kms = FakeKMS([SHOP_ID])
+
+  shop_clients.set_client("kms",      kms)
+  shop_clients.set_client("sns",      FakeSNS())
+  shop_clients.set_client("dynamodb", FakeDynamoDB())
+
+  return { "kms": kms }
+
+# get_sales
+# ---------
+
+def get_sales(number_of_lines):
+
+  sales = [{"item_no": str(20000 + line), "gross_number": "1", "gross_turnover": "1.25"} for line in range(number_of_lines)]
+
+  return { "decrypted_content": json.dumps({"sales": sales}) }
+
+# get_body
+# --------
+# The body the cash machine sends: RSA when the sales fit in one block, otherwise the envelope format
+
+def get_body(kms, data_key, message_id, decrypted_content):
+
+  from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+  plaintext = decrypted_content.encode("utf-8")
+  body      = { "shop_id": SHOP_ID, "message_id": message_id }
+
+  if (len(plaintext) <= RSA_MAX_BYTES):
+    encrypted_content            = kms.encrypt("alias/" + KEY_PREFIX + SHOP_ID, plaintext, "RSAES_OAEP_SHA_256")["CiphertextBlob"]
+  else:
+    nonce                        = os.urandom(AES_GCM_NONCE)
+    encrypted_content            = nonce + AESGCM(data_key["data_key"]).encrypt(nonce, plaintext, SHOP_ID.encode("utf-8"))
+    body["encrypted_key_base64"] = data_key["encrypted_key_base64"]
+
+  body["content_base64"] = base64.standard_b64encode(encrypted_content).decode("utf-8")
+
+  return { "body": body }
+
+# get_events
+# ----------
+# One event per call: every message needs its own message_id (of today), otherwise shop_update_db
+# drops it as a duplicate.
+
+def get_events(function, kms, number_of_events, number_of_lines):
+
+  import shop_message_id
+  from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+  decrypted_content = get_sales(number_of_lines)["decrypted_content"]
+  key               = AESGCM.generate_key(bit_length = DATA_KEY_SIZE)
+  data_key          = { "data_key": key,
+                        "encrypted_key_base64": base64.standard_b64encode(kms.encrypt("alias/" + KEY_PREFIX + SHOP_ID, key, "RSAES_OAEP_SHA_256")["CiphertextBlob"]).decode("utf-8") }
+  events            = []
+
+  for message_id in shop_message_id.reserve(number_of_events)["message_ids"]:
+
+    if (function == "shop_update_db"):
+      message = { "shop_id": SHOP_ID, "message_id": message_id, "decrypted_content": decrypted_content }
+      events.append({ "Records": [ { "EventSource": "aws:sns", "Sns": { "Type": "Notification", "Message": json.dumps(message) } } ] })
+      continue
+
+    api_event = { "body": json.dumps(get_body(kms, data_key, message_id, decrypted_content)["body"]) }
+
+    if (function == "shop_accept"):
+      events.append(api_event)
+    else:
+      events.append({ "Records": [ { "EventSource": "aws:sns", "Sns": { "Type": "Notification", "Message": json.dumps(api_event) } } ] })
+
+  return { "events": events }
+
+# get_percentile
+# --------------
+# Nearest rank
+
+def get_percentile(values, percentile):
+
+  sorted_values = sorted(values)
+  rank          = max(1, -(-len(sorted_values) * percentile // 100))
+
+  return { "value": sorted_values[int(rank) - 1] }
+
+# measure_cpu
+# -----------
+# CPU time and wall clock time per call, in microseconds
+
+def measure_cpu(handler, events, context):
+
+  cpu_times  = []
+  wall_times = []
+
+  for event in events:
+
+    cpu_start  = time.process_time()
+    wall_start = time.perf_counter()
+    handler(event, context)
+    wall_times.append((time.perf_counter() - wall_start) * 1000000)
+    cpu_times.append((time.process_time() - cpu_start) * 1000000)
+
+  return { "cpu_mean_us"  : sum(cpu_times) / len(cpu_times),
+           "cpu_p99_us"   : get_percentile(cpu_times, 99)["value"],
+           "wall_mean_us" : sum(wall_times) / len(wall_times),
+           "wall_p99_us"  : get_percentile(wall_times, 99)["value"] }
+
+# measure_allocations
+# -------------------
+# Peak of the memory that is allocated during a call, and the memory that is still allocated after
+# the call (f.e. the message_ids in the fake DynamoDB table). reset_peak needs python 3.9, for older
+# versions the peak is measured over all calls.
+
+def measure_allocations(handler, events, context):
+
+  peaks    = []
+  retained = 0
+
+  tracemalloc.start()
+
+  for event in events:
+
+    before, peak = tracemalloc.get_traced_memory()
+    if (hasattr(tracemalloc, "reset_peak")):
+      tracemalloc.reset_peak()
+
+    handler(event, context)
+
+    after, peak = tracemalloc.get_traced_memory()
+    peaks.append(peak - before)
+    retained += after - before
+
+  tracemalloc.stop()
+
+  return { "alloc_peak_mean_kib" : sum(peaks) / len(peaks) / 1024,
+           "alloc_peak_max_kib"  : max(peaks) / 1024,
+           "retained_per_call_b" : retained / len(events) }
+
+# measure_import
+# --------------
+# In a new python process per import, otherwise the modules are already loaded (boto3 is shared by
+# all functions). Returns the median in milliseconds.
+
+def measure_import(function, repeat):
+
+  code  = "import sys, time; sys.path[0:0] = " + repr([LAYER_DIRECTORY, os.path.join(SHOP_DIRECTORY, "lambdas", function)]) + \
+          "; start = time.perf_counter(); import " + function + "; print((time.perf_counter() - start) * 1000)"
+  times = []
+
+  for iteration in range(repeat):
+    result = subprocess.run([sys.executable, "-c", code], capture_output = True, text = True, env = os.environ.copy())
+    if (result.returncode != 0):
+      print("ERROR: import of " + function + " failed: " + result.stderr.strip().splitlines()[-1])
+      return { "import_ms": None }
+    times.append(float(result.stdout.strip().splitlines()[-1]))
+
+  times.sort()
+
+  return { "import_ms": times[len(times) // 2] }
+
+# benchmark
+# ---------
+
+def benchmark(function, kms, number_of_lines, parameters):
+
+  handler  = importlib.import_module(function).lambda_handler
+  context  = FakeContext()
+  events   = get_events(function, kms, parameters["warmup"] + parameters["calls"] + parameters["alloc_calls"], number_of_lines)["events"]
+  warmup   = events[:parameters["warmup"]]
+  measured = events[parameters["warmup"]:parameters["warmup"] + parameters["calls"]]
+  traced   = events[parameters["warmup"] + parameters["calls"]:]
+  result   = { "function": function, "lines": number_of_lines, "calls": len(measured) }
+
+  with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+    for event in warmup:
+      handler(event, context)
+    result.update(measure_cpu(handler, measured, context))
+    if (traced):
+      result.update(measure_allocations(handler, traced, context))
+
+  return result
+
+# print_results
+# -------------
+
+def print_results(results):
+
+  print(format("function", "<16") + format("lines", ">6") + format("cpu mean us", ">13") + format("cpu p99 us", ">12") +
+        format("wall mean us", ">14") + format("alloc peak KiB", ">16") + format("import ms", ">11"))
+
+  for result in results:
+    print(format(result["function"], "<16")                                         +
+          format(result["lines"], ">6")                                             +
+          format(result["cpu_mean_us"], ">13.1f")                                   +
+          format(result["cpu_p99_us"], ">12.1f")                                    +
+          format(result["wall_mean_us"], ">14.1f")                                  +
+          format(result.get("alloc_peak_mean_kib", float("nan")), ">16.1f")         +
+          format(result["import_ms"] if (result["import_ms"] != None) else float("nan"), ">11.1f"))
+
+  return
+
+# Main program:
+# =============
+
+parameters = get_parameters()
+set_environment(parameters["log_level"])
+
+import_times = { function: measure_import(function, parameters["import_repeat"])["import_ms"] for function in parameters["functions"] }
+
+kms     = install_fakes()["kms"]
+results = []
+
+for function in parameters["functions"]:
+  for number_of_lines in parameters["lines"]:
+    result = benchmark(function, kms, number_of_lines, parameters)
+    result["import_ms"] = import_times[function]
+    results.append(result)
+
+print("Calls per measurement = " + str(parameters["calls"]) + ", log_level = " + parameters["log_level"] + ", python " + sys.version.split()[0])
+print()
+print_results(results)
+
+if (parameters["output"]):
+  with open(parameters["output"], "w") as output_file:
+    json.dump({ "python": sys.version.split()[0], "log_level": parameters["log_level"], "results": results }, output_file, indent = 2)
+  print()
+  print("Results written to " + parameters["output"])
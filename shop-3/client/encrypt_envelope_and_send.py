@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+#
+# encrypt_envelope_and_send.py
+# ----------------------------
+# Does the same as encrypt_and_send.py, but uses envelope encryption: the content of sales.txt 
+# is encrypted with a random AES-GCM data key, only the data key is encrypted with the KMS key
+# of the shop. This makes it possible to send baskets that are larger than the RSA key can 
+# encrypt, and the decrypt function only needs KMS for the first message with a new data key.
+#
+
+import os
+import sys
+import requests
+import json
+import base64
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from local_encrypt import encrypt_locally
+
+# get_message_id is shared with the Lambda functions (shop layer)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shop", "layer"))
+from shop_message_id import get_message_id
+
+FILENAME           = "./sales.txt"
+NUMBER_OF_REQUESTS = 1
+KEY_PREFIX         = "alias/KeyQ-"
+DATA_KEY_SIZE      = 256
+AES_GCM_NONCE_SIZE = 12
+
+# get_parameters
+# --------------
+
+def get_parameters():
+
+  if (len(sys.argv) != 3):
+      print ("Add two arguments, f.e. ./encrypt_envelope_and_send.py AMIS1 https://amis.retsema.eu/shop")
+      sys.exit(1)
+
+  shop_id   = sys.argv[1]
+  key_alias = KEY_PREFIX + shop_id
+  url       = sys.argv[2]
+
+  return {"shop_id": shop_id, "key_alias": key_alias, "url": url}
+
+# create_data_key
+# ---------------
+# The data key is encrypted with the RSA key of the shop. The same data key (and therefore
+# the same encrypted_key_base64) should be reused for more messages, that's what makes the
+# cache in the decrypt function effective.
+
+def create_data_key(key_alias):
+
+  data_key = AESGCM.generate_key(bit_length = DATA_KEY_SIZE)
+
+  response             = encrypt_locally(key_alias, data_key)
+  encrypted_key_base64 = base64.standard_b64encode(response["encrypted_content"]).decode("utf-8")
+
+  return {"data_key": data_key, "encrypted_key_base64": encrypted_key_base64}
+
+# encrypt_sales
+# -------------
+# content_base64 = base64(nonce + ciphertext + tag). The shop_id is used as associated data:
+# the content cannot be moved to a message of another shop.
+
+def encrypt_sales(shop_id, data_key):
+
+  sales_file   = open(FILENAME, "r")
+  file_content = sales_file.read()
+  sales_file.close()
+
+  nonce             = os.urandom(AES_GCM_NONCE_SIZE)
+  encrypted_content = nonce + AESGCM(data_key).encrypt(nonce, file_content.encode("utf-8"), shop_id.encode("utf-8"))
+  content_base64    = base64.standard_b64encode(encrypted_content).decode("utf-8")
+
+  return {"content_base64": content_base64}
+
+# create_data
+# -----------
+
+def create_data(shop_id, message_id, encrypted_key_base64, content_base64):
+
+  data = {"shop_id": shop_id, "message_id": message_id, "encrypted_key_base64": encrypted_key_base64, "content_base64": content_base64}
+
+  return {"data": data}
+
+# send_data
+# ---------
+
+def send_data(url, data):
+
+  reply = requests.post(url, json.dumps(data))
+
+  return {"reply": reply}
+
+# Main program:
+# =============
+
+response  = get_parameters()
+shop_id   = response["shop_id"]
+key_alias = response["key_alias"]
+url       = response["url"]
+
+print ("Shop id        = " + shop_id)
+print ("Key alias      = " + key_alias)
+print ("URL            = " + url)
+
+response             = create_data_key(key_alias)
+data_key             = response["data_key"]
+encrypted_key_base64 = response["encrypted_key_base64"]
+
+for request_number in range(NUMBER_OF_REQUESTS):
+
+  response       = get_message_id()
+  message_id     = response["message_id"]
+
+  response       = encrypt_sales(shop_id, data_key)
+  content_base64 = response["content_base64"]
+
+  response       = create_data(shop_id, message_id, encrypted_key_base64, content_base64)
+  data           = response["data"]
+
+  print ("Data           = "+json.dumps(data))
+
+  response       = send_data(url, data)
+  reply          = response["reply"]
+
+print ("Status code    = "+str(reply.status_code))
+print ("Content        = "+str(reply.content))
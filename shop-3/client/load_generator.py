@@ -0,0 +1,337 @@
+#!/usr/bin/python3
+#
+# load_generator.py
+# -----------------
+# Sends encrypted sales (see sales.txt) concurrently to the URL that is specified on the command
+# line, for one or more shops, and prints the latency distribution and the errors at the end.
+#
+# There are two modes:
+#
+# - closed: every worker sends its next request as soon as the previous one has been answered.
+#           This shows the maximum throughput for the given concurrency, but when the shop gets
+#           slow the load generator also slows down.
+# - open  : requests are started at a fixed rate (--rate per second), independent of the speed
+#           of the answers. The latency is measured from the moment the request *should* have
+#           been started: when all workers are busy the waiting time is added to the latency
+#           (correction for coordinated omission).
+#
+# Examples:
+#   ./load_generator.py AMIS1 https://amis.retsema.eu/shop --mode closed --concurrency 10 --requests 1000
+#   ./load_generator.py AMIS1,AMIS2 https://amis.retsema.eu/shop --mode open --rate 200 --duration 60
+#
+
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import threading
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from local_encrypt      import encrypt_locally
+
+# get_message_id is shared with the Lambda functions (shop layer)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shop", "layer"))
+from shop_message_id import get_message_id
+
+FILENAME           = "./sales.txt"
+KEY_PREFIX         = "alias/KeyQ-"
+REQUEST_TIMEOUT    = 30
+PERCENTILES        = [50, 90, 99, 99.9]
+HISTOGRAM_BUCKETS  = [5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+# get_parameters
+# --------------
+
+def get_parameters():
+
+  parser = argparse.ArgumentParser(description = "Concurrent load generator for the shop example")
+  parser.add_argument("shop_ids",      help = "one or more shop ids, separated by commas, f.e. AMIS1,AMIS2")
+  parser.add_argument("url",           help = "f.e. https://amis.retsema.eu/shop")
+  parser.add_argument("--mode",        choices = ["open", "closed"], default = "closed")
+  parser.add_argument("--concurrency", type = int,   default = 10,   help = "number of worker threads (and HTTP connections)")
+  parser.add_argument("--rate",        type = float, default = 10.0, help = "open mode: requests per second")
+  parser.add_argument("--duration",    type = float, default = 60.0, help = "seconds to send requests")
+  parser.add_argument("--requests",    type = int,   default = None, help = "stop after this number of requests (closed mode: in total)")
+
+  arguments = parser.parse_args()
+
+  shop_ids  = arguments.shop_ids.split(",")
+
+  return {"shop_ids": shop_ids, "url": arguments.url, "mode": arguments.mode, "concurrency": arguments.concurrency,
+          "rate": arguments.rate, "duration": arguments.duration, "requests": arguments.requests}
+
+# read_sales
+# ----------
+
+def read_sales():
+
+  sales_file   = open(FILENAME, "r")
+  file_content = sales_file.read()
+  sales_file.close()
+
+  return {"file_content": file_content}
+
+# encrypt_sales
+# -------------
+
+def encrypt_sales(key_alias, file_content):
+
+  response          = encrypt_locally(key_alias, file_content)
+  encrypted_content = response["encrypted_content"]
+  content_base64    = base64.standard_b64encode(encrypted_content).decode("utf-8")
+
+  return {"content_base64": content_base64}
+
+# create_data
+# -----------
+
+def create_data(shop_id, message_id, content_base64):
+
+  data = {"shop_id": shop_id, "message_id": message_id, "content_base64": content_base64}
+
+  return {"data": data}
+
+# send_data
+# ---------
+# The session is shared by all workers: connections (and TLS sessions) are reused.
+
+def send_data(session, url, data):
+
+  reply = session.post(url, json.dumps(data), timeout = REQUEST_TIMEOUT)
+
+  return {"reply": reply}
+
+# create_session
+# --------------
+
+def create_session(concurrency):
+
+  session = requests.Session()
+  adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = concurrency)
+  session.mount("https://", adapter)
+  session.mount("http://", adapter)
+
+  return {"session": session}
+
+# Results
+# -------
+# Every request adds one result: (latency in ms, service time in ms, outcome). Outcome is
+# "200 OK" for good requests, otherwise the status code with the body (f.e. 500 "NotOK: retry
+# later, ..." from the accept function vs 500 {"message": "Internal server error"} from the
+# API Gateway) or the name of the exception (with the message, when it is not an error of requests).
+
+results      = []
+results_lock = threading.Lock()
+
+# send_one_request
+# ----------------
+# intended_start is the moment the request should have been started (open mode) or the
+# moment it was started (closed mode)
+
+def send_one_request(session, url, shop_id, file_content, intended_start):
+
+  actual_start   = time.perf_counter()
+
+  try:
+
+    response       = get_message_id()
+    message_id     = response["message_id"]
+
+    response       = encrypt_sales(KEY_PREFIX + shop_id, file_content)
+    content_base64 = response["content_base64"]
+
+    response       = create_data(shop_id, message_id, content_base64)
+    data           = response["data"]
+
+    response       = send_data(session, url, data)
+    reply          = response["reply"]
+
+    if (reply.status_code == 200):
+      outcome = "200 OK"
+    else:
+      outcome = str(reply.status_code) + " " + reply.text.strip()[:100]
+
+  except requests.exceptions.RequestException as e:
+
+    outcome = "exception " + type(e).__name__
+
+  except Exception as e:
+
+    # f.e. a botocore error of KMS in encrypt_sales: counted as an outcome, the worker goes on
+
+    outcome = "exception " + type(e).__name__ + " " + str(e).strip()[:100]
+
+  end_time     = time.perf_counter()
+  latency      = (end_time - intended_start) * 1000
+  service_time = (end_time - actual_start) * 1000
+
+  with results_lock:
+    results.append((latency, service_time, outcome))
+
+  return
+
+# run_closed_loop
+# ---------------
+
+def run_closed_loop(session, url, shop_ids, file_content, concurrency, duration, number_of_requests):
+
+  deadline     = time.perf_counter() + duration
+  counter      = {"sent": 0}
+  counter_lock = threading.Lock()
+
+  def worker(worker_number):
+
+    shop_id = shop_ids[worker_number % len(shop_ids)]
+
+    while (time.perf_counter() < deadline):
+
+      with counter_lock:
+        if ((number_of_requests != None) and (counter["sent"] >= number_of_requests)):
+          break
+        counter["sent"] += 1
+
+      send_one_request(session, url, shop_id, file_content, time.perf_counter())
+
+    return
+
+  with ThreadPoolExecutor(max_workers = concurrency) as executor:
+    futures = [executor.submit(worker, worker_number) for worker_number in range(concurrency)]
+
+  # Raises the exception of a worker that stopped, instead of reporting fewer requests
+
+  for future in futures:
+    future.result()
+
+  return
+
+# run_open_loop
+# -------------
+# The scheduler doesn't wait for answers. When all workers are busy, the request waits in the
+# queue of the executor - and that waiting time is part of the measured latency.
+
+def run_open_loop(session, url, shop_ids, file_content, concurrency, rate, duration, number_of_requests):
+
+  interval   = 1 / rate
+  start_time = time.perf_counter()
+  request_no = 0
+
+  with ThreadPoolExecutor(max_workers = concurrency) as executor:
+
+    while (True):
+
+      intended_start = start_time + request_no * interval
+
+      if ((intended_start - start_time >= duration) or
+          ((number_of_requests != None) and (request_no >= number_of_requests))):
+        break
+
+      wait_time = intended_start - time.perf_counter()
+      if (wait_time > 0):
+        time.sleep(wait_time)
+
+      shop_id = shop_ids[request_no % len(shop_ids)]
+      executor.submit(send_one_request, session, url, shop_id, file_content, intended_start)
+
+      request_no += 1
+
+  return
+
+# get_percentile
+# --------------
+# Nearest rank method, sorted_values must be sorted
+
+def get_percentile(sorted_values, percentile):
+
+  if (sorted_values == []):
+    return { "value": 0 }
+
+  rank  = int(-(-percentile * len(sorted_values) // 100))
+  value = sorted_values[max(rank, 1) - 1]
+
+  return { "value": value }
+
+# print_results
+# -------------
+
+def print_results(wall_time):
+
+  latencies     = sorted([result[0] for result in results])
+  service_times = sorted([result[1] for result in results])
+  outcomes      = {}
+
+  for result in results:
+    outcomes[result[2]] = outcomes.get(result[2], 0) + 1
+
+  print ("Requests       = " + str(len(results)))
+  print ("Wall time      = " + format(wall_time, ".2f") + " s")
+  print ("Throughput     = " + format(len(results) / wall_time, ".2f") + " requests/s")
+  print ("")
+
+  for percentile in PERCENTILES:
+    latency      = get_percentile(latencies, percentile)["value"]
+    service_time = get_percentile(service_times, percentile)["value"]
+    print ("p" + format(percentile, "<5") + "         = " + format(latency, "9.2f") + " ms (service time " + format(service_time, ".2f") + " ms)")
+
+  if (latencies != []):
+    print ("max            = " + format(latencies[-1], "9.2f") + " ms")
+
+  print ("")
+  print ("Latency histogram:")
+
+  lower_bound = 0
+  for upper_bound in HISTOGRAM_BUCKETS + [float("inf")]:
+    number = len([latency for latency in latencies if lower_bound <= latency < upper_bound])
+    print ("  " + format(str(lower_bound) + " - " + str(upper_bound) + " ms", "<20") + ": " + str(number))
+    lower_bound = upper_bound
+
+  print ("")
+  print ("Outcomes:")
+
+  for outcome, number in sorted(outcomes.items(), key = lambda item: -item[1]):
+    print ("  " + format(number, "6") + " x " + outcome)
+
+  return
+
+# Main program:
+# =============
+
+response           = get_parameters()
+shop_ids           = response["shop_ids"]
+url                = response["url"]
+mode               = response["mode"]
+concurrency        = response["concurrency"]
+rate               = response["rate"]
+duration           = response["duration"]
+number_of_requests = response["requests"]
+
+print ("Shop ids       = " + ",".join(shop_ids))
+print ("URL            = " + url)
+print ("Mode           = " + mode)
+print ("Concurrency    = " + str(concurrency))
+if (mode == "open"):
+  print ("Rate           = " + str(rate) + " requests/s")
+print ("")
+
+response           = read_sales()
+file_content       = response["file_content"]
+
+response           = create_session(concurrency)
+session            = response["session"]
+
+# Get the public keys before the clock starts
+
+for shop_id in shop_ids:
+  encrypt_sales(KEY_PREFIX + shop_id, file_content)
+
+start_time = time.perf_counter()
+
+if (mode == "open"):
+  run_open_loop(session, url, shop_ids, file_content, concurrency, rate, duration, number_of_requests)
+else:
+  run_closed_loop(session, url, shop_ids, file_content, concurrency, duration, number_of_requests)
+
+print_results(time.perf_counter() - start_time)
@@ -0,0 +1,107 @@
+#
+# local_encrypt.py
+# ----------------
+# Used by the client scripts in this directory. The keys of the shops are asymmetric RSA keys, 
+# so there is no need to ask KMS to encrypt the sales: the public key is fetched once with 
+# GetPublicKey, stored on disk (with the key id and an expiry time) and the encryption is done 
+# locally with RSAES_OAEP_SHA_256. The result can be decrypted by KMS in the same way as 
+# ciphertext that was created by kms.encrypt.
+#
+
+import os
+import json
+import time
+import base64
+import boto3
+
+from cryptography.hazmat.primitives                import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric     import padding
+
+PUBLIC_KEY_CACHE_FILE = os.path.expanduser("~/.shop_public_keys.json")
+PUBLIC_KEY_CACHE_TTL  = 24 * 60 * 60
+
+public_keys_in_memory = {}
+
+# read_public_key_cache
+# ---------------------
+
+def read_public_key_cache():
+
+  cache = {}
+
+  if (os.path.exists(PUBLIC_KEY_CACHE_FILE)):
+    try:
+      with open(PUBLIC_KEY_CACHE_FILE, "r") as cache_file:
+        cache = json.load(cache_file)
+    except ValueError:
+      print ("Cache file " + PUBLIC_KEY_CACHE_FILE + " is not valid json, it will be overwritten")
+
+  return {"cache": cache}
+
+# write_public_key_cache
+# ----------------------
+# Write to a temporary file first: other clients may read the file at the same time
+
+def write_public_key_cache(cache):
+
+  temp_file_name = PUBLIC_KEY_CACHE_FILE + "." + str(os.getpid())
+
+  with open(temp_file_name, "w") as cache_file:
+    json.dump(cache, cache_file)
+
+  os.replace(temp_file_name, PUBLIC_KEY_CACHE_FILE)
+
+  return
+
+# get_public_key
+# --------------
+
+def get_public_key(key_alias):
+
+  if (key_alias in public_keys_in_memory):
+    return public_keys_in_memory[key_alias]
+
+  response = read_public_key_cache()
+  cache    = response["cache"]
+  entry    = cache.get(key_alias)
+
+  if ((entry == None) or (entry["expires"] < time.time())):
+
+    kms      = boto3.client('kms')
+    response = kms.get_public_key(KeyId=key_alias)
+
+    if ("RSAES_OAEP_SHA_256" not in response["EncryptionAlgorithms"]):
+      raise ValueError("Key " + key_alias + " doesn't support RSAES_OAEP_SHA_256")
+
+    entry = {"key_id"           : response["KeyId"],
+             "public_key_base64": base64.standard_b64encode(response["PublicKey"]).decode("utf-8"),
+             "expires"          : time.time() + PUBLIC_KEY_CACHE_TTL}
+
+    cache[key_alias] = entry
+    write_public_key_cache(cache)
+
+  public_key = serialization.load_der_public_key(base64.standard_b64decode(entry["public_key_base64"]))
+
+  public_keys_in_memory[key_alias] = {"key_id": entry["key_id"], "public_key": public_key}
+
+  return public_keys_in_memory[key_alias]
+
+# encrypt_locally
+# ---------------
+# RSAES_OAEP_SHA_256 in KMS is OAEP with SHA-256 for both the hash and MGF1, without label.
+# OAEP is randomized: every call returns a different ciphertext for the same plaintext.
+
+def encrypt_locally(key_alias, plaintext):
+
+  if (isinstance(plaintext, str)):
+    plaintext = plaintext.encode("utf-8")
+
+  response          = get_public_key(key_alias)
+  public_key        = response["public_key"]
+
+  encrypted_content = public_key.encrypt(
+    plaintext,
+    padding.OAEP(mgf = padding.MGF1(algorithm = hashes.SHA256()), algorithm = hashes.SHA256(), label = None)
+  )
+
+  return {"encrypted_content": encrypted_content}
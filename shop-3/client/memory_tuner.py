@@ -0,0 +1,330 @@
+#!/usr/bin/python3
+#
+# memory_tuner.py
+# ---------------
+# Runs the same workload (perftest_test) at a list of memory sizes for shop_accept, shop_decrypt and
+# shop_update_db, reads the REPORT lines of every run with Logs Insights and computes per function
+# and memory size the latency, the billed duration and the Lambda cost per 1M messages. Then it
+# recommends per function the cheapest memory size that meets the latency SLO.
+#
+# The CPU power of a Lambda function grows with the memory size. That doesn't help much when most
+# of the time is spent waiting for KMS (shop_decrypt) or DynamoDB (shop_update_db), so the best
+# setting can be different for every function.
+#
+# Needs AWS credentials (like the vagrant user on the VM) and the test objects (perftest_test).
+# The original memory sizes are restored at the end. Example:
+#   ./memory_tuner.py --memory-sizes 128,256,512,1024 --invocations 3 --slo-ms 100 --output tuner
+#
+# Only the Lambda costs (duration and requests) are computed, not the costs of SNS, KMS, DynamoDB
+# or the API Gateway: these don't depend on the memory size.
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import boto3
+
+# The statistics of perftest_get_stats are used, the same numbers as in the perftest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "lambdas", "perftest_get_stats"))
+import perftest_get_stats
+
+FUNCTIONS                  = ["shop_accept", "shop_decrypt", "shop_update_db"]
+MEMORY_SIZES               = [128, 256, 512, 1024, 1536, 2048, 3008]
+
+# Prices of Lambda (x86) in eu-central-1 at the moment of writing, override them with the parameters
+
+PRICE_PER_GB_SECOND        = 0.0000166667
+PRICE_PER_MILLION_REQUESTS = 0.20
+
+# perftest_test sends NUMBER_OF_REQUESTS messages per invocation
+
+MESSAGES_PER_INVOCATION    = 100
+
+# get_parameters
+# --------------
+
+def get_parameters():
+
+  parser = argparse.ArgumentParser(description = "Memory size sweep and cost/latency tuner for the shop Lambda functions")
+  parser.add_argument("--name-prefix",    default = "AMIS",                                   help = "name_prefix in terraform.tfvars")
+  parser.add_argument("--functions",      default = ",".join(FUNCTIONS),                      help = "functions to tune, separated by commas")
+  parser.add_argument("--memory-sizes",   default = ",".join(str(size) for size in MEMORY_SIZES), help = "memory sizes in MB, separated by commas")
+  parser.add_argument("--invocations",    type = int,   default = 3,    help = "invocations of perftest_test per memory size")
+  parser.add_argument("--messages-per-invocation", type = int, default = MESSAGES_PER_INVOCATION, help = "messages that perftest_test sends per invocation")
+  parser.add_argument("--warmup",         type = int,   default = 1,    help = "invocations of perftest_test before the measurement (cold starts)")
+  parser.add_argument("--settle-seconds", type = int,   default = 60,   help = "wait time for the pipeline and the logs after the warmup and after the last invocation")
+  parser.add_argument("--slo-ms",         type = float, default = 200,  help = "latency SLO in ms")
+  parser.add_argument("--slo-percentile", default = "p99", choices = ["p50", "p90", "p95", "p99", "p99.9"], help = "percentile of the duration that must meet the SLO")
+  parser.add_argument("--price-per-gb-second",        type = float, default = PRICE_PER_GB_SECOND)
+  parser.add_argument("--price-per-million-requests", type = float, default = PRICE_PER_MILLION_REQUESTS)
+  parser.add_argument("--output",         default = "memory_tuner",    help = "name of the report files, .json and .csv are added")
+
+  arguments = parser.parse_args()
+
+  return { "name_prefix"                : arguments.name_prefix,
+           "functions"                  : arguments.functions.split(","),
+           "memory_sizes"               : [int(size) for size in arguments.memory_sizes.split(",")],
+           "invocations"                : arguments.invocations,
+           "messages_per_invocation"    : arguments.messages_per_invocation,
+           "warmup"                     : arguments.warmup,
+           "settle_seconds"             : arguments.settle_seconds,
+           "slo_ms"                     : arguments.slo_ms,
+           "slo_percentile"             : arguments.slo_percentile,
+           "price_per_gb_second"        : arguments.price_per_gb_second,
+           "price_per_million_requests" : arguments.price_per_million_requests,
+           "output"                     : arguments.output }
+
+# wait_for_update
+# ---------------
+# A function can only be invoked with the new configuration when LastUpdateStatus is Successful
+
+def wait_for_update(lambdaclient, function_name):
+
+  while True:
+
+    response = lambdaclient.get_function_configuration(FunctionName = function_name)
+    status   = response.get("LastUpdateStatus", "Successful")
+
+    if (status == "Successful"):
+      break
+
+    if (status == "Failed"):
+      raise RuntimeError("update of " + function_name + " failed: " + response.get("LastUpdateStatusReason", ""))
+
+    time.sleep(1)
+
+  return
+
+# set_memory_size
+# ---------------
+
+def set_memory_size(lambdaclient, function_name, memory_size):
+
+  lambdaclient.update_function_configuration(FunctionName = function_name, MemorySize = memory_size)
+  wait_for_update(lambdaclient, function_name)
+
+  return
+
+# get_memory_sizes
+# ----------------
+
+def get_memory_sizes(lambdaclient, function_names):
+
+  memory_sizes = {}
+
+  for function_name in function_names:
+    response = lambdaclient.get_function_configuration(FunctionName = function_name)
+    memory_sizes[function_name] = response["MemorySize"]
+
+  return { "memory_sizes": memory_sizes }
+
+# invoke_perftest
+# ---------------
+
+def invoke_perftest(lambdaclient, name_prefix, invocations):
+
+  for invocation in range(invocations):
+
+    response = lambdaclient.invoke(FunctionName = name_prefix + "_perftest_test", InvocationType = "RequestResponse")
+
+    if ("FunctionError" in response):
+      print("WARNING: perftest_test: " + response["Payload"].read().decode("utf-8"))
+
+  return
+
+# get_statistics_per_function
+# ---------------------------
+# Only the REPORT lines with the memory size of this run are used: lines of the previous run
+# can be in the same time window.
+
+def get_statistics_per_function(name_prefix, function_names, memory_size, start_time, end_time):
+
+  report_query = perftest_get_stats.get_report_query()["query"]
+  queries      = [{ "name": function_name, "log_group": "/aws/lambda/" + name_prefix + "_" + function_name, "query": report_query, "split": True } for function_name in function_names]
+
+  response     = perftest_get_stats.run_queries(queries, start_time, end_time, time.time() + 600)
+  statistics   = {}
+
+  for function_name in function_names:
+
+    columns = perftest_get_stats.new_columns()
+
+    for line in (response["results"][function_name] or []):
+      row = perftest_get_stats.parse_report_row(line)
+      if (row["memory_size"] == memory_size):
+        perftest_get_stats.add_row(columns, row)
+
+    if (len(columns["duration"]) == 0):
+      statistics[function_name] = None
+    else:
+      statistics[function_name] = perftest_get_stats.get_statistics(columns, 0, 0)
+
+  return { "statistics": statistics }
+
+# get_result
+# ----------
+# Lambda cost of all invocations: billed duration (GB-seconds) and requests. Divided by the number
+# of messages that perftest_test sent, this works for the SNS and the SQS (batch) trigger.
+
+def get_result(function_name, memory_size, statistics, messages, parameters):
+
+  if (statistics == None):
+    return { "function": function_name, "memory_size": memory_size, "invocations": 0 }
+
+  duration        = statistics["distributions"]["duration"]
+  billed_duration = statistics["distributions"]["billed_duration"]
+  invocations     = statistics["number_of_records"]
+
+  gb_seconds      = billed_duration["total"] / 1000 * memory_size / 1024
+  cost            = gb_seconds * parameters["price_per_gb_second"] + invocations * parameters["price_per_million_requests"] / 1000000
+
+  result = { "function"                  : function_name,
+             "memory_size"               : memory_size,
+             "invocations"               : invocations,
+             "messages"                  : messages,
+             "cold_starts"               : statistics["cold_starts"],
+             "avg_duration_ms"           : round(duration["avg"], 2),
+             "avg_billed_duration_ms"    : round(billed_duration["avg"], 2),
+             "max_memory_used_mb"        : statistics["distributions"]["memory_used"]["max"],
+             "cost_per_million_messages" : round(cost / messages * 1000000, 4) }
+
+  for percentile, value in duration["percentiles"].items():
+    result[percentile + "_duration_ms"] = round(value, 2)
+
+  return result
+
+# get_recommendations
+# -------------------
+# Per function the cheapest memory size that meets the SLO. When no memory size meets the SLO,
+# the fastest one is given.
+
+def get_recommendations(results, function_names, slo_ms, slo_percentile):
+
+  recommendations = {}
+  slo_field       = slo_percentile + "_duration_ms"
+
+  for function_name in function_names:
+
+    measured = [result for result in results if (result["function"] == function_name) and (result["invocations"] > 0)]
+
+    if (not measured):
+      recommendations[function_name] = None
+      continue
+
+    meets_slo = [result for result in measured if result[slo_field] <= slo_ms]
+
+    if (meets_slo):
+      best = min(meets_slo, key = lambda result: (result["cost_per_million_messages"], result[slo_field]))
+    else:
+      best = min(measured, key = lambda result: result[slo_field])
+
+    recommendations[function_name] = { "memory_size"               : best["memory_size"],
+                                       "slo_met"                   : (best[slo_field] <= slo_ms),
+                                       slo_field                   : best[slo_field],
+                                       "cost_per_million_messages" : best["cost_per_million_messages"] }
+
+  return { "recommendations": recommendations }
+
+# write_report
+# ------------
+
+def write_report(output, parameters, results, recommendations):
+
+  with open(output + ".json", "w") as json_file:
+    json.dump({ "parameters": parameters, "results": results, "recommendations": recommendations }, json_file, indent = 2)
+
+  fields = []
+  for result in results:
+    fields += [field for field in result if field not in fields]
+
+  with open(output + ".csv", "w", newline = "") as csv_file:
+    writer = csv.DictWriter(csv_file, fieldnames = fields)
+    writer.writeheader()
+    writer.writerows(results)
+
+  return
+
+# print_recommendations
+# ---------------------
+
+def print_recommendations(recommendations, slo_ms, slo_percentile):
+
+  print ("")
+  print ("Recommendations (SLO: " + slo_percentile + " <= " + format(slo_ms, "g") + " ms):")
+
+  for function_name, recommendation in recommendations.items():
+
+    if (recommendation == None):
+      print (format(function_name, "<16") + ": no REPORT lines")
+    else:
+      print (format(function_name, "<16") + ": " + format(recommendation["memory_size"], ">5") + " MB, " +
+             slo_percentile + " = " + format(recommendation[slo_percentile + "_duration_ms"], ".2f") + " ms, " +
+             format(recommendation["cost_per_million_messages"], ".4f") + " USD per 1M messages" +
+             ("" if recommendation["slo_met"] else " (SLO not met)"))
+
+  return
+
+# Main program:
+# =============
+
+parameters     = get_parameters()
+name_prefix    = parameters["name_prefix"]
+function_names = parameters["functions"]
+messages       = parameters["invocations"] * parameters["messages_per_invocation"]
+
+lambdaclient   = boto3.client("lambda")
+response       = get_memory_sizes(lambdaclient, [name_prefix + "_" + function_name for function_name in function_names])
+original_sizes = response["memory_sizes"]
+results        = []
+
+print ("Functions      = " + ",".join(function_names))
+print ("Memory sizes   = " + ",".join(str(size) for size in parameters["memory_sizes"]))
+print ("Messages       = " + str(messages) + " per memory size")
+print ("")
+
+try:
+
+  for memory_size in parameters["memory_sizes"]:
+
+    for function_name in function_names:
+      set_memory_size(lambdaclient, name_prefix + "_" + function_name, memory_size)
+
+    invoke_perftest(lambdaclient, name_prefix, parameters["warmup"])
+
+    # perftest_test returns when shop_accept has answered: shop_decrypt and shop_update_db get the
+    # messages of the warmup later, via SNS or SQS. Their REPORT lines (with the cold starts) must 
+    # stay out of the window, so the pipeline gets settle_seconds to process the warmup. Logs 
+    # Insights uses seconds.
+
+    if (parameters["warmup"] > 0):
+      time.sleep(parameters["settle_seconds"])
+
+    time.sleep(1)
+    start_time = int(time.time())
+    invoke_perftest(lambdaclient, name_prefix, parameters["invocations"])
+    end_time   = int(time.time()) + parameters["settle_seconds"]
+
+    time.sleep(parameters["settle_seconds"])
+
+    response   = get_statistics_per_function(name_prefix, function_names, memory_size, start_time, end_time)
+
+    for function_name in function_names:
+      result = get_result(function_name, memory_size, response["statistics"][function_name], messages, parameters)
+      results.append(result)
+      print (format(function_name, "<16") + ": " + format(memory_size, ">5") + " MB: " + json.dumps(result))
+
+finally:
+
+  for function_name, memory_size in original_sizes.items():
+    set_memory_size(lambdaclient, function_name, memory_size)
+
+response = get_recommendations(results, function_names, parameters["slo_ms"], parameters["slo_percentile"])
+
+write_report(parameters["output"], parameters, results, response["recommendations"])
+print_recommendations(response["recommendations"], parameters["slo_ms"], parameters["slo_percentile"])
+
+print ("")
+print ("Report: " + parameters["output"] + ".json, " + parameters["output"] + ".csv")
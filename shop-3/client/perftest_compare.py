@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+#
+# perftest_compare.py
+# -------------------
+# Compares the run record of a perftest (see Run records in perftest_get_stats.py) with a stored
+# baseline and exits with 1 when a number got worse than the tolerance allows, so it can be used as a
+# gate in a pipeline. Checked per function that is in both records:
+#
+# - the percentiles of the duration and the average billed duration  : --latency-tolerance-pct
+# - the memory headroom (configured memory size - max memory used)    : --memory-tolerance-mb
+# - the cold start rate (cold starts / REPORT lines)                  : --cold-start-tolerance-pct
+# - the throughput (REPORT lines per second)                          : --throughput-tolerance-pct
+#
+# and the percentiles of the total time in the pipeline traces (--latency-tolerance-pct).
+#
+# A run or baseline is a record (file or s3://bucket/key.json) or a directory or S3 prefix: then the
+# latest record in it is used. Examples:
+#   ./perftest_compare.py results/perftest-20210131T123456Z.json baseline.json
+#   ./perftest_compare.py s3://amis-perftest-results-123456789012/perftest baseline.json --latency-tolerance-pct 5
+#
+# Exit codes: 0 no regressions, 1 regressions, 2 a record could not be read.
+
+import os
+import sys
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "lambdas", "perftest_get_stats"))
+import perftest_get_stats
+
+# Small absolute differences are noise, even when the relative difference is large (f.e. 1 ms -> 2 ms)
+
+MIN_DIFFERENCE_MS         = 1.0
+MIN_DIFFERENCE_COLD_START = 0.01
+
+# get_parameters
+# --------------
+
+def get_parameters():
+
+  parser = argparse.ArgumentParser(description = "Compare a perftest run record with a baseline")
+  parser.add_argument("run",                                                  help = "run record, directory or s3://bucket/prefix (latest record)")
+  parser.add_argument("baseline",                                             help = "baseline record, directory or s3://bucket/prefix (latest record)")
+  parser.add_argument("--percentiles",              default = "p50,p90,p99",  help = "percentiles of the duration to compare, separated by commas")
+  parser.add_argument("--latency-tolerance-pct",    type = float, default = 10, help = "allowed increase of the latency in %%")
+  parser.add_argument("--memory-tolerance-mb",      type = float, default = 8,  help = "allowed decrease of the memory headroom in MB")
+  parser.add_argument("--cold-start-tolerance-pct", type = float, default = 50, help = "allowed increase of the cold start rate in %%")
+  parser.add_argument("--throughput-tolerance-pct", type = float, default = 10, help = "allowed decrease of the throughput in %%")
+
+  arguments = parser.parse_args()
+
+  return { "run"                      : arguments.run,
+           "baseline"                 : arguments.baseline,
+           "percentiles"              : arguments.percentiles.split(","),
+           "latency_tolerance_pct"    : arguments.latency_tolerance_pct,
+           "memory_tolerance_mb"      : arguments.memory_tolerance_mb,
+           "cold_start_tolerance_pct" : arguments.cold_start_tolerance_pct,
+           "throughput_tolerance_pct" : arguments.throughput_tolerance_pct }
+
+# new_check
+# ---------
+# A number that got higher is worse (latency, cold starts) unless higher_is_better (headroom, throughput)
+
+def new_check(name, baseline, run, limit, higher_is_better = False):
+
+  regression = (run < limit) if higher_is_better else (run > limit)
+
+  return { "name": name, "baseline": baseline, "run": run, "limit": limit, "regression": regression }
+
+# check_latency
+# -------------
+
+def check_latency(name, baseline, run, tolerance_pct):
+
+  if ((baseline == None) or (run == None)):
+    return None
+
+  limit = max(baseline * (1 + tolerance_pct / 100), baseline + MIN_DIFFERENCE_MS)
+
+  return new_check(name, baseline, run, limit)
+
+# compare_function
+# ----------------
+# Returns a list of checks, see new_check
+
+def compare_function(function, baseline, run, parameters):
+
+  checks = []
+
+  for percentile in parameters["percentiles"]:
+    checks.append(check_latency(function + " duration " + percentile,
+                                baseline["duration"].get(percentile), run["duration"].get(percentile),
+                                parameters["latency_tolerance_pct"]))
+
+  checks.append(check_latency(function + " billed_duration avg",
+                              baseline["billed_duration"].get("avg"), run["billed_duration"].get("avg"),
+                              parameters["latency_tolerance_pct"]))
+
+  checks.append(new_check(function + " memory_headroom_mb",
+                          baseline["memory_headroom_mb"], run["memory_headroom_mb"],
+                          baseline["memory_headroom_mb"] - parameters["memory_tolerance_mb"], higher_is_better = True))
+
+  limit = max(baseline["cold_start_rate"] * (1 + parameters["cold_start_tolerance_pct"] / 100), baseline["cold_start_rate"] + MIN_DIFFERENCE_COLD_START)
+  checks.append(new_check(function + " cold_start_rate", baseline["cold_start_rate"], run["cold_start_rate"], limit))
+
+  if ((baseline["throughput_per_second"] != None) and (run["throughput_per_second"] != None)):
+    checks.append(new_check(function + " throughput_per_second",
+                            baseline["throughput_per_second"], run["throughput_per_second"],
+                            baseline["throughput_per_second"] * (1 - parameters["throughput_tolerance_pct"] / 100), higher_is_better = True))
+
+  return [check for check in checks if check != None]
+
+# compare_records
+# ---------------
+
+def compare_records(baseline, run, parameters):
+
+  checks  = []
+  skipped = []
+
+  for function in sorted(set(baseline["functions"]) | set(run["functions"])):
+    if ((function in baseline["functions"]) and (function in run["functions"])):
+      checks += compare_function(function, baseline["functions"][function], run["functions"][function], parameters)
+    else:
+      skipped.append(function)
+
+  if (baseline.get("traces") and run.get("traces")):
+    for percentile in parameters["percentiles"]:
+      check = check_latency("traces total " + percentile,
+                            baseline["traces"]["total"].get(percentile), run["traces"]["total"].get(percentile),
+                            parameters["latency_tolerance_pct"])
+      if (check != None):
+        checks.append(check)
+
+  return { "checks": checks, "skipped": skipped }
+
+# print_checks
+# ------------
+
+def print_checks(checks, skipped):
+
+  print(format("check", "<40") + format("baseline", ">12") + format("run", ">12") + format("limit", ">12") + "  result")
+
+  for check in checks:
+    print(format(check["name"], "<40")        +
+          format(check["baseline"], ">12.2f") +
+          format(check["run"], ">12.2f")      +
+          format(check["limit"], ">12.2f")    +
+          ("  REGRESSION" if check["regression"] else "  OK"))
+
+  for function in skipped:
+    print(format(function, "<40") + "  not in both records, skipped")
+
+  return
+
+# Main program:
+# =============
+
+parameters = get_parameters()
+
+try:
+  baseline = perftest_get_stats.load_run_record(parameters["baseline"])
+  run      = perftest_get_stats.load_run_record(parameters["run"])
+except Exception as e:
+  print("ERROR: " + str(e))
+  sys.exit(2)
+
+print("Baseline: " + baseline["location"])
+print("Run     : " + run["location"])
+print()
+
+response    = compare_records(baseline["record"], run["record"], parameters)
+regressions = [check for check in response["checks"] if check["regression"]]
+
+print_checks(response["checks"], response["skipped"])
+print()
+print(str(len(regressions)) + " regression(s) in " + str(len(response["checks"])) + " checks")
+
+sys.exit(1 if regressions else 0)
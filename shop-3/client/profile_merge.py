@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+#
+# profile_merge.py
+# ----------------
+# Merges the profiles of the sampling profiler of the shop functions (see shop/layer/shop_profile.py)
+# into one file in the collapsed stack format. Make a flame graph of it with flamegraph.pl
+# (https://github.com/brendangregg/FlameGraph) or open it in https://www.speedscope.app.
+#
+# Sources:
+# - s3://bucket/prefix          : all .collapsed.gz objects under the prefix (profile_location = s3://...)
+# - --log-group <log group>     : the PROFILE: lines in CloudWatch of the last --hours hours
+# - files                       : .collapsed(.gz) files, or log exports with PROFILE: lines (plain or gzipped)
+#
+# Needs AWS credentials for S3 and CloudWatch. Examples:
+#   ./profile_merge.py --log-group /aws/lambda/AMIS_shop_update_db --hours 2 --output update_db.collapsed
+#   ./profile_merge.py s3://amis-profiles/shop --function AMIS_shop_update_db
+#   flamegraph.pl update_db.collapsed > update_db.svg
+
+import os
+import sys
+import gzip
+import time
+import base64
+import argparse
+
+PROFILE_PREFIX = "PROFILE: "
+GZIP_MAGIC     = b"\x1f\x8b"
+
+# get_parameters
+# --------------
+
+def get_parameters():
+
+  parser = argparse.ArgumentParser(description = "Merge the profiles of the shop functions into one collapsed stack file")
+  parser.add_argument("sources",     nargs = "*",                    help = "s3://bucket/prefix, .collapsed(.gz) files or log exports")
+  parser.add_argument("--log-group", default = None,                 help = "read the PROFILE: lines of this log group")
+  parser.add_argument("--hours",     type = float, default = 1,      help = "hours before now for --log-group")
+  parser.add_argument("--function",  default = None,                 help = "only the profiles of this function, f.e. AMIS_shop_update_db")
+  parser.add_argument("--output",    default = "profile.collapsed",  help = "merged profile")
+  parser.add_argument("--top",       type = int, default = 15,       help = "number of functions with the most samples to print")
+
+  arguments = parser.parse_args()
+
+  if ((not arguments.sources) and (arguments.log_group == None)):
+    parser.error("give one or more sources or --log-group")
+
+  return { "sources"   : arguments.sources,
+           "log_group" : arguments.log_group,
+           "hours"     : arguments.hours,
+           "function"  : arguments.function,
+           "output"    : arguments.output,
+           "top"       : arguments.top }
+
+# add_collapsed
+# -------------
+# Adds the lines "stack count" of text to stacks
+
+def add_collapsed(stacks, text):
+
+  for line in text.splitlines():
+
+    stack, separator, count = line.rstrip().rpartition(" ")
+
+    if (separator and count.isdigit()):
+      stacks[stack] = stacks.get(stack, 0) + int(count)
+
+  return
+
+# parse_profile_line
+# ------------------
+# "PROFILE: function: ..., invocations: ..., samples: ..., data: <base64 of gzipped collapsed stacks>"
+
+def parse_profile_line(line):
+
+  fields = {}
+
+  for part in line[line.find(PROFILE_PREFIX) + len(PROFILE_PREFIX):].strip().split(", "):
+    name, separator, value = part.partition(": ")
+    fields[name] = value
+
+  return { "function"    : fields["function"],
+           "invocations" : int(fields["invocations"]),
+           "collapsed"   : gzip.decompress(base64.standard_b64decode(fields["data"])).decode("utf-8") }
+
+# add_profile_line
+# ----------------
+# Returns the number of invocations in the line, 0 when the line is for another function
+
+def add_profile_line(stacks, line, function):
+
+  profile = parse_profile_line(line)
+
+  if ((function != None) and (profile["function"] != function)):
+    return { "invocations": 0 }
+
+  add_collapsed(stacks, profile["collapsed"])
+
+  return { "invocations": profile["invocations"] }
+
+# read_file
+# ---------
+
+def read_file(stacks, path, function):
+
+  with open(path, "rb") as profile_file:
+    content = profile_file.read()
+
+  if (content[:2] == GZIP_MAGIC):
+    content = gzip.decompress(content)
+
+  text        = content.decode("utf-8")
+  invocations = 0
+
+  if (PROFILE_PREFIX in text):
+    for line in text.splitlines():
+      if (PROFILE_PREFIX in line):
+        invocations += add_profile_line(stacks, line, function)["invocations"]
+  else:
+    add_collapsed(stacks, text)
+
+  return { "invocations": invocations }
+
+# read_s3
+# -------
+# The function name is part of the key: <prefix>/<function>/<timestamp>-<request_id>.collapsed.gz
+
+def read_s3(stacks, location, function):
+
+  import boto3
+
+  s3                        = boto3.client("s3")
+  bucket, separator, prefix = location[len("s3://"):].partition("/")
+  objects                   = 0
+
+  if (prefix and not prefix.endswith("/")):
+    prefix += "/"
+
+  if (function != None):
+    prefix += function + "/"
+
+  for page in s3.get_paginator("list_objects_v2").paginate(Bucket = bucket, Prefix = prefix):
+    for item in page.get("Contents", []):
+      if (item["Key"].endswith(".collapsed.gz")):
+        body = s3.get_object(Bucket = bucket, Key = item["Key"])["Body"].read()
+        add_collapsed(stacks, gzip.decompress(body).decode("utf-8"))
+        objects += 1
+
+  return { "objects": objects }
+
+# read_log_group
+# --------------
+
+def read_log_group(stacks, log_group, hours, function):
+
+  import boto3
+
+  logs        = boto3.client("logs")
+  end_time    = int(time.time() * 1000)
+  invocations = 0
+
+  paginator   = logs.get_paginator("filter_log_events")
+
+  for page in paginator.paginate(logGroupName = log_group, startTime = end_time - int(hours * 3600 * 1000), endTime = end_time, filterPattern = '"' + PROFILE_PREFIX.strip() + '"'):
+    for log_event in page.get("events", []):
+      if (log_event["message"].startswith(PROFILE_PREFIX)):
+        invocations += add_profile_line(stacks, log_event["message"], function)["invocations"]
+
+  return { "invocations": invocations }
+
+# get_top_functions
+# -----------------
+# Self samples: the samples in which the function is the innermost frame
+
+def get_top_functions(stacks, number):
+
+  self_samples = {}
+
+  for stack, count in stacks.items():
+    leaf               = stack.rsplit(";", 1)[-1]
+    self_samples[leaf] = self_samples.get(leaf, 0) + count
+
+  top = sorted(self_samples.items(), key = lambda item: item[1], reverse = True)[:number]
+
+  return { "top": top }
+
+# Main program:
+# =============
+
+parameters  = get_parameters()
+stacks      = {}
+invocations = 0
+objects     = 0
+
+if (parameters["log_group"] != None):
+  invocations += read_log_group(stacks, parameters["log_group"], parameters["hours"], parameters["function"])["invocations"]
+
+for source in parameters["sources"]:
+  if (source.startswith("s3://")):
+    objects += read_s3(stacks, source, parameters["function"])["objects"]
+  else:
+    invocations += read_file(stacks, source, parameters["function"])["invocations"]
+
+if (not stacks):
+  print("No profiles found")
+  sys.exit(1)
+
+with open(parameters["output"], "w", encoding = "utf-8") as output_file:
+  for stack, count in sorted(stacks.items()):
+    output_file.write(stack + " " + str(count) + "\n")
+
+total = sum(stacks.values())
+
+print("Profiles : " + str(invocations) + " invocations from log lines, " + str(objects) + " S3 objects")
+print("Samples  : " + str(total) + ", " + str(len(stacks)) + " different stacks, written to " + parameters["output"])
+print()
+print(format("self samples", ">12") + format("%", ">7") + "  function")
+
+for name, count in get_top_functions(stacks, parameters["top"])["top"]:
+  print(format(count, ">12") + format(count / total * 100, ">7.1f") + "  " + name)
@@ -4,12 +4,18 @@
 # -------------
 # Sends the same message twice, with the same message_id
 
+import os
 import sys
-import boto3
 import requests
 import json
 import base64
-import datetime
+
+from local_encrypt import encrypt_locally
+
+# get_message_id is shared with the Lambda functions (shop layer)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shop", "layer"))
+from shop_message_id import get_message_id
 
 FILENAME           = "./sales.txt"
 NUMBER_OF_REQUESTS = 1
@@ -30,26 +36,6 @@ def get_parameters():
 
   return {"shop_id": shop_id, "key_alias": key_alias, "url": url}
 
-# get_message_id
-# --------------
-
-def get_message_id():
-
-  datetime_object     = datetime.datetime.now()
-
-  year  = datetime_object.year
-  month = datetime_object.month
-  day   = datetime_object.day
-  hour  = datetime_object.hour
-  min   = datetime_object.minute
-  sec   = datetime_object.second
-  msec  = datetime_object.microsecond
-
-  format_string = "{msec:06}{sec:02}{min:02}{hour:02}-{year:04}{month:02}{day:02}"
-  message_id    = format_string.format(msec = msec, sec = sec, min = min, hour = hour, year = year, month = month, day = day)
-
-  return { "message_id": message_id } 
-
 # encrypt_sales
 # -------------
 
@@ -59,10 +45,8 @@ def encrypt_sales(key_alias):
   file_content = sales_file.read()
   sales_file.close()
 
-  kms      = boto3.client('kms')
-  response = kms.encrypt(KeyId=key_alias, Plaintext=file_content, EncryptionAlgorithm='RSAES_OAEP_SHA_256')
-
-  encrypted_content = response["CiphertextBlob"]
+  response          = encrypt_locally(key_alias, file_content)
+  encrypted_content = response["encrypted_content"]
   content_base64    = base64.standard_b64encode(encrypted_content).decode("utf-8")
 
   return {"content_base64": content_base64}
@@ -13,6 +13,7 @@ variable "domainname"                {}
 
 variable "name_prefix"               { description = "Is not used in this script. Declaration is done to prevent warnings." }
 variable "key_prefix"                { description = "Is not used in this script. Declaration is done to prevent warnings." }
+variable "profile_bucket"            { description = "Is not used in this script. Declaration is done to prevent warnings." }
 
 ##################################################################################
 # PROVIDERS
@@ -13,6 +13,14 @@ variable "domainname"                { description = "Not used in this configura
 
 variable "name_prefix"               {}
 variable "key_prefix"                {}
+variable "profile_bucket"            { 
+  default     = ""
+  description = "S3 bucket for the profiles of the shop functions (see shop_profile.py), empty = the profiles are written to the log"
+}
+
+locals {
+  shop_profile_to_s3 = var.profile_bucket == "" ? 0 : 1
+}
 
 ##################################################################################
 # PROVIDERS
@@ -80,10 +88,11 @@ EOF
 # lambda_shop_decrypt_policy
 # --------------------------
 # logs: needed to create entries in cloudwatch for the lambda function
-# sns : needed to send a message to the SNS to_shop_update_db topic
+# sns : needed to send a message to the SNS to_shop_update_db topic (Publish also allows PublishBatch)
 # kms : GetPublicKey needed because AWS will encrypt the environment variable with a default kms key. 
 #       The public key is needed to decrypt it.
 #       Decrypt is used to decrypt the encrypted text from the client ("cash machine")
+# sqs : needed to get batches of messages from the to_shop_decrypt queue (trigger_shop_decrypt = sqs)
 # xray: for sending trace information to xray (see blog about xray)
 
 resource "aws_iam_policy" "lambda_shop_decrypt_policy" {
@@ -101,6 +110,9 @@ resource "aws_iam_policy" "lambda_shop_decrypt_policy" {
 		  "sns:Publish",
                   "kms:GetPublicKey",
                   "kms:Decrypt",
+                  "sqs:ReceiveMessage",
+                  "sqs:DeleteMessage",
+                  "sqs:GetQueueAttributes",
                   "xray:PutTraceSegments",
                   "xray:PutTelemetryRecords"
                   ],
@@ -117,12 +129,58 @@ resource "aws_iam_policy" "lambda_shop_decrypt_policy" {
 EOF
 }
 
+# lambda_shop_decrypt_update_db_policy
+# ------------------------------------
+# Fused mode: the actions of both shop_decrypt and shop_update_db
+# logs    : needed to create entries in cloudwatch for the lambda function
+# kms     : GetPublicKey needed because AWS will encrypt the environment variable with a default kms key. 
+#           The public key is needed to decrypt it.
+#           Decrypt is used to decrypt the encrypted text from the client ("cash machine")
+# dynamodb: needed to create and update items. PutItem and UpdateItem are also checked for the 
+#           actions in TransactWriteItems, GetItem reads the claim of a message that is resumed
+# xray    : for sending trace information to xray (see blog about xray)
+
+resource "aws_iam_policy" "lambda_shop_decrypt_update_db_policy" {
+    name        = "${var.name_prefix}_lambda_shop_decrypt_update_db_policy"
+    description = "Policy for the Lambda shop_decrypt_update_db function"
+    policy      = <<EOF
+{
+    "Version": "2012-10-17",
+    "Statement": [
+      {
+        "Action": [
+		  "logs:CreateLogGroup",
+		  "logs:CreateLogStream",
+		  "logs:PutLogEvents",
+                  "kms:GetPublicKey",
+                  "kms:Decrypt",
+		  "dynamodb:PutItem",
+		  "dynamodb:UpdateItem",
+		  "dynamodb:GetItem",
+                  "xray:PutTraceSegments",
+                  "xray:PutTelemetryRecords"
+                  ],
+		"Effect": "Allow",
+		"Resource": "*",
+                "Condition": {
+                   "StringEquals": {
+                       "aws:RequestedRegion": "${var.aws_region}"
+                   }
+                }
+      }
+     ]
+}
+EOF
+}
+
 # lambda_shop_update_db_policy
 # ----------------------------
 # logs    : needed to create entries in cloudwatch for the lambda function
-# dynamodb: needed to create and update items
+# dynamodb: needed to create and update items. PutItem and UpdateItem are also checked for the 
+#           actions in TransactWriteItems, GetItem reads the claim of a message that is resumed
 # kms     : needed because AWS will encrypt the parameter with a default kms key. The public key is needed
 #           to decrypt it.
+# sqs     : needed to get batches of messages from the to_shop_update_db queue (trigger_shop_update_db = sqs)
 # xray    : for sending trace information to xray (see blog about xray)
 
 resource "aws_iam_policy" "lambda_shop_update_db_policy" {
@@ -139,7 +197,11 @@ resource "aws_iam_policy" "lambda_shop_update_db_policy" {
 		  "logs:PutLogEvents",
 		  "dynamodb:PutItem",
 		  "dynamodb:UpdateItem",
+		  "dynamodb:GetItem",
                   "kms:GetPublicKey",
+                  "sqs:ReceiveMessage",
+                  "sqs:DeleteMessage",
+                  "sqs:GetQueueAttributes",
                   "xray:PutTraceSegments",
                   "xray:PutTelemetryRecords"
                   ],
@@ -156,10 +218,35 @@ resource "aws_iam_policy" "lambda_shop_update_db_policy" {
 EOF
 }
 
+# lambda_shop_profile_policy
+# --------------------------
+# s3: the sampling profiler of the shop functions writes its batches to the profile bucket, only
+#     when profile_bucket is set (see profile_bucket in terraform_shop.tf)
+
+resource "aws_iam_policy" "lambda_shop_profile_policy" {
+    count       = local.shop_profile_to_s3
+    name        = "${var.name_prefix}_lambda_shop_profile_policy"
+    description = "Policy for the profiles of the Lambda shop functions"
+    policy      = <<EOF
+{
+    "Version": "2012-10-17",
+    "Statement": [
+      {
+        "Action": [
+                  "s3:PutObject"
+                  ],
+		"Effect": "Allow",
+		"Resource": "arn:aws:s3:::${var.profile_bucket}/profiles/*"
+      }
+     ]
+}
+EOF
+}
+
 # lambda_unittest_policy
 # ----------------------
 # lambda  : used to invoke other functions ("object_under_test" objects) and also to get and set the 
-#           environment variables of these functions (to create errors)
+#           environment variables of these functions and to publish versions of them (to create errors)
 # logs    : needed to create entries in cloudwatch for the lambda function, but also to get log information
 #           from CloudWatch from other functions.
 # sqs     : to put messages on a queue and to get messages from a queue
@@ -180,6 +267,8 @@ resource "aws_iam_policy" "lambda_unittest_policy" {
                   "lambda:InvokeFunction",
                   "lambda:GetFunctionConfiguration",
                   "lambda:UpdateFunctionConfiguration",
+                  "lambda:PublishVersion",
+                  "lambda:ListVersionsByFunction",
 		  "logs:*",
                   "sqs:SendMessage",
                   "sqs:ReceiveMessage",
@@ -243,6 +332,7 @@ EOF
 #           stats function.
 # kms     : needed because AWS will encrypt the parameter with a default kms key. The public key is needed
 #           to decrypt it.
+# s3      : the stats function stores its run records in the perftest results bucket (see terraform_tests.tf)
 
 resource "aws_iam_policy" "lambda_perftest_policy" {
     count       = var.use_test_objects
@@ -265,6 +355,18 @@ resource "aws_iam_policy" "lambda_perftest_policy" {
                        "aws:RequestedRegion": "${var.aws_region}"
                    }
                 }
+      },
+      {
+        "Action": [
+                  "s3:PutObject",
+                  "s3:GetObject",
+                  "s3:ListBucket"
+                  ],
+		"Effect": "Allow",
+		"Resource": [
+                  "arn:aws:s3:::${lower(var.name_prefix)}-perftest-results-${var.accountnumber}",
+                  "arn:aws:s3:::${lower(var.name_prefix)}-perftest-results-${var.accountnumber}/*"
+                  ]
       }
      ]
 }
@@ -421,6 +523,47 @@ resource "aws_iam_policy_attachment" "policy_to_shop_update_db_role" {
    policy_arn = aws_iam_policy.lambda_shop_update_db_policy.arn
 }
 
+# lambda_shop_decrypt_update_db_role
+# ----------------------------------
+
+resource "aws_iam_role" "lambda_shop_decrypt_update_db_role" {
+    name = "${var.name_prefix}_lambda_shop_decrypt_update_db_role"
+    description =  "Lambda shop_decrypt_update_db role"
+    force_detach_policies = true
+    assume_role_policy =  <<EOF
+{
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Principal": {
+                "Service": "lambda.amazonaws.com"
+            },
+            "Action": "sts:AssumeRole"
+        }
+    ]
+}
+EOF
+} 
+
+resource "aws_iam_policy_attachment" "policy_to_shop_decrypt_update_db_role" {
+   name       = "${var.name_prefix}_policy_to_shop_decrypt_update_db_role"
+   roles      = [aws_iam_role.lambda_shop_decrypt_update_db_role.name]
+   policy_arn = aws_iam_policy.lambda_shop_decrypt_update_db_policy.arn
+}
+
+# The profile policy is attached to the roles of all shop functions
+
+resource "aws_iam_policy_attachment" "profile_policy_to_shop_roles" {
+   count      = local.shop_profile_to_s3
+   name       = "${var.name_prefix}_profile_policy_to_shop_roles"
+   roles      = [aws_iam_role.lambda_shop_accept_role.name,
+                 aws_iam_role.lambda_shop_decrypt_role.name,
+                 aws_iam_role.lambda_shop_update_db_role.name,
+                 aws_iam_role.lambda_shop_decrypt_update_db_role.name]
+   policy_arn = aws_iam_policy.lambda_shop_profile_policy[count.index].arn
+}
+
 # lambda_unittest_role
 # --------------------
 
@@ -47,9 +47,12 @@ function remove_all_from_directory_except_codefile {
 remove_files
 remove_terraform_directory
 
+rm -f layer/shop_layer.zip
+
 remove_all_from_directory_except_codefile lambdas/shop_accept    shop_accept.py
 remove_all_from_directory_except_codefile lambdas/shop_decrypt   shop_decrypt.py
 remove_all_from_directory_except_codefile lambdas/shop_update_db shop_update_db.py
+remove_all_from_directory_except_codefile lambdas/shop_decrypt_update_db shop_decrypt_update_db.py
 
 remove_all_from_directory_except_codefile lambdas/smoketest_test smoketest_test.py
 remove_all_from_directory_except_codefile lambdas/perftest_test  perftest_test.py
@@ -20,12 +20,24 @@ function in_directory_zip {
 #
 # https://unix.stackexchange.com/questions/153862/remove-all-files-directories-except-for-one-file
 # https://linuxacademy.com/cp/courses/lesson/course/1905/lesson/4
+#
+# The optional fourth parameter contains python files of other functions (relative to the directory)
+# that are added to the zip file, f.e. for the fused shop_decrypt_update_db function.
+#
+# The libraries are installed for the Lambda runtime (python3.8 on Amazon Linux 2), not for the
+# python3 of this VM: cryptography contains compiled code, a wheel for another python version or 
+# platform gives an ImportError in Lambda. pip needs --only-binary=:all: to install for another 
+# platform.
+
+LAMBDA_PLATFORM=manylinux2014_x86_64
+LAMBDA_PYTHON_VERSION=3.8
 
 function in_directory_zip_with_library {
 
   directory=$1
   name=$2
   library=$3
+  modules=$4
 
   cd $directory
   ls | grep -v "${name}.py" | xargs rm -fr
@@ -35,16 +47,43 @@ function in_directory_zip_with_library {
 
   source venv/bin/activate
   pip install --upgrade pip
-  pip install ${library} -t .
+  pip install --platform ${LAMBDA_PLATFORM} --python-version ${LAMBDA_PYTHON_VERSION} --implementation cp --only-binary=:all: ${library} -t .
   deactivate
 
   rm -r venv
 
+  for module in ${modules}
+  do
+    cp ${module} .
+  done
+
   zip -r "${name}.zip" *
   cd ../..
 
 }
 
+# layer_zip
+# ---------
+# The shop layer contains the modules that are shared by the shop Lambda functions. 
+# Lambda adds the python directory of a layer to the python path.
+
+function layer_zip {
+
+  directory=$1
+  name=$2
+
+  cd $directory
+  rm -fr python "${name}.zip"
+
+  mkdir python
+  cp *.py python
+
+  zip -r "${name}.zip" python
+  rm -r python
+  cd ..
+
+}
+
 # terraform_init
 # --------------
 
@@ -110,6 +149,7 @@ function activate_xray {
   aws lambda update-function-configuration --function-name ${name_prefix}_shop_accept    --tracing-config Mode=Active
   aws lambda update-function-configuration --function-name ${name_prefix}_shop_decrypt   --tracing-config Mode=Active
   aws lambda update-function-configuration --function-name ${name_prefix}_shop_update_db --tracing-config Mode=Active
+  aws lambda update-function-configuration --function-name ${name_prefix}_shop_decrypt_update_db --tracing-config Mode=Active
 
 }
 
@@ -117,12 +157,17 @@ function activate_xray {
 # Main function
 # =============
 
+layer_zip "layer" "shop_layer"
+
 in_directory_zip_with_library "lambdas/shop_accept"    "shop_accept"    "aws-xray-sdk"
-in_directory_zip_with_library "lambdas/shop_decrypt"   "shop_decrypt"   "aws-xray-sdk"
+in_directory_zip_with_library "lambdas/shop_decrypt"   "shop_decrypt"   "aws-xray-sdk cryptography"
 in_directory_zip_with_library "lambdas/shop_update_db" "shop_update_db" "aws-xray-sdk"
 
+in_directory_zip_with_library "lambdas/shop_decrypt_update_db" "shop_decrypt_update_db" "aws-xray-sdk cryptography" \
+                              "../shop_decrypt/shop_decrypt.py ../shop_update_db/shop_update_db.py"
+
 in_directory_zip_with_library "lambdas/smoketest_test" "smoketest_test" "requests"
-in_directory_zip_with_library "lambdas/perftest_test"  "perftest_test"  "requests"
+in_directory_zip_with_library "lambdas/perftest_test"  "perftest_test"  "requests cryptography"
 
 terraform_init
 terraform_plan
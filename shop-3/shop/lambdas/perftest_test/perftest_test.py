@@ -4,9 +4,22 @@ import requests
 import json
 import base64
 import os
-import datetime
+import time
 
-NUMBER_OF_REQUESTS = 100
+from concurrent.futures                        import ThreadPoolExecutor
+from cryptography.hazmat.primitives            import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+
+from shop_message_id import get_message_id
+
+NUMBER_OF_REQUESTS    = 100
+CONCURRENCY           = int(os.environ.get("concurrency", "1"))
+
+# The public key of the shop is cached in /tmp, this survives as long as the container
+# of this function is reused. The encryption itself is done locally.
+
+PUBLIC_KEY_CACHE_FILE = "/tmp/public_keys.json"
+PUBLIC_KEY_CACHE_TTL  = 24 * 60 * 60
 
 # get_parameters
 # --------------
@@ -19,45 +32,58 @@ def get_parameters():
 
   return {"shop_id": shop_id, "key_alias": key_alias, "url": url}
 
-# get_message_id
+# get_public_key
 # --------------
+# Returns the public key of the shop from /tmp, or from KMS when it isn't cached (yet) or
+# when the cached key is expired.
+
+def get_public_key(key_alias):
+
+  cache = {}
+
+  if (os.path.exists(PUBLIC_KEY_CACHE_FILE)):
+    with open(PUBLIC_KEY_CACHE_FILE, "r") as cache_file:
+      cache = json.load(cache_file)
 
-def get_message_id():
+  entry = cache.get(key_alias)
 
-  datetime_object = datetime.datetime.now()
-  print("DEBUG: time: " + str(datetime_object))
+  if ((entry == None) or (entry["expires"] < time.time())):
 
-  year  = datetime_object.year
-  month = datetime_object.month
-  day   = datetime_object.day
-  
-  hour  = datetime_object.hour
-  min   = datetime_object.min
-  sec   = datetime_object.second
-  msec  = datetime_object.microsecond
+    kms      = boto3.client('kms')
+    response = kms.get_public_key(KeyId=key_alias)
+    print("DEBUG: Response of kms.get_public_key: KeyId: " + response["KeyId"])
 
-  format_string = "{msec:06}{sec:02}{min:02}{hour:02}-{year:04}{month:02}{day:02}"
-  message_id    = format_string.format(msec = msec, sec = sec, min = min, hour = hour, year = year, month = month, day = day)
+    entry = {"key_id"           : response["KeyId"],
+             "public_key_base64": base64.standard_b64encode(response["PublicKey"]).decode("utf-8"),
+             "expires"          : time.time() + PUBLIC_KEY_CACHE_TTL}
 
-  return { "message_id": message_id }
+    cache[key_alias] = entry
+    with open(PUBLIC_KEY_CACHE_FILE, "w") as cache_file:
+      json.dump(cache, cache_file)
+
+  public_key = serialization.load_der_public_key(base64.standard_b64decode(entry["public_key_base64"]))
+
+  return {"key_id": entry["key_id"], "public_key": public_key}
 
 # encrypt_sales
 # -------------
+# RSAES_OAEP_SHA_256 in KMS is OAEP with SHA-256 for both the hash and MGF1, without label.
+# The decrypt function can't see the difference with ciphertext that is created by kms.encrypt.
 
-def encrypt_sales(key_alias):
+def encrypt_sales(public_key):
 
   test_content   = {
    "sales": [{"item_no" : "90001", "gross_number": "5", "gross_turnover": "5"},
              {"item_no" : "90002", "gross_number": "1", "gross_turnover": "2"}]
    }
 
-  kms      = boto3.client('kms')
-  response = kms.encrypt(KeyId=key_alias, Plaintext=json.dumps(test_content), EncryptionAlgorithm='RSAES_OAEP_SHA_256')
-  print("DEBUG: Response of kms.encrypt: "+str(response))
+  encrypted_content = public_key.encrypt(
+    json.dumps(test_content).encode("utf-8"),
+    padding.OAEP(mgf = padding.MGF1(algorithm = hashes.SHA256()), algorithm = hashes.SHA256(), label = None)
+  )
 
   # To be able to send the encrypted text in JSON format to the other side, encode it with base64 and utf-8
   #
-  encrypted_content = response["CiphertextBlob"]
   content_base64    = base64.standard_b64encode(encrypted_content).decode("utf-8")
 
   return {"content_base64": content_base64}
@@ -73,15 +99,52 @@ def create_data(shop_id, message_id, content_base64):
 
 # send_data
 # ---------
+# The session is shared by all threads: the HTTPS connections to the API Gateway are reused
+
+def send_data(session, url, data):
+
+  reply = session.post(url, json.dumps(data))
+
+  return {"reply": reply}
+
+# create_session
+# --------------
+
+def create_session():
+
+  session = requests.Session()
+  adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = CONCURRENCY)
+  session.mount("https://", adapter)
+
+  return {"session": session}
+
+# send_request
+# ------------
+
+def send_request(session, url, shop_id, public_key, request_number):
+
+  print ("DEBUG: request_number = "+str(request_number+1))
 
-def send_data(url, data):
+  response       = get_message_id()
+  message_id     = response["message_id"]
 
-  reply = requests.post(url, json.dumps(data))
+  response       = encrypt_sales(public_key)
+  content_base64 = response["content_base64"]
+
+  response       = create_data(shop_id,message_id, content_base64)
+  data           = response["data"]
+
+  print ("DEBUG: Data           = "+json.dumps(data))
+
+  response       = send_data(session, url, data)
+  reply          = response["reply"]
 
   return {"reply": reply}
 
 # Main function
 # =============
+# The requests are sent by CONCURRENCY threads (environment variable concurrency, default 1: 
+# one request after another).
 
 def lambda_handler(event, context):
 
@@ -93,27 +156,26 @@ def lambda_handler(event, context):
   print ("DEBUG: Shop id        = " + shop_id)
   print ("DEBUG: Key alias      = " + key_alias)
   print ("DEBUG: URL            = " + url)
+  print ("DEBUG: Concurrency    = " + str(CONCURRENCY))
 
-  response       = encrypt_sales(key_alias)
-  content_base64 = response["content_base64"]
-
-  for request_number in range(NUMBER_OF_REQUESTS):
+  response       = get_public_key(key_alias)
+  public_key     = response["public_key"]
 
-    print ("DEBUG: request_number = "+str(request_number+1))
+  response       = create_session()
+  session        = response["session"]
 
-    response       = get_message_id()
-    message_id     = response["message_id"]
+  status_codes   = {}
 
-    response       = create_data(shop_id,message_id, content_base64)
-    data           = response["data"]
+  with ThreadPoolExecutor(max_workers = CONCURRENCY) as executor:
 
-    print ("DEBUG: Data           = "+json.dumps(data))
+    futures = [executor.submit(send_request, session, url, shop_id, public_key, request_number) for request_number in range(NUMBER_OF_REQUESTS)]
 
-    response       = send_data(url, data)
-    reply          = response["reply"]
+    for future in futures:
+      reply = future.result()["reply"]
+      status_codes[reply.status_code] = status_codes.get(reply.status_code, 0) + 1
 
   print ("INFO:  Status code    = "+str(reply.status_code))
   print ("INFO:  Content        = "+str(reply.content))
+  print ("INFO:  Status codes   = "+json.dumps(status_codes))
 
   return
-
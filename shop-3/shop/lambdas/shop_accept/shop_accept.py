@@ -14,44 +14,85 @@
 #                                                                   #
 #####################################################################
 
+# First, to measure the imports below (see shop_coldstart.py)
+import shop_coldstart
+
 import json
-import boto3
 import os
 
 from aws_xray_sdk.core   import patch
 from botocore.exceptions import ClientError
 
+import shop_clients
+import shop_log
+import shop_metrics
+import shop_xray
+import shop_profile
+
+# X-Ray: botocore is patched once per container, when the function is loaded
+
+patch(['botocore'])
+
+# get_ids
+# -------
+# Only used for the metrics and the TRACE lines: the body is checked by shop_decrypt
+
+def get_ids(event):
+
+  try:
+    body       = json.loads(event["body"])
+    shop_id    = str(body.get("shop_id", "unknown"))
+    message_id = body.get("message_id")
+  except (KeyError, TypeError, ValueError, AttributeError):
+    shop_id    = "unknown"
+    message_id = None
+
+  return { "shop_id": shop_id, "message_id": message_id }
+
 # Main function
 # =============
 
+@shop_profile.profiled
 def lambda_handler(event, context):
 
+  shop_coldstart.start_request()
+  shop_log.start_request()
+  shop_metrics.start_request()
+
   try: 
 
-    print("DEBUG: BEGIN: event: "+json.dumps(event))
+    shop_log.debug("BEGIN: event: {}", event)
 
-    # used for X-Ray
-    patch(['botocore'])
+    ids = get_ids(event)
+    if (ids["message_id"] != None):
+      shop_log.trace("accept_received", ids["shop_id"], ids["message_id"])
 
-    sns                   = boto3.client('sns')
+    sns                   = shop_clients.get_client('sns')
     sns_decrypt_topic_arn = os.environ['to_shop_decrypt_topic_arn']
 
     message               = json.dumps(event)
 
-    print ("INFO: Message to to_shop_decrypt: " + message)
+    shop_log.info("Message to to_shop_decrypt: shop_id: {}, message_id: {}", ids["shop_id"], ids["message_id"])
+    shop_log.debug("Message to to_shop_decrypt: {}", message)
 
-    response = sns.publish(
-      TopicArn = sns_decrypt_topic_arn,
-      Message = message
-    )
-    print ("DEBUG: Response of sns.publish: "+json.dumps(response))
+    start    = shop_metrics.start_timer()
+    with shop_xray.stage("send_to_to_shop_decrypt", shop_id = ids["shop_id"], message_id = ids["message_id"]):
+      response = sns.publish(
+        TopicArn = sns_decrypt_topic_arn,
+        Message = message
+      )
+    shop_metrics.add_timing(ids["shop_id"], "sns_publish_ms", start)
+
+    if (ids["message_id"] != None):
+      shop_log.trace("accept_published", ids["shop_id"], ids["message_id"])
+    shop_log.debug("Response of sns.publish: {}", response)
 
     statusCode    = 200
     returnMessage = "OK"
 
   except ClientError as e:
 
-    print("ERROR: "+str(e))
+    shop_log.error("{}", e)
 
     # Mind, that the client will also get a 500 eror when there is something wrong in the API gateway. 
     # In that case, the text is "Internal server error"
@@ -61,9 +102,10 @@ def lambda_handler(event, context):
     statusCode    = 500
     returnMessage = "NotOK: retry later, admins: see cloudwatch logs for error"
 
-  print("DEBUG: DONE: statusCode: " + str(statusCode) + \
-            ", returnMessage: \"" + returnMessage + "\"" + \
-            ", event:"+json.dumps(event))
+  shop_log.debug("DONE: statusCode: {}, returnMessage: \"{}\", event:{}, client_construction: {}",
+                 statusCode, returnMessage, event, shop_clients.get_construction_stats)
+
+  shop_metrics.flush()
 
   return { "statusCode": statusCode, 
            "headers"   : { "Content-Type" : "application/json" },
@@ -8,14 +8,66 @@
 #                                                                   #
 #####################################################################
 
+# First, to measure the imports below (see shop_coldstart.py)
+import shop_coldstart
+
 import json
-import boto3
 import os
 import base64
+import binascii
+import time
+import hashlib
+import threading
+
+from collections                                  import OrderedDict
+from concurrent.futures                           import ThreadPoolExecutor
 
 from aws_xray_sdk.core   import patch
 from botocore.exceptions import ClientError
 
+import shop_clients
+import shop_event
+import shop_log
+import shop_metrics
+import shop_xray
+import shop_profile
+
+# X-Ray: botocore is patched once per container, when the function is loaded
+
+patch(["botocore"])
+
+# Envelope encryption
+# -------------------
+# Messages in the envelope format contain a data key that is encrypted with the KMS key of 
+# the shop (encrypted_key_base64) and the sales, encrypted with that data key using AES-GCM 
+# (content_base64 = nonce + ciphertext + tag, the shop_id is used as associated data). 
+#
+# Clients reuse their data key for a while, so the decrypted data keys are kept in memory 
+# per container: only the first message with a new data key needs a call to KMS.
+
+AES_GCM_NONCE_SIZE = 12
+
+DATA_KEY_CACHE_TTL_SECONDS = int(os.environ.get('data_key_cache_ttl_seconds', '300'))
+DATA_KEY_CACHE_MAX_SIZE    = int(os.environ.get('data_key_cache_max_size', '100'))
+
+data_key_cache      = OrderedDict()
+data_key_cache_lock = threading.Lock()
+
+# Batch mode
+# ----------
+# When the queue mode is used (see trigger_shop_decrypt in terraform_shop.tf), an SQS queue is
+# subscribed to the to_shop_decrypt topic and sqs_lambda_handler gets up to 10 messages at once.
+# The messages are decrypted in parallel, the results are sent to to_shop_update_db in one 
+# publish_batch call.
+
+DECRYPT_THREADS     = int(os.environ.get('decrypt_threads', '10'))
+SNS_MAX_BATCH_SIZE  = 10
+
+# Errors of KMS that are caused by the message itself: the message will never be decrypted, so it
+# is not retried. Other errors (f.e. throttling) are retried by SQS.
+
+PERMANENT_KMS_ERRORS = ["InvalidCiphertextException", "IncorrectKeyException", "InvalidKeyUsageException"]
+
 # check_event_structure
 # ---------------------
 # We use the following structure:
@@ -34,170 +86,406 @@ from botocore.exceptions import ClientError
 #    ]
 # }
 #
+# Messages in the envelope format also contain "encrypted_key_base64" in the body.
+#
 # There are two common errors:
 # 1) An operator will test a Lambda function (either accept or decrypt) with test json
 #    that isn't simmulation SNS. In that case, the json will not contain the "Records" key.
 # 2) The client will send data to the API that is not meant for this program, in this case
 #    it doesn't contain the keys shop_id or content_base_64. 
 #
-# So: let's check for these two situations and accept that the function crashes in all
-#     other situations.
+# So: let's check for these two situations. The event is parsed once by shop_event (shop layer),
+# check_event_structure returns the parsed message.
 
+@shop_xray.capture("check_event_structure")
 def check_event_structure(event):
 
-  succeeded = True
-
-  if ('Records' in event):
-       
-    try:
-
-      body = json.loads(event["Records"][0]["Sns"]["Message"])["body"]
-      print("DEBUG: body: "+str(body))
-                  
-      if ('shop_id' in body):
-
-        if ('message_id' in body):
-                      
-          if ('content_base64' in body):
-                        
-            print("DEBUG: Valid event structure")
-                      
-          else:
-  
-            print("ERROR: in check_event_structure: no content_base64 in body")
-            succeeded = False
-
-        else:
-  
-          print("ERROR: in check_event_structure: no message_id in body")
-          succeeded = False
-
-      else:
+  response = shop_event.parse_encrypted_event(event)
 
-        print("ERROR: in check_event_structure: no shop_id in body")
-        succeeded = False
-                  
-    except ClientError as e:
-
-      print("ERROR: in check_event_structure: no valid json in body, " +str(e))
-      succeeded = False
-        
+  if (response["succeeded"]):
+    shop_log.debug("Valid event structure")
+    shop_xray.annotate("check_event_structure", shop_id = response["message"].shop_id, message_id = response["message"].message_id)
   else:
+    shop_log.error("in check_event_structure: {}", response["error"])
 
-    print("ERROR: in check_event_structure: no element Records in event - use SNS type of json to test accept or decrypt functions")
-    succeeded = False
-    
-  return {"succeeded": succeeded}
-
-# get_fields_from_event
-# ---------------------
-
-def get_fields_from_event(event):
-
-  message = json.loads(event["Records"][0]["Sns"]["Message"])
-  body    = json.loads(message["body"])
-  
-  shop_id        = body["shop_id"]
-  message_id     = body["message_id"]
-  content_base64 = bytearray(body["content_base64"], "utf-8")
-
-  return {"shop_id": shop_id, "message_id": message_id, "content_base64": content_base64}
+  return {"succeeded": response["succeeded"], "message": response["message"]}
 
 # decrypt
 # -------
 
+@shop_xray.capture("decrypt")
 def decrypt(shop_id, encrypted_content):
 
+  shop_xray.annotate("decrypt", shop_id = shop_id)
+
   try:
 
-    kms        = boto3.client('kms')
+    kms        = shop_clients.get_client('kms')
     key_prefix = os.environ['key_prefix']
     key        = 'alias/' + key_prefix + shop_id
 
+    start    = shop_metrics.start_timer()
     response = kms.decrypt(
       CiphertextBlob      = encrypted_content,
       KeyId               = key,
       EncryptionAlgorithm = "RSAES_OAEP_SHA_256")
-    print("DEBUG: Response of kms.decrypt: "+str(response))
+    shop_metrics.add_timing(shop_id, "kms_decrypt_ms", start)
+    shop_log.debug("Response of kms.decrypt: KeyId: {}, EncryptionAlgorithm: {}", response["KeyId"], response["EncryptionAlgorithm"])
 
     succeeded         = True
-    decrypted_content = response["Plaintext"].decode("utf-8")
+    retry             = False
+    plaintext         = response["Plaintext"]
 
   except ClientError as e:
 
-    print("ERROR: " + shop_id + " - " + str(encrypted_content) + " - " + str(e))
+    shop_log.error("{} - {}", shop_id, e)
 
     succeeded         = False
-    decrypted_content = ""
+    retry             = e.response["Error"]["Code"] not in PERMANENT_KMS_ERRORS
+    plaintext         = b""
+
+  return {"succeeded": succeeded, "retry": retry, "plaintext": plaintext}
+
+# decrypt_rsa
+# -----------
+# Messages in the original format: the sales are encrypted with the RSA key of the shop
+
+def decrypt_rsa(shop_id, encrypted_content):
+
+  response          = decrypt(shop_id, encrypted_content)
+  decrypted_content = response["plaintext"].decode("utf-8")
+
+  return {"succeeded": response["succeeded"], "retry": response["retry"], "decrypted_content": decrypted_content}
+
+# get_data_key_from_cache
+# -----------------------
+# Least recently used entries are at the start of the OrderedDict. Expired entries are
+# removed when they are found.
+
+def get_data_key_from_cache(cache_key):
+
+  data_key = None
+
+  with data_key_cache_lock:
+
+    entry = data_key_cache.get(cache_key)
+
+    if (entry != None):
+
+      if (entry["expires"] > time.monotonic()):
+        data_key_cache.move_to_end(cache_key)
+        data_key = entry["data_key"]
+      else:
+        del data_key_cache[cache_key]
+
+  return { "data_key": data_key }
+
+# put_data_key_in_cache
+# ---------------------
+
+def put_data_key_in_cache(cache_key, data_key):
+
+  with data_key_cache_lock:
+
+    data_key_cache[cache_key] = { "data_key": data_key, "expires": time.monotonic() + DATA_KEY_CACHE_TTL_SECONDS }
+    data_key_cache.move_to_end(cache_key)
+
+    while (len(data_key_cache) > DATA_KEY_CACHE_MAX_SIZE):
+      data_key_cache.popitem(last = False)
+
+  return
+
+# get_data_key
+# ------------
+# The cache key contains the shop_id: a data key that is decrypted with the key of one
+# shop will never be used for messages of another shop.
+
+def get_data_key(shop_id, encrypted_key):
+
+  cache_key = shop_id + ":" + hashlib.sha256(encrypted_key).hexdigest()
+
+  response  = get_data_key_from_cache(cache_key)
+  data_key  = response["data_key"]
+
+  if (data_key != None):
+
+    shop_log.debug("data key found in cache for shop_id {}", shop_id)
+    succeeded = True
+    retry     = False
+
+  else:
+
+    response  = decrypt(shop_id, encrypted_key)
+    succeeded = response["succeeded"]
+    retry     = response["retry"]
+
+    if (succeeded):
+      data_key = response["plaintext"]
+      put_data_key_in_cache(cache_key, data_key)
+
+  return { "succeeded": succeeded, "retry": retry, "data_key": data_key }
+
+# decrypt_envelope
+# ----------------
+# cryptography is imported on the first message in the envelope format: containers that only get 
+# messages in the original format don't pay for the import in their cold start.
+
+def decrypt_envelope(shop_id, encrypted_key, encrypted_content):
+
+  from cryptography.exceptions                      import InvalidTag
+  from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
-  return {"succeeded": succeeded, "decrypted_content": decrypted_content}
+  decrypted_content = ""
+
+  response  = get_data_key(shop_id, encrypted_key)
+  succeeded = response["succeeded"]
+  retry     = response["retry"]
+
+  if (succeeded):
+
+    try:
+
+      nonce             = encrypted_content[:AES_GCM_NONCE_SIZE]
+      ciphertext        = encrypted_content[AES_GCM_NONCE_SIZE:]
+      plaintext         = AESGCM(response["data_key"]).decrypt(nonce, ciphertext, shop_id.encode("utf-8"))
+      decrypted_content = plaintext.decode("utf-8")
+
+    except (InvalidTag, ValueError) as e:
+
+      shop_log.error("{} - decryption of content with data key failed - {}", shop_id, repr(e))
+      succeeded = False
+
+  return {"succeeded": succeeded, "retry": retry, "decrypted_content": decrypted_content}
 
 # send_to_to_shop_update_db
 # -------------------------
 
+@shop_xray.capture("send_to_to_shop_update_db")
 def send_to_to_shop_update_db(shop_id, message_id, decrypted_content):
 
+  shop_xray.annotate("send_to_to_shop_update_db", shop_id = shop_id, message_id = message_id)
+
   try: 
 
-    sns                   = boto3.client('sns')
+    sns                   = shop_clients.get_client('sns')
     sns_process_topic_arn = os.environ['to_shop_update_db_topic_arn']
 
     data = { "shop_id": shop_id, "message_id": message_id, "decrypted_content": decrypted_content}
     message = json.dumps(data)
 
-    print ("INFO: Message to to_shop_update_db: " + message)
+    shop_log.info("Message to to_shop_update_db: shop_id: {}, message_id: {}", shop_id, message_id)
+    shop_log.debug("Message to to_shop_update_db: {}", message)
 
+    start    = shop_metrics.start_timer()
     response = sns.publish(
       TopicArn = sns_process_topic_arn,
-      Message = json.dumps(data)
+      Message = message
     )
+    shop_metrics.add_timing(shop_id, "sns_publish_ms", start)
 
-    print("DEBUG: Response of sns.publish: "+json.dumps(response))
+    shop_log.debug("Response of sns.publish: {}", response)
+    shop_log.trace("decrypt_published", shop_id, message_id)
     succeeded = True
 
   except ClientError as e:
 
-    print("ERROR: "+str(e))
+    shop_log.error("{}", e)
     succeeded = False
 
   return { "succeeded": succeeded }
 
-# Main function
-# =============
+# decrypt_message
+# ---------------
+# Decrypts a message that is parsed by check_event_structure. Used by both handlers. retry is True
+# when the message may be decrypted the next time.
 
-def lambda_handler(event, context):
+def decrypt_message(message):
+
+  shop_id           = message.shop_id
+  message_id        = message.message_id
+
+  shop_log.trace("decrypt_received", shop_id, message_id)
+
+  encrypted_content = base64.standard_b64decode(message.content_base64)
+
+  if (message.encrypted_key_base64 != None):
+    encrypted_key   = base64.standard_b64decode(message.encrypted_key_base64)
+    response        = decrypt_envelope(shop_id, encrypted_key, encrypted_content)
+  else:
+    response        = decrypt_rsa(shop_id, encrypted_content)
+
+  decrypted_content = response["decrypted_content"]
+
+  return {"succeeded": response["succeeded"], "retry": response["retry"], "shop_id": shop_id, "message_id": message_id, "decrypted_content": decrypted_content}
+
+# get_event_from_sqs_record
+# -------------------------
+# The SQS subscription uses raw message delivery: the body of the SQS record is the message 
+# that shop_accept sent to the to_shop_decrypt topic. We put it in an SNS type of event, so 
+# check_event_structure can be used for both handlers.
+
+def get_event_from_sqs_record(record):
+
+  event = { "Records": [ { "Sns": { "Message": record["body"] } } ] }
+
+  return { "event": event }
+
+# decrypt_sqs_record
+# ------------------
+# Messages with an invalid structure or content (f.e. no valid base64, or encrypted with another 
+# key) will never succeed: they are logged and removed from the queue, the other records of the
+# batch are not affected. Messages that could not be decrypted because of a temporary error are 
+# retried by SQS, after maxReceiveCount attempts they are moved to the dead letter queue.
+
+def decrypt_sqs_record(record):
+
+  failed   = {"succeeded": False, "retry": False, "shop_id": "", "message_id": "", "decrypted_content": ""}
+
+  try:
+
+    response = get_event_from_sqs_record(record)
+    event    = response["event"]
+
+    response = check_event_structure(event)
+
+    if (response["succeeded"]):
+      response = decrypt_message(response["message"])
+    else:
+      response = failed
+
+  except (ValueError, KeyError, binascii.Error, UnicodeDecodeError) as e:
+
+    shop_log.error("in decrypt_sqs_record: messageId {}: {}", record.get("messageId"), repr(e))
+    response = failed
+
+  response["item_identifier"] = record["messageId"]
+
+  return response
 
-  print ("DEBUG: BEGIN: event: " + json.dumps(event))
+# send_batch_to_to_shop_update_db
+# -------------------------------
+# Returns the item_identifiers (SQS messageIds) of the messages that couldn't be sent. The time
+# of a publish_batch call is added to the metrics of every shop in that call: it is the time
+# their messages waited for SNS.
 
-  # Used by X-Ray
-  patch(["botocore"])
+def send_batch_to_to_shop_update_db(results):
+
+  sns                   = shop_clients.get_client('sns')
+  sns_process_topic_arn = os.environ['to_shop_update_db_topic_arn']
+  failed_identifiers    = []
+
+  for start in range(0, len(results), SNS_MAX_BATCH_SIZE):
+
+    chunk   = results[start : start + SNS_MAX_BATCH_SIZE]
+    entries = []
+
+    for index, result in enumerate(chunk):
+      data = { "shop_id": result["shop_id"], "message_id": result["message_id"], "decrypted_content": result["decrypted_content"]}
+      entries.append({ "Id": str(index), "Message": json.dumps(data) })
+      shop_log.info("Message to to_shop_update_db: shop_id: {}, message_id: {}", result["shop_id"], result["message_id"])
+      shop_log.debug("Message to to_shop_update_db: {}", entries[-1]["Message"])
+
+    try:
+
+      start    = shop_metrics.start_timer()
+      response = sns.publish_batch(
+        TopicArn                   = sns_process_topic_arn,
+        PublishBatchRequestEntries = entries
+      )
+
+      for shop_id in set(result["shop_id"] for result in chunk):
+        shop_metrics.add_timing(shop_id, "sns_publish_ms", start)
+
+      shop_log.debug("Response of sns.publish_batch: {}", response)
+
+      for successful in response.get("Successful", []):
+        result = chunk[int(successful["Id"])]
+        shop_log.trace("decrypt_published", result["shop_id"], result["message_id"])
+
+      for failed in response.get("Failed", []):
+        shop_log.error("publish_batch failed for message_id {}: {}", chunk[int(failed["Id"])]["message_id"], failed.get("Message", failed["Code"]))
+        failed_identifiers.append(chunk[int(failed["Id"])]["item_identifier"])
+
+    except ClientError as e:
+
+      shop_log.error("{}", e)
+      failed_identifiers.extend([result["item_identifier"] for result in chunk])
+
+  return { "failed_identifiers": failed_identifiers }
+
+# Main functions
+# ==============
+
+@shop_profile.profiled
+def lambda_handler(event, context):
+
+  shop_coldstart.start_request()
+  shop_log.start_request()
+  shop_metrics.start_request()
+  shop_log.debug("BEGIN: event: {}", event)
 
   decrypted_content     = ""
   shop_id               = ""
+  message_id            = ""
 
   response              = check_event_structure(event)
   valid_event_structure = response["succeeded"]
   
   if (valid_event_structure):
     
-    response          = get_fields_from_event(event)
+    response          = decrypt_message(response["message"])
     shop_id           = response["shop_id"]
     message_id        = response["message_id"]
-    content_base64    = response["content_base64"]
-  
-    encrypted_content = base64.standard_b64decode(content_base64)
-
-    response          = decrypt(shop_id, encrypted_content)
     decrypted_content = response["decrypted_content"]
 
     if (response["succeeded"]):
 
       response = send_to_to_shop_update_db(shop_id, message_id, decrypted_content)
 
-  print("DEBUG: DONE: shop_id: " + shop_id + \
-            ", succeeded: " + str(response["succeeded"]) + \
-            ", event: " + json.dumps(event) + \
-            ", decrypted_content: " + json.dumps(decrypted_content))
+  # The event is in the BEGIN line. The unittests read the last 4 KB of the log (LogResult): with
+  # the whole event here, the errors and the result of this invocation would fall outside it.
+
+  shop_log.debug("DONE: shop_id: {}, message_id: {}, succeeded: {}, decrypted_content: {}, client_construction: {}",
+                 shop_id, message_id, response["succeeded"], lambda: json.dumps(decrypted_content), shop_clients.get_construction_stats)
+
+  shop_metrics.flush()
 
   return
 
+
+# sqs_lambda_handler
+# ------------------
+# Only the messages that failed are reported back to SQS (ReportBatchItemFailures), the other
+# messages in the batch are removed from the queue.
+
+@shop_profile.profiled
+def sqs_lambda_handler(event, context):
+
+  shop_coldstart.start_request()
+  shop_log.start_request()
+  shop_metrics.start_request()
+  shop_log.debug("BEGIN: event: {}", event)
+
+  records = event.get("Records", [])
+
+  # The clients are created before the threads start, shop_clients will then not wait for its lock
+
+  shop_clients.get_client('kms')
+  shop_clients.get_client('sns')
+
+  with ThreadPoolExecutor(max_workers = max(1, min(DECRYPT_THREADS, len(records)))) as executor:
+    results = list(executor.map(decrypt_sqs_record, records))
+
+  decrypted_results  = [result for result in results if result["succeeded"]]
+  failed_identifiers = [result["item_identifier"] for result in results if result["retry"]]
+
+  if (decrypted_results != []):
+    response            = send_batch_to_to_shop_update_db(decrypted_results)
+    failed_identifiers += response["failed_identifiers"]
+
+  shop_log.debug("DONE: records: {}, decrypted: {}, failed: {}, client_construction: {}",
+                 len(records), len(decrypted_results), failed_identifiers, shop_clients.get_construction_stats)
+
+  shop_metrics.flush()
+
+  return { "batchItemFailures": [ { "itemIdentifier": identifier } for identifier in failed_identifiers ] }
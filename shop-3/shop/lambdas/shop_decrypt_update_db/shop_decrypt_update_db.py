@@ -0,0 +1,84 @@
+#####################################################################
+#                                                                   #
+#          DON'T START THIS LAMBDA FUNCTION VIA THE GUI !           #
+#          ==============================================           #
+#                                                                   #
+#          Use the smoketest Lambda function (or encrypt_and_send   #
+#          in the client directory on the VM) instead...            #
+#                                                                   #
+#####################################################################
+
+# Fused mode
+# ----------
+# In the split mode the pipeline is accept -> SNS -> decrypt -> SNS -> update_db. In the fused mode
+# (pipeline_mode_shop = "fused" in terraform_shop.tf) this function is subscribed to the 
+# to_shop_decrypt topic instead of shop_decrypt: it decrypts the message and updates the database 
+# in the same process, without the publish to to_shop_update_db.
+#
+# The code of shop_decrypt and shop_update_db is used as it is: init-shop.sh copies both files
+# into the zip file of this function.
+
+# First, to measure the imports below (see shop_coldstart.py)
+import shop_coldstart
+
+from aws_xray_sdk.core import patch
+
+import shop_clients
+import shop_log
+import shop_metrics
+import shop_profile
+import shop_event
+import shop_decrypt
+import shop_update_db
+
+# X-Ray: botocore is patched once per container, when the function is loaded
+
+patch(["botocore"])
+
+# Main function
+# =============
+
+@shop_profile.profiled
+def lambda_handler(event, context):
+
+  shop_coldstart.start_request()
+  shop_log.start_request()
+  shop_metrics.start_request()
+  shop_log.debug("BEGIN: event: {}", event)
+
+  shop_id    = ""
+  message_id = ""
+  succeeded  = False
+
+  response  = shop_decrypt.check_event_structure(event)
+
+  if (response["succeeded"]):
+
+    response   = shop_decrypt.decrypt_message(response["message"])
+    shop_id    = response["shop_id"]
+    message_id = response["message_id"]
+
+    if (response["succeeded"]):
+
+      response = shop_event.parse_decrypted_message({ "shop_id"           : response["shop_id"], 
+                                                      "message_id"        : response["message_id"], 
+                                                      "decrypted_content" : response["decrypted_content"] })
+
+      if (response["succeeded"]):
+
+        message   = response["message"]
+        response  = shop_update_db.update_sales(message.shop_id, message.message_id, message.sales, event)
+        succeeded = response["succeeded"]
+
+      else:
+
+        shop_log.error("in lambda_handler: {}", response["error"])
+
+  # The event is in the BEGIN line, see the DONE line of shop_decrypt
+
+  shop_log.debug("DONE: shop_id: {}, message_id: {}, succeeded: {}, context.get_remaining_time_in_millis(): {}, context.memory_limit_in_mb: {}, client_construction: {}",
+                 shop_id, message_id, succeeded, context.get_remaining_time_in_millis, context.memory_limit_in_mb, shop_clients.get_construction_stats)
+
+  shop_metrics.flush()
+
+  return
@@ -8,30 +8,67 @@
 #                                                                   #
 #####################################################################
 
+# First, to measure the imports below (see shop_coldstart.py)
+import shop_coldstart
+
 import json
-import boto3
 import os
-import base64
 import datetime
+import uuid
+
+from decimal             import Decimal
 
 from botocore.exceptions import ClientError
 from aws_xray_sdk.core   import patch
 
+import shop_clients
+import shop_event
+import shop_message_id
+import shop_log
+import shop_metrics
+import shop_xray
+import shop_profile
+
+# X-Ray: botocore is patched once per container, when the function is loaded
+
+patch(['botocore'])
+
+# DynamoDB accepts at most 100 actions in one TransactWriteItems call. Every chunk 
+# of a basket also contains an action on the claim of the message_id, so a chunk can 
+# contain MAX_TRANSACTION_ITEMS - 1 sales lines.
+
+MAX_TRANSACTION_ITEMS = 100
+
+# Batch mode
+# ----------
+# When the queue mode is used (see trigger_shop_update_db in terraform_shop.tf), an SQS queue is
+# subscribed to the to_shop_update_db topic and sqs_lambda_handler gets a batch of messages. 
+# Double messages within the batch are removed, the sales of all messages are added up per 
+# (shop_id, record_type) and every record is updated only once per batch: during promotions
+# many messages update the same few records. The claims of the message_ids and the updates are
+# written in one transaction (see write_batch), so a message is either completely written or
+# not at all and can then be retried.
+
 # get_fields_from_event
 # ---------------------
+# The event is parsed and the sales lines are validated once by shop_event (shop layer). An
+# invalid event raises the KeyError or ValueError that shop_event returns.
 
+@shop_xray.capture("get_fields_from_event")
 def get_fields_from_event(event):
 
-  message = json.loads(event["Records"][0]["Sns"]["Message"])
-  print("DEBUG: Message: "+json.dumps(message))
+  response = shop_event.parse_decrypted_event(event)
 
-  shop_id           = message["shop_id"]
-  message_id        = message["message_id"]
-  decrypted_content = json.loads(message["decrypted_content"])
+  if (response["succeeded"] == False):
+    shop_log.error("in get_fields_from_event: {}", response["error"])
+    raise response["exception"]
 
-  print("DEBUG: decrypted_content: "+ json.dumps(decrypted_content))
+  message  = response["message"]
+  shop_xray.annotate("get_fields_from_event", shop_id = message.shop_id, message_id = message.message_id, sales_lines = len(message.sales))
+  shop_log.debug("Message: {}", message.message)
+  shop_log.trace("update_db_received", message.shop_id, message.message_id)
 
-  return {"shop_id": shop_id, "message_id": message_id, "decrypted_content": decrypted_content}
+  return {"shop_id": message.shop_id, "message_id": message.message_id, "sales": message.sales}
 
 # get_record_type
 # ---------------
@@ -98,12 +135,12 @@ def message_is_sent_today(message_id):
   response             = get_date_from_message_id(message_id)
   date_from_message_id = response["date"]
 
-  print("DEBUG: date_from_message_id: " + date_from_message_id)
+  shop_log.debug("date_from_message_id: {}", date_from_message_id)
 
   response      = get_current_date()
   current_date  = response["current_date"]
 
-  print("DEBUG: current_date: " + current_date)
+  shop_log.debug("current_date: {}", current_date)
 
   is_sent_today = (date_from_message_id == current_date)
   
@@ -112,8 +149,11 @@ def message_is_sent_today(message_id):
 # is_double_record
 # ----------------
 
+@shop_xray.capture("is_double_record")
 def is_double_record(shop_id, message_id):
 
+  shop_xray.annotate("is_double_record", shop_id = shop_id, message_id = message_id)
+
   name_prefix   = os.environ['name_prefix']
   double_record = False
 
@@ -121,8 +161,9 @@ def is_double_record(shop_id, message_id):
   time_to_live  = str(response["time_to_live"])
 
   try:
-    print("DEBUG: put_item to shops-message-ids for shop = " + shop_id + " - message_id = " + message_id + " - time_to_live = " + time_to_live)
-    dynamodb = boto3.client('dynamodb')
+    shop_log.debug("put_item to shops-message-ids for shop = {} - message_id = {} - time_to_live = {}", shop_id, message_id, time_to_live)
+    dynamodb = shop_clients.get_client('dynamodb')
+    start    = shop_metrics.start_timer()
     response = dynamodb.put_item (
       TableName = name_prefix + "-shops-message-ids",
       Item      = {
@@ -132,12 +173,13 @@ def is_double_record(shop_id, message_id):
         },
       ConditionExpression = "attribute_not_exists(message_id)"
     ) 
-    print("DEBUG: response of put_item (shops-message-ids): "+json.dumps(response))
+    shop_metrics.add_timing(shop_id, "dedupe_put_ms", start)
+    shop_log.debug("response of put_item (shops-message-ids): {}", response)
 
     double_record = False
 
   except ClientError as e:
-    print("ERROR: " + shop_id + " - " + str(e))
+    shop_log.error("{} - {}", shop_id, e)
     double_record = True
 
   return { "double_record" : double_record } 
@@ -145,11 +187,15 @@ def is_double_record(shop_id, message_id):
 # update_dynamodb
 # ---------------
 
+@shop_xray.capture("update_dynamodb")
 def update_dynamodb(shop_id, sales):
 
+  shop_xray.annotate("update_dynamodb", shop_id = shop_id, sales_lines = len(sales))
+
   try:
 
     name_prefix = os.environ['name_prefix']
+    dynamodb    = shop_clients.get_client('dynamodb')
     
     for sales_item in sales:
 
@@ -163,78 +209,748 @@ def update_dynamodb(shop_id, sales):
     
       if (((float(gross_number) > 0 ) and (float(gross_turnover) < 0)) or
           ((float(gross_number) < 0 ) and (float(gross_turnover) > 0))):
-        print("ERROR: we gave products away -and- money, or we got products back -and- realised positive turnover for that: shop_id = "+str(shop_id)+", item_no = "+str(item_no)+", gross_number = " + str(gross_number)+ ", gross_turnover = " + str(gross_turnover))
+        shop_log.error("we gave products away -and- money, or we got products back -and- realised positive turnover for that: shop_id = {}, item_no = {}, gross_number = {}, gross_turnover = {}", shop_id, item_no, gross_number, gross_turnover)
         break
     
-      print("INFO: Update fields based on sales: shop_id: " + shop_id + " - record_type: " + record_type + " - gross_number: " + str(gross_number) + " - gross_turnover: " + str(gross_turnover))
+      shop_log.info("Update fields based on sales: shop_id: {} - record_type: {} - gross_number: {} - gross_turnover: {}", shop_id, record_type, gross_number, gross_turnover)
      
-      dynamodb = boto3.client('dynamodb')
-      response = dynamodb.update_item (
-          TableName = name_prefix + "-shops",
-          Key       = {
-                         'shop_id'     : { "S" : shop_id     },
-                         'record_type' : { "S" : record_type }
-          },
-          UpdateExpression = "set gross_number   = gross_number   + :gross_number," +\
-                                " gross_turnover = gross_turnover + :gross_turnover," +\
-                                " stock          = stock          - :gross_number",
-          ExpressionAttributeValues = {
-                                ':gross_number'  : { "N" : gross_number   },
-                                ':gross_turnover': { "N" : gross_turnover }
+      start    = shop_metrics.start_timer()
+      with shop_xray.stage("update_dynamodb_line", shop_id = shop_id, record_type = record_type):
+        response = dynamodb.update_item (
+            TableName = name_prefix + "-shops",
+            Key       = {
+                           'shop_id'     : { "S" : shop_id     },
+                           'record_type' : { "S" : record_type }
             },
-          ReturnValues = "UPDATED_NEW"
-        ) 
-      print("DEBUG: Response of dynamodb.update_item (shops): " + json.dumps(response))
+            UpdateExpression = "set gross_number   = gross_number   + :gross_number," +\
+                                  " gross_turnover = gross_turnover + :gross_turnover," +\
+                                  " stock          = stock          - :gross_number",
+            ExpressionAttributeValues = {
+                                  ':gross_number'  : { "N" : gross_number   },
+                                  ':gross_turnover': { "N" : gross_turnover }
+              },
+            ReturnValues = "UPDATED_NEW"
+          ) 
+      shop_metrics.add_timing(shop_id, "line_update_ms", start)
+      shop_log.debug("Response of dynamodb.update_item (shops): {}", response)
     
       if (float(response["Attributes"]["stock"]["N"]) < 0):
-        print("WARNING: stock is negative for item_no = "+str(item_no))
+        shop_log.warning("stock is negative for item_no = {}", item_no)
+        shop_metrics.add(shop_id, "negative_stock", 1)
     
     succeeded = True
     
   except ClientError as e:
-    print("ERROR: " + shop_id + " - " + str(e))
+    shop_log.error("{} - {}", shop_id, e)
     succeeded = False
 
   return {"succeeded": succeeded}
 
-# Main function
-# =============
+# get_update_mode
+# ---------------
+# "item"        : one update_item call per sales line (default, used by the unittests)
+# "transaction" : claim the message_id and update all sales lines in one TransactWriteItems call
+
+def get_update_mode():
 
-def lambda_handler(event, context):
+  update_mode = os.environ.get('update_mode', 'item')
 
-  print("DEBUG: BEGIN: event: "+json.dumps(event))
+  return { "update_mode": update_mode }
 
-  # Used for X-Ray
-  patch(['botocore'])
+# sales_item_is_valid
+# -------------------
 
-  succeeded         = False
+def sales_item_is_valid(shop_id, item_no, gross_number, gross_turnover):
 
-  response          = get_fields_from_event(event)
-  shop_id           = response["shop_id"]
-  message_id        = response["message_id"]
-  decrypted_content = response["decrypted_content"]
+  valid = True
+
+  if (((float(gross_number) > 0 ) and (float(gross_turnover) < 0)) or
+      ((float(gross_number) < 0 ) and (float(gross_turnover) > 0))):
+    shop_log.error("we gave products away -and- money, or we got products back -and- realised positive turnover for that: shop_id = {}, item_no = {}, gross_number = {}, gross_turnover = {}", shop_id, item_no, gross_number, gross_turnover)
+    valid = False
+
+  return { "valid": valid }
+
+# get_sales_per_record_type
+# -------------------------
+# A transaction cannot contain two actions on the same item. When the same item_no is 
+# in the basket more than once, the lines are added up to one update.
+#
+# All lines are validated before anything is written: one incorrect line rejects the 
+# whole basket.
+
+def get_sales_per_record_type(shop_id, sales):
+
+  valid                  = True
+  sales_per_record_type  = {}
+
+  for sales_item in sales:
+
+    item_no        = sales_item["item_no"]
+
+    response       = get_record_type(item_no)
+    record_type    = response["record_type"]
+
+    gross_number   = sales_item["gross_number"]
+    gross_turnover = sales_item["gross_turnover"]
+
+    response       = sales_item_is_valid(shop_id, item_no, gross_number, gross_turnover)
+    if (response["valid"] == False):
+      valid = False
+      break
+
+    if (record_type in sales_per_record_type):
+      current = sales_per_record_type[record_type]
+      current["gross_number"]   = str(Decimal(current["gross_number"])   + Decimal(gross_number))
+      current["gross_turnover"] = str(Decimal(current["gross_turnover"]) + Decimal(gross_turnover))
+    else:
+      sales_per_record_type[record_type] = {"item_no": item_no, "gross_number": gross_number, "gross_turnover": gross_turnover}
+
+  return { "valid": valid, "sales_per_record_type": sales_per_record_type }
+
+# get_chunks
+# ----------
+# The record_types of the basket per transaction. Every transaction also has one action on the 
+# claim of the message_id (see get_claim_action), so it can contain MAX_TRANSACTION_ITEMS - 1 
+# sales lines. The order of sales_per_record_type is the order of the sales lines, so a retry 
+# of the same message gives the same chunks.
+
+def get_chunks(sales_per_record_type):
+
+  record_types = list(sales_per_record_type)
+  chunk_size   = MAX_TRANSACTION_ITEMS - 1
+  chunks       = [record_types[start:start + chunk_size] for start in range(0, len(record_types), chunk_size)]
+
+  return { "chunks": chunks if chunks else [[]] }
+
+# get_claim_action
+# ----------------
+# The claim of the message_id keeps the number of transactions of the basket and the number of
+# transactions that are committed:
+# - the first transaction puts the claim, when the message_id doesn't exist yet
+# - every next transaction increases committed_chunks, when it is still the number of this chunk
+# So a transaction is written only once, and a retry of the message can resume with the first
+# transaction that wasn't committed (see update_dynamodb_transaction).
+
+def get_claim_action(name_prefix, shop_id, message_id, time_to_live, chunk_number, number_of_chunks):
+
+  if (chunk_number == 0):
+
+    claim_action = {
+      "Put": {
+        "TableName" : name_prefix + "-shops-message-ids",
+        "Item"      : {
+            'shop_id'          : { "S" : shop_id                },
+            'message_id'       : { "S" : message_id             },
+            'time_to_live'     : { "N" : time_to_live           },
+            'chunks'           : { "N" : str(number_of_chunks)  },
+            'committed_chunks' : { "N" : "1"                    }
+          },
+        "ConditionExpression" : "attribute_not_exists(message_id)"
+      }
+    }
+
+  else:
+
+    claim_action = {
+      "Update": {
+        "TableName" : name_prefix + "-shops-message-ids",
+        "Key"       : {
+                        'shop_id'    : { "S" : shop_id    },
+                        'message_id' : { "S" : message_id }
+        },
+        "UpdateExpression"          : "set committed_chunks = :next_chunk",
+        "ConditionExpression"       : "committed_chunks = :chunk",
+        "ExpressionAttributeValues" : {
+                                        ':chunk'      : { "N" : str(chunk_number)     },
+                                        ':next_chunk' : { "N" : str(chunk_number + 1) }
+        }
+      }
+    }
+
+  return { "claim_action": claim_action }
+
+# get_update_action
+# -----------------
+# TransactWriteItems doesn't return the new values. The condition on the stock cancels the 
+# transaction when the stock would become negative, and returns the old item: then the 
+# transaction is done again without the condition for that item (see write_chunk). So only a 
+# basket that makes the stock negative needs a second round trip.
+
+def get_update_action(name_prefix, shop_id, record_type, sales_item, check_stock):
+
+  update_action = {
+    "Update": {
+      "TableName" : name_prefix + "-shops",
+      "Key"       : {
+                       'shop_id'     : { "S" : shop_id     },
+                       'record_type' : { "S" : record_type }
+      },
+      "UpdateExpression" : "set gross_number   = gross_number   + :gross_number," +\
+                              " gross_turnover = gross_turnover + :gross_turnover," +\
+                              " stock          = stock          - :gross_number",
+      "ExpressionAttributeValues" : {
+                              ':gross_number'  : { "N" : sales_item["gross_number"]   },
+                              ':gross_turnover': { "N" : sales_item["gross_turnover"] }
+        }
+    }
+  }
+
+  if (check_stock):
+    update_action["Update"]["ConditionExpression"]                 = "stock >= :gross_number"
+    update_action["Update"]["ReturnValuesOnConditionCheckFailure"] = "ALL_OLD"
+
+  return { "update_action": update_action }
+
+# write_chunk
+# -----------
+# Writes one transaction of the basket. claim_failed is True when the condition on the claim 
+# of the message_id failed: the message_id already exists (first chunk), or this chunk was
+# already committed (next chunks). Other errors are raised.
+#
+# The time of a transaction is divided over its actions for the line_update_ms metric, the
+# action on the claim counts as an action.
+
+def write_chunk(name_prefix, shop_id, message_id, time_to_live, chunks, chunk_number, sales_per_record_type):
+
+  dynamodb       = shop_clients.get_client('dynamodb')
+  record_types   = chunks[chunk_number]
+  negative_stock = set()
+
+  response       = get_claim_action(name_prefix, shop_id, message_id, time_to_live, chunk_number, len(chunks))
+  claim_action   = response["claim_action"]
+
+  while (True):
+
+    chunk = [claim_action]
+    for record_type in record_types:
+      response = get_update_action(name_prefix, shop_id, record_type, sales_per_record_type[record_type], record_type not in negative_stock)
+      chunk.append(response["update_action"])
+
+    shop_log.info("Update fields based on sales: shop_id: {} - message_id: {} - transaction {} of {} - actions: {}", shop_id, message_id, chunk_number + 1, len(chunks), len(chunk))
+
+    try:
+
+      start = shop_metrics.start_timer()
+
+      if (chunk_number == 0):
+        response = dynamodb.transact_write_items(
+          TransactItems      = chunk
+        )
+      else:
+        # The transaction without the stock conditions has other parameters, so another token
+
+        token    = shop_id + "-" + message_id + "-" + str(chunk_number) + ("-unchecked" if negative_stock else "")
+        response = dynamodb.transact_write_items(
+          TransactItems      = chunk,
+          ClientRequestToken = str(uuid.uuid5(uuid.NAMESPACE_OID, token))
+        )
+
+      line_update_ms = (shop_metrics.start_timer() - start) * 1000 / len(chunk)
+      for action in chunk:
+        shop_metrics.add(shop_id, "line_update_ms", round(line_update_ms, 3))
+
+      shop_log.debug("Response of dynamodb.transact_write_items: {}", response)
+
+      return { "claim_failed": False }
+
+    except ClientError as e:
+
+      cancellation_reasons = e.response.get("CancellationReasons", [])
+
+      if ((cancellation_reasons != []) and (cancellation_reasons[0].get("Code") == "ConditionalCheckFailed")):
+        shop_log.error("{} - {} - CancellationReasons: {}", shop_id, e, cancellation_reasons)
+        return { "claim_failed": True }
+
+      # The condition on the stock failed: these items are updated without the condition. The
+      # condition also fails for items that don't exist, then the error of the update is raised.
+
+      failed_stock_checks = { record_types[reason_number - 1]: reason for reason_number, reason in enumerate(cancellation_reasons)
+                              if ((reason_number > 0) and (reason.get("Code") == "ConditionalCheckFailed")) }
+
+      if ((failed_stock_checks == {}) or (negative_stock != set())):
+        raise
+
+      for record_type, reason in failed_stock_checks.items():
+        if ("Item" in reason):
+          shop_log.warning("stock is negative for item_no = {}", sales_per_record_type[record_type]["item_no"])
+          shop_metrics.add(shop_id, "negative_stock", 1)
+
+      negative_stock = set(failed_stock_checks)
+
+# get_committed_chunks
+# --------------------
+# Reads the claim of the message_id. A claim that was written by the other modes has no 
+# chunks: that message is completely processed.
+
+def get_committed_chunks(name_prefix, shop_id, message_id):
+
+  dynamodb = shop_clients.get_client('dynamodb')
+  response = dynamodb.get_item(
+    TableName      = name_prefix + "-shops-message-ids",
+    Key            = {
+                       'shop_id'    : { "S" : shop_id    },
+                       'message_id' : { "S" : message_id }
+    },
+    ConsistentRead = True
+  )
+  shop_log.debug("Response of dynamodb.get_item (shops-message-ids): {}", response)
+
+  item             = response.get("Item", {})
+  chunks           = int(item.get("chunks",           { "N" : "1" })["N"])
+  committed_chunks = int(item.get("committed_chunks", { "N" : "1" })["N"])
+
+  return { "chunks": chunks, "committed_chunks": committed_chunks }
+
+# write_basket
+# ------------
+# Claims the message_id and updates all sales lines of one message. Baskets with more than
+# MAX_TRANSACTION_ITEMS - 1 different items are split into more transactions. When the claim
+# already exists, the claim tells if the basket is a double record (all transactions are
+# committed) or if an earlier try stopped halfway: then the next transactions are written now.
+# Mind, that only a basket that fits in one transaction is all-or-nothing.
+
+def write_basket(name_prefix, shop_id, message_id, time_to_live, sales_per_record_type):
+
+  double_record = False
+  succeeded     = False
+
+  response      = get_chunks(sales_per_record_type)
+  chunks        = response["chunks"]
+
+  try:
+
+    response    = write_chunk(name_prefix, shop_id, message_id, time_to_live, chunks, 0, sales_per_record_type)
+    first_chunk = 1
+
+    if (response["claim_failed"]):
+
+      response    = get_committed_chunks(name_prefix, shop_id, message_id)
+      first_chunk = response["committed_chunks"]
+
+      if (first_chunk >= response["chunks"]):
+        double_record = True
+        return { "succeeded": succeeded, "double_record": double_record }
+
+      shop_log.warning("resuming message: shop_id: {} - message_id: {} - transactions committed: {} of {}", shop_id, message_id, first_chunk, len(chunks))
+
+    for chunk_number in range(first_chunk, len(chunks)):
+
+      # claim_failed: another invocation with the same message committed this chunk in the meantime
+
+      response = write_chunk(name_prefix, shop_id, message_id, time_to_live, chunks, chunk_number, sales_per_record_type)
+      if (response["claim_failed"]):
+        return { "succeeded": succeeded, "double_record": double_record }
+
+    succeeded = True
+
+  except ClientError as e:
+
+    shop_log.error("{} - {} - CancellationReasons: {}", shop_id, e, e.response.get("CancellationReasons", []))
+
+  return { "succeeded": succeeded, "double_record": double_record }
+
+# update_dynamodb_transaction
+# ---------------------------
+# Claims the message_id and updates all sales lines in one round trip, see write_basket
+
+@shop_xray.capture("update_dynamodb_transaction")
+def update_dynamodb_transaction(shop_id, message_id, sales):
+
+  shop_xray.annotate("update_dynamodb_transaction", shop_id = shop_id, message_id = message_id, sales_lines = len(sales))
+
+  name_prefix           = os.environ['name_prefix']
+
+  response              = get_sales_per_record_type(shop_id, sales)
+  sales_per_record_type = response["sales_per_record_type"]
+
+  if (response["valid"] == False):
+    return { "succeeded": False, "double_record": False }
+
+  response              = get_time_to_live()
+  time_to_live          = str(response["time_to_live"])
+
+  response              = write_basket(name_prefix, shop_id, message_id, time_to_live, sales_per_record_type)
+
+  return { "succeeded": response["succeeded"], "double_record": response["double_record"] }
+
+# get_message_from_sqs_record
+# ---------------------------
+# The SQS subscription uses raw message delivery: the body of the SQS record is the message 
+# that shop_decrypt sent to the to_shop_update_db topic. 
+
+def get_message_from_sqs_record(record):
+
+  event    = { "Records": [ { "Sns": { "Message": record["body"] } } ] }
+  response = get_fields_from_event(event)
+
+  return response
+
+# get_batch_messages
+# ------------------
+# Returns the messages that should be processed, in the order of the batch. Messages that will 
+# never succeed (invalid, not sent today, double within the batch, incorrect sales) are logged 
+# and left out: they are not retried.
+
+def get_batch_messages(records):
+
+  messages     = []
+  message_keys = set()
+
+  for record in records:
+
+    # shop_event raises KeyError or ValueError, a message_id or body of the wrong type can also 
+    # give IndexError, TypeError or AttributeError: only this message is left out, not the batch
+
+    try:
+      response      = get_message_from_sqs_record(record)
+      shop_id       = response["shop_id"]
+      message_id    = response["message_id"]
+      is_sent_today = message_is_sent_today(message_id)["is_sent_today"]
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+      shop_log.error("in get_batch_messages: invalid message {} - {}", record["messageId"], repr(e))
+      continue
+
+    if (is_sent_today == False):
+      shop_log.warning("message not sent today or incorrect message_id: {}", record["body"])
+      continue
+
+    if ((shop_id, message_id) in message_keys):
+      shop_log.warning("message sent twice: {}", record["body"])
+      shop_metrics.add(shop_id, "duplicates", 1)
+      continue
+
+    message_keys.add((shop_id, message_id))
+    shop_metrics.add(shop_id, "sales_lines", len(response["sales"]))
+
+    response = get_sales_per_record_type(shop_id, response["sales"])
+    if (response["valid"] == False):
+      continue
+
+    messages.append({ "item_identifier"       : record["messageId"],
+                      "shop_id"               : shop_id, 
+                      "message_id"            : message_id, 
+                      "sales_per_record_type" : response["sales_per_record_type"] })
+
+  return { "messages": messages }
+
+# add_to_deltas
+# -------------
+
+def add_to_deltas(deltas, shop_id, sales_per_record_type):
+
+  for record_type, sales_item in sales_per_record_type.items():
+
+    key = (shop_id, record_type)
+
+    if (key in deltas):
+      current = deltas[key]
+      current["gross_number"]   = str(Decimal(current["gross_number"])   + Decimal(sales_item["gross_number"]))
+      current["gross_turnover"] = str(Decimal(current["gross_turnover"]) + Decimal(sales_item["gross_turnover"]))
+    else:
+      deltas[key] = { "item_no": sales_item["item_no"], "gross_number": sales_item["gross_number"], "gross_turnover": sales_item["gross_turnover"] }
+
+  return
+
+# get_transaction_batches
+# -----------------------
+# Splits the messages of an SQS batch in groups that fit in one transaction: one claim per message
+# and one update per (shop_id, record_type) of the group. A message with more different items than
+# fit in one transaction is written on its own, by write_basket.
+
+def get_transaction_batches(messages):
+
+  batches        = [[]]
+  batch_keys     = set()
+  large_messages = []
+
+  for message in messages:
+
+    keys = { (message["shop_id"], record_type) for record_type in message["sales_per_record_type"] }
+
+    if (len(keys) + 1 > MAX_TRANSACTION_ITEMS):
+      large_messages.append(message)
+      continue
+
+    if (len(batches[-1]) + 1 + len(batch_keys | keys) > MAX_TRANSACTION_ITEMS):
+      batches.append([])
+      batch_keys = set()
+
+    batches[-1].append(message)
+    batch_keys |= keys
+
+  return { "batches": [batch for batch in batches if batch != []], "large_messages": large_messages }
+
+# write_batch
+# -----------
+# Claims the message_ids of the messages and updates the records with the sum of their sales in
+# one transaction: either all messages are written, or none. When the transaction is cancelled,
+# the cancellation reasons tell which action failed:
+# - a claim that already exists: that message is a duplicate, the transaction is done again 
+#   without it
+# - an update that failed (f.e. an item_no that doesn't exist, or a conflict with another 
+#   transaction on the same record): the messages with sales for that record fail, the
+#   transaction is done again without them
+# - a stock that would become negative (see get_update_action): the transaction is done again 
+#   without the condition for those records. The condition also fails for a record that doesn't
+#   exist, that record is handled like a failed update.
+# - an error without reasons (f.e. throttling or a table that doesn't exist): nothing is written,
+#   all messages fail
+# SQS retries the messages that failed, nothing of them is in the database.
+#
+# The ClientRequestToken makes the retries of the SDK idempotent. A redelivery of the same group 
+# of messages by SQS within 10 minutes gets the same token: when the first transaction was 
+# committed, DynamoDB returns success without writing again, so the messages are committed once.
+# The time of the transaction is divided over its actions for the line_update_ms metric.
+
+def write_batch(name_prefix, messages, time_to_live):
+
+  dynamodb       = shop_clients.get_client('dynamodb')
+  pending        = list(messages)
+  duplicates     = []
+  failed         = []
+  negative_stock = set()
+
+  while (pending != []):
+
+    deltas = {}
+    for message in pending:
+      add_to_deltas(deltas, message["shop_id"], message["sales_per_record_type"])
+
+    keys   = list(deltas)
+    chunk  = []
+
+    for message in pending:
+      response = get_claim_action(name_prefix, message["shop_id"], message["message_id"], time_to_live, 0, 1)
+      chunk.append(response["claim_action"])
+
+    for (shop_id, record_type) in keys:
+      shop_log.info("Update fields based on sales: shop_id: {} - record_type: {} - gross_number: {} - gross_turnover: {}", shop_id, record_type, deltas[(shop_id, record_type)]["gross_number"], deltas[(shop_id, record_type)]["gross_turnover"])
+      response = get_update_action(name_prefix, shop_id, record_type, deltas[(shop_id, record_type)], (shop_id, record_type) not in negative_stock)
+      chunk.append(response["update_action"])
+
+    # The transaction without stock conditions has other parameters, so another token
+
+    token = ",".join(message["shop_id"] + "-" + message["message_id"] for message in pending) + \
+            "".join(sorted("-unchecked-" + shop_id + "-" + record_type for (shop_id, record_type) in negative_stock))
+
+    try:
+
+      start    = shop_metrics.start_timer()
+      response = dynamodb.transact_write_items(
+        TransactItems      = chunk,
+        ClientRequestToken = str(uuid.uuid5(uuid.NAMESPACE_OID, token))
+      )
+
+      line_update_ms = (shop_metrics.start_timer() - start) * 1000 / len(chunk)
+      for (shop_id, record_type) in keys:
+        shop_metrics.add(shop_id, "line_update_ms", round(line_update_ms, 3))
+
+      shop_log.debug("Response of dynamodb.transact_write_items: {}", response)
+
+      return { "committed": pending, "duplicates": duplicates, "failed": failed }
+
+    except ClientError as e:
+
+      cancellation_reasons = e.response.get("CancellationReasons", [])
+      claim_reasons        = cancellation_reasons[:len(pending)]
+      update_reasons       = { keys[reason_number]: reason for reason_number, reason in enumerate(cancellation_reasons[len(pending):]) 
+                               if (reason.get("Code", "None") != "None") }
+
+      failed_claims        = [message for message, reason in zip(pending, claim_reasons) if (reason.get("Code") == "ConditionalCheckFailed")]
+      failed_stock_checks  = { key: reason for key, reason in update_reasons.items() if ((reason["Code"] == "ConditionalCheckFailed") and ("Item" in reason)) }
+      failed_keys          = { key for key in update_reasons if (key not in failed_stock_checks) }
+      failed_updates       = [message for message in pending if any((message["shop_id"], record_type) in failed_keys for record_type in message["sales_per_record_type"])]
+
+      if (failed_claims != []):
+
+        for message in failed_claims:
+          shop_log.warning("message sent twice: shop_id: {}, message_id: {}", message["shop_id"], message["message_id"])
+          shop_metrics.add(message["shop_id"], "duplicates", 1)
+
+        duplicates += failed_claims
+        pending     = [message for message in pending if (message not in failed_claims)]
+
+      elif (failed_updates != []):
+
+        for message in failed_updates:
+          shop_log.error("message failed, it will be retried: shop_id: {}, message_id: {} - CancellationReasons: {}", message["shop_id"], message["message_id"],
+                         { record_type: update_reasons[(message["shop_id"], record_type)] for record_type in message["sales_per_record_type"] if ((message["shop_id"], record_type) in failed_keys) })
+
+        failed  += failed_updates
+        pending  = [message for message in pending if (message not in failed_updates)]
+
+      elif (failed_stock_checks != {}):
+
+        for (shop_id, record_type) in failed_stock_checks:
+          shop_log.warning("stock is negative for item_no = {}", deltas[(shop_id, record_type)]["item_no"])
+          shop_metrics.add(shop_id, "negative_stock", 1)
+
+        negative_stock |= set(failed_stock_checks)
+
+      else:
+
+        shop_log.error("transaction of {} messages failed, they will be retried: {} - CancellationReasons: {}", len(pending), e, cancellation_reasons)
+        return { "committed": [], "duplicates": duplicates, "failed": failed + pending }
+
+  return { "committed": [], "duplicates": duplicates, "failed": failed }
+
+# log_end_to_end_latency
+# ----------------------
+# The time between the creation of the message_id by the sender and the moment the sales are
+# in the database. perftest_get_stats uses these lines to compare the split and the fused mode.
+# Only useful when the sender uses the same clock as Lambda (UTC), f.e. perftest_test. The
+# update_db_committed TRACE line is written here as well.
+
+def log_end_to_end_latency(shop_id, message_id):
+
+  shop_log.trace("update_db_committed", shop_id, message_id)
+
+  response = shop_message_id.get_datetime_from_message_id(message_id)
+
+  if (response["datetime"] != None):
+
+    latency_ms = (datetime.datetime.now() - response["datetime"]).total_seconds() * 1000
+
+    if (latency_ms >= 0):
+      shop_log.info("end_to_end: message_id: {}, latency_ms: {}", message_id, format(latency_ms, ".0f"))
+
+  return
+
+# update_sales
+# ------------
+# Processes the sales of one message. Used by lambda_handler and by the fused shop_decrypt_update_db 
+# function. The event is only used for the log.
+
+def update_sales(shop_id, message_id, sales, event):
+
+  succeeded         = False
 
   response          = message_is_sent_today(message_id)
   is_sent_today     = response["is_sent_today"]
 
+  response          = get_update_mode()
+  update_mode       = response["update_mode"]
+
   if (is_sent_today == True):
 
-    response          = is_double_record(shop_id, message_id)
-    double_record     = response["double_record"]
+    shop_metrics.add(shop_id, "sales_lines", len(sales))
+
+    if (update_mode == "transaction"):
 
-    if (double_record == False):
-      response          = update_dynamodb(shop_id, decrypted_content["sales"])
+      response          = update_dynamodb_transaction(shop_id, message_id, sales)
+      double_record     = response["double_record"]
       succeeded         = response["succeeded"]
+
     else:
-      print("WARNING: message sent twice: " + json.dumps(event))
+
+      response          = is_double_record(shop_id, message_id)
+      double_record     = response["double_record"]
+
+      if (double_record == False):
+        response          = update_dynamodb(shop_id, sales)
+        succeeded         = response["succeeded"]
+
+    if (double_record == True):
+      shop_log.warning("message sent twice: {}", event)
+      shop_metrics.add(shop_id, "duplicates", 1)
       succeeded         = False
 
   else:
-    print("WARNING: message not sent today or incorrect message_id: " + json.dumps(event))
+    shop_log.warning("message not sent today or incorrect message_id: {}", event)
+
+  if (succeeded):
+    log_end_to_end_latency(shop_id, message_id)
+
+  return { "succeeded": succeeded }
+
+# Main functions
+# ==============
+
+@shop_profile.profiled
+def lambda_handler(event, context):
+
+  shop_coldstart.start_request()
+  shop_log.start_request()
+  shop_metrics.start_request()
+  shop_log.debug("BEGIN: event: {}", event)
+
+  response          = get_fields_from_event(event)
+  shop_id           = response["shop_id"]
+  message_id        = response["message_id"]
+  sales             = response["sales"]
+
+  response          = update_sales(shop_id, message_id, sales, event)
+  succeeded         = response["succeeded"]
+
+  # The event is in the BEGIN line, see the DONE line of shop_decrypt
+
+  shop_log.debug("DONE: shop_id: {}, message_id: {}, succeeded: {}, context.get_remaining_time_in_millis(): {}, context.memory_limit_in_mb: {}, client_construction: {}",
+                 shop_id, message_id, succeeded, context.get_remaining_time_in_millis, context.memory_limit_in_mb, shop_clients.get_construction_stats)
+
+  shop_metrics.flush()
+
+
+# sqs_lambda_handler
+# ------------------
+# Messages that were not written because of an error are reported back to SQS 
+# (ReportBatchItemFailures): nothing of them is in the database, so they can safely be retried.
+
+@shop_profile.profiled
+def sqs_lambda_handler(event, context):
+
+  shop_coldstart.start_request()
+  shop_log.start_request()
+  shop_metrics.start_request()
+  shop_log.debug("BEGIN: event: {}", event)
+
+  name_prefix        = os.environ['name_prefix']
+  records            = event.get("Records", [])
+  committed_messages = []
+  failed_messages    = []
+  duplicates         = 0
+
+  response           = get_batch_messages(records)
+  messages           = response["messages"]
+
+  response           = get_time_to_live()
+  time_to_live       = str(response["time_to_live"])
+
+  response           = get_transaction_batches(messages)
+  batches            = response["batches"]
+  large_messages     = response["large_messages"]
+
+  for batch in batches:
+    response            = write_batch(name_prefix, batch, time_to_live)
+    committed_messages += response["committed"]
+    failed_messages    += response["failed"]
+    duplicates         += len(response["duplicates"])
+
+  for message in large_messages:
+
+    response = write_basket(name_prefix, message["shop_id"], message["message_id"], time_to_live, message["sales_per_record_type"])
+
+    if (response["succeeded"]):
+      committed_messages.append(message)
+    elif (response["double_record"]):
+      shop_log.warning("message sent twice: shop_id: {}, message_id: {}", message["shop_id"], message["message_id"])
+      shop_metrics.add(message["shop_id"], "duplicates", 1)
+      duplicates += 1
+    else:
+      failed_messages.append(message)
+
+  # Only messages of which the sales are in the database are committed: the others are counted
+  # as never committed by perftest_get_stats
+
+  for message in committed_messages:
+    log_end_to_end_latency(message["shop_id"], message["message_id"])
+
+  failed_identifiers = [message["item_identifier"] for message in failed_messages]
+
+  shop_log.debug("DONE: records: {}, messages: {}, duplicates: {}, committed: {}, transactions: {}, failed: {}, context.get_remaining_time_in_millis(): {}, context.memory_limit_in_mb: {}, client_construction: {}",
+                 len(records), len(messages), duplicates, len(committed_messages), len(batches), failed_identifiers,
+                 context.get_remaining_time_in_millis, context.memory_limit_in_mb, shop_clients.get_construction_stats)
 
-  print("DEBUG: DONE: event: " + json.dumps(event) + \
-            ", shop_id: " + shop_id + \
-            ", succeeded: " + str(succeeded) + \
-            ", context.get_remaining_time_in_millis(): " + str(context.get_remaining_time_in_millis()) + \
-            ", context.memory_limit_in_mb: " + str(context.memory_limit_in_mb))
+  shop_metrics.flush()
 
+  return { "batchItemFailures": [ { "itemIdentifier": identifier } for identifier in failed_identifiers ] }
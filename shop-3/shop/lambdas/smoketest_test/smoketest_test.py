@@ -4,7 +4,8 @@ import requests
 import json
 import base64
 import os
-import datetime
+
+from shop_message_id import get_message_id
 
 NUMBER_OF_REQUESTS = 1
 
@@ -19,28 +20,6 @@ def get_parameters():
 
   return {"shop_id": shop_id, "key_alias": key_alias, "url": url}
 
-# get_message_id
-# --------------
-
-def get_message_id():
-
-  datetime_object = datetime.datetime.now()
-  print("DEBUG: time: " + str(datetime_object))
-
-  year  = datetime_object.year
-  month = datetime_object.month
-  day   = datetime_object.day
-  
-  hour  = datetime_object.hour
-  min   = datetime_object.min
-  sec   = datetime_object.second
-  msec  = datetime_object.microsecond
-
-  format_string = "{msec:06}{sec:02}{min:02}{hour:02}-{year:04}{month:02}{day:02}"
-  message_id    = format_string.format(msec = msec, sec = sec, min = min, hour = hour, year = year, month = month, day = day)
-
-  return { "message_id": message_id }
-
 # encrypt_sales
 # -------------
 
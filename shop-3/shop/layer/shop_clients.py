@@ -0,0 +1,132 @@
+# shop_clients.py
+# ---------------
+# Shared by the shop Lambda functions (deployed as the shop layer). The boto3 clients are
+# created the first time they are asked for and are kept at module level, so warm
+# invocations of the same container reuse both the client and its (kept alive) HTTPS
+# connections: only the first invocation pays for creating the client and the TLS
+# handshake.
+
+import os
+import time
+import threading
+
+import boto3
+
+from botocore.config import Config
+
+# CLIENT_SETTINGS
+# ---------------
+# Settings per service. The defaults of botocore (60 seconds read timeout, legacy retries)
+# are way too long for functions that have a timeout of 10 seconds: a hanging call should
+# be retried long before the function itself is aborted.
+#
+# The values can be overridden per service with environment variables, f.e.
+# client_read_timeout_kms = 5
+
+DEFAULT_CLIENT_SETTINGS = {"max_pool_connections": 10, "connect_timeout": 1, "read_timeout": 3, "max_attempts": 3}
+
+CLIENT_SETTINGS = {
+  "kms"      : {"max_pool_connections": 10, "connect_timeout": 1, "read_timeout": 2, "max_attempts": 3},
+  "sns"      : {"max_pool_connections": 10, "connect_timeout": 1, "read_timeout": 2, "max_attempts": 3},
+  "dynamodb" : {"max_pool_connections": 10, "connect_timeout": 1, "read_timeout": 2, "max_attempts": 5}
+}
+
+_session            = None
+_clients            = {}
+_lock               = threading.Lock()
+_construction_stats = {"clients_created": 0, "construction_ms": 0.0}
+
+# get_client_settings
+# -------------------
+# A value of an environment variable that can't be converted to the type of the setting
+# (f.e. "0.5" for max_attempts) is ignored with a warning: the client is created with the
+# default, instead of failing every invocation of the container.
+
+def get_client_settings(service_name):
+
+  settings = dict(CLIENT_SETTINGS.get(service_name, DEFAULT_CLIENT_SETTINGS))
+
+  for setting, default in settings.items():
+
+    name  = "client_" + setting + "_" + service_name
+    value = os.environ.get(name)
+
+    if (value != None):
+      try:
+        settings[setting] = type(default)(value)
+      except ValueError:
+        print("WARNING: " + name + " = " + value + " is not a valid " + type(default).__name__ + ", using the default " + str(default))
+
+  return settings
+
+# get_client_config
+# -----------------
+
+def get_client_config(service_name):
+
+  settings = get_client_settings(service_name)
+
+  config = Config(
+    max_pool_connections = settings["max_pool_connections"],
+    connect_timeout      = settings["connect_timeout"],
+    read_timeout         = settings["read_timeout"],
+    retries              = {"max_attempts": settings["max_attempts"], "mode": "standard"},
+    tcp_keepalive        = True
+  )
+
+  return config
+
+# get_client
+# ----------
+# Returns the client for service_name, creates it when it doesn't exist yet in this
+# container. Clients are thread safe, the creation of them is not: that's why the
+# lock is used (the decrypt function uses threads when it processes a batch).
+
+def get_client(service_name):
+
+  global _session
+
+  client = _clients.get(service_name)
+
+  if (client == None):
+
+    with _lock:
+
+      client = _clients.get(service_name)
+
+      if (client == None):
+
+        start_time = time.perf_counter()
+
+        if (_session == None):
+          _session = boto3.session.Session()
+
+        client = _session.client(service_name, config = get_client_config(service_name))
+        _clients[service_name] = client
+
+        _construction_stats["clients_created"] += 1
+        _construction_stats["construction_ms"] += (time.perf_counter() - start_time) * 1000
+
+  return client
+
+# set_client
+# ----------
+# Replaces the client for service_name, f.e. by an in-memory stand-in in a local benchmark
+# (see client/benchmark_handlers.py). Not used by the Lambda functions themselves.
+
+def set_client(service_name, client):
+
+  with _lock:
+    _clients[service_name] = client
+
+  return
+
+# get_construction_stats
+# ----------------------
+# Number of clients that were created in this container and the total time that was
+# needed to create them. On warm invocations, these numbers don't change anymore.
+
+def get_construction_stats():
+
+  return { "clients_created": _construction_stats["clients_created"],
+           "construction_ms": round(_construction_stats["construction_ms"], 2) }
@@ -0,0 +1,41 @@
+# shop_coldstart.py
+# -----------------
+# Cold starts of the shop Lambda functions. Import this module before the other modules in the
+# function (aws_xray_sdk, boto3 and the shop layer), so the time of their imports is included:
+#
+#   import shop_coldstart
+#   ...
+#   def lambda_handler(event, context):
+#     shop_coldstart.start_request()
+#
+# start_request writes "INFO: cold start:" on the first invocation of a container, with the time
+# between the import of this module and the first invocation (most of the Init Duration).
+#
+# The import time per module isn't measured here. With import_profile_shop = 1 in terraform_shop.tf
+# the functions get the environment variable PYTHONPROFILEIMPORTTIME = 1: python itself then writes
+# the lines of python -X importtime ("import time: self [us] | cumulative | imported package") to
+# stderr, which is in the CloudWatch log as well. This costs nothing when it is off.
+#
+# This module is part of the shop layer.
+
+import time
+
+_loaded_at        = time.perf_counter()
+_first_invocation = True
+
+# start_request
+# -------------
+# cold_start is True on the first invocation of the container
+
+def start_request():
+
+  global _first_invocation
+
+  if (not _first_invocation):
+    return { "cold_start": False }
+
+  _first_invocation = False
+
+  print("INFO: cold start: init_ms: " + format((time.perf_counter() - _loaded_at) * 1000, ".2f"))
+
+  return { "cold_start": True }
@@ -0,0 +1,238 @@
+# shop_event.py
+# -------------
+# Parses the SNS events of shop_decrypt and shop_update_db. The message in an SNS event is a
+# string with json, and the body (shop_decrypt) or decrypted_content (shop_update_db) in that
+# message is a string with json again. The old code parsed these strings more than once per
+# event (check_event_structure and get_fields_from_event), here they are parsed once.
+#
+# The parse functions don't raise exceptions for invalid messages, they return:
+# - succeeded : True when the message is valid
+# - message   : a ShopMessage object (None when the message is not valid)
+# - error     : text for the log
+# - exception : the exception (KeyError or ValueError) the caller can raise, f.e. to get
+#               the same errorType in the payload of the Lambda function as before
+#
+# This module is part of the shop layer.
+
+import json
+
+from decimal import Decimal
+
+# Schema
+# ------
+# The required fields are checked in this order, the error texts are the texts that
+# check_event_structure in shop_decrypt used.
+
+ENCRYPTED_MESSAGE_FIELDS = ("shop_id", "message_id", "content_base64")
+DECRYPTED_MESSAGE_FIELDS = ("shop_id", "message_id", "decrypted_content")
+
+# The values of a sales line are checked with the conversions the old code used for them (int
+# for item_no, float/Decimal for the numbers), so the same values are accepted: f.e. "1e3" or
+# " 5". NaN and Infinity are not accepted, DynamoDB can't store them.
+
+SALES_LINE_SCHEMA        = (("item_no",        int),
+                            ("gross_number",   Decimal),
+                            ("gross_turnover", Decimal))
+
+# ShopMessage
+# -----------
+# Fields that are not used for the type of message are None:
+# - encrypted messages (shop_decrypt)  : content_base64, encrypted_key_base64 (envelope format only)
+# - decrypted messages (shop_update_db): sales
+# message is the original Message string from the event, it can be logged without json.dumps.
+
+class ShopMessage:
+
+  __slots__ = ("shop_id", "message_id", "content_base64", "encrypted_key_base64", "sales", "message")
+
+  def __init__(self, shop_id, message_id, message, content_base64 = None, encrypted_key_base64 = None, sales = None):
+
+    self.shop_id              = shop_id
+    self.message_id           = message_id
+    self.message              = message
+    self.content_base64       = content_base64
+    self.encrypted_key_base64 = encrypted_key_base64
+    self.sales                = sales
+
+# invalid
+# -------
+
+def invalid(error, exception):
+
+  return { "succeeded": False, "message": None, "error": error, "exception": exception }
+
+# get_sns_message
+# ---------------
+# Returns the Message string of the first (and only) record of an SNS event
+
+def get_sns_message(event):
+
+  if ('Records' not in event):
+    error = "no element Records in event - use SNS type of json to test accept or decrypt functions"
+    return { "succeeded": False, "sns_message": None, "error": error, "exception": KeyError("Records") }
+
+  try:
+    sns_message = event["Records"][0]["Sns"]["Message"]
+  except (KeyError, IndexError, TypeError) as e:
+    return { "succeeded": False, "sns_message": None, "error": "no Records[0].Sns.Message in event, " + repr(e), "exception": e }
+
+  return { "succeeded": True, "sns_message": sns_message, "error": "", "exception": None }
+
+# load_json
+# ---------
+# Values that are already decoded (f.e. in test events) are returned as they are
+
+def load_json(value, name):
+
+  if (not isinstance(value, str)):
+    return { "succeeded": True, "value": value, "error": "", "exception": None }
+
+  try:
+    return { "succeeded": True, "value": json.loads(value), "error": "", "exception": None }
+  except ValueError as e:
+    return { "succeeded": False, "value": None, "error": "no valid json in " + name + ", " + repr(e), "exception": e }
+
+# find_missing_field
+# ------------------
+
+def find_missing_field(dictionary, fields):
+
+  if (not isinstance(dictionary, dict)):
+    return { "missing_field": fields[0] }
+
+  for field in fields:
+    if (field not in dictionary):
+      return { "missing_field": field }
+
+  return { "missing_field": None }
+
+# validate_sales
+# --------------
+# Returns a copy of the sales lines with all values as strings (the format DynamoDB expects
+# for numbers).
+
+def validate_sales(sales):
+
+  if (not isinstance(sales, list)):
+    return { "succeeded": False, "sales": None, "error": "sales is not a list", "exception": ValueError("sales is not a list") }
+
+  validated_sales = []
+
+  for line_number, sales_line in enumerate(sales, start = 1):
+
+    if (not isinstance(sales_line, dict)):
+      error = "sales line " + str(line_number) + " is not an object"
+      return { "succeeded": False, "sales": None, "error": error, "exception": ValueError(error) }
+
+    validated_line = {}
+
+    for field, conversion in SALES_LINE_SCHEMA:
+
+      if (field not in sales_line):
+        error = "no " + field + " in sales line " + str(line_number)
+        return { "succeeded": False, "sales": None, "error": error, "exception": KeyError(field) }
+
+      value = str(sales_line[field]).strip()
+
+      try:
+        number = conversion(value)
+        valid  = (not isinstance(number, Decimal)) or number.is_finite()
+      except (ValueError, ArithmeticError):
+        valid = False
+
+      if (not valid):
+        error = "invalid " + field + " in sales line " + str(line_number) + ": " + repr(value)
+        return { "succeeded": False, "sales": None, "error": error, "exception": ValueError(error) }
+
+      validated_line[field] = value
+
+    validated_sales.append(validated_line)
+
+  return { "succeeded": True, "sales": validated_sales, "error": "", "exception": None }
+
+# parse_encrypted_event
+# ---------------------
+# Event of shop_decrypt: the message contains "body", a string with json with shop_id, message_id,
+# content_base64 and (envelope format) encrypted_key_base64.
+
+def parse_encrypted_event(event):
+
+  response = get_sns_message(event)
+  if (not response["succeeded"]):
+    return invalid(response["error"], response["exception"])
+
+  sns_message = response["sns_message"]
+
+  response    = load_json(sns_message, "message")
+  if (not response["succeeded"]):
+    return invalid(response["error"], response["exception"])
+
+  message     = response["value"]
+
+  if ((not isinstance(message, dict)) or ("body" not in message)):
+    return invalid("no body in message", KeyError("body"))
+
+  response    = load_json(message["body"], "body")
+  if (not response["succeeded"]):
+    return invalid(response["error"], response["exception"])
+
+  body        = response["value"]
+
+  response    = find_missing_field(body, ENCRYPTED_MESSAGE_FIELDS)
+  if (response["missing_field"] != None):
+    return invalid("no " + response["missing_field"] + " in body", KeyError(response["missing_field"]))
+
+  shop_message = ShopMessage(body["shop_id"], body["message_id"], sns_message,
+                             content_base64       = body["content_base64"],
+                             encrypted_key_base64 = body.get("encrypted_key_base64"))
+
+  return { "succeeded": True, "message": shop_message, "error": "", "exception": None }
+
+# parse_decrypted_message
+# -----------------------
+# Message with shop_id, message_id and decrypted_content, a string with json with the sales lines.
+# Used by parse_decrypted_event and by the fused shop_decrypt_update_db function, that gets the 
+# message directly from the decrypt step.
+
+def parse_decrypted_message(message, sns_message = None):
+
+  response    = find_missing_field(message, DECRYPTED_MESSAGE_FIELDS)
+  if (response["missing_field"] != None):
+    return invalid("no " + response["missing_field"] + " in message", KeyError(response["missing_field"]))
+
+  response    = load_json(message["decrypted_content"], "decrypted_content")
+  if (not response["succeeded"]):
+    return invalid(response["error"], response["exception"])
+
+  decrypted_content = response["value"]
+
+  if ((not isinstance(decrypted_content, dict)) or ("sales" not in decrypted_content)):
+    return invalid("no sales in decrypted_content", KeyError("sales"))
+
+  response    = validate_sales(decrypted_content["sales"])
+  if (not response["succeeded"]):
+    return invalid(response["error"], response["exception"])
+
+  shop_message = ShopMessage(message["shop_id"], message["message_id"], sns_message, sales = response["sales"])
+
+  return { "succeeded": True, "message": shop_message, "error": "", "exception": None }
+
+# parse_decrypted_event
+# ---------------------
+# Event of shop_update_db: the SNS message is a decrypted message (see parse_decrypted_message).
+
+def parse_decrypted_event(event):
+
+  response = get_sns_message(event)
+  if (not response["succeeded"]):
+    return invalid(response["error"], response["exception"])
+
+  sns_message = response["sns_message"]
+
+  response    = load_json(sns_message, "message")
+  if (not response["succeeded"]):
+    return invalid(response["error"], response["exception"])
+
+  response    = parse_decrypted_message(response["value"], sns_message)
+
+  return response
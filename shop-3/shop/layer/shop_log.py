@@ -0,0 +1,128 @@
+# shop_log.py
+# -----------
+# Leveled logging for the shop Lambda functions. The lines have the same format as the print
+# statements that were used before ("DEBUG: ...", "INFO: ...", ...): the unittests, the
+# subscription filter on "DEBUG: BEGIN: event:" and the Logs Insights queries depend on that.
+#
+# Environment variables:
+# - log_level       : DEBUG, INFO (default), WARNING or ERROR
+# - log_sample_rate : fraction of the requests that is logged at DEBUG level anyway, f.e. 0.01
+# - test_mode       : 1 = always log at DEBUG level (the unittest_object_under_test functions)
+# - trace_enabled   : 1 (default) = write TRACE lines, see trace
+#
+# Formatting is lazy: the arguments are only converted to text when the line is written. Dicts
+# and lists are converted with json.dumps, functions are called. So
+#
+#   shop_log.debug("Response of sns.publish: {}", response)
+#
+# doesn't cost a json.dumps when DEBUG is off.
+#
+# This module is part of the shop layer.
+
+import os
+import json
+import time
+import random
+
+DEBUG   = 10
+INFO    = 20
+WARNING = 30
+ERROR   = 40
+
+LEVELS          = { "DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR }
+LEVEL_NAMES     = { DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR" }
+
+LOG_LEVEL       = LEVELS.get(os.environ.get('log_level', 'INFO').upper(), INFO)
+LOG_SAMPLE_RATE = float(os.environ.get('log_sample_rate', '0'))
+TEST_MODE       = (os.environ.get('test_mode', '0') == '1')
+TRACE_ENABLED   = (os.environ.get('trace_enabled', '1') == '1')
+
+# Level of the current request, see start_request
+
+_request_level  = DEBUG if TEST_MODE else LOG_LEVEL
+
+# start_request
+# -------------
+# Call at the start of every invocation: decides whether this request is sampled (logged at
+# DEBUG level). All lines of one request are sampled together.
+
+def start_request():
+
+  global _request_level
+
+  if (TEST_MODE or (random.random() < LOG_SAMPLE_RATE)):
+    _request_level = DEBUG
+  else:
+    _request_level = LOG_LEVEL
+
+  return { "level": LEVEL_NAMES.get(_request_level, str(_request_level)) }
+
+# is_enabled
+# ----------
+# For code that does extra work only for the log
+
+def is_enabled(level):
+
+  return (level >= _request_level)
+
+# to_text
+# -------
+
+def to_text(argument):
+
+  if isinstance(argument, str):
+    return argument
+
+  if isinstance(argument, (dict, list)):
+    return json.dumps(argument, default = str)
+
+  if callable(argument):
+    return to_text(argument())
+
+  return str(argument)
+
+# write
+# -----
+
+def write(level, message, arguments):
+
+  if (level < _request_level):
+    return
+
+  if (arguments):
+    message = message.format(*[to_text(argument) for argument in arguments])
+
+  print(LEVEL_NAMES[level] + ": " + message)
+
+  return
+
+# Logging functions
+# -----------------
+
+def debug(message, *arguments):
+  write(DEBUG, message, arguments)
+
+def info(message, *arguments):
+  write(INFO, message, arguments)
+
+def warning(message, *arguments):
+  write(WARNING, message, arguments)
+
+def error(message, *arguments):
+  write(ERROR, message, arguments)
+
+# trace
+# -----
+# Every stage of the pipeline writes the moment a message arrives and leaves, keyed by message_id.
+# perftest_get_stats joins these lines of all log groups to get the queueing delay, the time per
+# hop and the total time from shop_accept to the commit in the database. TRACE lines don't depend
+# on the log level. Stages:
+# accept_received, accept_published, decrypt_received, decrypt_published, update_db_received, 
+# update_db_committed
+
+def trace(stage, shop_id, message_id):
+
+  if (TRACE_ENABLED):
+    print("TRACE: stage: " + stage + ", shop_id: " + str(shop_id) + ", message_id: " + str(message_id) + ", timestamp_ms: " + str(int(time.time() * 1000)))
+
+  return
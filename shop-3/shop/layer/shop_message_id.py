@@ -0,0 +1,101 @@
+# shop_message_id.py
+# ------------------
+# Creates message_ids for the messages that are sent to the shop. The old message_ids were
+# only based on the clock ({usec}{sec}{min}{hour}-{YYYYMMDD}): two messages that are created
+# in the same microsecond (or by two processes at the same time) got the same message_id,
+# and shop_update_db drops the second message as a duplicate.
+#
+# Format: {usec:06}{sec:02}{min:02}{hour:02}_{node}_{counter}-{YYYYMMDD}
+#
+# - node    : random per process (Lambda containers all have the same pid, so the pid alone
+#             is not enough), combined with the pid
+# - counter : increases for every message_id of this process, also when the clock is
+#             set back
+#
+# The part after the (only) "-" is still the date: get_date_from_message_id in shop_update_db
+# depends on that.
+#
+# This module is part of the shop layer, the clients import it from ../shop/layer.
+
+import os
+import datetime
+import threading
+
+NODE_ID  = "{random:08x}{pid:05x}".format(random = int.from_bytes(os.urandom(4), "big"), pid = os.getpid() % 0x100000)
+
+_counter = 0
+_lock    = threading.Lock()
+
+# format_message_id
+# -----------------
+
+def format_message_id(datetime_object, counter):
+
+  format_string = "{usec:06}{sec:02}{min:02}{hour:02}_{node}_{counter}-{year:04}{month:02}{day:02}"
+  message_id    = format_string.format(usec    = datetime_object.microsecond,
+                                       sec     = datetime_object.second,
+                                       min     = datetime_object.minute,
+                                       hour    = datetime_object.hour,
+                                       node    = NODE_ID,
+                                       counter = counter,
+                                       year    = datetime_object.year,
+                                       month   = datetime_object.month,
+                                       day     = datetime_object.day)
+
+  return { "message_id": message_id }
+
+# reserve
+# -------
+# Returns number_of_ids message_ids at once (one lock, one call to the clock), for senders
+# that send their messages in batches.
+
+def reserve(number_of_ids):
+
+  global _counter
+
+  with _lock:
+    first_counter = _counter + 1
+    _counter     += number_of_ids
+
+  datetime_object = datetime.datetime.now()
+  message_ids     = [format_message_id(datetime_object, counter)["message_id"] for counter in range(first_counter, first_counter + number_of_ids)]
+
+  return { "message_ids": message_ids }
+
+# get_message_id
+# --------------
+# Thread safe, can be used instead of the get_message_id functions in the clients.
+
+def get_message_id():
+
+  response   = reserve(1)
+  message_id = response["message_ids"][0]
+
+  return { "message_id": message_id }
+
+# get_datetime_from_message_id
+# ----------------------------
+# Returns the moment the message_id was created (local time of the sender: UTC for senders 
+# that run in Lambda), or None when the message_id doesn't have the expected format. Works 
+# for both the old and the new format, they start and end in the same way.
+
+def get_datetime_from_message_id(message_id):
+
+  try:
+
+    time_part = message_id[0:12]
+    date_part = message_id[message_id.rindex("-") + 1:]
+
+    datetime_object = datetime.datetime(year        = int(date_part[0:4]),
+                                        month       = int(date_part[4:6]),
+                                        day         = int(date_part[6:8]),
+                                        hour        = int(time_part[10:12]),
+                                        minute      = int(time_part[8:10]),
+                                        second      = int(time_part[6:8]),
+                                        microsecond = int(time_part[0:6]))
+
+  except ValueError:
+
+    datetime_object = None
+
+  return { "datetime": datetime_object }
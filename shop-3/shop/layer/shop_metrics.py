@@ -0,0 +1,145 @@
+# shop_metrics.py
+# ---------------
+# Stage timings and counters of the shop Lambda functions in CloudWatch Embedded Metric Format
+# (EMF). The metrics are written as json lines to the log: CloudWatch extracts them, there are no
+# extra API calls (put_metric_data) and no extra time in the request.
+#
+# Usage:
+#
+#   shop_metrics.start_request()                      # at the start of the handler
+#   start = shop_metrics.start_timer()
+#   response = kms.decrypt(...)
+#   shop_metrics.add_timing(shop_id, "kms_decrypt_ms", start)
+#   shop_metrics.add(shop_id, "duplicates", 1)
+#   shop_metrics.flush()                              # at the end of the handler
+#
+# flush writes one line per shop_id, the dimensions are the name of the function and the shop_id.
+# The values of one request are written as a list, CloudWatch computes the percentiles.
+#
+# Environment variables:
+# - metrics_enabled   : 1 (default) or 0
+# - metrics_namespace : namespace of the metrics, default "shop"
+#
+# This module is part of the shop layer.
+
+import os
+import json
+import time
+import threading
+
+METRICS_ENABLED   = (os.environ.get('metrics_enabled', '1') == '1')
+METRICS_NAMESPACE = os.environ.get('metrics_namespace', 'shop')
+FUNCTION_NAME     = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+
+# EMF accepts at most 100 values per metric in one line
+
+MAX_VALUES        = 100
+
+UNITS = { "kms_decrypt_ms"      : "Milliseconds",
+          "sns_publish_ms"      : "Milliseconds",
+          "dedupe_put_ms"       : "Milliseconds",
+          "line_update_ms"      : "Milliseconds",
+          "sales_lines"         : "Count",
+          "duplicates"          : "Count",
+          "negative_stock"      : "Count" }
+
+# Values of the current request: { shop_id: { metric_name: [values] } }. shop_decrypt adds values
+# from more than one thread in the batch mode.
+
+_values      = {}
+_values_lock = threading.Lock()
+
+# start_request
+# -------------
+
+def start_request():
+
+  global _values
+
+  with _values_lock:
+    _values = {}
+
+  return
+
+# start_timer
+# -----------
+
+def start_timer():
+
+  return time.perf_counter()
+
+# add
+# ---
+
+def add(shop_id, name, value):
+
+  if (not METRICS_ENABLED):
+    return
+
+  with _values_lock:
+    _values.setdefault(shop_id, {}).setdefault(name, []).append(value)
+
+  return
+
+# add_timing
+# ----------
+# Adds the number of milliseconds since start (see start_timer)
+
+def add_timing(shop_id, name, start):
+
+  add(shop_id, name, round((time.perf_counter() - start) * 1000, 3))
+
+  return
+
+# get_records
+# -----------
+# Returns the EMF records for the values of the current request. A metric with more than
+# MAX_VALUES values is spread over more records.
+
+def get_records():
+
+  records   = []
+  timestamp = int(time.time() * 1000)
+
+  with _values_lock:
+    values_per_shop = _values.copy()
+
+  for shop_id, metrics in values_per_shop.items():
+
+    number_of_values = max(len(values) for values in metrics.values())
+
+    for start in range(0, number_of_values, MAX_VALUES):
+
+      record = { "function": FUNCTION_NAME, "shop_id": shop_id }
+      names  = []
+
+      for name, values in metrics.items():
+        if (len(values) > start):
+          record[name] = values[start : start + MAX_VALUES]
+          names.append(name)
+
+      record["_aws"] = { "Timestamp"         : timestamp,
+                         "CloudWatchMetrics" : [ { "Namespace"  : METRICS_NAMESPACE,
+                                                   "Dimensions" : [ [ "function", "shop_id" ] ],
+                                                   "Metrics"    : [ { "Name": name, "Unit": UNITS.get(name, "None") } for name in names ] } ] }
+
+      records.append(record)
+
+  return { "records": records }
+
+# flush
+# -----
+
+def flush():
+
+  if (not METRICS_ENABLED):
+    return
+
+  response = get_records()
+
+  for record in response["records"]:
+    print(json.dumps(record))
+
+  start_request()
+
+  return
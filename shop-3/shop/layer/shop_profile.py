@@ -0,0 +1,232 @@
+# shop_profile.py
+# ---------------
+# Opt-in sampling profiler for the shop Lambda functions. 1 in N invocations is profiled: a thread
+# looks at the stacks of all threads (the handler and the threads it starts, f.e. the decrypt 
+# threads of shop_decrypt) every PROFILE_INTERVAL seconds and counts the stacks. The counts of 
+# more invocations are kept in memory and written as one batch, in the collapsed stack format of
+# flame graphs ("module.function;module.function;... count"):
+#
+# - "log"               : one "PROFILE:" line with the gzipped, base64 encoded stacks (default)
+# - "s3://bucket/prefix": one object <prefix>/<function>/<timestamp>-<request_id>.collapsed.gz
+#
+# client/profile_merge.py merges the batches into one file for flamegraph.pl or speedscope.
+#
+# Usage:
+#
+#   @shop_profile.profiled
+#   def lambda_handler(event, context):
+#
+# Without profile_rate the handler is not changed at all, so there is no overhead.
+#
+# Environment variables:
+# - profile_rate          : fraction of the invocations that is profiled, f.e. 0.01. Default 0 (off)
+# - profile_interval_ms   : time between two samples, default 1
+# - profile_flush_every   : number of profiled invocations per batch, default 10
+# - profile_flush_seconds : a batch is also written at the end of an invocation (profiled or not)
+#                           when it is older than this, default 300
+# - profile_location      : "log" (default) or "s3://bucket/prefix" (needs s3:PutObject, see 
+#                           profile_bucket in terraform_shop.tf)
+#
+# The stacks of the functions in this process are written to the log or S3: don't switch this on
+# when the names of functions are secret.
+#
+# This module is part of the shop layer.
+
+import os
+import sys
+import time
+import gzip
+import base64
+import random
+import datetime
+import threading
+import functools
+
+import shop_clients
+
+PROFILE_RATE          = float(os.environ.get('profile_rate', '0'))
+PROFILE_INTERVAL      = float(os.environ.get('profile_interval_ms', '1')) / 1000
+PROFILE_FLUSH_EVERY   = int(os.environ.get('profile_flush_every', '10'))
+PROFILE_FLUSH_SECONDS = float(os.environ.get('profile_flush_seconds', '300'))
+PROFILE_LOCATION      = os.environ.get('profile_location', 'log')
+FUNCTION_NAME         = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+
+PROFILE_PREFIX        = "PROFILE: "
+
+# Batch: { stack: count } of the profiled invocations that are not written yet
+
+_stacks         = {}
+_invocations    = 0
+_samples        = 0
+_batch_started  = None
+
+# get_stack
+# ---------
+# "module.function;module.function;..." from the outermost to the innermost frame. The frames of
+# the Lambda runtime, above the handler (root_code is the code of the wrapper), are left out.
+
+def get_stack(frame, root_code = None):
+
+  names = []
+
+  while ((frame != None) and (frame.f_code is not root_code)):
+    code = frame.f_code
+    names.append(os.path.splitext(os.path.basename(code.co_filename))[0] + "." + code.co_name)
+    frame = frame.f_back
+
+  names.reverse()
+
+  return { "stack": ";".join(names) }
+
+# Sampler
+# -------
+# Counts the stacks of the threads of the process, except its own, until stop is called. samples
+# is the number of times the threads were looked at.
+
+class Sampler(threading.Thread):
+
+  def __init__(self, interval, root_code = None):
+
+    threading.Thread.__init__(self, name = "shop_profile", daemon = True)
+
+    self.root_code = root_code
+    self.interval  = interval
+    self.stacks    = {}
+    self.samples   = 0
+    self.stopped   = threading.Event()
+
+  def run(self):
+
+    own_thread_id = threading.get_ident()
+
+    while (not self.stopped.wait(self.interval)):
+
+      for thread_id, frame in sys._current_frames().items():
+
+        if (thread_id != own_thread_id):
+          stack              = get_stack(frame, self.root_code)["stack"]
+          self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+      self.samples += 1
+
+  def stop(self):
+
+    self.stopped.set()
+    self.join()
+
+# get_collapsed
+# -------------
+# The batch in the collapsed stack format, gzipped
+
+def get_collapsed(stacks):
+
+  lines = [stack + " " + str(count) for stack, count in sorted(stacks.items())]
+
+  return { "collapsed": gzip.compress(("\n".join(lines) + "\n").encode("utf-8")) }
+
+# flush
+# -----
+# Writes the batch to the log or to S3, also when it is not full yet
+
+def flush(request_id = "local"):
+
+  global _stacks, _invocations, _samples, _batch_started
+
+  if (_invocations == 0):
+    return
+
+  collapsed = get_collapsed(_stacks)["collapsed"]
+
+  if (PROFILE_LOCATION.startswith("s3://")):
+
+    bucket, separator, prefix = PROFILE_LOCATION[len("s3://"):].partition("/")
+    key = (prefix.rstrip("/") + "/" if prefix else "") + FUNCTION_NAME + "/" + \
+          datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S") + "-" + request_id + ".collapsed.gz"
+
+    try:
+      shop_clients.get_client('s3').put_object(Bucket = bucket, Key = key, Body = collapsed)
+      print("INFO: profile of " + str(_invocations) + " invocations written to s3://" + bucket + "/" + key)
+    except Exception as e:
+      print("WARNING: profile not written to s3://" + bucket + "/" + key + ": " + str(e))
+
+  else:
+
+    print(PROFILE_PREFIX + "function: " + FUNCTION_NAME + ", invocations: " + str(_invocations) +
+          ", samples: " + str(_samples) + ", data: " + base64.standard_b64encode(collapsed).decode("utf-8"))
+
+  _stacks        = {}
+  _invocations   = 0
+  _samples       = 0
+  _batch_started = None
+
+  return
+
+# add_to_batch
+# ------------
+
+def add_to_batch(sampler, request_id):
+
+  global _invocations, _samples, _batch_started
+
+  for stack, count in sampler.stacks.items():
+    _stacks[stack] = _stacks.get(stack, 0) + count
+
+  _invocations += 1
+  _samples     += sampler.samples
+
+  if (_batch_started == None):
+    _batch_started = time.monotonic()
+
+  if (_invocations >= PROFILE_FLUSH_EVERY):
+    flush(request_id)
+  else:
+    flush_old_batch(request_id)
+
+  return
+
+# flush_old_batch
+# ---------------
+# Writes the batch when it is older than PROFILE_FLUSH_SECONDS. Also called after invocations that
+# are not profiled: with a low profile_rate, the next profiled invocation may take a long time.
+
+def flush_old_batch(request_id):
+
+  if ((_batch_started != None) and (time.monotonic() - _batch_started >= PROFILE_FLUSH_SECONDS)):
+    flush(request_id)
+
+  return
+
+# profiled
+# --------
+# Decorator for lambda_handler and sqs_lambda_handler. The sampler thread can only look at the 
+# stack when it gets the GIL: while the handler uses the CPU, python switches threads every 5 ms by
+# default. During a profiled invocation the switch interval is made as short as the sample interval.
+
+def profiled(handler):
+
+  if (PROFILE_RATE <= 0):
+    return handler
+
+  @functools.wraps(handler)
+  def wrapper(event, context):
+
+    if (random.random() >= PROFILE_RATE):
+      try:
+        return handler(event, context)
+      finally:
+        flush_old_batch(getattr(context, "aws_request_id", "local"))
+
+    switch_interval = sys.getswitchinterval()
+    sampler         = Sampler(PROFILE_INTERVAL, wrapper.__code__)
+
+    sys.setswitchinterval(min(switch_interval, PROFILE_INTERVAL))
+    sampler.start()
+
+    try:
+      return handler(event, context)
+    finally:
+      sampler.stop()
+      sys.setswitchinterval(switch_interval)
+      add_to_batch(sampler, getattr(context, "aws_request_id", "local"))
+
+  return wrapper
@@ -0,0 +1,138 @@
+# shop_xray.py
+# ------------
+# X-Ray subsegments per stage of the shop pipeline, with the shop_id, message_id and the number of
+# sales lines as annotations: in the X-Ray console traces can be filtered on them, f.e.
+#
+#   annotation.shop_id = "AMIS1" AND duration > 1
+#
+# patch(['botocore']) adds the AWS calls (KMS, SNS, DynamoDB) as subsegments of these stages, so
+# a trace shows whether parsing, KMS or DynamoDB takes the time.
+#
+# Usage:
+#
+#   @shop_xray.capture("decrypt")                     # the whole function is one stage
+#   def decrypt(shop_id, encrypted_content):
+#     shop_xray.annotate("decrypt", shop_id = shop_id)
+#
+#   with shop_xray.stage("update_dynamodb_line", shop_id = shop_id, record_type = record_type):
+#     response = dynamodb.update_item(...)
+#
+# Whether an invocation is traced at all is decided before the function is started (sampling rule
+# of the API Gateway, see terraform_shop.tf). Per stage, the fraction of the traced invocations that
+# gets a subsegment can be set with the environment variable xray_stage_sampling, f.e.
+# "update_dynamodb_line=0.1,check_event_structure=0": stages that are not mentioned always get a
+# subsegment. A subsegment costs a bit of time, that adds up for update_dynamodb_line in baskets
+# with a lot of sales lines.
+#
+# Without an X-Ray segment (f.e. AWS_XRAY_SDK_ENABLED=false in a local benchmark) nothing is recorded.
+#
+# This module is part of the shop layer.
+
+import os
+import random
+import functools
+import contextlib
+
+from aws_xray_sdk.core import xray_recorder
+
+ANNOTATIONS = ["shop_id", "message_id", "sales_lines", "record_type"]
+
+# get_stage_sampling
+# ------------------
+# "stage=rate,stage=rate" -> { stage: rate }
+
+def get_stage_sampling(setting):
+
+  stage_sampling = {}
+
+  for part in setting.split(","):
+    stage, separator, rate = part.partition("=")
+    if (separator):
+      stage_sampling[stage.strip()] = float(rate)
+
+  return { "stage_sampling": stage_sampling }
+
+STAGE_SAMPLING = get_stage_sampling(os.environ.get('xray_stage_sampling', ''))["stage_sampling"]
+
+# is_sampled
+# ----------
+
+def is_sampled(name):
+
+  rate = STAGE_SAMPLING.get(name, 1.0)
+
+  return (rate >= 1.0) or ((rate > 0.0) and (random.random() < rate))
+
+# put_annotations
+# ---------------
+# Values of None are skipped, the other values must be strings, numbers or booleans
+
+def put_annotations(subsegment, annotations):
+
+  for key, value in annotations.items():
+    if (value != None):
+      subsegment.put_annotation(key, value)
+
+  return
+
+# stage
+# -----
+# Context manager, yields the subsegment or None. Invocations that are not traced get a shared
+# nullcontext: creating (dummy) subsegments would cost more time than the stage itself for 
+# update_dynamodb_line.
+
+NO_STAGE = contextlib.nullcontext()
+
+def stage(name, **annotations):
+
+  if ((not xray_recorder.is_sampled()) or (not is_sampled(name))):
+    return NO_STAGE
+
+  return recorded_stage(name, annotations)
+
+# recorded_stage
+# --------------
+
+@contextlib.contextmanager
+def recorded_stage(name, annotations):
+
+  with xray_recorder.in_subsegment(name) as subsegment:
+
+    if (subsegment != None):
+      put_annotations(subsegment, annotations)
+
+    yield subsegment
+
+# capture
+# -------
+# Decorator, the function is one stage
+
+def capture(name):
+
+  def decorator(function):
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with stage(name):
+        return function(*args, **kwargs)
+
+    return wrapper
+
+  return decorator
+
+# annotate
+# --------
+# Adds annotations to the subsegment of stage name, when that is the current subsegment. Used when
+# the values are only known within the stage, f.e. the shop_id after check_event_structure.
+
+def annotate(name, **annotations):
+
+  if (not xray_recorder.is_sampled()):
+    return
+
+  subsegment = xray_recorder.current_subsegment()
+
+  if ((subsegment != None) and (subsegment.name == name)):
+    put_annotations(subsegment, annotations)
+
+  return
@@ -17,6 +17,96 @@ variable "key_prefix"                {}
 variable "stage_name"                { default = "prod" }
 variable "log_level_api_gateway"     { default = "INFO" }
 
+variable "pipeline_mode_shop" {
+  default     = "split"
+  description = "split = accept -> decrypt -> update_db, fused = accept -> shop_decrypt_update_db (decrypt and update_db in one function)"
+}
+
+variable "trigger_shop_decrypt" {
+  default     = "sns"
+  description = "sns = shop_decrypt is started for every message, sqs = shop_decrypt gets batches of messages via an SQS queue"
+}
+
+variable "batch_window_shop_decrypt" {
+  default     = 1
+  description = "sqs trigger: maximum number of seconds to wait for a full batch of 10 messages"
+}
+
+variable "trigger_shop_update_db" {
+  default     = "sns"
+  description = "sns = shop_update_db is started for every message, sqs = shop_update_db gets batches of messages via an SQS queue"
+}
+
+variable "batch_size_shop_update_db" {
+  default     = 100
+  description = "sqs trigger: maximum number of messages in one batch"
+}
+
+variable "batch_window_shop_update_db" {
+  default     = 1
+  description = "sqs trigger: maximum number of seconds to wait for a full batch"
+}
+
+variable "update_mode_shop_update_db" { 
+  default     = "transaction"
+  description = "item = one update_item per sales line, transaction = one TransactWriteItems call per basket" 
+}
+
+variable "log_level_shop" {
+  default     = "INFO"
+  description = "log level of the shop Lambda functions: DEBUG, INFO, WARNING or ERROR"
+}
+
+variable "log_sample_rate_shop" {
+  default     = 0.01
+  description = "fraction of the requests that is logged at DEBUG level, independent of log_level_shop"
+}
+
+variable "xray_fixed_rate_shop" {
+  default     = 0.05
+  description = "fraction of the requests to the API Gateway that is traced by X-Ray, after the first request per second"
+}
+
+variable "xray_stage_sampling_shop" {
+  default     = ""
+  description = "fraction of the traced invocations with a subsegment per stage, f.e. update_dynamodb_line=0.1 (see shop_xray.py)"
+}
+
+variable "profile_rate_shop" {
+  default     = 0
+  description = "fraction of the invocations that is profiled by the sampling profiler, 0 = off (see shop_profile.py)"
+}
+
+variable "profile_bucket" {
+  default     = ""
+  description = "S3 bucket for the profiles (prefix profiles/), empty = log. init-infra gives the shop functions s3:PutObject on it"
+}
+
+variable "import_profile_shop" {
+  default     = 0
+  description = "1 = python logs the import time per module when a container starts (PYTHONPROFILEIMPORTTIME, see shop_coldstart.py)"
+}
+
+##################################################################################
+# LOCALS
+##################################################################################
+
+# In the fused mode, shop_decrypt is not subscribed to the to_shop_decrypt topic
+
+locals {
+  shop_decrypt_via_sns = var.pipeline_mode_shop == "split" && var.trigger_shop_decrypt == "sns" ? 1 : 0
+  shop_decrypt_via_sqs = var.pipeline_mode_shop == "split" && var.trigger_shop_decrypt == "sqs" ? 1 : 0
+  shop_fused           = var.pipeline_mode_shop == "fused" ? 1 : 0
+
+  # The profiles only go to S3 when the shop functions may write to the bucket, see terraform_infra.tf
+
+  profile_location_shop = var.profile_bucket == "" ? "log" : "s3://${var.profile_bucket}/profiles"
+
+  # python switches the import profile on for every value that isn't empty, also for "0"
+
+  python_profile_import_time_shop = var.import_profile_shop == 1 ? "1" : ""
+}
+
 ##################################################################################
 # PROVIDERS
 ##################################################################################
@@ -47,6 +137,10 @@ data "aws_iam_role" "lambda_shop_update_db_role" {
     name = "${var.name_prefix}_lambda_shop_update_db_role"
 }
 
+data "aws_iam_role" "lambda_shop_decrypt_update_db_role" {
+    name = "${var.name_prefix}_lambda_shop_decrypt_update_db_role"
+}
+
 data "aws_iam_role" "lambda_smoketest_role" {
     name = "${var.name_prefix}_lambda_smoketest_role"
 }
@@ -125,6 +219,23 @@ resource "aws_api_gateway_stage" "stage" {
   xray_tracing_enabled = true
 }
 
+# Sampling rule for the requests to the shop: the functions behind the API Gateway follow its
+# decision (the trace header is passed on by SNS). Subsegments per stage: see shop_xray.py.
+
+resource "aws_xray_sampling_rule" "shop" {
+  rule_name      = "${var.name_prefix}_shop"
+  priority       = 1000
+  version        = 1
+  reservoir_size = 1
+  fixed_rate     = var.xray_fixed_rate_shop
+  url_path       = "*"
+  host           = "*"
+  http_method    = "POST"
+  service_type   = "*"
+  service_name   = "${var.name_prefix}_api_gateway/${var.stage_name}"
+  resource_arn   = "*"
+}
+
 resource "aws_api_gateway_deployment" "deployment" {
   depends_on  = [aws_api_gateway_integration.integration,aws_api_gateway_rest_api.api_gateway, aws_api_gateway_resource.api_gateway_resource_shop, aws_api_gateway_method.api_gateway_method_post]
   rest_api_id = aws_api_gateway_rest_api.api_gateway.id
@@ -180,6 +291,18 @@ resource "aws_api_gateway_integration" "integration" {
   uri                     = aws_lambda_function.shop_accept.invoke_arn
 }
 
+# shop_layer
+# ----------
+# Modules that are shared by the shop Lambda functions (f.e. shop_clients, which keeps the
+# boto3 clients warm between invocations). The zip file is created in init-shop.sh.
+
+resource "aws_lambda_layer_version" "shop_layer" {
+    layer_name          = "${var.name_prefix}_shop_layer"
+    filename            = "./layer/shop_layer.zip"
+    source_code_hash    = filebase64sha256("./layer/shop_layer.zip")
+    compatible_runtimes = ["python3.8"]
+}
+
 # shop_accept
 # -----------
 # X-Ray is configured in the init-shop.sh file: terraform is not able to do that (yet)
@@ -199,10 +322,17 @@ resource "aws_lambda_function" "shop_accept" {
     role          = data.aws_iam_role.lambda_shop_accept_role.arn
     handler       = "shop_accept.lambda_handler"
     runtime       = "python3.8"
+    layers        = [aws_lambda_layer_version.shop_layer.arn]
     timeout       = 10
     environment {
         variables = {
-            to_shop_decrypt_topic_arn = aws_sns_topic.to_shop_decrypt.arn
+            to_shop_decrypt_topic_arn = aws_sns_topic.to_shop_decrypt.arn,
+            log_level                 = var.log_level_shop,
+            log_sample_rate           = var.log_sample_rate_shop,
+            PYTHONPROFILEIMPORTTIME   = local.python_profile_import_time_shop,
+            xray_stage_sampling       = var.xray_stage_sampling_shop,
+            profile_rate              = var.profile_rate_shop,
+            profile_location          = local.profile_location_shop
         }
     }
     tags = {
@@ -219,17 +349,82 @@ resource "aws_sns_topic" "to_shop_decrypt" {
 }
 
 resource "aws_sns_topic_subscription" "to_shop_decrypt_subscription" {
+  count      = local.shop_decrypt_via_sns
   depends_on = [aws_lambda_permission.lambda_shop_decrypt_permission]
   topic_arn  = aws_sns_topic.to_shop_decrypt.arn
   protocol   = "lambda"
   endpoint   = aws_lambda_function.shop_decrypt.arn
 }
 
+# to_shop_decrypt_queue
+# ---------------------
+# Only used when trigger_shop_decrypt = "sqs" (split mode). Raw message delivery: the body of the SQS message
+# is the message from shop_accept. Messages that cannot be decrypted three times are moved to the 
+# dead letter queue.
+
+resource "aws_sqs_queue" "to_shop_decrypt_dlq" {
+  count                      = local.shop_decrypt_via_sqs
+  name                       = "${var.name_prefix}_to_shop_decrypt_dlq"
+  message_retention_seconds  = 1209600
+}
+
+resource "aws_sqs_queue" "to_shop_decrypt_queue" {
+  count                      = local.shop_decrypt_via_sqs
+  name                       = "${var.name_prefix}_to_shop_decrypt_queue"
+  visibility_timeout_seconds = 60
+  redrive_policy             = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.to_shop_decrypt_dlq[0].arn,
+    maxReceiveCount     = 3
+  })
+}
+
+resource "aws_sqs_queue_policy" "to_shop_decrypt_queue_policy" {
+  count     = local.shop_decrypt_via_sqs
+  queue_url = aws_sqs_queue.to_shop_decrypt_queue[0].id
+  policy    = <<EOF
+{
+    "Version": "2012-10-17",
+    "Statement": [
+      {
+        "Effect": "Allow",
+        "Principal": { "Service": "sns.amazonaws.com" },
+        "Action": "sqs:SendMessage",
+        "Resource": "${aws_sqs_queue.to_shop_decrypt_queue[0].arn}",
+        "Condition": {
+          "ArnEquals": {
+            "aws:SourceArn": "${aws_sns_topic.to_shop_decrypt.arn}"
+          }
+        }
+      }
+    ]
+}
+EOF
+}
+
+resource "aws_sns_topic_subscription" "to_shop_decrypt_queue_subscription" {
+  count                = local.shop_decrypt_via_sqs
+  depends_on           = [aws_sqs_queue_policy.to_shop_decrypt_queue_policy]
+  topic_arn            = aws_sns_topic.to_shop_decrypt.arn
+  protocol             = "sqs"
+  endpoint             = aws_sqs_queue.to_shop_decrypt_queue[0].arn
+  raw_message_delivery = true
+}
+
+resource "aws_lambda_event_source_mapping" "to_shop_decrypt_queue_mapping" {
+  count                              = local.shop_decrypt_via_sqs
+  event_source_arn                   = aws_sqs_queue.to_shop_decrypt_queue[0].arn
+  function_name                      = aws_lambda_function.shop_decrypt.arn
+  batch_size                         = 10
+  maximum_batching_window_in_seconds = var.batch_window_shop_decrypt
+  function_response_types            = ["ReportBatchItemFailures"]
+}
+
 # shop_decrypt
 # ------------
 # X-Ray is configured in the init-shop.sh file: terraform is not able to do that (yet)
 
 resource "aws_lambda_permission" "lambda_shop_decrypt_permission" {
+  count         = local.shop_decrypt_via_sns
   depends_on    = [aws_lambda_function.shop_decrypt]
   statement_id  = "AllowExecutionFromSNSToShopDecrypt"
   action        = "lambda:InvokeFunction"
@@ -242,13 +437,23 @@ resource "aws_lambda_function" "shop_decrypt" {
     function_name = "${var.name_prefix}_shop_decrypt"
     filename      = "./lambdas/shop_decrypt/shop_decrypt.zip"
     role          = data.aws_iam_role.lambda_shop_decrypt_role.arn
-    handler       = "shop_decrypt.lambda_handler"
+    handler       = var.trigger_shop_decrypt == "sqs" ? "shop_decrypt.sqs_lambda_handler" : "shop_decrypt.lambda_handler"
     runtime       = "python3.8"
+    layers        = [aws_lambda_layer_version.shop_layer.arn]
     timeout       = 10
     environment {
         variables = {
             key_prefix                  = var.key_prefix,
-            to_shop_update_db_topic_arn = aws_sns_topic.to_shop_update_db.arn
+            to_shop_update_db_topic_arn = aws_sns_topic.to_shop_update_db.arn,
+            data_key_cache_ttl_seconds  = 300,
+            data_key_cache_max_size     = 100,
+            decrypt_threads             = 10,
+            log_level                   = var.log_level_shop,
+            log_sample_rate             = var.log_sample_rate_shop,
+            PYTHONPROFILEIMPORTTIME     = local.python_profile_import_time_shop,
+            xray_stage_sampling         = var.xray_stage_sampling_shop,
+            profile_rate                = var.profile_rate_shop,
+            profile_location            = local.profile_location_shop
         }
     }
     tags = {
@@ -265,17 +470,82 @@ resource "aws_sns_topic" "to_shop_update_db" {
 }
 
 resource "aws_sns_topic_subscription" "to_shop_update_db_subscription" {
+  count      = var.trigger_shop_update_db == "sns" ? 1 : 0
   depends_on = [aws_lambda_permission.lambda_shop_update_db_permission]
   topic_arn  = aws_sns_topic.to_shop_update_db.arn
   protocol   = "lambda"
   endpoint   = aws_lambda_function.shop_update_db.arn
 }
 
+# to_shop_update_db_queue
+# -----------------------
+# Only used when trigger_shop_update_db = "sqs". Raw message delivery: the body of the SQS message
+# is the message from shop_decrypt. Messages that fail three times are moved to the dead letter 
+# queue.
+
+resource "aws_sqs_queue" "to_shop_update_db_dlq" {
+  count                      = var.trigger_shop_update_db == "sqs" ? 1 : 0
+  name                       = "${var.name_prefix}_to_shop_update_db_dlq"
+  message_retention_seconds  = 1209600
+}
+
+resource "aws_sqs_queue" "to_shop_update_db_queue" {
+  count                      = var.trigger_shop_update_db == "sqs" ? 1 : 0
+  name                       = "${var.name_prefix}_to_shop_update_db_queue"
+  visibility_timeout_seconds = 60
+  redrive_policy             = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.to_shop_update_db_dlq[0].arn,
+    maxReceiveCount     = 3
+  })
+}
+
+resource "aws_sqs_queue_policy" "to_shop_update_db_queue_policy" {
+  count     = var.trigger_shop_update_db == "sqs" ? 1 : 0
+  queue_url = aws_sqs_queue.to_shop_update_db_queue[0].id
+  policy    = <<EOF
+{
+    "Version": "2012-10-17",
+    "Statement": [
+      {
+        "Effect": "Allow",
+        "Principal": { "Service": "sns.amazonaws.com" },
+        "Action": "sqs:SendMessage",
+        "Resource": "${aws_sqs_queue.to_shop_update_db_queue[0].arn}",
+        "Condition": {
+          "ArnEquals": {
+            "aws:SourceArn": "${aws_sns_topic.to_shop_update_db.arn}"
+          }
+        }
+      }
+    ]
+}
+EOF
+}
+
+resource "aws_sns_topic_subscription" "to_shop_update_db_queue_subscription" {
+  count                = var.trigger_shop_update_db == "sqs" ? 1 : 0
+  depends_on           = [aws_sqs_queue_policy.to_shop_update_db_queue_policy]
+  topic_arn            = aws_sns_topic.to_shop_update_db.arn
+  protocol             = "sqs"
+  endpoint             = aws_sqs_queue.to_shop_update_db_queue[0].arn
+  raw_message_delivery = true
+}
+
+resource "aws_lambda_event_source_mapping" "to_shop_update_db_queue_mapping" {
+  count                              = var.trigger_shop_update_db == "sqs" ? 1 : 0
+  event_source_arn                   = aws_sqs_queue.to_shop_update_db_queue[0].arn
+  function_name                      = aws_lambda_function.shop_update_db.arn
+  batch_size                         = var.batch_size_shop_update_db
+  maximum_batching_window_in_seconds = var.batch_window_shop_update_db
+  function_response_types            = ["ReportBatchItemFailures"]
+}
+
 # shop_update_db
 # --------------
 # X-Ray is configured in the init-shop.sh file: terraform is not able to do that (yet)
 
 resource "aws_lambda_permission" "lambda_shop_update_db_permission" {
+  count         = var.trigger_shop_update_db == "sns" ? 1 : 0
   depends_on    = [aws_lambda_function.shop_update_db]
   statement_id  = "AllowExecutionFromSNSToShopUpdateDb"
   action        = "lambda:InvokeFunction"
@@ -288,12 +558,72 @@ resource "aws_lambda_function" "shop_update_db" {
     function_name = "${var.name_prefix}_shop_update_db"
     filename      = "./lambdas/shop_update_db/shop_update_db.zip"
     role          = data.aws_iam_role.lambda_shop_update_db_role.arn
-    handler       = "shop_update_db.lambda_handler"
+    handler       = var.trigger_shop_update_db == "sqs" ? "shop_update_db.sqs_lambda_handler" : "shop_update_db.lambda_handler"
     runtime       = "python3.8"
+    layers        = [aws_lambda_layer_version.shop_layer.arn]
     timeout       = 10
     environment {
         variables = {
-            name_prefix = var.name_prefix
+            name_prefix         = var.name_prefix
+            update_mode         = var.update_mode_shop_update_db
+            log_level           = var.log_level_shop
+            log_sample_rate     = var.log_sample_rate_shop
+            PYTHONPROFILEIMPORTTIME = local.python_profile_import_time_shop
+            xray_stage_sampling = var.xray_stage_sampling_shop
+            profile_rate        = var.profile_rate_shop
+            profile_location    = local.profile_location_shop
+        }
+    }
+    tags = {
+        type            = "prod"
+        execute_via_gui = "no"
+    }
+}
+
+# shop_decrypt_update_db
+# ----------------------
+# Fused mode: decrypt and update_db in one function, subscribed to the to_shop_decrypt topic.
+# X-Ray is configured in the init-shop.sh file: terraform is not able to do that (yet)
+
+resource "aws_sns_topic_subscription" "to_shop_decrypt_fused_subscription" {
+  count      = local.shop_fused
+  depends_on = [aws_lambda_permission.lambda_shop_decrypt_update_db_permission]
+  topic_arn  = aws_sns_topic.to_shop_decrypt.arn
+  protocol   = "lambda"
+  endpoint   = aws_lambda_function.shop_decrypt_update_db.arn
+}
+
+resource "aws_lambda_permission" "lambda_shop_decrypt_update_db_permission" {
+  count         = local.shop_fused
+  depends_on    = [aws_lambda_function.shop_decrypt_update_db]
+  statement_id  = "AllowExecutionFromSNSToShopDecryptUpdateDb"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.shop_decrypt_update_db.function_name
+  principal     = "sns.amazonaws.com"
+  source_arn    = aws_sns_topic.to_shop_decrypt.arn
+}
+
+resource "aws_lambda_function" "shop_decrypt_update_db" {
+    function_name = "${var.name_prefix}_shop_decrypt_update_db"
+    filename      = "./lambdas/shop_decrypt_update_db/shop_decrypt_update_db.zip"
+    role          = data.aws_iam_role.lambda_shop_decrypt_update_db_role.arn
+    handler       = "shop_decrypt_update_db.lambda_handler"
+    runtime       = "python3.8"
+    layers        = [aws_lambda_layer_version.shop_layer.arn]
+    timeout       = 10
+    environment {
+        variables = {
+            key_prefix                  = var.key_prefix,
+            name_prefix                 = var.name_prefix,
+            update_mode                 = var.update_mode_shop_update_db,
+            data_key_cache_ttl_seconds  = 300,
+            data_key_cache_max_size     = 100,
+            log_level                   = var.log_level_shop,
+            log_sample_rate             = var.log_sample_rate_shop,
+            PYTHONPROFILEIMPORTTIME     = local.python_profile_import_time_shop,
+            xray_stage_sampling         = var.xray_stage_sampling_shop,
+            profile_rate                = var.profile_rate_shop,
+            profile_location            = local.profile_location_shop
         }
     }
     tags = {
@@ -319,6 +649,7 @@ resource "aws_lambda_function" "smoketest_test" {
     role          = data.aws_iam_role.lambda_smoketest_role.arn
     handler       = "smoketest_test.lambda_handler"
     runtime       = "python3.8"
+    layers        = [aws_lambda_layer_version.shop_layer.arn]
     timeout       = 5
     environment {
         variables = {
@@ -354,6 +685,7 @@ resource "aws_lambda_function" "perftest_test" {
     role          = data.aws_iam_role.lambda_perftest_role[count.index].arn
     handler       = "perftest_test.lambda_handler"
     runtime       = "python3.8"
+    layers        = [aws_lambda_layer_version.shop_layer.arn]
     timeout       = 120
     environment {
         variables = {
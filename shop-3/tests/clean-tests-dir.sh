@@ -41,6 +41,20 @@ function remove_zip_from_directory {
   
 }
 
+# remove_all_from_directory_except_codefile
+# -----------------------------------------
+
+function remove_all_from_directory_except_codefile {
+
+  directory=$1
+  codefile=$2
+
+  cd ${directory}
+  ls | grep -v ${codefile} | xargs rm -fr
+  cd ../..
+
+}
+
 # Main program
 # ============
 
@@ -48,7 +62,7 @@ remove_files
 remove_terraform_directory
 
 remove_zip_from_directory lambdas/unittest_test_accept
-remove_zip_from_directory lambdas/unittest_test_decrypt
+remove_all_from_directory_except_codefile lambdas/unittest_test_decrypt unittest_test_decrypt.py
 remove_zip_from_directory lambdas/unittest_test_update_db
 remove_zip_from_directory lambdas/unittest_support_send_logs_from_unittest_support_echo
 remove_zip_from_directory lambdas/unittest_support_echo
@@ -15,6 +15,38 @@ function in_directory_zip {
 
 }
 
+# in_directory_zip_with_library
+# -----------------------------
+# Same as in_directory_zip, with libraries. They are installed for the Lambda runtime (python3.8 
+# on Amazon Linux 2), see in_directory_zip_with_library in ../shop/init-shop.sh.
+
+LAMBDA_PLATFORM=manylinux2014_x86_64
+LAMBDA_PYTHON_VERSION=3.8
+
+function in_directory_zip_with_library {
+
+  directory=$1
+  name=$2
+  library=$3
+
+  cd $directory
+  ls | grep -v "${name}.py" | xargs rm -fr
+
+  mkdir venv
+  python3 -m venv ./venv
+
+  source venv/bin/activate
+  pip install --upgrade pip
+  pip install --platform ${LAMBDA_PLATFORM} --python-version ${LAMBDA_PYTHON_VERSION} --implementation cp --only-binary=:all: ${library} -t .
+  deactivate
+
+  rm -r venv
+
+  zip -r "${name}.zip" *
+  cd ../..
+
+}
+
 # terraform_init
 # --------------
 
@@ -61,7 +93,7 @@ function terraform_apply {
 # ============
 
 in_directory_zip "lambdas/unittest_test_accept"                                  "unittest_test_accept"
-in_directory_zip "lambdas/unittest_test_decrypt"                                 "unittest_test_decrypt"
+in_directory_zip_with_library "lambdas/unittest_test_decrypt"                    "unittest_test_decrypt" "cryptography"
 in_directory_zip "lambdas/unittest_test_update_db"                               "unittest_test_update_db"
 
 in_directory_zip "lambdas/unittest_support_echo"                                 "unittest_support_echo"
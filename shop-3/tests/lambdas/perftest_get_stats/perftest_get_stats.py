@@ -4,43 +4,196 @@ import boto3
 import os
 import base64
 import time
+import math
+import bisect
+import array
+import gzip
+import argparse
+import importlib
 
 from datetime            import datetime, timedelta
 from botocore.exceptions import ClientError
 
-# search
-# ------
-# (see also: https://stackoverflow.com/questions/8653516/python-list-of-dictionaries-search )
+# Logs Insights queries
+# ---------------------
+# I used this information to get the log entries from Cloudwatch:
+# https://stackoverflow.com/questions/59240107/how-to-query-cloudwatch-logs-using-boto3-in-python
+#
+# All queries are started at once (Logs Insights runs them in parallel, at most MAX_RUNNING_QUERIES
+# at the same time) and polled with an increasing interval. A query returns at most MAX_RESULTS
+# rows: when a query for rows (not for STATS) matches more records, its time window is split in 
+# two and both halves are queried again, until all rows are read.
 
-def search(attribute, value, list):
-    return [element for element in list if element[attribute] == value]
+MAX_RESULTS          = 10000
+MAX_RUNNING_QUERIES  = int(os.environ.get("max_running_queries", "10"))
+POLL_INTERVAL_START  = 0.25
+POLL_INTERVAL_MAX    = 5
+DEFAULT_WINDOW_HOURS = 2
 
-# int_from_string_with_optional_dot
-# ---------------------------------
+FUNCTIONS            = ["shop_accept", "shop_decrypt", "shop_update_db", "shop_decrypt_update_db"]
 
-def int_from_string_with_optional_dot(string_with_optional_dot):
+RUNNING_STATUSES     = ["Scheduled", "Running", "Unknown"]
 
-  pos_dot = string_with_optional_dot.find('.')
+# get_time_window
+# ---------------
+# The event can contain the window of the queries:
+# - start_time, end_time : epoch seconds
+# - hours                : number of hours before end_time (default 2), when start_time is not given
 
-  if (pos_dot > 0):
-    string_to_convert_to_int = string_with_optional_dot[0:pos_dot]
+def get_time_window(event):
+
+  end_time = int(event.get("end_time", datetime.now().timestamp()))
+
+  if ("start_time" in event):
+    start_time = int(event["start_time"])
   else:
-    string_to_convert_to_int = string_with_optional_dot
+    start_time = end_time - int(float(event.get("hours", DEFAULT_WINDOW_HOURS)) * 3600)
 
-  int_value = int(string_to_convert_to_int)
+  return { "start_time": start_time, "end_time": end_time }
 
-  return { "int_value" : int_value }
+# start_query
+# -----------
+# Returns None when the query cannot be started, f.e. because the log group doesn't exist (the 
+# shop_decrypt_update_db function only has a log group after it is used in the fused mode).
 
-# stats_cloudwatch
-# ----------------
-# I used this information to get the log entries from Cloudwatch:
-# https://stackoverflow.com/questions/59240107/how-to-query-cloudwatch-logs-using-boto3-in-python
+def start_query(logs, window):
+
+  try:
+
+    start_query_response = logs.start_query(
+      logGroupName = window["log_group"],
+      startTime    = window["start_time"],
+      endTime      = window["end_time"],
+      queryString  = window["query"],
+      limit        = MAX_RESULTS
+    )
+    print("DEBUG: Response of logs.start_query: "+json.dumps(start_query_response))
+
+  except ClientError as e:
+
+    print("INFO: No statistics for log group " + window["log_group"] + ": " + str(e))
+    return { "query_id": None }
+
+  return { "query_id": start_query_response["queryId"] }
+
+# split_window
+# ------------
+# startTime and endTime of a query are both inclusive
+
+def split_window(window):
+
+  middle = (window["start_time"] + window["end_time"]) // 2
+
+  first  = dict(window, end_time   = middle)
+  second = dict(window, start_time = middle + 1)
+
+  return { "windows": [first, second] }
+
+# handle_query_results
+# --------------------
+# Returns the windows that have to be queried again (split windows), adds the rows to the 
+# results otherwise.
+
+def handle_query_results(window, response, results):
+
+  status = response["status"]
+
+  if (status != "Complete"):
+    print("WARNING: query for " + window["name"] + " ended with status " + status)
+    return { "windows": [] }
+
+  # For STATS queries, recordsMatched is the number of records that are aggregated
+
+  rows             = response["results"]
+  records_matched  = int(response.get("statistics", {}).get("recordsMatched", len(rows)))
+  truncated        = window["split"] and ((len(rows) >= MAX_RESULTS) or (records_matched > len(rows)))
+
+  if (truncated and (window["end_time"] > window["start_time"])):
+    print("DEBUG: " + window["name"] + ": " + str(records_matched) + " records in " + str(window["end_time"] - window["start_time"] + 1) + " seconds, window is split")
+    return split_window(window)
+
+  if (truncated):
+    print("WARNING: " + window["name"] + ": only " + str(len(rows)) + " of " + str(records_matched) + " records are used")
+
+  if (results[window["name"]] == None):
+    results[window["name"]] = []
+
+  results[window["name"]].append({ "start_time": window["start_time"], "rows": rows })
+
+  return { "windows": [] }
+
+# run_queries
+# -----------
+# queries: list of { "name", "log_group", "query", "split" }, split is True for queries that return
+# rows and False for STATS queries. Returns the rows per name (None when 
+# the query could not be started), rows of split windows are put back in the order of time.
+
+def run_queries(queries, start_time, end_time, deadline):
+
+  logs          = boto3.client('logs')
+  results       = {}
+  waiting       = []
+  running       = {}
+  poll_interval = POLL_INTERVAL_START
+
+  for query in queries:
+    results[query["name"]] = None
+    waiting.append(dict(query, start_time = start_time, end_time = end_time))
+
+  while (waiting or running):
+
+    while (waiting and (len(running) < MAX_RUNNING_QUERIES)):
+
+      window   = waiting.pop(0)
+      response = start_query(logs, window)
+
+      if (response["query_id"] != None):
+        running[response["query_id"]] = window
+        poll_interval = POLL_INTERVAL_START
+
+    if (not running):
+      break
+
+    if (time.time() + poll_interval > deadline):
+
+      for query_id, window in running.items():
+        print("WARNING: query for " + window["name"] + " is stopped, the function is out of time")
+        try:
+          logs.stop_query(queryId = query_id)
+        except ClientError as e:
+          print("INFO: " + str(e))
+      break
+
+    print("DEBUG: Waiting " + str(poll_interval) + " seconds for " + str(len(running)) + " queries ...")
+    time.sleep(poll_interval)
+    poll_interval = min(poll_interval * 2, POLL_INTERVAL_MAX)
+
+    for query_id in list(running.keys()):
+
+      response = logs.get_query_results(queryId = query_id)
+
+      if (response["status"] in RUNNING_STATUSES):
+        continue
 
-def stats_cloudwatch(name_prefix, log_group):
+      print("DEBUG: Query " + query_id + " ended, status: " + response["status"] + ", rows: " + str(len(response["results"])))
 
-  logs = boto3.client('logs')
+      window   = running.pop(query_id)
+      response = handle_query_results(window, response, results)
+      waiting  = response["windows"] + waiting
+
+  for name in results:
+    if (results[name] != None):
+      results[name] = [row for part in sorted(results[name], key = lambda part: part["start_time"]) for row in part["rows"]]
+
+  return { "results": results }
+
+# get_report_query
+# ----------------
+
+def get_report_query():
 
   # Get all REPORT lines, and from that, get the values of timestamp, duration, billed_duration, memory_size, max_memory_used. Sort on timestamp (to get first/last timestamp more easy)
+  # max_memory_used also contains the rest of the line: "Init Duration: ... ms" for cold starts
 
   query = "FIELDS @timestamp, @message | "          + \
           "PARSE @message \"* *\" as type, rest | " + \
@@ -49,218 +202,997 @@ def stats_cloudwatch(name_prefix, log_group):
           "PARSE @message \"REPORT RequestId: *	Duration: * ms	Billed Duration: * ms	Memory Size: * MB	Max Memory Used: *\" as request_id, duration, billed_duration, memory_size, max_memory_used |" + \
           "DISPLAY @timestamp, duration, billed_duration, memory_size, max_memory_used" 
 
-  print("DEBUG: query = "+query)
-  print("DEBUG: log_group = "+log_group)
+  return { "query": query }
 
-  start_time=int((datetime.today() - timedelta(hours=2)).timestamp())   
+# Percentiles and histograms
+# --------------------------
+# The bounds of the histogram buckets are fixed, so histograms of different runs can be compared.
+# A bucket contains the values that are less than or equal to its bound ("le") and more than the
+# bound of the previous bucket.
 
-  start_query_response = logs.start_query(
-    logGroupName=log_group,
-    startTime=start_time,   
-    endTime=int(datetime.now().timestamp()),
-    queryString=query,
-  )
-  print("DEBUG: Response of logs.start_query: "+json.dumps(start_query_response))
+PERCENTILES             = [50, 90, 95, 99, 99.9]
 
-  query_id = start_query_response['queryId']
-  response = None
+DURATION_BUCKETS_MS     = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+MEMORY_BUCKETS_MB       = [32, 64, 96, 128, 192, 256, 384, 512, 768, 1024, 1536, 2048, 3008, 4096]
 
-  while ((response == None) or (response['status'] == 'Running')):
-    print('DEBUG: Waiting for query to complete ...')
-    time.sleep(1)
+# name, column (see new_columns), bounds
 
-    response = logs.get_query_results(
-        queryId=query_id
-    )
-    print("DEBUG: Response of logs.get_query_results: "+json.dumps(response))
-
-  print("DEBUG: response after while: "+str(response))
-
-  first_timestamp       = "n/a"
-  last_timestamp        = "n/a"
-  number_of_records     = 0
-
-  min_duration          = 99999
-  max_duration          = -1
-  total_duration        = 0
-  total_billed_duration = 0
-  limit_value_duration  = int(os.environ["limit_value_duration"])
-  under_limit_duration  = 0
-  over_limit_duration   = 0
-
-  min_mem               = 99999
-  max_mem               = -1
-  total_mem             = 0
-  limit_value_diff_mem  = int(os.environ["limit_value_diff_mem"])
-  under_limit_diff_mem  = 0
-  over_limit_diff_mem   = 0
-  current_memory_config = 0     # This is the "slider" in the Lambda function
-  
-  for line in response["results"]: 
+HISTOGRAMS              = [("duration",        "duration",        DURATION_BUCKETS_MS),
+                           ("billed_duration", "billed_duration", DURATION_BUCKETS_MS),
+                           ("init_duration",   "init_duration",   DURATION_BUCKETS_MS),
+                           ("memory_used",     "max_memory_used", MEMORY_BUCKETS_MB)]
 
-    # General statistics
-    # ------------------
+INIT_DURATION_SEPARATOR = "Init Duration: "
 
-    number_of_records += 1
-    timestamp_record  = search("field", "@timestamp", line)
-    timestamp         = timestamp_record[0]["value"]
+# get_fields
+# ----------
+# A row of the results of Logs Insights is a list of {"field": ..., "value": ...}, this replaces 
+# search() over every row for every field.
 
-    # Results of the query are ordered by timestamp
+def get_fields(line):
 
-    if (first_timestamp == "n/a"):
-      first_timestamp = timestamp
-    else:
-      last_timestamp = timestamp
+  return { element["field"]: element["value"] for element in line }
 
-    # Duration 
-    # --------
-    # Duration is the time it really took to execute the Lambda function
+# parse_report_row
+# ----------------
+# Max memory used is the amount of memory we really used. We will get back something like 
+# "123 MB", followed by "Init Duration: 456.78 ms" when a new instance was started (cold start).
 
-    # What we want to know, is how often AWS starts a new instance of an
-    # object. We assume that when the number of milliseconds is lower than
-    # the limit, this means that no new instance is started. When the number
-    # of milliseconds is higher than this limit, we assume a new instance 
-    # is started.
+def parse_report_row(line):
 
-    duration_key_value_list = search("field", "duration", line)
-    duration                = duration_key_value_list[0]["value"]
-    response                = int_from_string_with_optional_dot(duration)
-    int_duration            = response["int_value"]
+  fields          = get_fields(line)
 
-    total_duration += int_duration
-    
-    if int_duration < min_duration:
-      min_duration  = int_duration
-    
-    if int_duration > max_duration:
-      max_duration  = int_duration
-      
-    if int_duration < limit_value_duration:
-      under_limit_duration += 1
-    else:
-      over_limit_duration  += 1
-
-    # Billed duration
-    # ---------------
-    # This is the duration rounded up to 100 ms. 
-    
-    # We are interested in the total amount of billed milliseconds, 
-    # to be able to compare it to the total of used milliseconds.
-      
-    billed_duration_key_value_list = search("field", "billed_duration", line)
-    billed_duration                = billed_duration_key_value_list[0]["value"]
-    int_billed_duration            = int(billed_duration)
-    
-    total_billed_duration += int_billed_duration
+  max_memory_used = fields["max_memory_used"]
+  pos_init        = max_memory_used.find(INIT_DURATION_SEPARATOR)
 
-    # Memory size
-    # -----------
-    # Memory size is this the memory size that we asked for,
-    # it has the same value as the "slider" in the Lambda gui: 
-    # this number will be the same in all the records.
-    
-    # We will compare the actual size that the Lambda used
-    # (in "max_memory_used", which is a confusing name)
-    # with this value. When these values are almost the same
-    # we want to know this.
-
-    memory_size_key_value_list = search("field", "memory_size", line)
-    memory_size                = memory_size_key_value_list[0]["value"]
-    int_memory_size            = int(memory_size)
-
-    current_memory_config      = int_memory_size
-
-    # Max memory used
-    # ---------------
-    # Max memory used is the amount of memory we really used.
-    # We will get back something like 123 MB. Strip the MB by 
-    # stripping off the space (and everything behind it). 
-    
-    max_memory_used_key_value_list = search("field", "max_memory_used", line)
-    max_memory_used                = max_memory_used_key_value_list[0]["value"]
-    pos_space                      = max_memory_used.find(' ')
-    max_memory_used                = max_memory_used[0:pos_space]
-    int_max_memory_used            = int(max_memory_used)
-
-    if int_max_memory_used < min_mem:
-      min_mem = int_max_memory_used
-    
-    if int_max_memory_used > max_mem:
-      max_mem = int_max_memory_used
+  if (pos_init >= 0):
+    init_duration = float(max_memory_used[pos_init + len(INIT_DURATION_SEPARATOR):].split(" ")[0])
+  else:
+    init_duration = None
 
-    total_mem = total_mem + int_max_memory_used
+  return { "timestamp"       : fields["@timestamp"],
+           "duration"        : float(fields["duration"]),
+           "billed_duration" : int(fields["billed_duration"]),
+           "memory_size"     : int(fields["memory_size"]),
+           "max_memory_used" : int(max_memory_used.split(" ")[0]),
+           "init_duration"   : init_duration }
 
-    # Diff_mem
-    # --------
-    # Diff mem is the difference between the amount of memory that is
-    # currently configured (int_memory_size) and the amount of memory that
-    # the Lambda function really needed (int_max_memory_used)
-    
-    # When the diff is higher than the limit value, this is good.
-    # That means that we have some slack before the Lambda function
-    # will stop working because of out-of-memory errors
+# new_columns
+# -----------
+# The values of the REPORT lines of one log group are kept per field in arrays of floats: this 
+# uses little memory for millions of lines and NumPy can use the arrays without a copy. Init 
+# durations are only added for cold starts. Timestamps have the format of Logs Insights 
+# ("2021-01-31 12:34:56.789"), only the first and last one are kept.
 
-    # When the diff is lower, and when this happens a lot, you
-    # might want to consider to configure more memory for the 
-    # lambda function that is checked.
-    
-    diff_mem = int_memory_size - int_max_memory_used
+def new_columns():
+
+  columns = { "first_timestamp" : None,
+              "last_timestamp"  : None }
+
+  for field in ["duration", "billed_duration", "memory_size", "max_memory_used", "init_duration"]:
+    columns[field] = array.array("d")
+
+  return columns
+
+# add_row
+# -------
+
+def add_row(columns, row):
+
+  timestamp = row["timestamp"]
+
+  if ((columns["first_timestamp"] == None) or (timestamp < columns["first_timestamp"])):
+    columns["first_timestamp"] = timestamp
+
+  if ((columns["last_timestamp"] == None) or (timestamp > columns["last_timestamp"])):
+    columns["last_timestamp"] = timestamp
+
+  columns["duration"].append(row["duration"])
+  columns["billed_duration"].append(row["billed_duration"])
+  columns["memory_size"].append(row["memory_size"])
+  columns["max_memory_used"].append(row["max_memory_used"])
+
+  if (row["init_duration"] != None):
+    columns["init_duration"].append(row["init_duration"])
+
+  return
+
+# get_percentiles
+# ---------------
+# Nearest rank method, values must be sorted
+
+def get_percentiles(sorted_values):
+
+  percentiles = {}
+
+  for percentile in PERCENTILES:
+    rank = max(1, math.ceil(percentile / 100 * len(sorted_values)))
+    percentiles["p" + format(percentile, "g")] = float(sorted_values[rank - 1])
+
+  return { "percentiles": percentiles }
+
+# get_histogram
+# -------------
+
+def get_histogram(sorted_values, bounds):
+
+  histogram = []
+  previous  = 0
+
+  for bound in bounds:
+    position = bisect.bisect_right(sorted_values, bound)
+    histogram.append({ "le": bound, "count": position - previous })
+    previous = position
+
+  histogram.append({ "le": "+Inf", "count": len(sorted_values) - previous })
+
+  return { "histogram": histogram }
+
+# get_distribution
+# ----------------
+# min, max, total, avg, percentiles and histogram of a list of values
 
-    if diff_mem < limit_value_diff_mem:
-      under_limit_diff_mem += 1
-    else:
-      over_limit_diff_mem += 1
+def get_distribution(values, bounds):
 
-  # Send the results to CloudWatch
-  # ------------------------------
+  sorted_values = sorted(values)
+  distribution  = { "count": len(sorted_values), "histogram": get_histogram(sorted_values, bounds)["histogram"] }
+
+  if (sorted_values):
+    distribution["min"]         = sorted_values[0]
+    distribution["max"]         = sorted_values[-1]
+    distribution["total"]       = sum(sorted_values)
+    distribution["avg"]         = distribution["total"] / len(sorted_values)
+    distribution["percentiles"] = get_percentiles(sorted_values)["percentiles"]
+
+  return distribution
+
+# get_distribution_numpy
+# ----------------------
+# Same result as get_distribution, for the offline analysis of large log exports
+
+def get_distribution_numpy(numpy, values, bounds):
+
+  sorted_values = numpy.sort(numpy.frombuffer(values, dtype = numpy.float64))
+  positions     = numpy.searchsorted(sorted_values, numpy.array(bounds, dtype = numpy.float64), side = "right")
+  counts        = numpy.diff(numpy.concatenate(([0], positions, [len(sorted_values)])))
+
+  histogram     = [{ "le": bound, "count": int(count) } for bound, count in zip(bounds + ["+Inf"], counts)]
+  distribution  = { "count": len(sorted_values), "histogram": histogram }
+
+  if (len(sorted_values) > 0):
+    distribution["min"]         = float(sorted_values[0])
+    distribution["max"]         = float(sorted_values[-1])
+    distribution["total"]       = float(sorted_values.sum())
+    distribution["avg"]         = distribution["total"] / len(sorted_values)
+    distribution["percentiles"] = get_percentiles(sorted_values)["percentiles"]
+
+  return distribution
+
+# get_statistics
+# --------------
+# Duration is the time it really took to execute the Lambda function, the billed duration is the
+# duration that is rounded up. 
+#
+# The old way to guess how often a new instance is started: the number of milliseconds is higher 
+# than limit_value_duration. The real number of cold starts is the number of REPORT lines with an
+# Init Duration.
+#
+# Memory size is the memory size that we asked for (the "slider" in the Lambda gui), this number
+# will be the same in all the records. When the memory we really used is almost the same, we want
+# to know this: when this happens a lot, you might want to consider to configure more memory for 
+# the lambda function that is checked.
+#
+# numpy is the NumPy module for the offline analysis, or None.
+
+def get_statistics(columns, limit_value_duration, limit_value_diff_mem, numpy = None):
+
+  statistics = { "number_of_records"     : len(columns["duration"]),
+                 "first_timestamp"       : columns["first_timestamp"],
+                 "last_timestamp"        : columns["last_timestamp"],
+                 "limit_value_duration"  : limit_value_duration,
+                 "limit_value_diff_mem"  : limit_value_diff_mem,
+                 "current_memory_config" : int(columns["memory_size"][-1]) }
+
+  if (numpy == None):
+
+    distributions        = { name: get_distribution(columns[column], bounds) for name, column, bounds in HISTOGRAMS }
+    under_limit_duration = sum(1 for duration in columns["duration"] if duration < limit_value_duration)
+    under_limit_diff_mem = sum(1 for memory_size, max_memory_used in zip(columns["memory_size"], columns["max_memory_used"]) 
+                                 if memory_size - max_memory_used < limit_value_diff_mem)
+
+  else:
+
+    distributions        = { name: get_distribution_numpy(numpy, columns[column], bounds) for name, column, bounds in HISTOGRAMS }
+    durations            = numpy.frombuffer(columns["duration"], dtype = numpy.float64)
+    diff_mem             = numpy.frombuffer(columns["memory_size"], dtype = numpy.float64) - numpy.frombuffer(columns["max_memory_used"], dtype = numpy.float64)
+    under_limit_duration = int(numpy.count_nonzero(durations < limit_value_duration))
+    under_limit_diff_mem = int(numpy.count_nonzero(diff_mem < limit_value_diff_mem))
+
+  statistics["distributions"]        = distributions
+  statistics["cold_starts"]          = distributions["init_duration"]["count"]
+  statistics["under_limit_duration"] = under_limit_duration
+  statistics["over_limit_duration"]  = statistics["number_of_records"] - under_limit_duration
+  statistics["under_limit_diff_mem"] = under_limit_diff_mem
+  statistics["over_limit_diff_mem"]  = statistics["number_of_records"] - under_limit_diff_mem
+
+  return statistics
+
+# print_percentiles
+# -----------------
+
+def print_percentiles(name, distribution):
+
+  for percentile, value in distribution["percentiles"].items():
+    print("INFO: " + format(name + "_" + percentile, "<21") + ":" + format(value, ".2f"))
+
+  return
+
+# print_statistics
+# ----------------
+# Returns the histograms, one line of json per log group is printed
+
+def print_statistics(log_group, statistics):
+
+  number_of_records = statistics["number_of_records"]
+  duration          = statistics["distributions"]["duration"]
+  billed_duration   = statistics["distributions"]["billed_duration"]
+  init_duration     = statistics["distributions"]["init_duration"]
+  memory_used       = statistics["distributions"]["memory_used"]
 
   print("INFO: Log group            : " + log_group)      
-  print("INFO: first_timestamp      : " + first_timestamp)
-  print("INFO: last_timestamp       : " + last_timestamp)
+  print("INFO: first_timestamp      : " + statistics["first_timestamp"])
+  print("INFO: last_timestamp       : " + (statistics["last_timestamp"] if (number_of_records > 1) else "n/a"))
   print("INFO: number_of_records    :"  + str(number_of_records))
 
   print("INFO: ")
 
-  print("INFO: min_duration         :"  + str(min_duration))
-  print("INFO: max_duration         :"  + str(max_duration))
-  print("INFO: total_duration       :"  + str(total_duration))
-  print("INFO: avg_duration         :"  + format(total_duration / number_of_records,".2f")) 
-  print("INFO: total_billed_duration:"  + str(total_billed_duration))
-  print("INFO: avg_billed_duration  :"  + format(total_billed_duration / number_of_records,".2f"))
-  print("INFO: limit_value_duration :"  + str(limit_value_duration))
-  print("INFO: under_limit_duration :"  + str(under_limit_duration))
-  print("INFO: over_limit_duration  :"  + str(over_limit_duration))
+  print("INFO: min_duration         :"  + format(duration["min"], ".2f"))
+  print("INFO: max_duration         :"  + format(duration["max"], ".2f"))
+  print("INFO: total_duration       :"  + format(duration["total"], ".2f"))
+  print("INFO: avg_duration         :"  + format(duration["avg"], ".2f")) 
+  print_percentiles("duration", duration)
+  print("INFO: total_billed_duration:"  + format(billed_duration["total"], ".0f"))
+  print("INFO: avg_billed_duration  :"  + format(billed_duration["avg"], ".2f"))
+  print_percentiles("billed_duration", billed_duration)
+  print("INFO: limit_value_duration :"  + str(statistics["limit_value_duration"]))
+  print("INFO: under_limit_duration :"  + str(statistics["under_limit_duration"]))
+  print("INFO: over_limit_duration  :"  + str(statistics["over_limit_duration"]))
+
+  print("INFO: ")
+
+  print("INFO: cold_starts          :"  + str(statistics["cold_starts"]))
+
+  if (statistics["cold_starts"] > 0):
+    print("INFO: min_init_duration    :"  + format(init_duration["min"], ".2f"))
+    print("INFO: max_init_duration    :"  + format(init_duration["max"], ".2f"))
+    print("INFO: avg_init_duration    :"  + format(init_duration["avg"], ".2f"))
+    print_percentiles("init_duration", init_duration)
 
   print("INFO: ")
   
-  print("INFO: min_memory used      :"  + str(min_mem))
-  print("INFO: max_memory used      :"  + str(max_mem))
-  print("INFO: avg_memory used      :"  + format(total_mem / number_of_records,".2f")) 
-  print("INFO: configured memory    :"  + str(current_memory_config))
-  print("INFO: limit_value_diff_mem :"  + str(limit_value_diff_mem))
-  print("INFO: under_limit_diff_mem :"  + str(under_limit_diff_mem))
-  print("INFO: over_limit_diff_mem  :"  + str(over_limit_diff_mem))
+  print("INFO: min_memory used      :"  + format(memory_used["min"], ".0f"))
+  print("INFO: max_memory used      :"  + format(memory_used["max"], ".0f"))
+  print("INFO: avg_memory used      :"  + format(memory_used["avg"], ".2f")) 
+  print_percentiles("memory_used", memory_used)
+  print("INFO: configured memory    :"  + str(statistics["current_memory_config"]))
+  print("INFO: limit_value_diff_mem :"  + str(statistics["limit_value_diff_mem"]))
+  print("INFO: under_limit_diff_mem :"  + str(statistics["under_limit_diff_mem"]))
+  print("INFO: over_limit_diff_mem  :"  + str(statistics["over_limit_diff_mem"]))
+
+  print("INFO: ")
+
+  histograms = { "log_group": log_group, "records": number_of_records }
+
+  for name, column, bounds in HISTOGRAMS:
+    histograms[name] = statistics["distributions"][name]["histogram"]
+
+  print("INFO: histograms: " + json.dumps(histograms))
+  print("INFO: ")
+
+  return { "histograms": histograms }
+
+# stats_cloudwatch
+# ----------------
+
+def stats_cloudwatch(log_group, results):
+
+  print("DEBUG: log_group = "+log_group)
+
+  if (not results):
+    print("INFO: Log group            : " + log_group + " - no REPORT lines")
+    print("INFO: ")
+    return
+
+  columns = new_columns()
+
+  for line in results:
+    add_row(columns, parse_report_row(line))
+
+  statistics = get_statistics(columns, int(os.environ["limit_value_duration"]), int(os.environ["limit_value_diff_mem"]))
+  response   = print_statistics(log_group, statistics)
+
+  return { "histograms": response["histograms"], "statistics": statistics }
+
+# get_end_to_end_query
+# --------------------
+# shop_update_db (split mode) and shop_decrypt_update_db (fused mode) log the time between the 
+# creation of the message_id and the update of the database in "INFO: end_to_end:" lines.
+
+def get_end_to_end_query():
+
+  query = "FIELDS @message | "                                        + \
+          "FILTER @message like /INFO: end_to_end:/ | "               + \
+          "PARSE @message \"latency_ms: *\" as latency_ms | "        + \
+          "STATS count(*) as messages, avg(latency_ms) as avg_ms, "   + \
+          "pct(latency_ms, 50) as p50_ms, pct(latency_ms, 90) as p90_ms, pct(latency_ms, 99) as p99_ms, max(latency_ms) as max_ms"
+
+  return { "query": query }
+
+# stats_end_to_end
+# ----------------
+
+def stats_end_to_end(log_group, results):
+
+  stats    = None
+
+  if (results):
+
+    stats = {}
+    for field in results[0]:
+      stats[field["field"]] = field["value"]
+
+    if (int(stats.get("messages", "0")) == 0):
+      stats = None
+
+  if (stats == None):
+
+    print("INFO: End to end latency   : " + log_group + " - no messages")
+
+  else:
+
+    print("INFO: End to end latency   : " + log_group)
+    print("INFO: messages             :" + stats["messages"])
+    for name in ["avg_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms"]:
+      print("INFO: " + format(name, "<21") + ":" + format(float(stats[name]), ".2f"))
+
+  print("INFO: ")
+
+  return { "stats": stats }
+
+# compare_end_to_end
+# ------------------
+# Only when the perftest ran in both modes within the time window of the queries
+
+def compare_end_to_end(split_stats, fused_stats):
+
+  if ((split_stats == None) or (fused_stats == None)):
+    print("INFO: End to end latency split vs fused: run the perftest in both modes to compare")
+    return
+
+  for name in ["avg_ms", "p50_ms", "p90_ms", "p99_ms"]:
+    difference = float(split_stats[name]) - float(fused_stats[name])
+    print("INFO: End to end latency split - fused, " + format(name, "<6") + ": " + format(difference, ".2f"))
+
+  print("INFO: ")
+
+  return
+
+# Pipeline traces
+# ---------------
+# Every stage of the shop pipeline writes "TRACE: stage: ..., shop_id: ..., message_id: ..., 
+# timestamp_ms: ..." lines (see trace in shop_log.py). The lines of all log groups are joined on 
+# message_id. An interval is only counted for messages that have both stages: in the fused mode
+# (shop_decrypt_update_db) there is no decrypt_published and no update_db_received.
+
+TRACE_PREFIX    = "TRACE: "
+
+TRACE_INTERVALS = [("accept",             "accept_received",    "accept_published"),
+                   ("queue_to_decrypt",   "accept_published",   "decrypt_received"),
+                   ("decrypt",            "decrypt_received",   "decrypt_published"),
+                   ("queue_to_update_db", "decrypt_published",  "update_db_received"),
+                   ("update_db",          "update_db_received", "update_db_committed"),
+                   ("decrypt_to_commit",  "decrypt_received",   "update_db_committed"),
+                   ("total",              "accept_received",    "update_db_committed")]
+
+# get_trace_query
+# ---------------
+
+def get_trace_query():
+
+  query = "FIELDS @message | "                                                                    + \
+          "FILTER @message like /^TRACE: / | "                                                    + \
+          "PARSE @message \"TRACE: stage: *, shop_id: *, message_id: *, timestamp_ms: *\" as stage, shop_id, message_id, timestamp_ms | " + \
+          "DISPLAY stage, message_id, timestamp_ms"
+
+  return { "query": query }
+
+# parse_trace_message
+# -------------------
+# For the offline analysis, returns None for other lines
+
+def parse_trace_message(message):
+
+  if (not message.startswith(TRACE_PREFIX)):
+    return None
+
+  fields = {}
 
+  for part in message[len(TRACE_PREFIX):].strip().split(", "):
+    name, separator, value = part.partition(": ")
+    fields[name] = value
+
+  return { "stage": fields["stage"], "message_id": fields["message_id"], "timestamp_ms": fields["timestamp_ms"] }
+
+# add_trace
+# ---------
+# traces: { message_id: { stage: timestamp_ms } }. When a stage is done more than once (retries, 
+# double messages) the first moment is used.
+
+def add_trace(traces, row):
+
+  stages       = traces.setdefault(row["message_id"], {})
+  timestamp_ms = int(row["timestamp_ms"])
+
+  if ((row["stage"] not in stages) or (timestamp_ms < stages[row["stage"]])):
+    stages[row["stage"]] = timestamp_ms
+
+  return
+
+# get_trace_statistics
+# --------------------
+
+def get_trace_statistics(traces):
+
+  intervals     = { name: [] for name, begin, end in TRACE_INTERVALS }
+  not_committed = 0
+
+  for stages in traces.values():
+
+    for name, begin, end in TRACE_INTERVALS:
+      if ((begin in stages) and (end in stages)):
+        intervals[name].append(stages[end] - stages[begin])
+
+    if ("update_db_committed" not in stages):
+      not_committed += 1
+
+  distributions = { name: get_distribution(values, DURATION_BUCKETS_MS) for name, values in intervals.items() }
+
+  return { "messages": len(traces), "not_committed": not_committed, "distributions": distributions }
+
+# print_trace_statistics
+# ----------------------
+# Messages that were accepted just before the end of the time window can still be on their way.
+
+def print_trace_statistics(statistics):
+
+  print("INFO: Pipeline traces      : " + str(statistics["messages"]) + " messages")
+  print("INFO: not_committed        :" + str(statistics["not_committed"]))
+
+  for name, begin, end in TRACE_INTERVALS:
+
+    distribution = statistics["distributions"][name]
+
+    if (distribution["count"] == 0):
+      continue
+
+    print("INFO: ")
+    print("INFO: " + format(name + "_ms", "<21") + ": " + begin + " -> " + end + ", " + str(distribution["count"]) + " messages")
+    print("INFO: " + format(name + "_avg", "<21") + ":" + format(distribution["avg"], ".2f"))
+    print_percentiles(name, distribution)
+    print("INFO: " + format(name + "_max", "<21") + ":" + format(distribution["max"], ".2f"))
+
+  histograms = { name: statistics["distributions"][name]["histogram"] for name, begin, end in TRACE_INTERVALS }
+
+  print("INFO: trace histograms: " + json.dumps(histograms))
   print("INFO: ")
 
   return
 
+# stats_traces
+# ------------
+
+def stats_traces(results_per_log_group):
+
+  traces = {}
+
+  for results in results_per_log_group:
+    for line in (results or []):
+      add_trace(traces, get_fields(line))
+
+  if (not traces):
+    print("INFO: Pipeline traces      : no TRACE lines")
+    print("INFO: ")
+    return
+
+  statistics = get_trace_statistics(traces)
+  print_trace_statistics(statistics)
+
+  return { "statistics": statistics }
+
+# Run records
+# -----------
+# The results of a run are stored as a versioned json record, in a local directory or under an S3
+# prefix ("s3://bucket/prefix"), so later runs can be compared with a baseline (see 
+# client/perftest_compare.py). The name of a record is the run_id, f.e. perftest-20210131T123456Z.json:
+# sorted by name, the last record is the latest run.
+#
+# Record version 1:
+# { "version": 1, "run_id": ..., "created": ..., "window": { "start_time", "end_time" },
+#   "functions"  : { function: { "records", "cold_starts", "cold_start_rate", "memory_size", 
+#                                "memory_headroom_mb", "under_limit_diff_mem", "throughput_per_second",
+#                                "duration", "billed_duration", "init_duration", "memory_used" } },
+#   "end_to_end" : { "split": ..., "fused": ... },
+#   "traces"     : { "messages", "not_committed", interval: { "count", "avg", "max", "p50", ... } } }
+
+RUN_RECORD_VERSION = 1
+RUN_RECORD_PREFIX  = "perftest-"
+RUN_RECORD_SUFFIX  = ".json"
+TIMESTAMP_FORMAT   = "%Y-%m-%d %H:%M:%S.%f"
+
+# get_summary
+# -----------
+# The numbers of a distribution that are compared, without the histogram
+
+def get_summary(distribution):
+
+  summary = { "count": distribution["count"] }
+
+  if (distribution["count"] > 0):
+    summary["avg"] = distribution["avg"]
+    summary["max"] = distribution["max"]
+    summary.update(distribution["percentiles"])
+
+  return summary
+
+# get_throughput
+# --------------
+# Records per second between the first and the last REPORT line, None when it can't be computed
+
+def get_throughput(statistics):
+
+  try:
+    seconds = (datetime.strptime(statistics["last_timestamp"], TIMESTAMP_FORMAT) - 
+               datetime.strptime(statistics["first_timestamp"], TIMESTAMP_FORMAT)).total_seconds()
+  except (TypeError, ValueError):
+    return { "throughput_per_second": None }
+
+  if (seconds <= 0):
+    return { "throughput_per_second": None }
+
+  return { "throughput_per_second": statistics["number_of_records"] / seconds }
+
+# get_function_record
+# -------------------
+# Memory headroom: the configured memory size minus the highest memory use
+
+def get_function_record(statistics):
+
+  distributions = statistics["distributions"]
+
+  record = { "records"               : statistics["number_of_records"],
+             "cold_starts"           : statistics["cold_starts"],
+             "cold_start_rate"       : statistics["cold_starts"] / statistics["number_of_records"],
+             "memory_size"           : statistics["current_memory_config"],
+             "memory_headroom_mb"    : statistics["current_memory_config"] - distributions["memory_used"]["max"],
+             "under_limit_diff_mem"  : statistics["under_limit_diff_mem"],
+             "throughput_per_second" : get_throughput(statistics)["throughput_per_second"] }
+
+  for name, column, bounds in HISTOGRAMS:
+    record[name] = get_summary(distributions[name])
+
+  return record
+
+# get_run_record
+# --------------
+# statistics_per_function: { function: statistics (see get_statistics) or None }
+
+def get_run_record(window, statistics_per_function, end_to_end = None, trace_statistics = None):
+
+  created = datetime.utcnow()
+  record  = { "version"    : RUN_RECORD_VERSION,
+              "run_id"     : RUN_RECORD_PREFIX + created.strftime("%Y%m%dT%H%M%SZ"),
+              "created"    : created.isoformat() + "Z",
+              "window"     : window,
+              "functions"  : {},
+              "end_to_end" : {},
+              "traces"     : None }
+
+  # Logs Insights returns the values of STATS as strings
+
+  for mode, stats in (end_to_end or {}).items():
+    record["end_to_end"][mode] = { name: float(value) for name, value in stats.items() } if (stats != None) else None
+
+  for function, statistics in statistics_per_function.items():
+    if (statistics != None):
+      record["functions"][function] = get_function_record(statistics)
+
+  if (trace_statistics != None):
+    record["traces"] = { "messages": trace_statistics["messages"], "not_committed": trace_statistics["not_committed"] }
+    for name, distribution in trace_statistics["distributions"].items():
+      record["traces"][name] = get_summary(distribution)
+
+  return record
+
+# split_s3_location
+# -----------------
+# "s3://bucket/prefix/name" -> bucket, "prefix/name"
+
+def split_s3_location(location):
+
+  bucket, separator, key = location[len("s3://"):].partition("/")
+
+  return { "bucket": bucket, "key": key }
+
+# store_run_record
+# ----------------
+# location: a local directory or "s3://bucket/prefix". Returns the location of the record.
+
+def store_run_record(record, location):
+
+  name = record["run_id"] + RUN_RECORD_SUFFIX
+  body = json.dumps(record, indent = 2, sort_keys = True)
+
+  if (location.startswith("s3://")):
+
+    s3_location = split_s3_location(location.rstrip("/") + "/" + name)
+    s3          = boto3.client("s3")
+    s3.put_object(Bucket = s3_location["bucket"], Key = s3_location["key"], Body = body.encode("utf-8"), ContentType = "application/json")
+    record_location = "s3://" + s3_location["bucket"] + "/" + s3_location["key"]
+
+  else:
+
+    os.makedirs(location, exist_ok = True)
+    record_location = os.path.join(location, name)
+    with open(record_location, "w", encoding = "utf-8") as record_file:
+      record_file.write(body + "\n")
+
+  print("INFO: Run record stored in : " + record_location)
+
+  return { "location": record_location }
+
+# get_latest_location
+# -------------------
+# The location of the latest run record in a directory or under an S3 prefix, None when there is none
+
+def get_latest_location(location):
+
+  names = []
+
+  if (location.startswith("s3://")):
+
+    s3_location = split_s3_location(location.rstrip("/") + "/")
+    paginator   = boto3.client("s3").get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket = s3_location["bucket"], Prefix = s3_location["key"] + RUN_RECORD_PREFIX):
+      names += [item["Key"] for item in page.get("Contents", []) if item["Key"].endswith(RUN_RECORD_SUFFIX)]
+
+    latest = ("s3://" + s3_location["bucket"] + "/" + max(names)) if names else None
+
+  else:
+
+    names  = [name for name in os.listdir(location) if name.startswith(RUN_RECORD_PREFIX) and name.endswith(RUN_RECORD_SUFFIX)]
+    latest = os.path.join(location, max(names)) if names else None
+
+  return { "location": latest }
+
+# load_run_record
+# ---------------
+# location: a record (file or s3://bucket/key.json), or a directory or S3 prefix for the latest record
+
+def load_run_record(location):
+
+  if (not location.endswith(RUN_RECORD_SUFFIX)):
+    latest = get_latest_location(location)["location"]
+    if (latest == None):
+      raise FileNotFoundError("No run records in " + location)
+    location = latest
+
+  if (location.startswith("s3://")):
+    s3_location = split_s3_location(location)
+    response    = boto3.client("s3").get_object(Bucket = s3_location["bucket"], Key = s3_location["key"])
+    record      = json.loads(response["Body"].read())
+  else:
+    with open(location, "r", encoding = "utf-8") as record_file:
+      record = json.load(record_file)
+
+  if (record.get("version") != RUN_RECORD_VERSION):
+    raise ValueError("Unsupported version of run record " + location + ": " + str(record.get("version")))
+
+  return { "location": location, "record": record }
+
 # Main function
 # -------------
-# Event is not relevant. The accept function is pretty simple. There are just two test situations:
-#
-# - Check the good situation:     status_code = 200, function_error = "OK" 
-# - Check the an error situation
+# The event can contain the time window of the queries (see get_time_window), f.e.
+# { "hours": 6 } or { "start_time": 1609455600, "end_time": 1609459200 }. Default: the last 2 hours.
 
 def lambda_handler(event, context):
 
   print("DEBUG: BEGIN: event: "+json.dumps(event))
   name_prefix = os.environ['name_prefix']
 
-  response = stats_cloudwatch(name_prefix, "/aws/lambda/"+name_prefix+"_shop_accept")
-  response = stats_cloudwatch(name_prefix, "/aws/lambda/"+name_prefix+"_shop_decrypt")
-  response = stats_cloudwatch(name_prefix, "/aws/lambda/"+name_prefix+"_shop_update_db")
+  response    = get_time_window(event if isinstance(event, dict) else {})
+  start_time  = response["start_time"]
+  end_time    = response["end_time"]
+
+  # Keep 10 seconds to process the results
+
+  deadline    = time.time() + context.get_remaining_time_in_millis() / 1000 - 10
+
+  report_query     = get_report_query()["query"]
+  end_to_end_query = get_end_to_end_query()["query"]
+  trace_query      = get_trace_query()["query"]
+  functions        = FUNCTIONS
+
+  queries = [{ "name": function, "log_group": "/aws/lambda/"+name_prefix+"_"+function, "query": report_query, "split": True } for function in functions]
+  queries.append({ "name": "end_to_end_split", "log_group": "/aws/lambda/"+name_prefix+"_shop_update_db",         "query": end_to_end_query, "split": False })
+  queries.append({ "name": "end_to_end_fused", "log_group": "/aws/lambda/"+name_prefix+"_shop_decrypt_update_db", "query": end_to_end_query, "split": False })
+  queries += [{ "name": "trace_" + function, "log_group": "/aws/lambda/"+name_prefix+"_"+function, "query": trace_query, "split": True } for function in functions]
+
+  print("INFO: Time window          : " + datetime.fromtimestamp(start_time).isoformat() + " - " + datetime.fromtimestamp(end_time).isoformat())
+  print("INFO: ")
+
+  response = run_queries(queries, start_time, end_time, deadline)
+  results  = response["results"]
+
+  statistics_per_function = {}
+
+  for function in functions:
+    response = stats_cloudwatch("/aws/lambda/"+name_prefix+"_"+function, results[function])
+    statistics_per_function[function] = response["statistics"] if response else None
+
+  split_stats = stats_end_to_end("/aws/lambda/"+name_prefix+"_shop_update_db", results["end_to_end_split"])["stats"]
+  fused_stats = stats_end_to_end("/aws/lambda/"+name_prefix+"_shop_decrypt_update_db", results["end_to_end_fused"])["stats"]
+  compare_end_to_end(split_stats, fused_stats)
+
+  response    = stats_traces([results["trace_" + function] for function in functions])
+
+  record      = get_run_record({ "start_time": start_time, "end_time": end_time }, 
+                               statistics_per_function, 
+                               { "split": split_stats, "fused": fused_stats }, 
+                               response["statistics"] if response else None)
+
+  if (os.environ.get("results_location")):
+    store_run_record(record, os.environ["results_location"])
     
   print("DEBUG: DONE: event: " + json.dumps(event))
 
 
+# Offline analysis
+# ================
+# The same statistics for CloudWatch log exports, without Logs Insights (no query limits, no cost).
+# Example, on a laptop with NumPy (without NumPy the statistics are computed in plain python):
+#
+#   python3 perftest_get_stats.py --log-group shop_decrypt export/*.gz subscription_payloads.json
+#
+# Supported files, plain or gzipped:
+# - exports to S3: one event per line, "<timestamp> <message>"
+# - awslogs payloads of subscription filters: {"awslogs": {"data": "<base64 of gzipped json>"}},
+#   one or more per line (the format unittest_support_send_logs_from_unittest_support_echo gets)
+# - decoded payloads ({"logGroup": ..., "logEvents": [...]}), f.e. delivered by Firehose
+# - output of aws logs filter-log-events ({"events": [...]})
+#
+# Payloads contain the name of the log group, for other files --log-group is used. TRACE lines of all
+# files are joined on message_id (see Pipeline traces).
+
+REPORT_PREFIX = "REPORT RequestId: "
+GZIP_MAGIC    = b"\x1f\x8b"
+
+# parse_report_message
+# --------------------
+# "REPORT RequestId: ...<tab>Duration: 12.34 ms<tab>Billed Duration: 13 ms<tab>Memory Size: 128 MB
+# <tab>Max Memory Used: 70 MB<tab>Init Duration: 456.78 ms<tab>" (Init Duration for cold starts only)
+
+def parse_report_message(timestamp, message):
+
+  fields = {}
+
+  for part in message.split("\t")[1:]:
+    name, separator, value = part.partition(": ")
+    if (separator):
+      fields[name.strip()] = value.split(" ")[0]
+
+  init_duration = fields.get("Init Duration")
+
+  return { "timestamp"       : timestamp,
+           "duration"        : float(fields["Duration"]),
+           "billed_duration" : float(fields["Billed Duration"]),
+           "memory_size"     : float(fields["Memory Size"]),
+           "max_memory_used" : float(fields["Max Memory Used"]),
+           "init_duration"   : float(init_duration) if (init_duration != None) else None }
+
+# timestamp_from_epoch_ms
+# -----------------------
+# Same format as @timestamp in Logs Insights, so first/last timestamps compare as strings
+
+def timestamp_from_epoch_ms(epoch_ms):
+
+  timestamp = datetime.utcfromtimestamp(epoch_ms / 1000).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+  return { "timestamp": timestamp }
+
+# timestamp_from_export
+# ---------------------
+# "2021-01-31T12:34:56.789Z" -> "2021-01-31 12:34:56.789"
+
+def timestamp_from_export(text):
+
+  timestamp = text.strip().replace("T", " ").rstrip("Z")
+
+  return { "timestamp": timestamp }
+
+# open_log_file
+# -------------
+
+def open_log_file(path):
+
+  with open(path, "rb") as log_file:
+    magic = log_file.read(2)
+
+  if (magic == GZIP_MAGIC):
+    return gzip.open(path, "rt", encoding = "utf-8")
+
+  return open(path, "r", encoding = "utf-8")
+
+# get_events_from_document
+# ------------------------
+# Yields (log_group, timestamp, message) for the log events in a decoded json document
+
+def get_events_from_document(document, log_group):
+
+  if ("awslogs" in document):
+    document = json.loads(gzip.decompress(base64.b64decode(document["awslogs"]["data"])))
+
+  log_group = document.get("logGroup", log_group)
+
+  for log_event in document.get("logEvents", document.get("events", [])):
+    yield (log_group, timestamp_from_epoch_ms(log_event["timestamp"])["timestamp"], log_event["message"])
+
+# get_events_from_file
+# --------------------
+# Yields (log_group, timestamp, message), for exports to S3 only the REPORT and TRACE lines. Files 
+# are read line by line, a json document that doesn't fit on one line (f.e. the output of aws logs 
+# filter-log-events) is read as a whole.
+
+def get_events_from_file(path, log_group):
+
+  decoder = json.JSONDecoder()
+
+  with open_log_file(path) as log_file:
+
+    for line in log_file:
+
+      line = line.strip()
+
+      if (line.startswith("{")):
+
+        try:
+
+          position = 0
+          while (position < len(line)):
+            document, position = decoder.raw_decode(line, position)
+            yield from get_events_from_document(document, log_group)
+            while ((position < len(line)) and line[position].isspace()):
+              position += 1
+
+        except ValueError:
+
+          log_file.seek(0)
+          yield from get_events_from_document(json.load(log_file), log_group)
+          return
+
+      else:
+
+        pos_message = line.find(REPORT_PREFIX)
+        if (pos_message < 0):
+          pos_message = line.find(TRACE_PREFIX)
+
+        if (pos_message >= 0):
+          yield (log_group, timestamp_from_export(line[:pos_message])["timestamp"], line[pos_message:])
+
+# analyze_files
+# -------------
+# Returns the columns (see new_columns) per log group and the traces (see add_trace)
+
+def analyze_files(paths, log_group):
+
+  columns_per_log_group = {}
+  traces                = {}
+
+  for path in paths:
+    for event_log_group, timestamp, message in get_events_from_file(path, log_group):
+
+      if (not message.startswith(REPORT_PREFIX)):
+        row = parse_trace_message(message)
+        if (row != None):
+          add_trace(traces, row)
+        continue
+
+      if (event_log_group not in columns_per_log_group):
+        columns_per_log_group[event_log_group] = new_columns()
+
+      add_row(columns_per_log_group[event_log_group], parse_report_message(timestamp, message))
+
+  return { "columns_per_log_group": columns_per_log_group, "traces": traces }
+
+# get_parameters
+# --------------
+
+def get_parameters():
+
+  parser = argparse.ArgumentParser(description = "Statistics of the REPORT lines in CloudWatch log exports")
+  parser.add_argument("files", nargs = "+", help = "log exports, plain or gzipped")
+  parser.add_argument("--log-group",            default = "offline", help = "name for events without log group (exports to S3)")
+  parser.add_argument("--limit-value-duration", type = int, default = int(os.environ.get("limit_value_duration", "500")))
+  parser.add_argument("--limit-value-diff-mem", type = int, default = int(os.environ.get("limit_value_diff_mem", "28")))
+  parser.add_argument("--no-numpy",             action = "store_true", help = "compute the statistics in plain python")
+  parser.add_argument("--results-location",     default = os.environ.get("results_location"), help = "directory or s3://bucket/prefix to store the run record")
+
+  arguments = parser.parse_args()
+
+  return { "files"                : arguments.files,
+           "log_group"            : arguments.log_group,
+           "limit_value_duration" : arguments.limit_value_duration,
+           "limit_value_diff_mem" : arguments.limit_value_diff_mem,
+           "no_numpy"             : arguments.no_numpy,
+           "results_location"     : arguments.results_location }
+
+# get_function_name
+# -----------------
+# The run records use the names of the functions, log groups are "/aws/lambda/<name_prefix>_<function>".
+# Other names (f.e. --log-group) are used as they are.
+
+def get_function_name(log_group):
+
+  name = log_group.split("/")[-1]
+
+  for function in FUNCTIONS:
+    if ((name == function) or name.endswith("_" + function)):
+      return { "function": function }
+
+  return { "function": log_group }
+
+# offline_main
+# ------------
+
+def offline_main():
+
+  parameters = get_parameters()
+  numpy      = None
+
+  if (not parameters["no_numpy"]):
+    try:
+      numpy = importlib.import_module("numpy")
+    except ImportError:
+      print("INFO: NumPy is not installed, the statistics are computed in plain python")
+
+  start_time = time.perf_counter()
+  response   = analyze_files(parameters["files"], parameters["log_group"])
+  read_time  = time.perf_counter() - start_time
+
+  statistics_per_log_group = {}
+  trace_statistics         = None
+
+  for log_group, columns in sorted(response["columns_per_log_group"].items()):
+    statistics = get_statistics(columns, parameters["limit_value_duration"], parameters["limit_value_diff_mem"], numpy)
+    print_statistics(log_group, statistics)
+    statistics_per_log_group[log_group] = statistics
+
+  if (not response["columns_per_log_group"]):
+    print("INFO: No REPORT lines found")
+
+  if (response["traces"]):
+    trace_statistics = get_trace_statistics(response["traces"])
+    print_trace_statistics(trace_statistics)
+
+  if (parameters["results_location"]):
+    statistics_per_function = { get_function_name(log_group)["function"]: statistics for log_group, statistics in statistics_per_log_group.items() }
+    window                  = { "first_timestamp": min(statistics["first_timestamp"] for statistics in statistics_per_log_group.values()),
+                                "last_timestamp" : max(statistics["last_timestamp"]  for statistics in statistics_per_log_group.values()) } if statistics_per_log_group else {}
+    store_run_record(get_run_record(window, statistics_per_function, None, trace_statistics), parameters["results_location"])
+
+  print("DEBUG: read in " + format(read_time, ".2f") + " s, total " + format(time.perf_counter() - start_time, ".2f") + " s")
+
+  return
+
+if __name__ == "__main__":
+  offline_main()
@@ -4,29 +4,58 @@ import boto3
 import os
 import base64
 import time
+import threading
+import concurrent.futures
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 # FUNCTION NAME is the function name of the object under test (with AMIS_ prefix). 
-# It is used to read or change the settings of this function (for creating an error 
-# by changing the SNS ARN to a non existing ARN).
+# It is used to read the settings of this function and to publish versions of it with 
+# errors (f.e. a non existing SNS ARN), see get_error_version.
 
 NAME_PREFIX        = os.environ["name_prefix"]
 NAME               = "unittest_object_under_test_accept"
 FUNCTION_NAME      = NAME_PREFIX + "_" + NAME
 
-# search_for_elements_with_attribute_is_value_in_list
-# ---------------------------------------------------
-# (see also: https://stackoverflow.com/questions/8653516/python-list-of-dictionaries-search ) 
+# The testcases run at the same time in MAX_WORKERS threads. Error testcases don't change the
+# environment of the object under test, they invoke a published version with their own environment
+# (see get_error_version). UPDATE_TIMEOUT is the maximum time in seconds for a configuration update.
 
-def search_for_elements_with_attribute_is_value_in_list(attribute, value, list):
-    return [element for element in list if element[attribute] == value]
+MAX_WORKERS    = int(os.environ.get("max_workers", "16"))
+UPDATE_TIMEOUT = 60
+
+# Maximum time in seconds to wait for the test_ids that are expected on SNS, see check_SNS_topic.
+# SNS_CHECK_MARGIN is the time in seconds that is left for the end of the function.
+
+SNS_CHECK_TIMEOUT = int(os.environ.get("sns_check_timeout", "60"))
+SNS_CHECK_MARGIN  = 5
+
+# Versions of the object under test for the error testcases: { name: version }
+
+error_versions = {}
+
+# get_client
+# ----------
+# boto3.client() is not thread safe, the clients themselves are. Every client is created once,
+# with a connection pool for all threads.
+
+_clients      = {}
+_clients_lock = threading.Lock()
+
+def get_client(service_name):
+
+  with _clients_lock:
+    if (service_name not in _clients):
+      _clients[service_name] = boto3.client(service_name, config = Config(max_pool_connections = MAX_WORKERS))
+
+  return _clients[service_name]
 
 # get_function_configuration
 # --------------------------
 
 def get_function_configuration():
   
-  lambdaclient = boto3.client("lambda")
+  lambdaclient = get_client("lambda")
   response     = lambdaclient.get_function_configuration(
     FunctionName = FUNCTION_NAME
   )
@@ -39,13 +68,15 @@ def get_function_configuration():
 
 def update_function_configuration(environment):
 
-  lambdaclient = boto3.client('lambda')
+  lambdaclient = get_client('lambda')
   response     = lambdaclient.update_function_configuration(
     FunctionName = FUNCTION_NAME,
     Environment  = environment
   )
   print("DEBUG: Response of lambdaclient.update_function_configuration: "+json.dumps(response))
 
+  wait_for_function_update()
+
   return
 
 # update_environment_variables
@@ -60,15 +91,87 @@ def update_environment_variables(function_configuration, environment_variables):
 
   return 
 
+# wait_for_function_update
+# ------------------------
+# A new configuration isn't used immediately: poll LastUpdateStatus until the update is done
+
+def wait_for_function_update():
+
+  lambdaclient = get_client('lambda')
+  deadline     = time.monotonic() + UPDATE_TIMEOUT
+
+  while True:
+
+    response = lambdaclient.get_function_configuration(
+      FunctionName = FUNCTION_NAME
+    )
+    status   = response.get("LastUpdateStatus", "Successful")
+
+    if (status == "Successful"):
+      return { "succeeded": True }
+
+    if ((status == "Failed") or (time.monotonic() > deadline)):
+      print("ERROR: update of the configuration of " + FUNCTION_NAME + ": " + status + " " + response.get("LastUpdateStatusReason", ""))
+      return { "succeeded": False }
+
+    time.sleep(0.5)
+
+# get_error_version
+# -----------------
+# Returns a published version of the object under test with the environment variables of an error
+# testcase. A version of an earlier run is used again when its code, configuration and environment
+# are the same. Otherwise $LATEST gets these environment variables, is published and gets its own 
+# environment back. This is done before the testcases are started, so no testcase sees the changed
+# $LATEST. The version is None when it couldn't be published.
+
+VERSION_KEYS = ["CodeSha256", "Layers", "Handler", "Runtime", "Role", "MemorySize", "Timeout"]
+
+def get_error_version(description, environment_variables):
+
+  lambdaclient               = get_client('lambda')
+  response                   = get_function_configuration()
+  function_configuration_org = response["function_configuration"]
+
+  for page in lambdaclient.get_paginator("list_versions_by_function").paginate(FunctionName = FUNCTION_NAME):
+    for version in page["Versions"]:
+
+      if ((version["Version"] != "$LATEST") and 
+          (version.get("Description") == description) and
+          (version.get("Environment", {}).get("Variables") == environment_variables) and
+          all(version.get(key) == function_configuration_org.get(key) for key in VERSION_KEYS)):
+
+        print("INFO: " + description + ": version " + version["Version"])
+        return { "version": version["Version"] }
+
+  update_environment_variables(function_configuration_org, environment_variables)
+
+  try:
+    response = lambdaclient.publish_version(
+      FunctionName = FUNCTION_NAME,
+      CodeSha256   = function_configuration_org["CodeSha256"],
+      Description  = description
+    )
+    print("DEBUG: Response of lambdaclient.publish_version: "+json.dumps(response))
+    version  = response["Version"]
+    print("INFO: " + description + ": published version " + version)
+  except ClientError as e:
+    print("ERROR: " + description + ": " + str(e))
+    version  = None
+
+  update_environment_variables(function_configuration_org, function_configuration_org["Environment"]["Variables"])
+
+  return { "version": version }
+
 # invoke_lambda
 # -------------
 
-def invoke_lambda(test_id, event, expected_status_code, checkstring):
+def invoke_lambda(test_id, event, expected_status_code, checkstring, version = "$LATEST"):
 
-  lambdaclient = boto3.client('lambda')
+  lambdaclient = get_client('lambda')
 
   response     = lambdaclient.invoke(
     FunctionName   = FUNCTION_NAME,
+    Qualifier      = version,
     InvocationType = "RequestResponse",
     LogType        = "Tail",
     Payload        = bytearray(json.dumps(event),'utf-8')
@@ -105,81 +208,87 @@ def get_test_id_from_body(body_string):
 # check_SNS_topic
 # ---------------
 # We can check what is sent to the SNS topic, because there is an echo function behind the
-# SNS topic which will send all the information to cloudwatch. The logs of that echo function 
+# SNS topic which will send all the information to CloudWatch. The logs of that echo function 
 # are sent to the SQS queue cloudwatch_messages_echo by the Lambda function 
-# unittest_support_send_logs_support_echo. The queue is filled by a CloudWatch log filter, 
-# next to real time (in my environment: about 10 seconds between invocation of the first 
-# "good" Lambda function and getting back the results)
+# unittest_support_send_logs_support_echo. The queue is filled by a CloudWatch log filter,
+# next to real time (in my environment: about 10 seconds between invocation of the first
+# "good" Lambda function and getting back the results).
 #
-# We'll wait for 3 x 5 seconds after the last message was comming (this is still 
-# less than the 4 minutes we had to wait for the non-next-to-realtime CloudWatch 
-# query to finish). When there are no results at all, this unittest_test function will be
-# aborted by AWS when the timeout time is reached.
+# The queue is read with long polling until every test_id that is expected on SNS has arrived,
+# or until the deadline (the expected test_ids that haven't arrived then are errors). After that, 
+# the messages that are already on the queue are read once more: they may contain test_ids that 
+# were not expected on SNS.
 
-def check_SNS_topic(checklist):
+def check_SNS_topic(checklist, deadline):
 
-  sqs                       = boto3.client("sqs")
-  sqs_queue_url             = os.environ['sqs_queue_url']
+  sqs           = get_client("sqs")
+  sqs_queue_url = os.environ['sqs_queue_url']
 
-  wait_for_first_message    = True
-  max_reads_after_first_msg = 3
+  # checks: { test_id: will_be_sent_to_SNS }, waiting_for: the expected test_ids that didn't arrive yet
 
-  no_reads_after_first_msg  = 0
-  ok                        = 0
-  errors                    = 0
-  
-  while ((wait_for_first_message) or (no_reads_after_first_msg < max_reads_after_first_msg)):
+  checks        = { element["test_id"]: element["will_be_sent_to_SNS"] for element in checklist }
+  waiting_for   = { test_id for test_id, will_be_sent_to_SNS in checks.items() if will_be_sent_to_SNS }
+  arrived       = set()
+
+  ok            = 0
+  errors        = 0
+  last_read     = False
+
+  while (not last_read):
+
+    wait_time_seconds = min(20, int(deadline - time.monotonic()))
+    last_read         = ((not waiting_for) or (wait_time_seconds <= 0))
 
     response = sqs.receive_message(
-        QueueUrl        = sqs_queue_url,
-        WaitTimeSeconds = 5
+        QueueUrl            = sqs_queue_url,
+        WaitTimeSeconds     = 0 if last_read else wait_time_seconds,
+        MaxNumberOfMessages = 10
       )
     print("DEBUG: Response of sqs.receive_message: "+json.dumps(response))     
 
-    if ("Messages" in response):
-      print("DEBUG: Found message on the queue")
-      wait_for_first_message = False
-      
-      for sqs_message in response["Messages"]:
+    if ("Messages" not in response):
+      print("DEBUG: No messages on the queue")
+      continue
+
+    sqs_messages = response["Messages"]
 
-        response = get_test_id_from_body(sqs_message["Body"])
-        test_id  = response["test_id"]
+    for sqs_message in sqs_messages:
 
-        search_result = search_for_elements_with_attribute_is_value_in_list("test_id", test_id, checklist)
-        if (search_result != []):
+      response = get_test_id_from_body(sqs_message["Body"])
+      test_id  = response["test_id"]
 
-          if (search_result[0]["will_be_sent_to_SNS"] == True):
-            print("DEBUG: "+test_id+" is sent to SNS, which was expected")
-            ok += 1
-          else:
-            print("ERROR: "+test_id+" is sent to SNS, this was not expected")
-            errors+=1
-          checklist.remove(search_result[0])
+      if ((test_id in checks) and (test_id not in arrived)):
 
-        response = sqs.delete_message(
-          QueueUrl      = sqs_queue_url,
-          ReceiptHandle = sqs_message["ReceiptHandle"]
-          )
-        print("DEBUG: Response of sqs.delete_message: "+json.dumps(response))
+        if checks[test_id]:
+          print("DEBUG: "+test_id+" is sent to SNS, which was expected")
+          ok += 1
+        else:
+          print("ERROR: "+test_id+" is sent to SNS, this was not expected")
+          errors += 1
 
-    else:
-      print("DEBUG: No messages on the queue")
-      if (wait_for_first_message == False):
-        no_reads_after_first_msg += 1
-    
-  expected_tests_left = search_for_elements_with_attribute_is_value_in_list("will_be_sent_to_SNS", True, checklist)
+        arrived.add(test_id)
+        waiting_for.discard(test_id)
+
+    entries  = [{ "Id": str(number), "ReceiptHandle": sqs_message["ReceiptHandle"] } for number, sqs_message in enumerate(sqs_messages)]
+    response = sqs.delete_message_batch(
+      QueueUrl = sqs_queue_url,
+      Entries  = entries
+      )
+    print("DEBUG: Response of sqs.delete_message_batch: "+json.dumps(response))
+
+    for failed in response.get("Failed", []):
+      print("WARNING: message not deleted from the queue: "+json.dumps(failed))
+
+  expected_tests_left = sorted(waiting_for)
   print("INFO: Tests that have not been sent to SNS, but were expected to be sent (these are errors): "+json.dumps(expected_tests_left))
-  for element in expected_tests_left:
-    errors += 1
+  errors += len(expected_tests_left)
 
-  non_expected_tests_left = search_for_elements_with_attribute_is_value_in_list("will_be_sent_to_SNS", False, checklist)
+  non_expected_tests_left = sorted(test_id for test_id, will_be_sent_to_SNS in checks.items() if (not will_be_sent_to_SNS) and (test_id not in arrived))
   print("INFO: Tests that have not been sent to SNS, and were not expected to be sent to SNS (correct): "+json.dumps(non_expected_tests_left))
-  for element in non_expected_tests_left:
-    ok += 1
+  ok += len(non_expected_tests_left)
     
   return { "ok": ok, "errors": errors }
 
-
 # testcase_accept_correct
 # -----------------------
 # Good situation: pas a JSON string and get a 200 code and OK back
@@ -203,38 +312,78 @@ def testcase_accept_correct():
 # The only way to test this, is to pass an incorrect parameter to the SNS function. 
 # This is done by changing the environment variable from the 
 # unittest_object_under_test_accept function and let it point to a non-existing 
-# SNS topic.
+# SNS topic, in a published version of it (see prepare_error_versions).
 
 def testcase_accept_error():
 
-  response                   = get_function_configuration()
-  function_configuration_org = response["function_configuration"]
-
-  environment_variables_org                              = function_configuration_org["Environment"]["Variables"]
-  environment_variables_new                              = copy.deepcopy(environment_variables_org)
-  environment_variables_new["to_shop_decrypt_topic_arn"] = "non-existing-" + environment_variables_new["to_shop_decrypt_topic_arn"]
-
-  update_environment_variables(function_configuration_org, environment_variables_new)
-
-  # We need to wait for 5 seconds before we call the function to force AWS to use the version of the 
-  # function that we updated (not the version that is still in memory, including the old content of
-  # the environment variable)
-
-  time.sleep(5)
-
   test_id              = "testcase_accept_error"
   test_record          = { "test_id" : test_id }
   expected_status_code = 200
   check_text           = "NotOK: retry later, admins: see cloudwatch logs for error"
   will_be_sent_to_SNS  = False
 
-  response    = invoke_lambda(test_id, test_record, expected_status_code, check_text)
+  response    = invoke_lambda(test_id, test_record, expected_status_code, check_text, error_versions["incorrect_SNS_topic"])
   succeeded   = response["succeeded"]
-  
-  update_environment_variables(function_configuration_org, environment_variables_org)
 
   return { "succeeded" : succeeded, "will_be_sent_to_SNS" : will_be_sent_to_SNS }
 
+# prepare_error_versions
+# ----------------------
+# Publishes the versions of the object under test for the error testcases, before the testcases 
+# are started
+
+def prepare_error_versions():
+
+  response                                               = get_function_configuration()
+  environment_variables_org                              = response["function_configuration"]["Environment"]["Variables"]
+
+  environment_variables_new                              = copy.deepcopy(environment_variables_org)
+  environment_variables_new["to_shop_decrypt_topic_arn"] = "non-existing-" + environment_variables_new["to_shop_decrypt_topic_arn"]
+
+  response                                               = get_error_version("unittest: incorrect SNS topic", environment_variables_new)
+  error_versions["incorrect_SNS_topic"]                  = response["version"]
+
+  return
+
+# run_testcase
+# ------------
+# An exception in a testcase only makes that testcase fail
+
+def run_testcase(testcase):
+
+  try:
+    return testcase()
+  except Exception as e:
+    print("ERROR: in " + testcase.__name__ + ": " + repr(e))
+    return { "succeeded": False, "will_be_sent_to_SNS": False }
+
+# run_testcases
+# -------------
+# Runs the testcases at the same time, the responses are in the order of testcase_list
+
+def run_testcases(testcase_list):
+
+  start_time = time.monotonic()
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers = MAX_WORKERS) as executor:
+    responses = list(executor.map(run_testcase, testcase_list))
+
+  print("INFO: " + str(len(testcase_list)) + " testcases done in " + format(time.monotonic() - start_time, ".1f") + " seconds")
+
+  return { "responses": responses }
+
+# get_deadline
+# ------------
+# One deadline for check_SNS_topic: SNS_CHECK_TIMEOUT seconds from now, but before the function
+# is aborted by AWS
+
+def get_deadline(context):
+
+  seconds_left = context.get_remaining_time_in_millis() / 1000 - SNS_CHECK_MARGIN
+  deadline     = time.monotonic() + min(SNS_CHECK_TIMEOUT, seconds_left)
+
+  return { "deadline": deadline }
+
 # Main function
 # -------------
 # Content of the event parameter will be ignored. 
@@ -250,9 +399,12 @@ def lambda_handler(event, context):
   testcase_list = [testcase_accept_correct,
                    testcase_accept_error]
                    
-  for testcase in testcase_list:
+  prepare_error_versions()
+
+  response  = run_testcases(testcase_list)
+
+  for testcase, response in zip(testcase_list, response["responses"]):
 
-    response            = testcase()
     testcase_succeeded  = response["succeeded"]
     will_be_sent_to_SNS = response["will_be_sent_to_SNS"]
 
@@ -265,7 +417,10 @@ def lambda_handler(event, context):
 
     checklist += [{ "test_id" : testcase.__name__, "will_be_sent_to_SNS" : will_be_sent_to_SNS }]
 
-  response = check_SNS_topic(checklist)
+  response = get_deadline(context)
+  deadline = response["deadline"]
+
+  response = check_SNS_topic(checklist, deadline)
   ok      += response["ok"]
   errors  += response["errors"]
     
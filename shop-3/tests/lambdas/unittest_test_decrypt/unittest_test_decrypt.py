@@ -4,29 +4,65 @@ import boto3
 import os
 import base64
 import time
+import threading
+import concurrent.futures
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 # FUNCTION NAME is the function name of the object under test (with AMIS_ prefix). 
-# It is used to read or change the settings of this function (for creating an error 
-# by changing the SNS ARN to a non existing ARN).
+# It is used to read the settings of this function and to publish versions of it with 
+# errors (f.e. a non existing SNS ARN), see get_error_version.
 
 NAME_PREFIX   = os.environ["name_prefix"]
 NAME          = "unittest_object_under_test_decrypt"
 FUNCTION_NAME = NAME_PREFIX + "_" + NAME
 
-# search_for_elements_with_attribute_is_value_in_list
-# ---------------------------------------------------
-# (see also: https://stackoverflow.com/questions/8653516/python-list-of-dictionaries-search ) 
+# The testcases run at the same time in MAX_WORKERS threads. Error testcases don't change the
+# environment of the object under test, they invoke a published version with their own environment
+# (see get_error_version). UPDATE_TIMEOUT is the maximum time in seconds for a configuration update.
+
+MAX_WORKERS    = int(os.environ.get("max_workers", "16"))
+UPDATE_TIMEOUT = 60
+
+# Maximum time in seconds to wait for the test_ids that are expected on SNS, see check_SNS_topic.
+# SNS_CHECK_MARGIN is the time in seconds that is left for the end of the function.
+
+SNS_CHECK_TIMEOUT = int(os.environ.get("sns_check_timeout", "60"))
+SNS_CHECK_MARGIN  = 5
+
+# Envelope format (see shop_decrypt): a data key of DATA_KEY_SIZE bytes, the content is 
+# nonce + ciphertext + tag of AES-GCM
+
+DATA_KEY_SIZE      = 32
+AES_GCM_NONCE_SIZE = 12
+
+# Versions of the object under test for the error testcases: { name: version }
+
+error_versions = {}
+
+# get_client
+# ----------
+# boto3.client() is not thread safe, the clients themselves are. Every client is created once,
+# with a connection pool for all threads.
 
-def search_for_elements_with_attribute_is_value_in_list(attribute, test_id, checklist):
-    return [element for element in checklist if element[attribute] == test_id]
+_clients      = {}
+_clients_lock = threading.Lock()
+
+def get_client(service_name):
+
+  with _clients_lock:
+    if (service_name not in _clients):
+      _clients[service_name] = boto3.client(service_name, config = Config(max_pool_connections = MAX_WORKERS))
+
+  return _clients[service_name]
 
 # get_function_configuration
 # --------------------------
 
 def get_function_configuration():
   
-  lambdaclient = boto3.client('lambda')
+  lambdaclient = get_client('lambda')
   response     = lambdaclient.get_function_configuration(
     FunctionName = FUNCTION_NAME
   )
@@ -37,37 +73,115 @@ def get_function_configuration():
 # update_function_configuration
 # -----------------------------
 
-def update_function_configuration(environment):
+def update_function_configuration(environment, handler):
 
-  lambdaclient = boto3.client('lambda')
+  lambdaclient = get_client('lambda')
   response     = lambdaclient.update_function_configuration(
     FunctionName = FUNCTION_NAME,
-    Environment  = environment
+    Environment  = environment,
+    Handler      = handler
   )
   print("DEBUG: Response of lambdaclient.update_function_configuration: "+json.dumps(response))
 
-  return 
+  wait_for_function_update()
+
+  return
 
 # update_environment_variables
 # ----------------------------
+# Environment variables and handler of the Lambda function that is tested
 
-def update_environment_variables(response, environment_variables):
+def update_environment_variables(response, environment_variables, handler):
   
   environment_new              = copy.deepcopy(response["Environment"])
   environment_new["Variables"] = environment_variables
 
-  update_function_configuration(environment_new)
+  update_function_configuration(environment_new, handler)
 
   return 
 
+# wait_for_function_update
+# ------------------------
+# A new configuration isn't used immediately: poll LastUpdateStatus until the update is done
+
+def wait_for_function_update():
+
+  lambdaclient = get_client('lambda')
+  deadline     = time.monotonic() + UPDATE_TIMEOUT
+
+  while True:
+
+    response = lambdaclient.get_function_configuration(
+      FunctionName = FUNCTION_NAME
+    )
+    status   = response.get("LastUpdateStatus", "Successful")
+
+    if (status == "Successful"):
+      return { "succeeded": True }
+
+    if ((status == "Failed") or (time.monotonic() > deadline)):
+      print("ERROR: update of the configuration of " + FUNCTION_NAME + ": " + status + " " + response.get("LastUpdateStatusReason", ""))
+      return { "succeeded": False }
+
+    time.sleep(0.5)
+
+# get_error_version
+# -----------------
+# Returns a published version of the object under test with the environment variables (and the
+# handler, f.e. sqs_lambda_handler) of a testcase. A version of an earlier run is used again when
+# its code, configuration and environment are the same. Otherwise $LATEST gets these environment 
+# variables, is published and gets its own environment back. This is done before the testcases are
+# started, so no testcase sees the changed $LATEST. The version is None when it couldn't be published.
+
+VERSION_KEYS = ["CodeSha256", "Layers", "Runtime", "Role", "MemorySize", "Timeout"]
+
+def get_error_version(description, environment_variables, handler = None):
+
+  lambdaclient               = get_client('lambda')
+  response                   = get_function_configuration()
+  function_configuration_org = response["function_configuration"]
+  handler                    = handler if (handler != None) else function_configuration_org["Handler"]
+
+  for page in lambdaclient.get_paginator("list_versions_by_function").paginate(FunctionName = FUNCTION_NAME):
+    for version in page["Versions"]:
+
+      if ((version["Version"] != "$LATEST") and 
+          (version.get("Description") == description) and
+          (version.get("Environment", {}).get("Variables") == environment_variables) and
+          (version.get("Handler") == handler) and
+          all(version.get(key) == function_configuration_org.get(key) for key in VERSION_KEYS)):
+
+        print("INFO: " + description + ": version " + version["Version"])
+        return { "version": version["Version"] }
+
+  update_environment_variables(function_configuration_org, environment_variables, handler)
+
+  try:
+    response = lambdaclient.publish_version(
+      FunctionName = FUNCTION_NAME,
+      CodeSha256   = function_configuration_org["CodeSha256"],
+      Description  = description
+    )
+    print("DEBUG: Response of lambdaclient.publish_version: "+json.dumps(response))
+    version  = response["Version"]
+    print("INFO: " + description + ": published version " + version)
+  except ClientError as e:
+    print("ERROR: " + description + ": " + str(e))
+    version  = None
+
+  update_environment_variables(function_configuration_org, function_configuration_org["Environment"]["Variables"], function_configuration_org["Handler"])
+
+  return { "version": version }
+
 # invoke_lambda
 # -------------
 
-def invoke_lambda(test_id, event, expected_status_code, checkstring):
+def invoke_lambda(test_id, event, expected_status_code, checkstring, version = "$LATEST"):
 
-  lambdaclient = boto3.client('lambda')
+  lambdaclient = get_client('lambda')
   response = lambdaclient.invoke(
     FunctionName   = FUNCTION_NAME,
+    Qualifier      = version,
     InvocationType = "RequestResponse",
     LogType        = "Tail",
     Payload        = bytearray(json.dumps(event),'utf-8')
@@ -91,6 +205,37 @@ def invoke_lambda(test_id, event, expected_status_code, checkstring):
   
   return { "succeeded" : succeed }
 
+# invoke_sqs_lambda
+# -----------------
+# Invokes a version with sqs_lambda_handler, checks the log like invoke_lambda and returns the 
+# itemIdentifiers of the batchItemFailures in the payload
+
+def invoke_sqs_lambda(test_id, event, checkstring, version):
+
+  lambdaclient = get_client('lambda')
+
+  response = lambdaclient.invoke(
+    FunctionName   = FUNCTION_NAME,
+    Qualifier      = version,
+    InvocationType = "RequestResponse",
+    LogType        = "Tail",
+    Payload        = bytearray(json.dumps(event),'utf-8')
+  )
+  print("DEBUG: Response of lambdaclient.invoke: "+str(response))
+
+  log_result  = str(base64.b64decode(response["LogResult"]))
+  payload     = response["Payload"].read().decode('utf-8')
+  print("DEBUG: log: " + log_result)
+  print("DEBUG: " + test_id + ": Payload = " + payload)
+
+  failed_identifiers = []
+  succeeded          = (response.get("FunctionError") == None) and (log_result.find(checkstring) >= 0)
+
+  if (succeeded):
+    failed_identifiers = [failure["itemIdentifier"] for failure in json.loads(payload)["batchItemFailures"]]
+
+  return { "succeeded": succeeded, "failed_identifiers": failed_identifiers }
+
 # get_message_id
 # --------------
 # These are unit tests, decrypt doesn't do anything except for passing it on. So just give it a name...
@@ -109,7 +254,7 @@ def encrypt_text(shop_id, text):
   key_prefix = os.environ['key_prefix']
   key_alias  = 'alias/' + key_prefix + shop_id
 
-  kms      = boto3.client('kms')
+  kms      = get_client('kms')
   response = kms.encrypt(
      KeyId=key_alias, 
      Plaintext=text, 
@@ -121,13 +266,37 @@ def encrypt_text(shop_id, text):
   content_base64    = base64.standard_b64encode(encrypted_content).decode("utf-8")
 
   return { "content_base64" : content_base64 }
+
+# encrypt_envelope
+# ----------------
+# Encrypts the text like encrypt_envelope_and_send.py does: with a new data key, that is 
+# encrypted with the KMS key of the shop. The associated data of AES-GCM is the shop_id, 
+# associated_data is only used to test a message with content of another shop.
+
+def encrypt_envelope(shop_id, text, associated_data = None):
+
+  associated_data      = associated_data if (associated_data != None) else shop_id
+  data_key             = os.urandom(DATA_KEY_SIZE)
+  nonce                = os.urandom(AES_GCM_NONCE_SIZE)
+
+  encrypted_content    = nonce + AESGCM(data_key).encrypt(nonce, text.encode("utf-8"), associated_data.encode("utf-8"))
+  content_base64       = base64.standard_b64encode(encrypted_content).decode("utf-8")
+
+  response             = encrypt_text(shop_id, data_key)
+  encrypted_key_base64 = response["content_base64"]
+
+  return { "content_base64": content_base64, "encrypted_key_base64": encrypted_key_base64 }
   
 # get_valid_sns_event
 # -------------------
 # I used the text from a previous message (sent via shop-2/client/encrypt_and_send.py) and use it in this testset. This 
-# shouldn't be a problem because none of the parameters is checked.
+# shouldn't be a problem because none of the parameters is checked. Messages in the envelope format also have an
+# encrypted_key_base64.
+
+def get_valid_sns_event(shop_id, message_id, content_base64, encrypted_key_base64 = None):
+
+  encrypted_key = "" if (encrypted_key_base64 == None) else ", \\\"encrypted_key_base64\\\": \\\"" + encrypted_key_base64 + "\\\""
 
-def get_valid_sns_event(shop_id, message_id, content_base64):
   event = {
       "Records": [ 
          { 
@@ -139,7 +308,7 @@ def get_valid_sns_event(shop_id, message_id, content_base64):
                  "MessageId": "1965b2a8-6dfe-5de8-ab45-e58b19b63b4e", 
                  "TopicArn": "arn:aws:sns:eu-west-1:300577164517:AMIS_to_shop_decrypt",
                  "Subject": "null",
-                 "Message": "{\"resource\": \"/shop\", \"path\": \"/shop\", \"httpMethod\": \"POST\", \"headers\": {\"Accept\": \"*/*\", \"Accept-Encoding\": \"gzip, deflate\", \"Host\": \"o9330wv5vl.execute-api.eu-west-1.amazonaws.com\", \"User-Agent\": \"python-requests/2.23.0\", \"X-Amzn-Trace-Id\": \"Root=1-5ea97206-e83cbcdbcf616c8681882743\", \"X-Forwarded-For\": \"86.88.108.53\", \"X-Forwarded-Port\": \"443\", \"X-Forwarded-Proto\": \"https\"}, \"multiValueHeaders\": {\"Accept\": [\"*/*\"], \"Accept-Encoding\": [\"gzip, deflate\"], \"Host\": [\"o9330wv5vl.execute-api.eu-west-1.amazonaws.com\"], \"User-Agent\": [\"python-requests/2.23.0\"], \"X-Amzn-Trace-Id\": [\"Root=1-5ea97206-e83cbcdbcf616c8681882743\"], \"X-Forwarded-For\": [\"86.88.108.53\"], \"X-Forwarded-Port\": [\"443\"], \"X-Forwarded-Proto\": [\"https\"]}, \"queryStringParameters\": null, \"multiValueQueryStringParameters\": null, \"pathParameters\": null, \"stageVariables\": null, \"requestContext\": {\"resourceId\": \"84sjgf\", \"resourcePath\": \"/shop\", \"httpMethod\": \"POST\", \"extendedRequestId\": \"Lv7BEHlojoEFV0Q=\", \"requestTime\": \"29/Apr/2020:12:24:38 +0000\", \"path\": \"/prod/shop\", \"accountId\": \"300577164517\", \"protocol\": \"HTTP/1.1\", \"stage\": \"prod\", \"domainPrefix\": \"o9330wv5vl\", \"requestTimeEpoch\": 1588163078706, \"requestId\": \"cf7540c5-afba-49d8-b133-317a6884711e\", \"identity\": {\"cognitoIdentityPoolId\": null, \"accountId\": null, \"cognitoIdentityId\": null, \"caller\": null, \"sourceIp\": \"86.88.108.53\", \"principalOrgId\": null, \"accessKey\": null, \"cognitoAuthenticationType\": null, \"cognitoAuthenticationProvider\": null, \"userArn\": null, \"userAgent\": \"python-requests/2.23.0\", \"user\": null}, \"domainName\": \"o9330wv5vl.execute-api.eu-west-1.amazonaws.com\", \"apiId\": \"o9330wv5vl\"}, \"body\": \"{\\\"shop_id\\\": \\\"" + shop_id + "\\\", \\\"message_id\\\": \\\"" + message_id + "\\\", \\\"content_base64\\\": \\\"" + content_base64 + "\\\"}\", \"isBase64Encoded\": false}",
+                 "Message": "{\"resource\": \"/shop\", \"path\": \"/shop\", \"httpMethod\": \"POST\", \"headers\": {\"Accept\": \"*/*\", \"Accept-Encoding\": \"gzip, deflate\", \"Host\": \"o9330wv5vl.execute-api.eu-west-1.amazonaws.com\", \"User-Agent\": \"python-requests/2.23.0\", \"X-Amzn-Trace-Id\": \"Root=1-5ea97206-e83cbcdbcf616c8681882743\", \"X-Forwarded-For\": \"86.88.108.53\", \"X-Forwarded-Port\": \"443\", \"X-Forwarded-Proto\": \"https\"}, \"multiValueHeaders\": {\"Accept\": [\"*/*\"], \"Accept-Encoding\": [\"gzip, deflate\"], \"Host\": [\"o9330wv5vl.execute-api.eu-west-1.amazonaws.com\"], \"User-Agent\": [\"python-requests/2.23.0\"], \"X-Amzn-Trace-Id\": [\"Root=1-5ea97206-e83cbcdbcf616c8681882743\"], \"X-Forwarded-For\": [\"86.88.108.53\"], \"X-Forwarded-Port\": [\"443\"], \"X-Forwarded-Proto\": [\"https\"]}, \"queryStringParameters\": null, \"multiValueQueryStringParameters\": null, \"pathParameters\": null, \"stageVariables\": null, \"requestContext\": {\"resourceId\": \"84sjgf\", \"resourcePath\": \"/shop\", \"httpMethod\": \"POST\", \"extendedRequestId\": \"Lv7BEHlojoEFV0Q=\", \"requestTime\": \"29/Apr/2020:12:24:38 +0000\", \"path\": \"/prod/shop\", \"accountId\": \"300577164517\", \"protocol\": \"HTTP/1.1\", \"stage\": \"prod\", \"domainPrefix\": \"o9330wv5vl\", \"requestTimeEpoch\": 1588163078706, \"requestId\": \"cf7540c5-afba-49d8-b133-317a6884711e\", \"identity\": {\"cognitoIdentityPoolId\": null, \"accountId\": null, \"cognitoIdentityId\": null, \"caller\": null, \"sourceIp\": \"86.88.108.53\", \"principalOrgId\": null, \"accessKey\": null, \"cognitoAuthenticationType\": null, \"cognitoAuthenticationProvider\": null, \"userArn\": null, \"userAgent\": \"python-requests/2.23.0\", \"user\": null}, \"domainName\": \"o9330wv5vl.execute-api.eu-west-1.amazonaws.com\", \"apiId\": \"o9330wv5vl\"}, \"body\": \"{\\\"shop_id\\\": \\\"" + shop_id + "\\\", \\\"message_id\\\": \\\"" + message_id + "\\\", \\\"content_base64\\\": \\\"" + content_base64 + "\\\"" + encrypted_key + "}\", \"isBase64Encoded\": false}",
                  "Timestamp": "2020-04-29T12:24:40.008Z",
                  "SignatureVersion": "1", 
                  "Signature": "Ud4xxGJN2ahESHUC7oP0+fSWvzblay5QzJp5SXpuUOjwRaw3qiy+RvTHLqK5I0kO0OjgO75Z1rCZM1eSHFxGJecYnvClNgm/7mgIm3SuZQf3saOMJs/9zbIudF+gxhw7hd/0FghEdEt77GgE+VerSMSJczBUcyVVJcXx+OCn72QcWjHmdacb7CA1FpGKZsUnCjtcZudvX8cKaJiOty1JRI609tvp0HB3M7HDA7hj60wZBVNa8vnAf/jZZ+nhPBLZmkzR9gOvYAuFTIHn+cd1ymIw3jlOIwZAQNOftnuVitBWQNkarKes4AFMqPZ22I9unmBBSOf5wKlk267itfjdMQ==",
@@ -153,6 +322,34 @@ def get_valid_sns_event(shop_id, message_id, content_base64):
 
   return { "event" : event }
 
+# get_valid_sqs_event
+# -------------------
+# Batch of the to_shop_decrypt queue (raw message delivery): the body of a record is the message 
+# of the SNS event. records is a list of (shop_id, message_id, content_base64), the messageId of 
+# the SQS records is the position in the batch.
+
+def get_valid_sqs_event(records):
+
+  sqs_records = []
+
+  for record_number, (shop_id, message_id, content_base64) in enumerate(records):
+
+    response = get_valid_sns_event(shop_id, message_id, content_base64)
+    message  = response["event"]["Records"][0]["Sns"]["Message"]
+
+    sqs_records.append({
+      "messageId"         : "sqs-message-" + str(record_number),
+      "receiptHandle"     : "receipt-handle-" + str(record_number),
+      "body"              : message,
+      "attributes"        : { "ApproximateReceiveCount": "1" },
+      "messageAttributes" : {},
+      "eventSource"       : "aws:sqs",
+      "eventSourceARN"    : "arn:aws:sqs:eu-west-1:300577164517:AMIS_to_shop_decrypt",
+      "awsRegion"         : "eu-west-1"
+    })
+
+  return { "event": { "Records": sqs_records } }
+
 # get_test_id_from_body
 # ---------------------
 
@@ -167,79 +364,85 @@ def get_test_id_from_body(body_string):
 
 # check_SNS_topic
 # ---------------
-# We can check what is sent to the SNS topic, because there is an echo function behind
-# the SNS topic which will send all the information to CloudWatch. The logs of that 
-# echo function are sent to the SQS queue cloudwatch_messages_echo by the Lambda function 
+# We can check what is sent to the SNS topic, because there is an echo function behind the
+# SNS topic which will send all the information to CloudWatch. The logs of that echo function 
+# are sent to the SQS queue cloudwatch_messages_echo by the Lambda function 
 # unittest_support_send_logs_support_echo. The queue is filled by a CloudWatch log filter,
 # next to real time (in my environment: about 10 seconds between invocation of the first
 # "good" Lambda function and getting back the results).
 #
-# We'll wait for 3 x 5 seconds after the last message was comming (this is still 
-# less than the 4 minutes we had to wait for the non-next-to-realtime CloudWatch 
-# query to finish). When there are no results at all, this unittest_test function will be
-# aborted by AWS when the timeout time is reached.
+# The queue is read with long polling until every test_id that is expected on SNS has arrived,
+# or until the deadline (the expected test_ids that haven't arrived then are errors). After that, 
+# the messages that are already on the queue are read once more: they may contain test_ids that 
+# were not expected on SNS.
 
-def check_SNS_topic(checklist):
+def check_SNS_topic(checklist, deadline):
 
-  sqs                       = boto3.client("sqs")
-  sqs_queue_url             = os.environ['sqs_queue_url']
+  sqs           = get_client("sqs")
+  sqs_queue_url = os.environ['sqs_queue_url']
 
-  wait_for_first_message    = True
-  max_reads_after_first_msg = 3
+  # checks: { test_id: will_be_sent_to_SNS }, waiting_for: the expected test_ids that didn't arrive yet
 
-  no_reads_after_first_msg  = 0
-  ok                        = 0
-  errors                    = 0
-  
-  while ((wait_for_first_message) or (no_reads_after_first_msg < max_reads_after_first_msg)):
+  checks        = { element["test_id"]: element["will_be_sent_to_SNS"] for element in checklist }
+  waiting_for   = { test_id for test_id, will_be_sent_to_SNS in checks.items() if will_be_sent_to_SNS }
+  arrived       = set()
+
+  ok            = 0
+  errors        = 0
+  last_read     = False
+
+  while (not last_read):
+
+    wait_time_seconds = min(20, int(deadline - time.monotonic()))
+    last_read         = ((not waiting_for) or (wait_time_seconds <= 0))
 
     response = sqs.receive_message(
         QueueUrl            = sqs_queue_url,
-        WaitTimeSeconds     = 5,
+        WaitTimeSeconds     = 0 if last_read else wait_time_seconds,
         MaxNumberOfMessages = 10
       )
     print("DEBUG: Response of sqs.receive_message: "+json.dumps(response))     
 
-    if ("Messages" in response):
-      print("DEBUG: Found message(s) on the queue")
-      wait_for_first_message = False
-      
-      for sqs_message in response["Messages"]:
+    if ("Messages" not in response):
+      print("DEBUG: No messages on the queue")
+      continue
 
-        response = get_test_id_from_body(sqs_message["Body"])
-        test_id  = response["test_id"]
+    sqs_messages = response["Messages"]
 
-        search_result = search_for_elements_with_attribute_is_value_in_list("test_id", test_id, checklist)
-        if (search_result != []):
+    for sqs_message in sqs_messages:
 
-          if search_result[0]["will_be_sent_to_SNS"]:
-            print("DEBUG: "+test_id+" is sent to SNS, which was expected")
-            ok += 1
-          else:
-            print("ERROR: "+test_id+" is sent to SNS, this was not expected")
-            errors += 1
+      response = get_test_id_from_body(sqs_message["Body"])
+      test_id  = response["test_id"]
 
-          checklist.remove(search_result[0])
+      if ((test_id in checks) and (test_id not in arrived)):
 
-        response = sqs.delete_message(
-          QueueUrl      = sqs_queue_url,
-          ReceiptHandle = sqs_message["ReceiptHandle"]
-          )
-        print("DEBUG: Response of sqs.delete_message: "+json.dumps(response))
-    else:
-      print("DEBUG: No messages on the queue")
-      if (wait_for_first_message == False):
-        no_reads_after_first_msg += 1
-    
-  expected_tests_left = search_for_elements_with_attribute_is_value_in_list("will_be_sent_to_SNS", True, checklist)
+        if checks[test_id]:
+          print("DEBUG: "+test_id+" is sent to SNS, which was expected")
+          ok += 1
+        else:
+          print("ERROR: "+test_id+" is sent to SNS, this was not expected")
+          errors += 1
+
+        arrived.add(test_id)
+        waiting_for.discard(test_id)
+
+    entries  = [{ "Id": str(number), "ReceiptHandle": sqs_message["ReceiptHandle"] } for number, sqs_message in enumerate(sqs_messages)]
+    response = sqs.delete_message_batch(
+      QueueUrl = sqs_queue_url,
+      Entries  = entries
+      )
+    print("DEBUG: Response of sqs.delete_message_batch: "+json.dumps(response))
+
+    for failed in response.get("Failed", []):
+      print("WARNING: message not deleted from the queue: "+json.dumps(failed))
+
+  expected_tests_left = sorted(waiting_for)
   print("INFO: Tests that have not been sent to SNS, but were expected to be sent (these are errors): "+json.dumps(expected_tests_left))
-  for element in expected_tests_left:
-    errors += 1
+  errors += len(expected_tests_left)
 
-  non_expected_tests_left = search_for_elements_with_attribute_is_value_in_list("will_be_sent_to_SNS", False, checklist)
-  print("INFO: Tests that have not been in the logs, and we didn't expect them to show up (correct): "+json.dumps(non_expected_tests_left))
-  for element in non_expected_tests_left:
-    ok += 1
+  non_expected_tests_left = sorted(test_id for test_id, will_be_sent_to_SNS in checks.items() if (not will_be_sent_to_SNS) and (test_id not in arrived))
+  print("INFO: Tests that have not been sent to SNS, and were not expected to be sent to SNS (correct): "+json.dumps(non_expected_tests_left))
+  ok += len(non_expected_tests_left)
     
   return { "ok": ok, "errors": errors }
 
@@ -546,26 +749,323 @@ def testcase_decrypt_error_incorrect_SNS_topic():
   response                   = get_valid_sns_event(shop_id, message_id, content_base64)
   event                      = response["event"]
 
+  # The version with the non existing SNS topic is published by prepare_error_versions
+
+  response                   = invoke_lambda(test_id, event, expected_status_code, check_text, error_versions["incorrect_SNS_topic"])
+  succeeded                  = response["succeeded"]
+
+  return { "succeeded" : succeeded, "will_be_sent_to_SNS": will_be_sent_to_SNS }
+
+# testcase_decrypt_correct_sqs_batch
+# ----------------------------------
+# Good situation: a batch of the to_shop_decrypt queue. Both messages are decrypted and sent to 
+# SNS in one call, no message is given back to SQS.
+
+def testcase_decrypt_correct_sqs_batch():
+
+  test_id              = "testcase_decrypt_correct_sqs_batch"
+  check_text           = "records: 2, decrypted: 2, failed: []"
+  will_be_sent_to_SNS  = True
+
+  to_be_encrypted      = json.dumps({"test_id" : test_id })
+  content_base64_AMIS1 = encrypt_text("AMIS1", to_be_encrypted)["content_base64"]
+  content_base64_AMIS2 = encrypt_text("AMIS2", to_be_encrypted)["content_base64"]
+
+  response             = get_message_id()
+  message_id           = response["message_id"]
+
+  response             = get_valid_sqs_event([("AMIS1", message_id, content_base64_AMIS1), ("AMIS2", message_id, content_base64_AMIS2)])
+  event                = response["event"]
+
+  response             = invoke_sqs_lambda(test_id, event, check_text, error_versions["sqs_handler"])
+  succeeded            = response["succeeded"] and (response["failed_identifiers"] == [])
+
+  return { "succeeded": succeeded, "will_be_sent_to_SNS": will_be_sent_to_SNS }
+
+# testcase_decrypt_error_sqs_bogus_records
+# ----------------------------------------
+# A batch with one correct message and messages that can't be decrypted. A bogus base64 string, 
+# a message that is encrypted with the key of another shop and a record without a body will never 
+# succeed: they are removed from the queue. The message of a non existing shop may be retried (the
+# key may not be there yet), it is the only message that is given back to SQS. The correct message 
+# is sent to SNS with another test_id: this test_id isn't checked by check_SNS_topic.
+
+def testcase_decrypt_error_sqs_bogus_records():
+
+  test_id              = "testcase_decrypt_error_sqs_bogus_records"
+  shop_id              = "AMIS1"
+  check_text           = 'records: 5, decrypted: 1, failed: ["sqs-message-4"]'
+  will_be_sent_to_SNS  = False
+
+  content_base64_valid = encrypt_text(shop_id, json.dumps({"test_id" : test_id + "_valid_record" }))["content_base64"]
+  content_base64       = encrypt_text(shop_id, json.dumps({"test_id" : test_id }))["content_base64"]
+
+  response             = get_message_id()
+  message_id           = response["message_id"]
+
+  response             = get_valid_sqs_event([(shop_id, message_id, content_base64_valid),
+                                              (shop_id, message_id, "bogus"),
+                                              ("AMIS2", message_id, content_base64),
+                                              (shop_id, message_id, content_base64),
+                                              ("bogus", message_id, content_base64)])
+  event                = response["event"]
+
+  del event["Records"][3]["body"]
+
+  response             = invoke_sqs_lambda(test_id, event, check_text, error_versions["sqs_handler"])
+  succeeded            = response["succeeded"] and (response["failed_identifiers"] == ["sqs-message-4"])
+
+  return { "succeeded": succeeded, "will_be_sent_to_SNS": will_be_sent_to_SNS }
+
+# testcase_decrypt_error_sqs_incorrect_SNS_topic
+# ----------------------------------------------
+# The message is decrypted, but can't be sent to SNS: it is given back to SQS to be retried
+
+def testcase_decrypt_error_sqs_incorrect_SNS_topic():
+
+  test_id              = "testcase_decrypt_error_sqs_incorrect_SNS_topic"
+  shop_id              = "AMIS1"
+  check_text           = "An error occurred (InvalidParameter) when calling the PublishBatch operation"
+  will_be_sent_to_SNS  = False
+
+  to_be_encrypted      = json.dumps({"test_id" : test_id })
+  response             = encrypt_text(shop_id, to_be_encrypted)
+  content_base64       = response["content_base64"]
+
+  response             = get_message_id()
+  message_id           = response["message_id"]
+
+  response             = get_valid_sqs_event([(shop_id, message_id, content_base64)])
+  event                = response["event"]
+
+  response             = invoke_sqs_lambda(test_id, event, check_text, error_versions["sqs_handler_incorrect_SNS_topic"])
+  succeeded            = response["succeeded"] and (response["failed_identifiers"] == ["sqs-message-0"])
+
+  return { "succeeded": succeeded, "will_be_sent_to_SNS": will_be_sent_to_SNS }
+
+# testcase_decrypt_correct_envelope
+# ---------------------------------
+# Good situation: a message in the envelope format
+
+def testcase_decrypt_correct_envelope():
+
+  test_id              = "testcase_decrypt_correct_envelope"
+  shop_id              = "AMIS1"
+  expected_status_code = 200
+  check_text           = "succeeded: True"
+  will_be_sent_to_SNS  = True
+
+  to_be_encrypted      = json.dumps({"test_id" : test_id })
+  response             = encrypt_envelope(shop_id, to_be_encrypted)
+  content_base64       = response["content_base64"]
+  encrypted_key_base64 = response["encrypted_key_base64"]
+
+  response             = get_message_id()
+  message_id           = response["message_id"]
+
+  response             = get_valid_sns_event(shop_id, message_id, content_base64, encrypted_key_base64)
+  event                = response["event"]
+
+  response             = invoke_lambda(test_id, event, expected_status_code, check_text)
+  succeeded            = response["succeeded"]
+
+  return { "succeeded": succeeded, "will_be_sent_to_SNS": will_be_sent_to_SNS }
+
+# testcase_decrypt_correct_envelope_data_key_cache
+# ------------------------------------------------
+# Two messages with the same (new) data key: the data key of the first message is decrypted by 
+# KMS, the second message uses the data key in the cache. The messages are sent one after the 
+# other to a version that only this testcase uses, so the second message gets the same container.
+
+def testcase_decrypt_correct_envelope_data_key_cache():
+
+  test_id              = "testcase_decrypt_correct_envelope_data_key_cache"
+  shop_id              = "AMIS1"
+  expected_status_code = 200
+  check_text_1         = "Response of kms.decrypt"
+  check_text_2         = "data key found in cache for shop_id AMIS1"
+  will_be_sent_to_SNS  = True
+
+  to_be_encrypted      = json.dumps({"test_id" : test_id })
+  response             = encrypt_envelope(shop_id, to_be_encrypted)
+  content_base64       = response["content_base64"]
+  encrypted_key_base64 = response["encrypted_key_base64"]
+
+  response             = get_message_id()
+  message_id           = response["message_id"]
+
+  response             = get_valid_sns_event(shop_id, message_id, content_base64, encrypted_key_base64)
+  event                = response["event"]
+
+  response             = invoke_lambda(test_id, event, expected_status_code, check_text_1, error_versions["data_key_cache"])
+  succeeded            = response["succeeded"]
+
+  if (succeeded):
+    response           = invoke_lambda(test_id, event, expected_status_code, check_text_2, error_versions["data_key_cache"])
+    succeeded          = response["succeeded"]
+
+  return { "succeeded": succeeded, "will_be_sent_to_SNS": will_be_sent_to_SNS }
+
+# testcase_decrypt_error_envelope_tampered_content
+# ------------------------------------------------
+# A message in the envelope format of which one byte of the ciphertext is changed: the tag of 
+# AES-GCM doesn't match
+
+def testcase_decrypt_error_envelope_tampered_content():
+
+  test_id              = "testcase_decrypt_error_envelope_tampered_content"
+  shop_id              = "AMIS1"
+  expected_status_code = 200
+  check_text           = "decryption of content with data key failed - InvalidTag()"
+  will_be_sent_to_SNS  = False
+
+  to_be_encrypted      = json.dumps({"test_id" : test_id })
+  response             = encrypt_envelope(shop_id, to_be_encrypted)
+  encrypted_content    = bytearray(base64.standard_b64decode(response["content_base64"]))
+  encrypted_key_base64 = response["encrypted_key_base64"]
+
+  encrypted_content[AES_GCM_NONCE_SIZE] ^= 1
+  content_base64       = base64.standard_b64encode(encrypted_content).decode("utf-8")
+
+  response             = get_message_id()
+  message_id           = response["message_id"]
+
+  response             = get_valid_sns_event(shop_id, message_id, content_base64, encrypted_key_base64)
+  event                = response["event"]
+
+  response             = invoke_lambda(test_id, event, expected_status_code, check_text)
+  succeeded            = response["succeeded"]
+
+  return { "succeeded": succeeded, "will_be_sent_to_SNS": will_be_sent_to_SNS }
+
+# testcase_decrypt_error_envelope_content_of_other_shop
+# -----------------------------------------------------
+# The data key is encrypted with the key of AMIS2, but the content is encrypted for AMIS1 (the 
+# associated data is the shop_id): KMS decrypts the data key, AES-GCM refuses the content
+
+def testcase_decrypt_error_envelope_content_of_other_shop():
+
+  test_id              = "testcase_decrypt_error_envelope_content_of_other_shop"
+  shop_id              = "AMIS2"
+  expected_status_code = 200
+  check_text           = "AMIS2 - decryption of content with data key failed - InvalidTag()"
+  will_be_sent_to_SNS  = False
+
+  to_be_encrypted      = json.dumps({"test_id" : test_id })
+  response             = encrypt_envelope(shop_id, to_be_encrypted, "AMIS1")
+  content_base64       = response["content_base64"]
+  encrypted_key_base64 = response["encrypted_key_base64"]
+
+  response             = get_message_id()
+  message_id           = response["message_id"]
+
+  response             = get_valid_sns_event(shop_id, message_id, content_base64, encrypted_key_base64)
+  event                = response["event"]
+
+  response             = invoke_lambda(test_id, event, expected_status_code, check_text)
+  succeeded            = response["succeeded"]
+
+  return { "succeeded": succeeded, "will_be_sent_to_SNS": will_be_sent_to_SNS }
+
+# testcase_decrypt_error_envelope_bogus_encrypted_key
+# ---------------------------------------------------
+# A message in the envelope format with a data key that KMS can't decrypt
+
+def testcase_decrypt_error_envelope_bogus_encrypted_key():
+
+  test_id              = "testcase_decrypt_error_envelope_bogus_encrypted_key"
+  shop_id              = "AMIS1"
+  expected_status_code = 200
+  check_text           = "An error occurred (InvalidCiphertextException) when calling the Decrypt operation"
+  will_be_sent_to_SNS  = False
+
+  to_be_encrypted      = json.dumps({"test_id" : test_id })
+  response             = encrypt_envelope(shop_id, to_be_encrypted)
+  content_base64       = response["content_base64"]
+  encrypted_key_base64 = base64.standard_b64encode(b"bogus").decode("utf-8")
+
+  response             = get_message_id()
+  message_id           = response["message_id"]
+
+  response             = get_valid_sns_event(shop_id, message_id, content_base64, encrypted_key_base64)
+  event                = response["event"]
+
+  response             = invoke_lambda(test_id, event, expected_status_code, check_text)
+  succeeded            = response["succeeded"]
+
+  return { "succeeded": succeeded, "will_be_sent_to_SNS": will_be_sent_to_SNS }
+
+# prepare_error_versions
+# ----------------------
+# Publishes the versions of the object under test for the error testcases, before the testcases 
+# are started
+
+def prepare_error_versions():
+
   response                                                 = get_function_configuration()
-  function_configuration_org                               = response["function_configuration"]
-  environment_variables_org                                = function_configuration_org["Environment"]["Variables"]
+  environment_variables_org                                = response["function_configuration"]["Environment"]["Variables"]
 
   environment_variables_new                                = copy.deepcopy(environment_variables_org)
   environment_variables_new["to_shop_update_db_topic_arn"] = "non-existing-"+environment_variables_new["to_shop_update_db_topic_arn"]
-  update_environment_variables(function_configuration_org, environment_variables_new)
 
-  # We need to wait for 5 seconds before we call the function to force AWS to use the version of the 
-  # function that we updated (not the version that is still in memory, including the old content of
-  # the environment variable)
+  response                                                 = get_error_version("unittest: incorrect SNS topic", environment_variables_new)
+  error_versions["incorrect_SNS_topic"]                    = response["version"]
 
-  time.sleep(5)
+  # A version with the environment of $LATEST, for the testcase of the data key cache only
 
-  response                   = invoke_lambda(test_id, event, expected_status_code, check_text)
-  succeeded                  = response["succeeded"]
+  response                                                 = get_error_version("unittest: data key cache", environment_variables_org)
+  error_versions["data_key_cache"]                         = response["version"]
 
-  update_environment_variables(function_configuration_org, environment_variables_org)
-  
-  return { "succeeded" : succeeded, "will_be_sent_to_SNS": will_be_sent_to_SNS }
+  # The batches of the to_shop_decrypt queue go to sqs_lambda_handler
+
+  sqs_handler                                              = "shop_decrypt.sqs_lambda_handler"
+
+  response                                                 = get_error_version("unittest: sqs handler", environment_variables_org, sqs_handler)
+  error_versions["sqs_handler"]                            = response["version"]
+
+  response                                                 = get_error_version("unittest: sqs handler, incorrect SNS topic", environment_variables_new, sqs_handler)
+  error_versions["sqs_handler_incorrect_SNS_topic"]        = response["version"]
+
+  return
+
+# run_testcase
+# ------------
+# An exception in a testcase only makes that testcase fail
+
+def run_testcase(testcase):
+
+  try:
+    return testcase()
+  except Exception as e:
+    print("ERROR: in " + testcase.__name__ + ": " + repr(e))
+    return { "succeeded": False, "will_be_sent_to_SNS": False }
+
+# run_testcases
+# -------------
+# Runs the testcases at the same time, the responses are in the order of testcase_list
+
+def run_testcases(testcase_list):
+
+  start_time = time.monotonic()
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers = MAX_WORKERS) as executor:
+    responses = list(executor.map(run_testcase, testcase_list))
+
+  print("INFO: " + str(len(testcase_list)) + " testcases done in " + format(time.monotonic() - start_time, ".1f") + " seconds")
+
+  return { "responses": responses }
+
+# get_deadline
+# ------------
+# One deadline for check_SNS_topic: SNS_CHECK_TIMEOUT seconds from now, but before the function
+# is aborted by AWS
+
+def get_deadline(context):
+
+  seconds_left = context.get_remaining_time_in_millis() / 1000 - SNS_CHECK_MARGIN
+  deadline     = time.monotonic() + min(SNS_CHECK_TIMEOUT, seconds_left)
+
+  return { "deadline": deadline }
 
 # Main function
 # -------------
@@ -591,12 +1091,23 @@ def lambda_handler(event, context):
                    testcase_decrypt_error_base64_bogus_in_content_base64,
                    testcase_decrypt_error_bogus_in_shop_id,
                    testcase_decrypt_error_key_swap,
-                   testcase_decrypt_error_incorrect_SNS_topic
+                   testcase_decrypt_error_incorrect_SNS_topic,
+                   testcase_decrypt_correct_envelope,
+                   testcase_decrypt_correct_envelope_data_key_cache,
+                   testcase_decrypt_error_envelope_tampered_content,
+                   testcase_decrypt_error_envelope_content_of_other_shop,
+                   testcase_decrypt_error_envelope_bogus_encrypted_key,
+                   testcase_decrypt_correct_sqs_batch,
+                   testcase_decrypt_error_sqs_bogus_records,
+                   testcase_decrypt_error_sqs_incorrect_SNS_topic
                   ]
 
-  for testcase in testcase_list:
+  prepare_error_versions()
+
+  response  = run_testcases(testcase_list)
+
+  for testcase, response in zip(testcase_list, response["responses"]):
 
-    response            = testcase()
     process_testcase    = response["succeeded"]
     will_be_sent_to_SNS = response["will_be_sent_to_SNS"]
 
@@ -609,7 +1120,10 @@ def lambda_handler(event, context):
       
     checklist += [{ "test_id": testcase.__name__, "will_be_sent_to_SNS": will_be_sent_to_SNS }]
   
-  response = check_SNS_topic(checklist)
+  response = get_deadline(context)
+  deadline = response["deadline"]
+
+  response = check_SNS_topic(checklist, deadline)
   ok      += response["ok"]
   errors  += response["errors"]
     
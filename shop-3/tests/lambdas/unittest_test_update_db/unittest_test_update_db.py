@@ -4,13 +4,16 @@ import boto3
 import os
 import base64
 import time
+import threading
+import concurrent.futures
 import datetime
 
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 # FUNCTION NAME is the function name of the object under test (with AMIS_ prefix). 
-# It is used to read or change the settings of this function (for creating an error 
-# by changing the SNS ARN to a non existing ARN).
+# It is used to read the settings of this function and to publish versions of it with 
+# errors (f.e. a non existing SNS ARN), see get_error_version.
 
 NAME_PREFIX                 = os.environ["name_prefix"]
 NAME                        = "unittest_object_under_test_update_db"
@@ -18,12 +21,48 @@ FUNCTION_NAME               = NAME_PREFIX + "_" + NAME
 TABLE_NAME_SHOPS            = NAME_PREFIX + "-" + "unittest-shops"
 TABLE_NAME_SHOPS_MESSAGE_ID = NAME_PREFIX + "-" + "unittest-shops-message-ids"
 
+# The fused function (decrypt and update_db in one function) is tested here as well: it updates
+# the same tables. It gets encrypted messages, like shop_decrypt.
+
+FUNCTION_NAME_DECRYPT_UPDATE_DB = NAME_PREFIX + "_" + "unittest_object_under_test_decrypt_update_db"
+KEY_PREFIX                      = os.environ["key_prefix"]
+
+# The testcases run at the same time in MAX_WORKERS threads. Error testcases don't change the
+# environment of the object under test, they invoke a published version with their own environment
+# (see get_error_version). UPDATE_TIMEOUT is the maximum time in seconds for a configuration update.
+
+MAX_WORKERS    = int(os.environ.get("max_workers", "16"))
+UPDATE_TIMEOUT = 60
+
+# Versions of the object under test for the error testcases: { name: version }. The testcases run
+# twice: with update_mode "item" ($LATEST) and with update_mode "transaction" (a published version, 
+# see prepare_error_versions). update_mode is the update mode of the testcases that are running.
+
+error_versions = {}
+update_mode    = "item"
+
+# get_client
+# ----------
+# boto3.client() is not thread safe, the clients themselves are. Every client is created once,
+# with a connection pool for all threads.
+
+_clients      = {}
+_clients_lock = threading.Lock()
+
+def get_client(service_name):
+
+  with _clients_lock:
+    if (service_name not in _clients):
+      _clients[service_name] = boto3.client(service_name, config = Config(max_pool_connections = MAX_WORKERS))
+
+  return _clients[service_name]
+
 # get_function_configuration
 # --------------------------
 
 def get_function_configuration():
   
-  lambdaclient = boto3.client('lambda')
+  lambdaclient = get_client('lambda')
   response     = lambdaclient.get_function_configuration(
     FunctionName = FUNCTION_NAME
   )
@@ -34,42 +73,135 @@ def get_function_configuration():
 # update_function_configuration
 # -----------------------------
 
-def update_function_configuration(environment):
+def update_function_configuration(environment, handler):
 
-  lambdaclient = boto3.client('lambda')
+  lambdaclient = get_client('lambda')
   response     = lambdaclient.update_function_configuration(
     FunctionName = FUNCTION_NAME,
-    Environment  = environment
+    Environment  = environment,
+    Handler      = handler
   )
   print("DEBUG: Response of lambdaclient.update_function_configuration: "+json.dumps(response))
 
+  wait_for_function_update()
+
   return
 
 # update_environment_variables
 # ----------------------------
-# Environment variables of the Lambda function that is tested
+# Environment variables and handler of the Lambda function that is tested
 
-def update_environment_variables(response, environment_variables):
+def update_environment_variables(response, environment_variables, handler):
   
   environment_new              = copy.deepcopy(response["Environment"])
   environment_new["Variables"] = environment_variables
 
-  update_function_configuration(environment_new)
+  update_function_configuration(environment_new, handler)
 
   return 
 
+# wait_for_function_update
+# ------------------------
+# A new configuration isn't used immediately: poll LastUpdateStatus until the update is done
+
+def wait_for_function_update():
+
+  lambdaclient = get_client('lambda')
+  deadline     = time.monotonic() + UPDATE_TIMEOUT
+
+  while True:
+
+    response = lambdaclient.get_function_configuration(
+      FunctionName = FUNCTION_NAME
+    )
+    status   = response.get("LastUpdateStatus", "Successful")
+
+    if (status == "Successful"):
+      return { "succeeded": True }
+
+    if ((status == "Failed") or (time.monotonic() > deadline)):
+      print("ERROR: update of the configuration of " + FUNCTION_NAME + ": " + status + " " + response.get("LastUpdateStatusReason", ""))
+      return { "succeeded": False }
+
+    time.sleep(0.5)
+
+# get_error_version
+# -----------------
+# Returns a published version of the object under test with the environment variables (and the
+# handler, f.e. sqs_lambda_handler) of a testcase. A version of an earlier run is used again when
+# its code, configuration and environment are the same. Otherwise $LATEST gets these environment 
+# variables, is published and gets its own environment back. This is done before the testcases are
+# started, so no testcase sees the changed $LATEST. The version is None when it couldn't be published.
+
+VERSION_KEYS = ["CodeSha256", "Layers", "Runtime", "Role", "MemorySize", "Timeout"]
+
+def get_error_version(description, environment_variables, handler = None):
+
+  lambdaclient               = get_client('lambda')
+  response                   = get_function_configuration()
+  function_configuration_org = response["function_configuration"]
+  handler                    = handler if (handler != None) else function_configuration_org["Handler"]
+
+  for page in lambdaclient.get_paginator("list_versions_by_function").paginate(FunctionName = FUNCTION_NAME):
+    for version in page["Versions"]:
+
+      if ((version["Version"] != "$LATEST") and 
+          (version.get("Description") == description) and
+          (version.get("Environment", {}).get("Variables") == environment_variables) and
+          (version.get("Handler") == handler) and
+          all(version.get(key) == function_configuration_org.get(key) for key in VERSION_KEYS)):
+
+        print("INFO: " + description + ": version " + version["Version"])
+        return { "version": version["Version"] }
+
+  update_environment_variables(function_configuration_org, environment_variables, handler)
+
+  try:
+    response = lambdaclient.publish_version(
+      FunctionName = FUNCTION_NAME,
+      CodeSha256   = function_configuration_org["CodeSha256"],
+      Description  = description
+    )
+    print("DEBUG: Response of lambdaclient.publish_version: "+json.dumps(response))
+    version  = response["Version"]
+    print("INFO: " + description + ": published version " + version)
+  except ClientError as e:
+    print("ERROR: " + description + ": " + str(e))
+    version  = None
+
+  update_environment_variables(function_configuration_org, function_configuration_org["Environment"]["Variables"], function_configuration_org["Handler"])
+
+  return { "version": version }
+
+# get_update_mode_version
+# -----------------------
+# Returns the version of the object under test for the update mode of the running testcases. name 
+# is the name of an error version (f.e. "incorrect_table_name"), None is the object under test itself.
+
+def get_update_mode_version(name = None):
+
+  if (update_mode == "item"):
+    version = "$LATEST" if (name == None) else error_versions[name]
+  else:
+    version = error_versions["transaction_mode" if (name == None) else name + "_transaction_mode"]
+
+  return { "version": version }
+
 # invoke_lambda
 # -------------
 # Invoke lambda function and check response with what is expected print statements 
 # can be used for debugging or to look at the lead time of the invoke function. To 
-# keep the logs clean, I commented out most of them.
+# keep the logs clean, I commented out most of them. Without a version, the version of the 
+# update mode is invoked.
 
-def invoke_lambda(test_id, event, expected_status_code, checkstring):
+def invoke_lambda(test_id, event, expected_status_code, checkstring, version = None, function_name = FUNCTION_NAME):
 
-  lambdaclient = boto3.client('lambda')
+  lambdaclient = get_client('lambda')
+  version      = version if (version != None) else get_update_mode_version()["version"]
 
   response = lambdaclient.invoke(
-    FunctionName   = FUNCTION_NAME,
+    FunctionName   = function_name,
+    Qualifier      = version,
     InvocationType = "RequestResponse",
     LogType        = "Tail",
     Payload        = bytearray(json.dumps(event),'utf-8')
@@ -100,10 +232,11 @@ def invoke_lambda(test_id, event, expected_status_code, checkstring):
 def invoke_lambda_and_check_error(test_id, event, expected_status_code, checkstring):
   
   pos_in_payload = 0
-  lambdaclient   = boto3.client('lambda')
+  lambdaclient   = get_client('lambda')
 
   response = lambdaclient.invoke(
     FunctionName   = FUNCTION_NAME,
+    Qualifier      = get_update_mode_version()["version"],
     InvocationType = "RequestResponse",
     LogType        = "Tail",
     Payload        = bytearray(json.dumps(event),'utf-8')
@@ -130,10 +263,24 @@ def invoke_lambda_and_check_error(test_id, event, expected_status_code, checkstr
 
 # get_message_id
 # --------------
+# Testcases run at the same time: every message_id must be unique, otherwise update_db sees a 
+# message that is sent twice. When two testcases get the same time, the microseconds are increased.
+
+_last_message_datetime = None
+_message_id_lock       = threading.Lock()
 
 def get_message_id(): 
 
-  datetime_object = datetime.datetime.now()
+  global _last_message_datetime
+
+  with _message_id_lock:
+
+    datetime_object = datetime.datetime.now()
+
+    if ((_last_message_datetime != None) and (datetime_object <= _last_message_datetime)):
+      datetime_object = _last_message_datetime + datetime.timedelta(microseconds = 1)
+
+    _last_message_datetime = datetime_object
 
   year  = datetime_object.year
   month = datetime_object.month
@@ -216,6 +363,39 @@ def get_valid_sns_event(shop_id, message_id, sales_content):
 
   return { "event" : event }
 
+# encrypt_text
+# ------------
+
+def encrypt_text(shop_id, text):
+  
+  key_alias  = 'alias/' + KEY_PREFIX + shop_id
+
+  kms      = get_client('kms')
+  response = kms.encrypt(
+     KeyId=key_alias, 
+     Plaintext=text, 
+     EncryptionAlgorithm='RSAES_OAEP_SHA_256'
+  )
+  print("DEBUG: Response of kms.encrypt: "+str(response))
+
+  encrypted_content = response["CiphertextBlob"]
+  content_base64    = base64.standard_b64encode(encrypted_content).decode("utf-8")
+
+  return { "content_base64" : content_base64 }
+
+# get_valid_encrypted_sns_event
+# -----------------------------
+# Event of the fused function: the message of the to_shop_decrypt topic, with the encrypted sales
+
+def get_valid_encrypted_sns_event(shop_id, message_id, content_base64):
+
+  message    = json.dumps({"body": json.dumps({"shop_id": shop_id, "message_id": message_id, "content_base64": content_base64})})
+
+  response   = get_valid_sns_event_from_message(message)
+  event      = response["event"]
+
+  return { "event" : event }
+
 # get_sns_event_without_shop_id
 # -----------------------------
   
@@ -252,6 +432,64 @@ def get_sns_event_without_decrypted_content(shop_id, message_id):
 
   return { "event" : event }
 
+# get_valid_sqs_event
+# -------------------
+# Batch of the to_shop_update_db queue (raw message delivery): messages is a list of 
+# (shop_id, message_id, sales_content). The messageId of the SQS records is the position in 
+# the batch.
+
+def get_valid_sqs_event(messages):
+
+  records = []
+
+  for record_number, (shop_id, message_id, sales_content) in enumerate(messages):
+
+    message = json.dumps({"shop_id": shop_id, "message_id": message_id, "decrypted_content": json.dumps({"sales": sales_content })})
+
+    records.append({
+      "messageId"         : "sqs-message-" + str(record_number),
+      "receiptHandle"     : "receipt-handle-" + str(record_number),
+      "body"              : message,
+      "attributes"        : { "ApproximateReceiveCount": "1" },
+      "messageAttributes" : {},
+      "eventSource"       : "aws:sqs",
+      "eventSourceARN"    : "arn:aws:sqs:eu-west-1:300577164517:AMIS_to_shop_update_db",
+      "awsRegion"         : "eu-west-1"
+    })
+
+  return { "event": { "Records": records } }
+
+# invoke_sqs_lambda
+# -----------------
+# Invokes a version with sqs_lambda_handler, checks the log like invoke_lambda and returns the 
+# itemIdentifiers of the batchItemFailures in the payload
+
+def invoke_sqs_lambda(test_id, event, checkstring, version):
+
+  lambdaclient = get_client('lambda')
+
+  response = lambdaclient.invoke(
+    FunctionName   = FUNCTION_NAME,
+    Qualifier      = version,
+    InvocationType = "RequestResponse",
+    LogType        = "Tail",
+    Payload        = bytearray(json.dumps(event),'utf-8')
+  )
+  print("DEBUG: Response of lambdaclient.invoke: "+str(response))
+
+  log_result  = str(base64.b64decode(response["LogResult"]))
+  payload     = response["Payload"].read().decode('utf-8')
+  print("DEBUG: log: " + log_result)
+  print("DEBUG: " + test_id + ": Payload = " + payload)
+
+  failed_identifiers = []
+  succeeded          = (response.get("FunctionError") == None) and (log_result.find(checkstring) >= 0)
+
+  if (succeeded):
+    failed_identifiers = [failure["itemIdentifier"] for failure in json.loads(payload)["batchItemFailures"]]
+
+  return { "succeeded": succeeded, "failed_identifiers": failed_identifiers }
+
 # set_item_shops
 # --------------
 
@@ -259,7 +497,7 @@ def set_item_shops(shop_id, record_type, gross_number, gross_turnover, stock):
 
   try:
 
-    dynamodb = boto3.client('dynamodb')
+    dynamodb = get_client('dynamodb')
     response = dynamodb.update_item (
       TableName = TABLE_NAME_SHOPS,
       Key       = {
@@ -293,7 +531,7 @@ def get_item_shops(shop_id, record_type):
 
   try:
 
-    dynamodb = boto3.client('dynamodb')
+    dynamodb = get_client('dynamodb')
     response = dynamodb.get_item (
       TableName = TABLE_NAME_SHOPS,
       Key       = {
@@ -315,6 +553,28 @@ def get_item_shops(shop_id, record_type):
 
   return {"succeeded": succeeded, "item": item}
 
+# delete_item_shops
+# -----------------
+
+def delete_item_shops(shop_id, record_type):
+
+  try:
+
+    dynamodb = get_client('dynamodb')
+    response = dynamodb.delete_item (
+      TableName = TABLE_NAME_SHOPS,
+      Key       = {
+        'shop_id'     : { "S": shop_id },
+        'record_type' : { "S": record_type }
+      }
+    ) 
+    print("DEBUG: Response of dynamodb.delete_item (-shops): "+json.dumps(response))
+
+  except ClientError as e:
+    print("ERROR:" + shop_id + " - " + record_type + " - " + str(e))
+
+  return
+
 # delete_item_shops_message_id
 # ----------------------------
 
@@ -322,7 +582,7 @@ def delete_item_shops_message_id(shop_id, message_id):
 
   try:
 
-    dynamodb = boto3.client('dynamodb')
+    dynamodb = get_client('dynamodb')
     response = dynamodb.delete_item (
       TableName = TABLE_NAME_SHOPS_MESSAGE_ID,
       Key       = {
@@ -352,7 +612,7 @@ def get_item_shops_message_id(shop_id, message_id):
 
   try:
 
-    dynamodb = boto3.client('dynamodb')
+    dynamodb = get_client('dynamodb')
     response = dynamodb.get_item (
       TableName = TABLE_NAME_SHOPS_MESSAGE_ID,
       Key       = {
@@ -833,6 +1093,269 @@ def testcase_update_db_correct_customer_returned_goods():
     
   return {"succeeded" : succeeded}  
 
+# testcase_update_db_correct_number_formats
+# -----------------------------------------
+# Good situation: numbers in exponent notation or with spaces around them are accepted, like 
+# they were before the events were parsed by shop_event
+
+def testcase_update_db_correct_number_formats():
+
+  test_id                 = "testcase_update_db_correct_number_formats"
+  shop_id                 = 'AMIS1'
+
+  initial_gross_number    = "0"
+  initial_gross_turnover  = "0"
+  initial_stock           = "100000"
+
+  sales_item_no           = '00030'
+  sales_gross_number      = '1e1'
+  sales_gross_turnover    = ' 25 '
+
+  expected_status_code    = 200
+  check_text              = "succeeded: True"
+
+  expected_gross_number   = "10"
+  expected_gross_turnover = "25"
+  expected_stock          = "99990"
+  
+  record_type             = 's-'+str(sales_item_no)
+  sales_list              = [{"item_no": sales_item_no, "gross_number": sales_gross_number, "gross_turnover": sales_gross_turnover}]
+  
+  response                = get_message_id()
+  message_id              = response["message_id"]
+  
+  set_item_shops(shop_id, record_type, initial_gross_number, initial_gross_turnover, initial_stock)
+
+  response  = get_valid_sns_event(shop_id, message_id, sales_list)
+  event     = response["event"]
+
+  response  = invoke_lambda(test_id, event, expected_status_code, check_text)
+  succeeded = response["succeeded"]
+
+  if (succeeded):
+    response  = get_and_check_item(shop_id, record_type, expected_gross_number, expected_gross_turnover, expected_stock) 
+    succeeded = response["succeeded"]
+    
+  return {"succeeded" : succeeded}  
+
+# testcase_update_db_correct_sqs_batch
+# ------------------------------------
+# Good situation: a batch of the to_shop_update_db queue. The sales of the messages are added up
+# per item, the message that is twice in the batch is counted once and no message is given back 
+# to SQS.
+
+def testcase_update_db_correct_sqs_batch():
+
+  test_id                   = "testcase_update_db_correct_sqs_batch"
+  shop_id                   = 'AMIS1'
+
+  initial_gross_number      = "0"
+  initial_gross_turnover    = "0"
+  initial_stock             = "100000"
+
+  sales_item_no_1           = '00040'
+  sales_item_no_2           = '00041'
+
+  check_text                = "WARNING: message sent twice"
+
+  expected_gross_number_1   = "5"
+  expected_gross_turnover_1 = "25"
+  expected_stock_1          = "99995"
+
+  expected_gross_number_2   = "1"
+  expected_gross_turnover_2 = "5"
+  expected_stock_2          = "99999"
+
+  record_type_1             = 's-'+str(sales_item_no_1)
+  record_type_2             = 's-'+str(sales_item_no_2)
+
+  message_id_1              = get_message_id()["message_id"]
+  message_id_2              = get_message_id()["message_id"]
+
+  sales_list_1              = [{"item_no": sales_item_no_1, "gross_number": "2", "gross_turnover": "10"}]
+  sales_list_2              = [{"item_no": sales_item_no_1, "gross_number": "3", "gross_turnover": "15"},
+                               {"item_no": sales_item_no_2, "gross_number": "1", "gross_turnover": "5"}]
+
+  set_item_shops(shop_id, record_type_1, initial_gross_number, initial_gross_turnover, initial_stock)
+  set_item_shops(shop_id, record_type_2, initial_gross_number, initial_gross_turnover, initial_stock)
+
+  response  = get_valid_sqs_event([(shop_id, message_id_1, sales_list_1),
+                                   (shop_id, message_id_2, sales_list_2),
+                                   (shop_id, message_id_1, sales_list_1)])
+  event     = response["event"]
+
+  response  = invoke_sqs_lambda(test_id, event, check_text, error_versions["sqs_handler"])
+  succeeded = response["succeeded"] and (response["failed_identifiers"] == [])
+
+  if (succeeded):
+    response  = get_and_check_item(shop_id, record_type_1, expected_gross_number_1, expected_gross_turnover_1, expected_stock_1) 
+    succeeded = response["succeeded"]
+
+  if (succeeded):
+    response  = get_and_check_item(shop_id, record_type_2, expected_gross_number_2, expected_gross_turnover_2, expected_stock_2) 
+    succeeded = response["succeeded"]
+    
+  return {"succeeded" : succeeded}  
+
+# testcase_update_db_correct_sqs_batch_sent_twice
+# -----------------------------------------------
+# Good situation: a message that is already in the database comes again in another batch (f.e. 
+# after a timeout of the function), with a new message. The new message is added, the old one 
+# isn't added again. When SQS then delivers that batch again, DynamoDB recognizes the transaction
+# (same ClientRequestToken) and nothing is added. No message is given back to SQS.
+
+def testcase_update_db_correct_sqs_batch_sent_twice():
+
+  test_id                 = "testcase_update_db_correct_sqs_batch_sent_twice"
+  shop_id                 = 'AMIS1'
+
+  initial_gross_number    = "0"
+  initial_gross_turnover  = "0"
+  initial_stock           = "100000"
+
+  sales_item_no           = '00045'
+
+  check_text              = "WARNING: message sent twice"
+
+  expected_gross_number   = "5"
+  expected_gross_turnover = "10"
+  expected_stock          = "99995"
+  
+  record_type             = 's-'+str(sales_item_no)
+  sales_list_1            = [{"item_no": sales_item_no, "gross_number": "4", "gross_turnover": "8"}]
+  sales_list_2            = [{"item_no": sales_item_no, "gross_number": "1", "gross_turnover": "2"}]
+  
+  message_id_1            = get_message_id()["message_id"]
+  message_id_2            = get_message_id()["message_id"]
+
+  set_item_shops(shop_id, record_type, initial_gross_number, initial_gross_turnover, initial_stock)
+
+  response  = get_valid_sqs_event([(shop_id, message_id_1, sales_list_1)])
+  event_1   = response["event"]
+
+  response  = get_valid_sqs_event([(shop_id, message_id_1, sales_list_1), (shop_id, message_id_2, sales_list_2)])
+  event_2   = response["event"]
+
+  response  = invoke_sqs_lambda(test_id, event_1, "", error_versions["sqs_handler"])
+  succeeded = response["succeeded"] and (response["failed_identifiers"] == [])
+
+  if (succeeded):
+    response  = invoke_sqs_lambda(test_id, event_2, check_text, error_versions["sqs_handler"])
+    succeeded = response["succeeded"] and (response["failed_identifiers"] == [])
+
+  if (succeeded):
+    response  = invoke_sqs_lambda(test_id, event_2, "", error_versions["sqs_handler"])
+    succeeded = response["succeeded"] and (response["failed_identifiers"] == [])
+
+  if (succeeded):
+    response  = get_and_check_item(shop_id, record_type, expected_gross_number, expected_gross_turnover, expected_stock) 
+    succeeded = response["succeeded"]
+    
+  return {"succeeded" : succeeded}  
+
+# testcase_update_db_correct_large_basket
+# ---------------------------------------
+# A basket with more sales lines than fit in one transaction (MAX_TRANSACTION_ITEMS = 100 in 
+# shop_update_db, one of them is the message_id): in update_mode "transaction" it is written in two
+# transactions. All items must be updated.
+
+def testcase_update_db_correct_large_basket():
+
+  test_id                 = "testcase_update_db_correct_large_basket"
+  shop_id                 = 'AMIS1'
+
+  initial_gross_number    = "0"
+  initial_gross_turnover  = "0"
+  initial_stock           = "100000"
+
+  first_item_no           = 30000
+  number_of_items         = 101
+
+  expected_status_code    = 200
+  check_text              = "succeeded: True"
+
+  expected_gross_number   = "1"
+  expected_gross_turnover = "2"
+  expected_stock          = "99999"
+
+  item_nos                = [str(item_no) for item_no in range(first_item_no, first_item_no + number_of_items)]
+  sales_list              = [{"item_no": item_no, "gross_number": "1", "gross_turnover": "2"} for item_no in item_nos]
+
+  response                = get_message_id()
+  message_id              = response["message_id"]
+
+  for item_no in item_nos:
+    set_item_shops(shop_id, 's-'+item_no, initial_gross_number, initial_gross_turnover, initial_stock)
+
+  response  = get_valid_sns_event(shop_id, message_id, sales_list)
+  event     = response["event"]
+
+  response  = invoke_lambda(test_id, event, expected_status_code, check_text)
+  succeeded = response["succeeded"]
+
+  for item_no in item_nos:
+    if (succeeded):
+      response  = get_and_check_item(shop_id, 's-'+item_no, expected_gross_number, expected_gross_turnover, expected_stock) 
+      succeeded = response["succeeded"]
+
+  return { "succeeded" : succeeded }  
+
+# testcase_update_db_correct_resumed_basket
+# -----------------------------------------
+# Only in update_mode "transaction": the second transaction of a large basket fails (the last item
+# doesn't exist yet), the first one is committed. When the message is sent again, after the item is
+# added, only the second transaction is written: the items of the first transaction are updated once.
+
+def testcase_update_db_correct_resumed_basket():
+
+  test_id                 = "testcase_update_db_correct_resumed_basket"
+  shop_id                 = 'AMIS1'
+
+  initial_gross_number    = "0"
+  initial_gross_turnover  = "0"
+  initial_stock           = "100000"
+
+  first_item_no           = 31000
+  number_of_items         = 101
+
+  expected_status_code    = 200
+  check_text_1            = "CancellationReasons"
+  check_text_2            = "resuming message: shop_id: AMIS1"
+
+  expected_gross_number   = "1"
+  expected_gross_turnover = "2"
+  expected_stock          = "99999"
+
+  item_nos                = [str(item_no) for item_no in range(first_item_no, first_item_no + number_of_items)]
+  sales_list              = [{"item_no": item_no, "gross_number": "1", "gross_turnover": "2"} for item_no in item_nos]
+
+  response                = get_message_id()
+  message_id              = response["message_id"]
+
+  for item_no in item_nos[:-1]:
+    set_item_shops(shop_id, 's-'+item_no, initial_gross_number, initial_gross_turnover, initial_stock)
+
+  delete_item_shops(shop_id, 's-'+item_nos[-1])
+
+  response  = get_valid_sns_event(shop_id, message_id, sales_list)
+  event     = response["event"]
+
+  response  = invoke_lambda(test_id, event, expected_status_code, check_text_1)
+  succeeded = response["succeeded"]
+
+  if (succeeded):
+    set_item_shops(shop_id, 's-'+item_nos[-1], initial_gross_number, initial_gross_turnover, initial_stock)
+
+    response  = invoke_lambda(test_id, event, expected_status_code, check_text_2)
+    succeeded = response["succeeded"]
+
+  for item_no in item_nos:
+    if (succeeded):
+      response  = get_and_check_item(shop_id, 's-'+item_no, expected_gross_number, expected_gross_turnover, expected_stock) 
+      succeeded = response["succeeded"]
+
+  return { "succeeded" : succeeded }  
+
 # testcase_update_db_error_message_too_old
 # ----------------------------------------
 
@@ -954,7 +1477,7 @@ def testcase_update_db_error_event_without_decrypted_content():
 # It is hard to test an error situation in the call to update the DynamoDB table, as the error will come back from AWS. 
 # The only way to test this, is to pass an incorrect parameter to the DynamoDB function. 
 # This is done by changing the environment variable from the unittest_object_under_test_update_db function 
-# and let it point to a non-existing table.
+# and let it point to a non-existing table, in a published version of it (see prepare_error_versions).
 
 def testcase_update_db_error_incorrect_table_name():
 
@@ -977,25 +1500,9 @@ def testcase_update_db_error_incorrect_table_name():
   response                = get_valid_sns_event(shop_id, message_id, sales_list)
   event                   = response["event"]
 
-  response                   = get_function_configuration()
-  function_configuration_org = response["function_configuration"]
-  environment_variables_org  = function_configuration_org["Environment"]["Variables"]
-
-  environment_variables_new                = copy.deepcopy(environment_variables_org)
-  environment_variables_new["name_prefix"] = "non-existing-"+environment_variables_new["name_prefix"]
-  update_environment_variables(function_configuration_org, environment_variables_new)
-
-  # We need to wait for 5 seconds before we call the function to force AWS to use the version of the 
-  # function that we updated (not the version that is still in memory, including the old content of 
-  # the environment variable)
-
-  time.sleep(5)
-
-  response  = invoke_lambda(test_id, event, expected_status_code, check_text)
+  response  = invoke_lambda(test_id, event, expected_status_code, check_text, get_update_mode_version("incorrect_table_name")["version"])
   succeeded = response["succeeded"]
 
-  update_environment_variables(function_configuration_org, environment_variables_org)
-
   return {"succeeded" : succeeded}  
   
 # testcase_update_db_error_incorrect_shop_id
@@ -1260,12 +1767,306 @@ def testcase_update_db_error_negative_gross_turnover():
 
   return {"succeeded" : succeeded}  
 
+# testcase_update_db_error_sqs_update_fails
+# -----------------------------------------
+# The transaction of the batch fails (here: the table doesn't exist, in real life f.e. throttling 
+# on a hot item). Nothing is written and all messages are given back to SQS, so they are retried.
+# A retry of the same batch with a correct table must then write them.
+
+def testcase_update_db_error_sqs_update_fails():
+
+  test_id                 = "testcase_update_db_error_sqs_update_fails"
+  shop_id                 = 'AMIS1'
+
+  initial_gross_number    = "0"
+  initial_gross_turnover  = "0"
+  initial_stock           = "100000"
+
+  sales_item_no           = '20045'
+
+  check_text              = "they will be retried"
+
+  expected_gross_number   = "3"
+  expected_gross_turnover = "9"
+  expected_stock          = "99997"
+
+  record_type             = 's-'+str(sales_item_no)
+  sales_list_1            = [{"item_no": sales_item_no, "gross_number": "1", "gross_turnover": "3"}]
+  sales_list_2            = [{"item_no": sales_item_no, "gross_number": "2", "gross_turnover": "6"}]
+
+  message_id_1            = get_message_id()["message_id"]
+  message_id_2            = get_message_id()["message_id"]
+
+  set_item_shops(shop_id, record_type, initial_gross_number, initial_gross_turnover, initial_stock)
+
+  response  = get_valid_sqs_event([(shop_id, message_id_1, sales_list_1), (shop_id, message_id_2, sales_list_2)])
+  event     = response["event"]
+
+  response  = invoke_sqs_lambda(test_id, event, check_text, error_versions["sqs_handler_incorrect_table_name"])
+  succeeded = response["succeeded"] and (sorted(response["failed_identifiers"]) == [record["messageId"] for record in event["Records"]])
+
+  if (succeeded):
+    response  = invoke_sqs_lambda(test_id, event, "", error_versions["sqs_handler"])
+    succeeded = response["succeeded"] and (response["failed_identifiers"] == [])
+
+  if (succeeded):
+    response  = get_and_check_item(shop_id, record_type, expected_gross_number, expected_gross_turnover, expected_stock) 
+    succeeded = response["succeeded"]
+
+  return {"succeeded" : succeeded}  
+
+# testcase_update_db_error_sqs_unknown_item
+# -----------------------------------------
+# One message of the batch has an item_no that doesn't exist. Only that message is given back to 
+# SQS, the other messages are written.
+
+def testcase_update_db_error_sqs_unknown_item():
+
+  test_id                 = "testcase_update_db_error_sqs_unknown_item"
+  shop_id                 = 'AMIS1'
+
+  initial_gross_number    = "0"
+  initial_gross_turnover  = "0"
+  initial_stock           = "100000"
+
+  sales_item_no           = '20050'
+  unknown_item_no         = '20055'
+
+  check_text              = "message failed, it will be retried"
+
+  expected_gross_number   = "4"
+  expected_gross_turnover = "12"
+  expected_stock          = "99996"
+
+  record_type             = 's-'+str(sales_item_no)
+  sales_list_1            = [{"item_no": sales_item_no,   "gross_number": "1", "gross_turnover": "3"}]
+  sales_list_2            = [{"item_no": sales_item_no,   "gross_number": "2", "gross_turnover": "6"},
+                             {"item_no": unknown_item_no, "gross_number": "1", "gross_turnover": "1"}]
+  sales_list_3            = [{"item_no": sales_item_no,   "gross_number": "3", "gross_turnover": "9"}]
+
+  message_id_1            = get_message_id()["message_id"]
+  message_id_2            = get_message_id()["message_id"]
+  message_id_3            = get_message_id()["message_id"]
+
+  set_item_shops(shop_id, record_type, initial_gross_number, initial_gross_turnover, initial_stock)
+
+  response  = get_valid_sqs_event([(shop_id, message_id_1, sales_list_1), (shop_id, message_id_2, sales_list_2), (shop_id, message_id_3, sales_list_3)])
+  event     = response["event"]
+
+  response  = invoke_sqs_lambda(test_id, event, check_text, error_versions["sqs_handler"])
+  succeeded = response["succeeded"] and (response["failed_identifiers"] == [event["Records"][1]["messageId"]])
+
+  if (succeeded):
+    response  = get_and_check_item(shop_id, record_type, expected_gross_number, expected_gross_turnover, expected_stock) 
+    succeeded = response["succeeded"]
+
+  return {"succeeded" : succeeded}  
+
+# testcase_decrypt_update_db_correct
+# ----------------------------------
+# The fused function decrypts the message and updates the item
+
+def testcase_decrypt_update_db_correct():
+
+  test_id                 = "testcase_decrypt_update_db_correct"
+  shop_id                 = 'AMIS1'
+
+  initial_gross_number    = "0"
+  initial_gross_turnover  = "0"
+  initial_stock           = "100000"
+
+  sales_item_no           = '20060'
+  sales_gross_number      = '2'
+  sales_gross_turnover    = '10'
+
+  expected_status_code    = 200
+  check_text              = "succeeded: True"
+
+  expected_gross_number   = "2"
+  expected_gross_turnover = "10"
+  expected_stock          = "99998"
+
+  record_type             = 's-'+str(sales_item_no)
+  sales_list              = [{"item_no": sales_item_no, "gross_number": sales_gross_number, "gross_turnover": sales_gross_turnover}]
+
+  response                = get_message_id()
+  message_id              = response["message_id"]
+
+  set_item_shops(shop_id, record_type, initial_gross_number, initial_gross_turnover, initial_stock)
+
+  response  = encrypt_text(shop_id, json.dumps({"sales": sales_list}))
+  response  = get_valid_encrypted_sns_event(shop_id, message_id, response["content_base64"])
+  event     = response["event"]
+
+  response  = invoke_lambda(test_id, event, expected_status_code, check_text, "$LATEST", FUNCTION_NAME_DECRYPT_UPDATE_DB)
+  succeeded = response["succeeded"]
+
+  if (succeeded):
+    response  = get_and_check_item(shop_id, record_type, expected_gross_number, expected_gross_turnover, expected_stock) 
+    succeeded = response["succeeded"]
+
+  return { "succeeded" : succeeded }  
+
+# testcase_decrypt_update_db_error_key_swap
+# -----------------------------------------
+# The message is encrypted with the key of AMIS1, but sent by AMIS2: it can't be decrypted and 
+# the item isn't changed
+
+def testcase_decrypt_update_db_error_key_swap():
+
+  test_id                 = "testcase_decrypt_update_db_error_key_swap"
+  shop_id                 = 'AMIS2'
+
+  initial_gross_number    = "0"
+  initial_gross_turnover  = "0"
+  initial_stock           = "100000"
+
+  sales_item_no           = '20065'
+
+  expected_status_code    = 200
+  check_text              = "An error occurred (InvalidCiphertextException) when calling the Decrypt operation"
+
+  record_type             = 's-'+str(sales_item_no)
+  sales_list              = [{"item_no": sales_item_no, "gross_number": "1", "gross_turnover": "1"}]
+
+  response                = get_message_id()
+  message_id              = response["message_id"]
+
+  set_item_shops(shop_id, record_type, initial_gross_number, initial_gross_turnover, initial_stock)
+
+  response  = encrypt_text("AMIS1", json.dumps({"sales": sales_list}))
+  response  = get_valid_encrypted_sns_event(shop_id, message_id, response["content_base64"])
+  event     = response["event"]
+
+  response  = invoke_lambda(test_id, event, expected_status_code, check_text, "$LATEST", FUNCTION_NAME_DECRYPT_UPDATE_DB)
+  succeeded = response["succeeded"]
+
+  if (succeeded):
+    response  = get_and_check_item(shop_id, record_type, initial_gross_number, initial_gross_turnover, initial_stock) 
+    succeeded = response["succeeded"]
+
+  return { "succeeded" : succeeded }  
+
+# testcase_decrypt_update_db_error_unknown_item
+# ---------------------------------------------
+# The message is decrypted, but one of the items doesn't exist: the transaction fails and the 
+# other item isn't changed either
+
+def testcase_decrypt_update_db_error_unknown_item():
+
+  test_id                 = "testcase_decrypt_update_db_error_unknown_item"
+  shop_id                 = 'AMIS1'
+
+  initial_gross_number    = "0"
+  initial_gross_turnover  = "0"
+  initial_stock           = "100000"
+
+  sales_item_no           = '20070'
+  unknown_item_no         = '20075'
+
+  expected_status_code    = 200
+  check_text              = "ValidationError"
+
+  record_type             = 's-'+str(sales_item_no)
+  sales_list              = [{"item_no": sales_item_no,   "gross_number": "1", "gross_turnover": "1"},
+                             {"item_no": unknown_item_no, "gross_number": "1", "gross_turnover": "1"}]
+
+  response                = get_message_id()
+  message_id              = response["message_id"]
+
+  set_item_shops(shop_id, record_type, initial_gross_number, initial_gross_turnover, initial_stock)
+
+  response  = encrypt_text(shop_id, json.dumps({"sales": sales_list}))
+  response  = get_valid_encrypted_sns_event(shop_id, message_id, response["content_base64"])
+  event     = response["event"]
+
+  response  = invoke_lambda(test_id, event, expected_status_code, check_text, "$LATEST", FUNCTION_NAME_DECRYPT_UPDATE_DB)
+  succeeded = response["succeeded"]
+
+  if (succeeded):
+    response  = get_and_check_item(shop_id, record_type, initial_gross_number, initial_gross_turnover, initial_stock) 
+    succeeded = response["succeeded"]
+
+  return { "succeeded" : succeeded }  
+
+# prepare_error_versions
+# ----------------------
+# Publishes the versions of the object under test for the error testcases, before the testcases 
+# are started
+
+def prepare_error_versions():
+
+  response                                 = get_function_configuration()
+  environment_variables_org                = response["function_configuration"]["Environment"]["Variables"]
+
+  environment_variables_new                = copy.deepcopy(environment_variables_org)
+  environment_variables_new["name_prefix"] = "non-existing-"+environment_variables_new["name_prefix"]
+
+  response                                 = get_error_version("unittest: incorrect table name", environment_variables_new)
+  error_versions["incorrect_table_name"]   = response["version"]
+
+  # The batches of the to_shop_update_db queue go to sqs_lambda_handler
+
+  sqs_handler                              = "shop_update_db.sqs_lambda_handler"
+
+  response                                 = get_error_version("unittest: sqs handler", environment_variables_org, sqs_handler)
+  error_versions["sqs_handler"]            = response["version"]
+
+  response                                 = get_error_version("unittest: sqs handler, incorrect table name", environment_variables_new, sqs_handler)
+  error_versions["sqs_handler_incorrect_table_name"] = response["version"]
+
+  # The same testcases with update_mode "transaction", see get_update_mode_version
+
+  environment_variables_transaction                = copy.deepcopy(environment_variables_org)
+  environment_variables_transaction["update_mode"] = "transaction"
+
+  environment_variables_new                        = copy.deepcopy(environment_variables_transaction)
+  environment_variables_new["name_prefix"]         = "non-existing-"+environment_variables_new["name_prefix"]
+
+  response                                 = get_error_version("unittest: transaction mode", environment_variables_transaction)
+  error_versions["transaction_mode"]       = response["version"]
+
+  response                                 = get_error_version("unittest: transaction mode, incorrect table name", environment_variables_new)
+  error_versions["incorrect_table_name_transaction_mode"] = response["version"]
+
+  return
+
+# run_testcase
+# ------------
+# An exception in a testcase only makes that testcase fail
+
+def run_testcase(testcase):
+
+  try:
+    return testcase()
+  except Exception as e:
+    print("ERROR: in " + testcase.__name__ + ": " + repr(e))
+    return { "succeeded": False }
+
+# run_testcases
+# -------------
+# Runs the testcases at the same time, the responses are in the order of testcase_list
+
+def run_testcases(testcase_list):
+
+  start_time = time.monotonic()
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers = MAX_WORKERS) as executor:
+    responses = list(executor.map(run_testcase, testcase_list))
+
+  print("INFO: " + str(len(testcase_list)) + " testcases done in " + format(time.monotonic() - start_time, ".1f") + " seconds")
+
+  return { "responses": responses }
+
 # Main function
 # =============
-# Event is not relevant. 
+# Event is not relevant. The testcases of the SNS handler run in both update modes, one mode after
+# the other: the testcases of a mode use the same items as the testcases of the other mode.
 
 def lambda_handler(event, context):
 
+  global update_mode
+
   print("DEBUG: BEGIN: event: "+json.dumps(event))
 
   ok          = 0
@@ -1282,6 +2083,8 @@ def lambda_handler(event, context):
                    testcase_update_db_correct_maximum_values,
                    testcase_update_db_correct_negative_stock,
                    testcase_update_db_correct_customer_returned_goods,
+                   testcase_update_db_correct_number_formats,
+                   testcase_update_db_correct_large_basket,
                    testcase_update_db_error_message_too_old,
                    testcase_update_db_error_event_without_shop_id,
                    testcase_update_db_error_event_without_message_id,
@@ -1295,17 +2098,39 @@ def lambda_handler(event, context):
                    testcase_update_db_error_alpha_gross_turnover,
                    testcase_update_db_error_negative_gross_number,
                    testcase_update_db_error_negative_gross_turnover]
+
+  sqs_testcase_list = [testcase_update_db_correct_sqs_batch,
+                       testcase_update_db_correct_sqs_batch_sent_twice,
+                       testcase_update_db_error_sqs_update_fails,
+                       testcase_update_db_error_sqs_unknown_item]
+
+  transaction_testcase_list = [testcase_update_db_correct_resumed_basket]
+
+  # The fused function has update_mode "transaction", its testcases run once
+
+  decrypt_update_db_testcase_list = [testcase_decrypt_update_db_correct,
+                                     testcase_decrypt_update_db_error_key_swap,
+                                     testcase_decrypt_update_db_error_unknown_item]
+
+  update_mode_testcase_lists = [("item",        testcase_list + sqs_testcase_list),
+                                ("transaction", testcase_list + transaction_testcase_list + decrypt_update_db_testcase_list)]
                    
-  for testcase in testcase_list:
-    response           = testcase()
-    update_db_testcase = response["succeeded"]
-
-    if (update_db_testcase):
-      print("INFO: " + testcase.__name__ + " succeeded")
-      ok += 1
-    else:
-      print("ERROR: in " + testcase.__name__)
-      errors += 1
+  prepare_error_versions()
+
+  for update_mode, update_mode_testcase_list in update_mode_testcase_lists:
+
+    response = run_testcases(update_mode_testcase_list)
+
+    for testcase, response in zip(update_mode_testcase_list, response["responses"]):
+      update_db_testcase = response["succeeded"]
+      name               = testcase.__name__ + " (update_mode " + update_mode + ")"
+
+      if (update_db_testcase):
+        print("INFO: " + name + " succeeded")
+        ok += 1
+      else:
+        print("ERROR: in " + name)
+        errors += 1
 
   print("INFO: OK: "+str(ok)+", Errors: "+str(errors))
 
@@ -0,0 +1,843 @@
+#!/usr/bin/python3
+#
+# run_unittests_local.py
+# ----------------------
+# Runs the unittest functions unittest_test_accept, unittest_test_decrypt and unittest_test_update_db
+# in this process, without AWS. The testcases are the same, only the AWS services are replaced by
+# in-memory stand-ins:
+#
+# - Lambda   : invoke starts the handler of shop_accept, shop_decrypt or shop_update_db (the objects
+#              under test) with the environment of the function, like terraform_tests.tf. The log
+#              tail (LogResult) and the payload of errors look like the ones of Lambda. Versions
+#              with their own environment and handler can be published, so the error and SQS
+#              testcases work like they do in AWS.
+# - KMS      : RSA keys that are generated at the start, RSAES_OAEP_SHA_256 like KMS
+# - SNS      : the topic to_unittest_support_echo delivers to unittest_support_echo. The log lines
+#              with "DEBUG: BEGIN: event:" go to unittest_support_send_logs_from_unittest_support_echo,
+#              like the subscription filter does. Other topics don't exist.
+# - SQS      : the queue log_messages_from_unittest_support_echo
+# - DynamoDB : the tables <name_prefix>-unittest-shops and <name_prefix>-unittest-shops-message-ids,
+#              with the update expressions, conditions and transactions of shop_update_db and the unittests
+#
+# The testcases run at the same time, like in AWS (max_workers threads, default 16). Every 
+# invocation has its own log and environment variables, see Invocations.
+#
+# Needs boto3, aws-xray-sdk and cryptography (pip3 install boto3 aws-xray-sdk cryptography), not
+# AWS access. Exits with 1 when a testcase failed. Example:
+#   ./run_unittests_local.py --suites decrypt,update_db --verbose
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import gzip
+import base64
+import argparse
+import datetime
+import collections.abc
+import threading
+import importlib
+import traceback
+import contextlib
+
+from decimal import Decimal
+
+TESTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SHOP_DIRECTORY  = os.path.join(TESTS_DIRECTORY, "..", "shop")
+SUITES          = ["accept", "decrypt", "update_db"]
+
+NAME_PREFIX     = "local"
+KEY_PREFIX      = "KeyLocal"
+SHOP_IDS        = ["AMIS1", "AMIS2"]
+ACCOUNT         = "000000000000"
+REGION          = "local"
+
+ECHO_TOPIC_ARN  = "arn:aws:sns:" + REGION + ":" + ACCOUNT + ":" + NAME_PREFIX + "_to_unittest_support_echo"
+QUEUE_URL       = "https://sqs." + REGION + ".amazonaws.com/" + ACCOUNT + "/" + NAME_PREFIX + "_log_messages_from_unittest_support_echo"
+FILTER_PATTERN  = "DEBUG: BEGIN: event:"
+
+# Lambda returns the last 4 KB of the log in LogResult
+
+LOG_TAIL_BYTES  = 4096
+RSA_KEY_SIZE    = 2048
+
+# FUNCTIONS
+# ---------
+# Per function (without the name_prefix): the module and the environment, like terraform_tests.tf
+
+FUNCTIONS = {
+  "unittest_object_under_test_accept"                     : { "module"      : "shop_accept",
+                                                              "environment" : { "to_shop_decrypt_topic_arn": ECHO_TOPIC_ARN, "test_mode": "1" } },
+  "unittest_object_under_test_decrypt"                    : { "module"      : "shop_decrypt",
+                                                              "environment" : { "key_prefix": KEY_PREFIX, "to_shop_update_db_topic_arn": ECHO_TOPIC_ARN, "test_mode": "1" } },
+  "unittest_object_under_test_update_db"                  : { "module"      : "shop_update_db",
+                                                              "environment" : { "name_prefix": NAME_PREFIX + "-unittest", "test_mode": "1" } },
+  "unittest_object_under_test_decrypt_update_db"          : { "module"      : "shop_decrypt_update_db",
+                                                              "environment" : { "key_prefix": KEY_PREFIX, "name_prefix": NAME_PREFIX + "-unittest", "update_mode": "transaction", "test_mode": "1" } },
+  "unittest_support_echo"                                 : { "module"      : "unittest_support_echo",
+                                                              "environment" : {} },
+  "unittest_support_send_logs_from_unittest_support_echo" : { "module"      : "unittest_support_send_logs_from_unittest_support_echo",
+                                                              "environment" : { "sqs_queue_url": QUEUE_URL } }
+}
+
+# get_parameters
+# --------------
+
+def get_parameters():
+
+  parser = argparse.ArgumentParser(description = "Run the unittests of the shop functions in this process, with in-memory stand-ins for AWS")
+  parser.add_argument("--suites",            default = ",".join(SUITES),  help = "suites to run, separated by commas")
+  parser.add_argument("--sns-check-timeout", type = int, default = 5,     help = "seconds to wait for the messages that are expected on SNS")
+  parser.add_argument("--max-workers",       type = int, default = 16,    help = "number of testcases that run at the same time")
+  parser.add_argument("--verbose",           action = "store_true",       help = "print all log lines of the unittest functions, not only INFO and ERROR")
+
+  arguments = parser.parse_args()
+
+  return { "suites"            : arguments.suites.split(","),
+           "sns_check_timeout" : arguments.sns_check_timeout,
+           "max_workers"       : arguments.max_workers,
+           "verbose"           : arguments.verbose }
+
+# set_environment
+# ---------------
+# The environment of the unittest functions. X-Ray is switched off, there is no daemon.
+
+def set_environment(sns_check_timeout, max_workers):
+
+  os.environ["name_prefix"]          = NAME_PREFIX
+  os.environ["key_prefix"]           = KEY_PREFIX
+  os.environ["sqs_queue_url"]        = QUEUE_URL
+  os.environ["max_workers"]          = str(max_workers)
+  os.environ["sns_check_timeout"]    = str(sns_check_timeout)
+  os.environ["AWS_XRAY_SDK_ENABLED"] = "false"
+  os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+
+  sys.path.append(os.path.join(SHOP_DIRECTORY, "layer"))
+  for function in ["shop_accept", "shop_decrypt", "shop_update_db", "shop_decrypt_update_db"]:
+    sys.path.append(os.path.join(SHOP_DIRECTORY, "lambdas", function))
+
+  for directory in sorted(os.listdir(os.path.join(TESTS_DIRECTORY, "lambdas"))):
+    sys.path.append(os.path.join(TESTS_DIRECTORY, "lambdas", directory))
+
+  return
+
+# get_client_error
+# ----------------
+
+def get_client_error(code, message, operation_name, **response_fields):
+
+  from botocore.exceptions import ClientError
+
+  return ClientError(dict({"Error": {"Code": code, "Message": message}}, **response_fields), operation_name)
+
+# Invocations
+# -----------
+# Invocations run at the same time, in the threads of the testcases. The log that print() writes
+# to and the environment variables (a copy of the environment of this process with the variables
+# of the function) belong to the invocation of the thread. Threads that are started during an 
+# invocation (f.e. the decrypt threads of shop_decrypt) belong to the same invocation. Outside an
+# invocation, the stdout and environment of this process are used.
+
+invocation = threading.local()
+
+class InvocationStdout(io.TextIOBase):
+
+  def __init__(self, stdout):
+
+    self.stdout = stdout
+
+  def write(self, text):
+
+    log = getattr(invocation, "log", None)
+
+    return (self.stdout if (log == None) else log).write(text)
+
+  def flush(self):
+
+    self.stdout.flush()
+
+class InvocationEnvironment(collections.abc.MutableMapping):
+
+  def __init__(self, environ):
+
+    self.environ = environ
+
+  def get_variables(self):
+
+    variables = getattr(invocation, "environment", None)
+
+    return self.environ if (variables == None) else variables
+
+  def __getitem__(self, name):
+
+    return self.get_variables()[name]
+
+  def __setitem__(self, name, value):
+
+    self.get_variables()[name] = value
+
+  def __delitem__(self, name):
+
+    del self.get_variables()[name]
+
+  def __iter__(self):
+
+    return iter(self.get_variables())
+
+  def __len__(self):
+
+    return len(self.get_variables())
+
+# start_in_invocation
+# -------------------
+# Replaces threading.Thread.start: the new thread gets the invocation of the thread that starts it
+
+def start_in_invocation(thread, start = threading.Thread.start):
+
+  log, environment = getattr(invocation, "log", None), getattr(invocation, "environment", None)
+  run              = thread.run
+
+  def run_in_invocation():
+    invocation.log, invocation.environment = log, environment
+    run()
+
+  thread.run = run_in_invocation
+  start(thread)
+
+  return
+
+# set_invocations
+# ---------------
+
+def set_invocations():
+
+  sys.stdout             = InvocationStdout(sys.stdout)
+  os.environ             = InvocationEnvironment(os.environ)
+  threading.Thread.start = start_in_invocation
+
+  return
+
+# in_invocation
+# -------------
+# The log and environment variables of the current thread during an invocation. An invocation 
+# within an invocation (SNS to the echo function) gets its own log and environment.
+
+@contextlib.contextmanager
+def in_invocation(log, variables):
+
+  caller                  = (getattr(invocation, "log", None), getattr(invocation, "environment", None))
+  invocation.log          = log
+  invocation.environment  = dict(os.environ.environ, **variables)
+
+  try:
+    yield
+  finally:
+    invocation.log, invocation.environment = caller
+
+# FakeContext
+# -----------
+
+class FakeContext:
+
+  memory_limit_in_mb = 128
+
+  def __init__(self, function_name, timeout = 120):
+
+    self.function_name   = function_name
+    self.aws_request_id  = str(uuid.uuid4())
+    self.deadline        = time.monotonic() + timeout
+
+  def get_remaining_time_in_millis(self):
+
+    return int((self.deadline - time.monotonic()) * 1000)
+
+# FakeLambda
+# ----------
+# $LATEST and the published versions have their own environment. Invocations run at the same 
+# time, an invocation from within an invocation (SNS to the echo function) is possible.
+#
+# Like the containers of Lambda, a container has its own copy of the handler module and the shop
+# layer: the modules read their environment variables when they are imported (f.e. test_mode in
+# shop_log). A container handles one invocation at a time. When all containers of the function 
+# and version are busy, a new one is started (imported). A new configuration of $LATEST starts 
+# with new containers.
+
+class FakeLambda:
+
+  def __init__(self):
+
+    self.functions     = {}
+    self.containers    = {}
+    self.layer_clients = {}
+    self.lock          = threading.RLock()
+    self.module_names  = [os.path.splitext(file_name)[0] for file_name in os.listdir(os.path.join(SHOP_DIRECTORY, "layer")) if file_name.endswith(".py")] + \
+                         [function["module"] for function in FUNCTIONS.values()]
+
+    for name, function in FUNCTIONS.items():
+      self.functions[NAME_PREFIX + "_" + name] = { "module"   : function["module"],
+                                                   "versions" : { "$LATEST": { "Version": "$LATEST", "Description": "", "Environment": { "Variables": dict(function["environment"]) } } } }
+
+  def get_configuration(self, FunctionName, Qualifier = "$LATEST"):
+
+    if ((FunctionName not in self.functions) or (Qualifier not in self.functions[FunctionName]["versions"])):
+      raise get_client_error("ResourceNotFoundException", "Function not found: " + FunctionName + ":" + Qualifier, "GetFunctionConfiguration")
+
+    configuration = { "FunctionName"     : FunctionName,
+                      "Runtime"          : "python3.8",
+                      "Role"             : "arn:aws:iam::" + ACCOUNT + ":role/local",
+                      "Handler"          : self.functions[FunctionName]["module"] + ".lambda_handler",
+                      "CodeSha256"       : "local",
+                      "MemorySize"       : 128,
+                      "Timeout"          : 3,
+                      "State"            : "Active",
+                      "LastUpdateStatus" : "Successful" }
+    configuration.update(json.loads(json.dumps(self.functions[FunctionName]["versions"][Qualifier])))
+
+    return configuration
+
+  def get_function_configuration(self, FunctionName, Qualifier = "$LATEST"):
+
+    return self.get_configuration(FunctionName, Qualifier)
+
+  def update_function_configuration(self, FunctionName, Environment = None, Handler = None):
+
+    self.get_configuration(FunctionName)
+
+    if (Environment != None):
+      self.functions[FunctionName]["versions"]["$LATEST"]["Environment"] = json.loads(json.dumps(Environment))
+    if (Handler != None):
+      self.functions[FunctionName]["versions"]["$LATEST"]["Handler"] = Handler
+    self.containers[(FunctionName, "$LATEST")] = []
+
+    return self.get_configuration(FunctionName)
+
+  def publish_version(self, FunctionName, CodeSha256 = None, Description = ""):
+
+    versions = self.functions[FunctionName]["versions"]
+    version  = str(len(versions))
+
+    versions[version] = dict(json.loads(json.dumps(versions["$LATEST"])), Version = version, Description = Description)
+
+    return self.get_configuration(FunctionName, version)
+
+  def list_versions_by_function(self, FunctionName):
+
+    return { "Versions": [self.get_configuration(FunctionName, version) for version in self.functions[FunctionName]["versions"]] }
+
+  def get_paginator(self, operation_name):
+
+    fake_lambda = self
+
+    class Paginator:
+      def paginate(self, **kwargs):
+        return [getattr(fake_lambda, operation_name)(**kwargs)]
+
+    return Paginator()
+
+  # start_container
+  # ---------------
+  # Imports the modules of a new container. The modules are only in sys.modules during the import,
+  # after that they use each other via their own references.
+
+  def start_container(self, FunctionName):
+
+    with self.lock:
+
+      caller  = { name: sys.modules.pop(name) for name in self.module_names if name in sys.modules }
+
+      try:
+        importlib.import_module(self.functions[FunctionName]["module"])
+        if ("shop_clients" in sys.modules):
+          for service_name, client in self.layer_clients.items():
+            sys.modules["shop_clients"].set_client(service_name, client)
+      finally:
+        modules = { name: sys.modules.pop(name) for name in self.module_names if name in sys.modules }
+        sys.modules.update(caller)
+
+    return { "modules": modules }
+
+  # container
+  # ---------
+  # An idle container of the function and version, or a new one. Afterwards it is idle again, 
+  # unless the configuration was changed in the meantime.
+
+  @contextlib.contextmanager
+  def container(self, FunctionName, Qualifier):
+
+    with self.lock:
+      idle    = self.containers.setdefault((FunctionName, Qualifier), [])
+      modules = idle.pop() if idle else None
+
+    if (modules == None):
+      modules = self.start_container(FunctionName)["modules"]
+
+    try:
+      yield modules[self.functions[FunctionName]["module"]]
+    finally:
+      with self.lock:
+        idle.append(modules)
+
+  def run(self, FunctionName, event, Qualifier = "$LATEST"):
+
+    configuration = self.get_configuration(FunctionName, Qualifier)
+    context       = FakeContext(FunctionName, configuration["Timeout"])
+    log           = io.StringIO()
+    error_type    = None
+
+    with in_invocation(log, configuration["Environment"]["Variables"]):
+
+      print("START RequestId: " + context.aws_request_id + " Version: " + Qualifier)
+      start = time.perf_counter()
+
+      try:
+        with self.container(FunctionName, Qualifier) as module:
+          payload  = getattr(module, configuration["Handler"].rsplit(".", 1)[1])(event, context)
+      except Exception as e:
+        print("[ERROR] " + type(e).__name__ + ": " + str(e))
+        print(traceback.format_exc())
+        payload    = { "errorMessage": str(e), "errorType": type(e).__name__, "stackTrace": traceback.format_tb(e.__traceback__) }
+        error_type = "Unhandled"
+
+      duration = (time.perf_counter() - start) * 1000
+      print("END RequestId: " + context.aws_request_id)
+      print("REPORT RequestId: " + context.aws_request_id + "\tDuration: " + format(duration, ".2f") + " ms\tMemory Size: 128 MB")
+
+    return { "payload": payload, "log": log.getvalue(), "function_error": error_type }
+
+  def invoke(self, FunctionName, Payload, Qualifier = "$LATEST", InvocationType = "RequestResponse", LogType = "None"):
+
+    response = self.run(FunctionName, json.loads(bytes(Payload).decode("utf-8")), Qualifier)
+    result   = { "StatusCode": 200, "ExecutedVersion": Qualifier, "Payload": io.BytesIO(json.dumps(response["payload"]).encode("utf-8")) }
+
+    if (response["function_error"] != None):
+      result["FunctionError"] = response["function_error"]
+
+    if (LogType == "Tail"):
+      result["LogResult"] = base64.b64encode(response["log"].encode("utf-8")[-LOG_TAIL_BYTES:]).decode("utf-8")
+
+    return result
+
+# FakeKMS
+# -------
+
+class FakeKMS:
+
+  def __init__(self, shop_ids):
+
+    from cryptography.hazmat.primitives.asymmetric import rsa, padding
+    from cryptography.hazmat.primitives            import hashes
+
+    self.padding = padding.OAEP(mgf = padding.MGF1(algorithm = hashes.SHA256()), algorithm = hashes.SHA256(), label = None)
+    self.keys    = { "alias/" + KEY_PREFIX + shop_id: rsa.generate_private_key(public_exponent = 65537, key_size = RSA_KEY_SIZE)
+                     for shop_id in shop_ids }
+
+  def encrypt(self, KeyId, Plaintext, EncryptionAlgorithm):
+
+    if (KeyId not in self.keys):
+      raise get_client_error("NotFoundException", "Alias " + KeyId + " is not found.", "Encrypt")
+
+    if isinstance(Plaintext, str):
+      Plaintext = Plaintext.encode("utf-8")
+
+    return { "KeyId": KeyId, "CiphertextBlob": self.keys[KeyId].public_key().encrypt(Plaintext, self.padding), "EncryptionAlgorithm": EncryptionAlgorithm }
+
+  def decrypt(self, CiphertextBlob, KeyId, EncryptionAlgorithm):
+
+    if (KeyId not in self.keys):
+      raise get_client_error("NotFoundException", "Alias " + KeyId + " is not found.", "Decrypt")
+
+    try:
+      plaintext = self.keys[KeyId].decrypt(CiphertextBlob, self.padding)
+    except ValueError:
+      raise get_client_error("InvalidCiphertextException", "", "Decrypt")
+
+    return { "KeyId": KeyId, "Plaintext": plaintext, "EncryptionAlgorithm": EncryptionAlgorithm }
+
+# FakeSNS
+# -------
+# Only the echo topic exists. A message to it is delivered to unittest_support_echo, the log lines
+# of the echo function that match the subscription filter are sent to the send_logs function.
+
+class FakeSNS:
+
+  def __init__(self, fake_lambda):
+
+    self.fake_lambda = fake_lambda
+
+  def deliver(self, TopicArn, Message):
+
+    message_id = str(uuid.uuid4())
+    event      = { "Records": [ { "EventSource"          : "aws:sns",
+                                  "EventVersion"         : "1.0",
+                                  "EventSubscriptionArn" : TopicArn + ":" + str(uuid.uuid4()),
+                                  "Sns"                  : { "Type"              : "Notification",
+                                                             "MessageId"         : message_id,
+                                                             "TopicArn"          : TopicArn,
+                                                             "Subject"           : None,
+                                                             "Message"           : Message,
+                                                             "Timestamp"         : datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+                                                             "MessageAttributes" : {} } } ] }
+
+    log        = self.fake_lambda.run(NAME_PREFIX + "_unittest_support_echo", event)["log"]
+    log_events = [{ "id": str(number), "timestamp": int(time.time() * 1000), "message": line }
+                  for number, line in enumerate(log.splitlines()) if (FILTER_PATTERN in line)]
+
+    if (log_events):
+      data = { "messageType": "DATA_MESSAGE", "logGroup": "/aws/lambda/" + NAME_PREFIX + "_unittest_support_echo", "logEvents": log_events }
+      self.fake_lambda.run(NAME_PREFIX + "_unittest_support_send_logs_from_unittest_support_echo",
+                           { "awslogs": { "data": base64.b64encode(gzip.compress(json.dumps(data).encode("utf-8"))).decode("utf-8") } })
+
+    return { "message_id": message_id }
+
+  def publish(self, TopicArn, Message, **kwargs):
+
+    if (TopicArn != ECHO_TOPIC_ARN):
+      raise get_client_error("InvalidParameter", "Invalid parameter: TopicArn", "Publish")
+
+    return { "MessageId": self.deliver(TopicArn, Message)["message_id"] }
+
+  def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+
+    if (TopicArn != ECHO_TOPIC_ARN):
+      raise get_client_error("InvalidParameter", "Invalid parameter: TopicArn", "PublishBatch")
+
+    return { "Successful": [ { "Id": entry["Id"], "MessageId": self.deliver(TopicArn, entry["Message"])["message_id"] } for entry in PublishBatchRequestEntries ],
+             "Failed"    : [] }
+
+# FakeSQS
+# -------
+# One queue. A received message is invisible until it is deleted (no visibility timeout).
+# receive_message waits at most WaitTimeSeconds for a message, like long polling.
+
+class FakeSQS:
+
+  def __init__(self):
+
+    self.messages  = []
+    self.condition = threading.Condition()
+
+  def check_queue_url(self, QueueUrl, operation_name):
+
+    if (QueueUrl != QUEUE_URL):
+      raise get_client_error("AWS.SimpleQueueService.NonExistentQueue", "The specified queue does not exist.", operation_name)
+
+  def send_message(self, QueueUrl, MessageBody):
+
+    self.check_queue_url(QueueUrl, "SendMessage")
+    message_id = str(uuid.uuid4())
+
+    with self.condition:
+      self.messages.append({ "MessageId": message_id, "ReceiptHandle": str(uuid.uuid4()), "Body": MessageBody, "visible": True })
+      self.condition.notify_all()
+
+    return { "MessageId": message_id }
+
+  def receive_message(self, QueueUrl, WaitTimeSeconds = 0, MaxNumberOfMessages = 1):
+
+    self.check_queue_url(QueueUrl, "ReceiveMessage")
+
+    with self.condition:
+
+      self.condition.wait_for(lambda: any(message["visible"] for message in self.messages), timeout = WaitTimeSeconds)
+
+      received = [message for message in self.messages if message["visible"]][:MaxNumberOfMessages]
+      for message in received:
+        message["visible"] = False
+
+    if (not received):
+      return {}
+
+    return { "Messages": [ { "MessageId": message["MessageId"], "ReceiptHandle": message["ReceiptHandle"], "Body": message["Body"] } for message in received ] }
+
+  def delete_message(self, QueueUrl, ReceiptHandle):
+
+    self.check_queue_url(QueueUrl, "DeleteMessage")
+
+    with self.condition:
+      self.messages = [message for message in self.messages if (message["ReceiptHandle"] != ReceiptHandle)]
+
+    return {}
+
+  def delete_message_batch(self, QueueUrl, Entries):
+
+    for entry in Entries:
+      self.delete_message(QueueUrl, entry["ReceiptHandle"])
+
+    return { "Successful": [ { "Id": entry["Id"] } for entry in Entries ] }
+
+# FakeDynamoDB
+# ------------
+# Tables are dicts of (hash key, range key) -> item. Update expressions of the form
+# "set a = :a, b = b + :b, c = c - :b" and conditions of the form attribute_not_exists(a),
+# "a = :a" and "a >= :a", like shop_update_db and the unittests use: when an attribute in a 
+# calculation doesn't exist, DynamoDB returns a ValidationException.
+
+KEY_NAMES = { "shops": ("shop_id", "record_type"), "shops-message-ids": ("shop_id", "message_id") }
+
+SET_ACTION = re.compile(r"^\s*(\w+)\s*=\s*(?:(:\w+)|(\w+)\s*([+-])\s*(:\w+))\s*$")
+CONDITION  = re.compile(r"^\s*(\w+)\s*(=|>=)\s*(:\w+)\s*$")
+
+# A ClientRequestToken of TransactWriteItems is remembered for 10 minutes, like DynamoDB does
+
+TOKEN_SECONDS = 600
+
+# to_number_text
+# --------------
+# Numbers as DynamoDB returns them: 100000 and not 1E+5, 1.5 and not 1.50
+
+def to_number_text(number):
+
+  text = format(number.normalize(), "f")
+
+  return { "text": text }
+
+class FakeDynamoDB:
+
+  def __init__(self, table_prefix):
+
+    self.tables = { table_prefix + "-" + name: {} for name in KEY_NAMES }
+    self.keys   = { table_prefix + "-" + name: key_names for name, key_names in KEY_NAMES.items() }
+    self.tokens = {}
+    self.lock   = threading.Lock()
+
+  def get_table(self, TableName, operation_name):
+
+    if (TableName not in self.tables):
+      raise get_client_error("ResourceNotFoundException", "Requested resource not found", operation_name)
+
+    return self.tables[TableName]
+
+  def get_key(self, TableName, Key):
+
+    return tuple(Key[name]["S"] for name in self.keys[TableName])
+
+  def check_condition(self, item, ConditionExpression, ExpressionAttributeValues):
+
+    if (ConditionExpression == None):
+      return True
+
+    if (ConditionExpression.startswith("attribute_not_exists(")):
+      return ((item == None) or (ConditionExpression[len("attribute_not_exists("):-1] not in item))
+
+    name, operator, value_name = CONDITION.match(ConditionExpression).groups()
+
+    if ((item == None) or (name not in item)):
+      return False
+
+    if (operator == "="):
+      return (Decimal(item[name]["N"]) == Decimal(ExpressionAttributeValues[value_name]["N"]))
+
+    return (Decimal(item[name]["N"]) >= Decimal(ExpressionAttributeValues[value_name]["N"]))
+
+  def apply_update(self, item, UpdateExpression, ExpressionAttributeValues, operation_name):
+
+    item    = json.loads(json.dumps(item))
+    updated = {}
+
+    for action in UpdateExpression.strip()[len("set"):].split(","):
+
+      match = SET_ACTION.match(action)
+      if (match == None):
+        raise get_client_error("ValidationException", "Invalid UpdateExpression: " + UpdateExpression, operation_name)
+
+      name, value_name, operand, operator, operand_value_name = match.groups()
+
+      if (value_name != None):
+        value = Decimal(ExpressionAttributeValues[value_name]["N"])
+      else:
+        if (operand not in item):
+          raise get_client_error("ValidationException", "The provided expression refers to an attribute that does not exist in the item", operation_name)
+        value = Decimal(item[operand]["N"])
+        if (operator == "+"):
+          value += Decimal(ExpressionAttributeValues[operand_value_name]["N"])
+        else:
+          value -= Decimal(ExpressionAttributeValues[operand_value_name]["N"])
+
+      updated[name] = { "N": to_number_text(value)["text"] }
+
+    item.update(updated)
+
+    return { "item": item, "updated": updated }
+
+  def put_item(self, TableName, Item, ConditionExpression = None):
+
+    with self.lock:
+
+      table = self.get_table(TableName, "PutItem")
+      key   = self.get_key(TableName, Item)
+
+      if (not self.check_condition(table.get(key), ConditionExpression, {})):
+        raise get_client_error("ConditionalCheckFailedException", "The conditional request failed", "PutItem")
+
+      table[key] = json.loads(json.dumps(Item))
+
+    return {}
+
+  def get_item(self, TableName, Key, AttributesToGet = None, ConsistentRead = False):
+
+    with self.lock:
+
+      table = self.get_table(TableName, "GetItem")
+      item  = table.get(self.get_key(TableName, Key))
+
+    if (item == None):
+      return {}
+
+    return { "Item": { name: value for name, value in item.items() if ((AttributesToGet == None) or (name in AttributesToGet)) } }
+
+  def delete_item(self, TableName, Key):
+
+    with self.lock:
+      self.get_table(TableName, "DeleteItem").pop(self.get_key(TableName, Key), None)
+
+    return {}
+
+  def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues = "NONE"):
+
+    with self.lock:
+
+      table    = self.get_table(TableName, "UpdateItem")
+      key      = self.get_key(TableName, Key)
+      response = self.apply_update(table.get(key, Key), UpdateExpression, ExpressionAttributeValues, "UpdateItem")
+      table[key] = response["item"]
+
+    if (ReturnValues == "UPDATED_NEW"):
+      return { "Attributes": response["updated"] }
+
+    return {}
+
+  # transact_write_items
+  # --------------------
+  # All actions or none: a failed condition or update cancels the transaction, with a reason per 
+  # action like DynamoDB. Like DynamoDB, a committed transaction with the same ClientRequestToken 
+  # in the last 10 minutes makes the call succeed without writing again, when the actions are the
+  # same.
+
+  def transact_write_items(self, TransactItems, ClientRequestToken = None):
+
+    with self.lock:
+
+      if (ClientRequestToken in self.tokens):
+
+        committed_items, committed_time = self.tokens[ClientRequestToken]
+
+        if (time.monotonic() - committed_time < TOKEN_SECONDS):
+          if (committed_items != json.dumps(TransactItems, sort_keys = True)):
+            raise get_client_error("IdempotentParameterMismatchException", "The request uses the same client token as a previous, but non-identical request", "TransactWriteItems")
+          return {}
+
+      writes  = []
+      reasons = []
+
+      for action in TransactItems:
+
+        kind, parameters = next(iter(action.items()))
+        table  = self.get_table(parameters["TableName"], "TransactWriteItems")
+        key    = self.get_key(parameters["TableName"], parameters["Item"] if (kind == "Put") else parameters["Key"])
+        item   = table.get(key)
+        values = parameters.get("ExpressionAttributeValues", {})
+
+        if (not self.check_condition(item, parameters.get("ConditionExpression"), values)):
+          reason = { "Code": "ConditionalCheckFailed", "Message": "The conditional request failed" }
+          if ((item != None) and (parameters.get("ReturnValuesOnConditionCheckFailure") == "ALL_OLD")):
+            reason["Item"] = json.loads(json.dumps(item))
+          reasons.append(reason)
+          continue
+
+        if (kind == "Put"):
+          writes.append((table, key, json.loads(json.dumps(parameters["Item"]))))
+          reasons.append({ "Code": "None" })
+          continue
+
+        try:
+          response = self.apply_update(item if (item != None) else parameters["Key"], parameters["UpdateExpression"], values, "TransactWriteItems")
+          writes.append((table, key, response["item"]))
+          reasons.append({ "Code": "None" })
+        except Exception as e:
+          reasons.append({ "Code": "ValidationError", "Message": str(e) })
+
+      if (any(reason["Code"] != "None" for reason in reasons)):
+        raise get_client_error("TransactionCanceledException", "Transaction cancelled, please refer cancellation reasons for specific reasons [" +
+                               ", ".join(reason["Code"] for reason in reasons) + "]", "TransactWriteItems", CancellationReasons = reasons)
+
+      for table, key, item in writes:
+        table[key] = item
+
+      if (ClientRequestToken != None):
+        self.tokens[ClientRequestToken] = (json.dumps(TransactItems, sort_keys = True), time.monotonic())
+
+    return {}
+
+# install_fakes
+# -------------
+# boto3.client is replaced for the unittest functions and the support functions, the shop layer
+# of every container gets the stand-ins with shop_clients.set_client.
+
+def install_fakes():
+
+  import boto3
+
+  fake_lambda = FakeLambda()
+  clients     = { "lambda"   : fake_lambda,
+                  "kms"      : FakeKMS(SHOP_IDS),
+                  "sns"      : FakeSNS(fake_lambda),
+                  "sqs"      : FakeSQS(),
+                  "dynamodb" : FakeDynamoDB(NAME_PREFIX + "-unittest") }
+
+  boto3.client = lambda service_name, *args, **kwargs: clients[service_name]
+
+  fake_lambda.layer_clients = { service_name: clients[service_name] for service_name in ["kms", "sns", "dynamodb"] }
+
+  return { "clients": clients }
+
+# run_suite
+# ---------
+# Starts the lambda_handler of unittest_test_<suite> and reads the result from its log
+
+def run_suite(suite, verbose):
+
+  name       = "unittest_test_" + suite
+  log        = io.StringIO()
+  start      = time.perf_counter()
+
+  with in_invocation(log, {}):
+    importlib.import_module(name).lambda_handler({}, FakeContext(NAME_PREFIX + "_" + name))
+
+  duration   = time.perf_counter() - start
+  lines      = log.getvalue().splitlines()
+
+  for line in lines:
+    if (verbose or line.startswith("INFO:") or line.startswith("ERROR:")):
+      print(name + ": " + line)
+
+  result     = { "suite": suite, "ok": 0, "errors": 1, "duration": duration }
+  ok_errors  = [line for line in lines if line.startswith("INFO: OK: ")]
+
+  if (ok_errors):
+    match = re.match(r"INFO: OK: (\d+), Errors: (\d+)", ok_errors[-1])
+    result.update({ "ok": int(match.group(1)), "errors": int(match.group(2)) })
+  else:
+    print("ERROR: " + name + " didn't report its results")
+
+  return result
+
+# Main program:
+# =============
+
+parameters = get_parameters()
+set_environment(parameters["sns_check_timeout"], parameters["max_workers"])
+set_invocations()
+install_fakes()
+
+results    = [run_suite(suite, parameters["verbose"]) for suite in parameters["suites"]]
+
+print()
+print(format("suite", "<12") + format("ok", ">6") + format("errors", ">8") + format("seconds", ">10"))
+
+for result in results:
+  print(format(result["suite"], "<12") + format(result["ok"], ">6") + format(result["errors"], ">8") + format(result["duration"], ">10.2f"))
+
+sys.exit(1 if any(result["errors"] > 0 for result in results) else 0)
@@ -10,6 +10,7 @@ variable "use_public_route53_domain" { default = "Not used in this script. Publi
 variable "use_test_objects"          { default = "Not used in this script. We assume that this will always be 1, because otherwise people wouldn't enroll this script at all" }
 variable "domainname"                {}
 variable "accountnumber"             {}
+variable "profile_bucket"            { description = "Not used in this script, declaration is done to prevent warnings." }
 
 variable "name_prefix"               {}
 variable "key_prefix"                {}
@@ -40,6 +41,10 @@ data "aws_iam_role" "lambda_shop_update_db_role" {
     name = "${var.name_prefix}_lambda_shop_update_db_role"
 }
 
+data "aws_iam_role" "lambda_shop_decrypt_update_db_role" {
+    name = "${var.name_prefix}_lambda_shop_decrypt_update_db_role"
+}
+
 data "aws_iam_role" "lambda_unittest_role" {
     name = "${var.name_prefix}_lambda_unittest_role"
 }
@@ -56,6 +61,10 @@ data "aws_lambda_function" "perftest_test" {
     function_name = "${var.name_prefix}_perftest_test"
 }
 
+data "aws_lambda_layer_version" "shop_layer" {
+    layer_name = "${var.name_prefix}_shop_layer"
+}
+
 ##################################################################################
 # RESOURCES
 ##################################################################################
@@ -83,9 +92,11 @@ resource "aws_lambda_function" "unittest_object_under_test_accept" {
     role          = data.aws_iam_role.lambda_shop_accept_role.arn
     handler       = "shop_accept.lambda_handler"
     runtime       = "python3.8"
+    layers        = [data.aws_lambda_layer_version.shop_layer.arn]
     environment {
         variables = {
-            to_shop_decrypt_topic_arn = aws_sns_topic.to_unittest_support_echo.arn
+            to_shop_decrypt_topic_arn = aws_sns_topic.to_unittest_support_echo.arn,
+            test_mode                 = 1
         }
     }
     tags = {
@@ -111,10 +122,12 @@ resource "aws_lambda_function" "unittest_object_under_test_decrypt" {
     role          = data.aws_iam_role.lambda_shop_decrypt_role.arn
     handler       = "shop_decrypt.lambda_handler"
     runtime       = "python3.8"
+    layers        = [data.aws_lambda_layer_version.shop_layer.arn]
     environment {
         variables = {
             key_prefix                  = var.key_prefix,
-            to_shop_update_db_topic_arn = aws_sns_topic.to_unittest_support_echo.arn
+            to_shop_update_db_topic_arn = aws_sns_topic.to_unittest_support_echo.arn,
+            test_mode                   = 1
         }
     }
     tags = {
@@ -140,9 +153,45 @@ resource "aws_lambda_function" "unittest_object_under_test_update_db" {
     role          = data.aws_iam_role.lambda_shop_update_db_role.arn
     handler       = "shop_update_db.lambda_handler"
     runtime       = "python3.8"
+    layers        = [data.aws_lambda_layer_version.shop_layer.arn]
+    environment {
+        variables = {
+            name_prefix           = "${var.name_prefix}-unittest",
+            test_mode             = 1
+        }
+    }
+    tags = {
+        type = "object_under_test"
+        execute_via_gui = "no"
+    }
+}
+
+# unittest_object_under_test_decrypt_update_db
+# --------------------------------------------
+# The fused function (pipeline_mode_shop = "fused"), tested by unittest_test_update_db. It has the
+# update_mode of the default of terraform_shop.tf.
+
+resource "aws_lambda_permission" "lambda_unittest_object_under_test_decrypt_update_db_permission" {
+  depends_on    = [aws_lambda_function.unittest_object_under_test_decrypt_update_db]
+  statement_id  = "AllowExecutionFromLambdaForUnittestObjectUnderTestDecryptUpdateDb"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.unittest_object_under_test_decrypt_update_db.function_name
+  principal     = "lambda.amazonaws.com"
+}
+
+resource "aws_lambda_function" "unittest_object_under_test_decrypt_update_db" {
+    function_name = "${var.name_prefix}_unittest_object_under_test_decrypt_update_db"
+    filename      = "../shop/lambdas/shop_decrypt_update_db/shop_decrypt_update_db.zip"
+    role          = data.aws_iam_role.lambda_shop_decrypt_update_db_role.arn
+    handler       = "shop_decrypt_update_db.lambda_handler"
+    runtime       = "python3.8"
+    layers        = [data.aws_lambda_layer_version.shop_layer.arn]
     environment {
         variables = {
+            key_prefix            = var.key_prefix,
             name_prefix           = "${var.name_prefix}-unittest",
+            update_mode           = "transaction",
+            test_mode             = 1
         }
     }
     tags = {
@@ -264,6 +313,15 @@ resource "aws_lambda_permission" "lambda_unittest_test_update_db_permission" {
   source_arn    = aws_lambda_function.unittest_test_update_db.arn
 }
 
+resource "aws_lambda_permission" "lambda_unittest_test_update_db_decrypt_update_db_permission" {
+  depends_on    = [aws_lambda_function.unittest_test_update_db]
+  statement_id  = "AllowExecutionUnittestTestUpdateDbDecryptUpdateDb"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.unittest_object_under_test_decrypt_update_db.function_name
+  principal     = "lambda.amazonaws.com"
+  source_arn    = aws_lambda_function.unittest_test_update_db.arn
+}
+
 resource "aws_lambda_function" "unittest_test_update_db" {
     function_name = "${var.name_prefix}_unittest_test_update_db"
     filename      = "./lambdas/unittest_test_update_db/unittest_test_update_db.zip"
@@ -274,6 +332,7 @@ resource "aws_lambda_function" "unittest_test_update_db" {
     environment {
         variables = {
             name_prefix   = var.name_prefix
+            key_prefix    = var.key_prefix
         }
     }
     tags = {
@@ -363,18 +422,30 @@ resource "aws_lambda_permission" "lambda_perftest_get_stats" {
   principal     = "lambda.amazonaws.com"
 }
 
+# The run records of perftest_get_stats, compare them with client/perftest_compare.py. The name of the
+# bucket is also used in lambda_perftest_policy (init-infra).
+
+resource "aws_s3_bucket" "perftest_results" {
+    bucket        = "${lower(var.name_prefix)}-perftest-results-${var.accountnumber}"
+    force_destroy = true
+    tags = {
+        type = "perftest"
+    }
+}
+
 resource "aws_lambda_function" "perftest_get_stats" {
     function_name = "${var.name_prefix}_perftest_get_stats"
     filename      = "./lambdas/perftest_get_stats/perftest_get_stats.zip"
     role          = data.aws_iam_role.lambda_perftest_role.arn
     handler       = "perftest_get_stats.lambda_handler"
     runtime       = "python3.8"
-    timeout       = 120
+    timeout       = 180
     environment {
         variables = {
             name_prefix          = var.name_prefix
             limit_value_duration = 500
             limit_value_diff_mem = 28
+            results_location     = "s3://${aws_s3_bucket.perftest_results.bucket}/perftest"
         }
     }
     tags = {